@@ -242,7 +242,7 @@ def create_announce(session, base_dir: str, federation_list: [],
                          signing_priv_key_pem, 639633,
                          curr_domain, onion_domain, i2p_domain,
                          extra_headers, sites_unavailable,
-                         system_language, mitm_servers)
+                         system_language, mitm_servers, None)
 
     return new_announce
 
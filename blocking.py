@@ -8,14 +8,16 @@ __status__ = "Production"
 __module_group__ = "Core"
 
 import os
-import json
 import time
+import threading
 from session import get_json_valid
 from session import create_session
 from flags import is_evil
 from utils import get_user_paths
 from utils import contains_statuses
 from utils import data_dir
+from utils import remove_post_id_from_cache
+from utils import update_post_in_cache
 from utils import string_contains
 from utils import date_from_string_format
 from utils import date_utcnow
@@ -48,6 +50,15 @@ from conversation import unmute_conversation
 from auth import create_basic_auth_header
 from session import get_json
 
+# Block and allow lists are compiled into sets of handles, nicknames
+# and domains held in memory, so that checking whether an account is
+# blocked doesn't involve reading the list files. Each file is checked
+# for changes at most once per BLOCKLIST_CHECK_SECS, and straight away
+# after it has been written by blocklist_changed.
+BLOCKLIST_CHECK_SECS = 2
+BLOCKLISTS = {}
+BLOCKLISTS_LOCK = threading.Lock()
+
 
 def get_global_block_reason(search_text: str,
                             blocking_reasons_filename: str) -> str:
@@ -212,6 +223,7 @@ def add_account_blocks(base_dir: str,
             except OSError:
                 print('EX: _profile_edit unable to delete  blocking ' +
                       blocking_filename)
+            blocklist_changed(blocking_filename)
         if os.path.isfile(blocking_reasons_filename):
             try:
                 os.remove(blocking_reasons_filename)
@@ -225,6 +237,7 @@ def add_account_blocks(base_dir: str,
             fp_block.write(blocking_file_text)
     except OSError:
         print('EX: Failed to write ' + blocking_filename)
+    blocklist_changed(blocking_filename)
 
     try:
         with open(blocking_reasons_filename, 'w+',
@@ -321,6 +334,8 @@ def add_global_block(base_dir: str,
         except OSError:
             print('EX: unable to save blocked handle ' + block_handle)
             return False
+        blocklist_changed(blocking_filename)
+        return True
     else:
         block_hashtag = block_nickname
         # is the hashtag already blocked?
@@ -334,6 +349,7 @@ def add_global_block(base_dir: str,
         except OSError:
             print('EX: unable to save blocked hashtag ' + block_hashtag)
             return False
+    blocklist_changed(blocking_filename)
     return True
 
 
@@ -474,6 +490,7 @@ def add_block(base_dir: str, nickname: str, domain: str,
     except OSError:
         print('EX: unable to append block handle ' + block_handle)
         return False
+    blocklist_changed(blocking_filename)
 
     if reason:
         _add_block_reason(base_dir, nickname, domain,
@@ -558,6 +575,7 @@ def remove_global_block(base_dir: str,
                         print('EX: remove_global_block unable to rename ' +
                               unblocking_filename)
                         return False
+                    blocklist_changed(unblocking_filename)
                     return True
     else:
         unblock_hashtag = unblock_nickname
@@ -585,6 +603,7 @@ def remove_global_block(base_dir: str,
                         print('EX: remove_global_block unable to rename 2 ' +
                               unblocking_filename)
                         return False
+                    blocklist_changed(unblocking_filename)
                     return True
     return False
 
@@ -621,6 +640,7 @@ def remove_block(base_dir: str, nickname: str, domain: str,
                     print('EX: remove_block unable to rename 3 ' +
                           unblocking_filename)
                     return False
+                blocklist_changed(unblocking_filename)
                 return True
     return False
 
@@ -632,12 +652,11 @@ def is_blocked_hashtag(base_dir: str, hashtag: str) -> bool:
     if len(hashtag) > 32:
         return True
     global_blocking_filename = data_dir(base_dir) + '/blocking.txt'
-    if os.path.isfile(global_blocking_filename):
-        hashtag = hashtag.strip('\n').strip('\r')
-        if not hashtag.startswith('#'):
-            hashtag = '#' + hashtag
-        if text_in_file(hashtag + '\n', global_blocking_filename):
-            return True
+    hashtag = hashtag.strip('\n').strip('\r')
+    if not hashtag.startswith('#'):
+        hashtag = '#' + hashtag
+    if hashtag in _blocklist_index(global_blocking_filename)['entries']:
+        return True
     return False
 
 
@@ -708,10 +727,127 @@ def _get_short_domain(domain: str) -> str:
     return None
 
 
+def _blocklist_domain_key(domain: str) -> str:
+    """Returns the key used to match a domain against an allow list.
+    Subdomains match their short domain, so that an instance which
+    changes its subdomain is still allowed
+    """
+    domain = remove_domain_port(domain)
+    short_domain = _get_short_domain(domain)
+    if short_domain:
+        return short_domain
+    return domain
+
+
+def _blocklist_compile(filename: str) -> {}:
+    """Reads a block or allow list file and returns an index of its
+    entries, so that they can be looked up without searching the file
+    """
+    index = {
+        "exists": False,
+        "entries": set(),
+        "nicknames": set(),
+        "domains": set(),
+        "domainKeys": set()
+    }
+    try:
+        with open(filename, 'r', encoding='utf-8') as fp_list:
+            lines = fp_list.read().split('\n')
+    except OSError:
+        return index
+    index['exists'] = True
+    for line in lines:
+        entry = line.strip()
+        if not entry:
+            continue
+        index['entries'].add(entry)
+        if entry.endswith('@*'):
+            # nickname@* blocks the nickname on any instance
+            index['nicknames'].add(entry[:-2])
+        elif entry.startswith('*@'):
+            # *@domain blocks every account on the instance
+            index['domains'].add(entry[2:])
+        elif '@' not in entry and '://' not in entry:
+            index['domainKeys'].add(_blocklist_domain_key(entry))
+    return index
+
+
+def _blocklist_file_state(filename: str) -> ():
+    """Returns the modification time, inode and size of a list file,
+    which are used to detect whether it has changed
+    """
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_size)
+
+
+def _blocklist_index(filename: str) -> {}:
+    """Returns the index for the given block or allow list file,
+    compiling it again if the file has changed
+    """
+    curr_time = time.time()
+    blocklist = BLOCKLISTS.get(filename)
+    if blocklist:
+        if curr_time - blocklist['checked'] < BLOCKLIST_CHECK_SECS:
+            return blocklist['index']
+    with BLOCKLISTS_LOCK:
+        blocklist = BLOCKLISTS.get(filename)
+        if blocklist is None:
+            blocklist = {
+                "index": None,
+                "fileState": None,
+                "checked": 0,
+                "reloads": 0
+            }
+            BLOCKLISTS[filename] = blocklist
+        elif curr_time - blocklist['checked'] < BLOCKLIST_CHECK_SECS:
+            return blocklist['index']
+        file_state = _blocklist_file_state(filename)
+        if blocklist['index'] is None or \
+           file_state != blocklist['fileState']:
+            blocklist['index'] = _blocklist_compile(filename)
+            blocklist['fileState'] = file_state
+            blocklist['reloads'] += 1
+        blocklist['checked'] = curr_time
+        return blocklist['index']
+
+
+def blocklist_changed(filename: str) -> None:
+    """Called after a block or allow list file has been written,
+    so that the next lookup checks the file rather than waiting
+    for the check interval
+    """
+    with BLOCKLISTS_LOCK:
+        blocklist = BLOCKLISTS.get(filename)
+        if blocklist:
+            blocklist['checked'] = 0
+
+
+def _blocklist_blocks_account(index: {},
+                              block_nickname: str, block_domain: str,
+                              block_handle: str) -> bool:
+    """Does the given block list index block the account?
+    """
+    if block_nickname:
+        if block_nickname in index['nicknames']:
+            return True
+    if block_domain:
+        if block_domain in index['domains']:
+            return True
+    if block_handle:
+        if block_handle in index['entries']:
+            return True
+    return False
+
+
 def is_blocked_domain(base_dir: str, domain: str,
                       blocked_cache: [],
                       block_federated: []) -> bool:
     """Is the given domain blocked?
+    blocked_cache and block_federated are no longer needed, since the
+    instance and federated block lists are held in memory
     """
     if '.' not in domain:
         return False
@@ -721,48 +857,26 @@ def is_blocked_domain(base_dir: str, domain: str,
 
     short_domain = _get_short_domain(domain)
 
-    search_str = '*@' + domain
     if not broch_mode_is_active(base_dir):
-        if block_federated:
-            if domain in block_federated:
-                return True
+        federated_blocks_filename = data_dir(base_dir) + '/block_api.txt'
+        federated_index = _blocklist_index(federated_blocks_filename)
+        if domain in federated_index['entries']:
+            return True
 
-        if blocked_cache:
-            for blocked_str in blocked_cache:
-                if blocked_str == search_str:
-                    return True
-                if short_domain:
-                    if blocked_str == '*@' + short_domain:
-                        return True
-        else:
-            # instance block list
-            global_blocking_filename = data_dir(base_dir) + '/blocking.txt'
-            if os.path.isfile(global_blocking_filename):
-                search_str += '\n'
-                search_str_short = None
-                if short_domain:
-                    search_str_short = '*@' + short_domain + '\n'
-                try:
-                    with open(global_blocking_filename, 'r',
-                              encoding='utf-8') as fp_blocked:
-                        blocked_str = fp_blocked.read()
-                        if search_str in blocked_str:
-                            return True
-                        if short_domain:
-                            if search_str_short in blocked_str:
-                                return True
-                except OSError as ex:
-                    print('EX: is_blocked_domain unable to read ' +
-                          global_blocking_filename + ' ' + str(ex))
+        # instance block list
+        global_blocking_filename = data_dir(base_dir) + '/blocking.txt'
+        blocked_domains = _blocklist_index(global_blocking_filename)['domains']
+        if domain in blocked_domains:
+            return True
+        if short_domain:
+            if short_domain in blocked_domains:
+                return True
     else:
-        allow_filename = data_dir(base_dir) + '/allowedinstances.txt'
         # instance allow list
-        if not short_domain:
-            if not text_in_file(domain, allow_filename):
-                return True
-        else:
-            if not text_in_file(short_domain, allow_filename):
-                return True
+        allow_filename = data_dir(base_dir) + '/allowedinstances.txt'
+        allow_index = _blocklist_index(allow_filename)
+        if _blocklist_domain_key(domain) not in allow_index['domainKeys']:
+            return True
 
     return False
 
@@ -771,26 +885,10 @@ def is_blocked_nickname(base_dir: str, nickname: str,
                         blocked_cache: [] = None) -> bool:
     """Is the given nickname blocked?
     """
-    search_str = nickname + '@*'
-    if blocked_cache:
-        for blocked_str in blocked_cache:
-            if blocked_str == search_str:
-                return True
-    else:
-        # instance-wide block list
-        global_blocking_filename = data_dir(base_dir) + '/blocking.txt'
-        if os.path.isfile(global_blocking_filename):
-            search_str += '\n'
-            try:
-                with open(global_blocking_filename, 'r',
-                          encoding='utf-8') as fp_blocked:
-                    blocked_str = fp_blocked.read()
-                    if search_str in blocked_str:
-                        return True
-            except OSError as ex:
-                print('EX: is_blocked_nickname unable to read ' +
-                      global_blocking_filename + ' ' + str(ex))
-
+    # instance-wide block list
+    global_blocking_filename = data_dir(base_dir) + '/blocking.txt'
+    if nickname in _blocklist_index(global_blocking_filename)['nicknames']:
+        return True
     return False
 
 
@@ -799,6 +897,8 @@ def is_blocked(base_dir: str, nickname: str, domain: str,
                blocked_cache: [],
                block_federated: []) -> bool:
     """Is the given account blocked?
+    blocked_cache and block_federated are no longer needed, since the
+    instance and federated block lists are held in memory
     """
     if is_evil(block_domain):
         return True
@@ -808,87 +908,49 @@ def is_blocked(base_dir: str, nickname: str, domain: str,
         block_handle = block_nickname + '@' + block_domain
 
     if not broch_mode_is_active(base_dir):
-        # instance level block list
-        if block_federated:
-            for blocked_str in block_federated:
-                if '@' in blocked_str or '://' in blocked_str:
-                    if block_handle:
-                        if blocked_str == block_handle:
-                            return True
-                elif blocked_str == block_domain:
-                    return True
+        # federated block list, containing handles and domains
+        federated_blocks_filename = data_dir(base_dir) + '/block_api.txt'
+        federated_index = _blocklist_index(federated_blocks_filename)
+        if block_domain:
+            if block_domain in federated_index['entries']:
+                return True
+        if block_handle:
+            if block_handle in federated_index['entries']:
+                return True
 
-        if blocked_cache:
-            for blocked_str in blocked_cache:
-                if block_nickname:
-                    if block_nickname + '@*' in blocked_str:
-                        return True
-                if block_domain:
-                    if '*@' + block_domain in blocked_str:
-                        return True
-                if block_handle:
-                    if blocked_str == block_handle:
-                        return True
-        else:
-            global_blocks_filename = data_dir(base_dir) + '/blocking.txt'
-            if os.path.isfile(global_blocks_filename):
-                if block_nickname:
-                    if text_in_file(block_nickname + '@*\n',
-                                    global_blocks_filename):
-                        return True
-                if text_in_file('*@' + block_domain, global_blocks_filename):
-                    return True
-                if block_handle:
-                    block_str = block_handle + '\n'
-                    if text_in_file(block_str, global_blocks_filename):
-                        return True
-            if not block_federated:
-                federated_blocks_filename = \
-                    data_dir(base_dir) + '/block_api.txt'
-                if os.path.isfile(federated_blocks_filename):
-                    block_federated: list[str] = []
-                    try:
-                        with open(federated_blocks_filename, 'r',
-                                  encoding='utf-8') as fp_fed:
-                            block_federated = fp_fed.read().split('\n')
-                    except OSError:
-                        print('EX: is_blocked unable to load ' +
-                              federated_blocks_filename)
-                    if block_domain in block_federated:
-                        return True
-                    if block_handle:
-                        if block_handle in block_federated:
-                            return True
+        # instance level block list
+        global_blocks_filename = data_dir(base_dir) + '/blocking.txt'
+        global_index = _blocklist_index(global_blocks_filename)
+        if _blocklist_blocks_account(global_index,
+                                     block_nickname, block_domain,
+                                     block_handle):
+            return True
     else:
         # instance allow list
+        if not block_domain:
+            return True
         allow_filename = data_dir(base_dir) + '/allowedinstances.txt'
-        short_domain = _get_short_domain(block_domain)
-        if not short_domain and block_domain:
-            if not text_in_file(block_domain + '\n', allow_filename):
-                return True
-        else:
-            if not text_in_file(short_domain + '\n', allow_filename):
-                return True
+        allow_index = _blocklist_index(allow_filename)
+        if _blocklist_domain_key(block_domain) not in \
+           allow_index['domainKeys']:
+            return True
 
     # account level allow list
     account_dir = acct_dir(base_dir, nickname, domain)
-    allow_filename = account_dir + '/allowedinstances.txt'
-    if block_domain and os.path.isfile(allow_filename):
-        if not text_in_file(block_domain + '\n', allow_filename):
-            return True
+    if block_domain:
+        allow_filename = account_dir + '/allowedinstances.txt'
+        allow_index = _blocklist_index(allow_filename)
+        if allow_index['exists']:
+            if block_domain not in allow_index['entries']:
+                return True
 
     # account level block list
     blocking_filename = account_dir + '/blocking.txt'
-    if os.path.isfile(blocking_filename):
-        if block_nickname:
-            if text_in_file(block_nickname + '@*\n', blocking_filename):
-                return True
-        if block_domain:
-            if text_in_file('*@' + block_domain + '\n', blocking_filename):
-                return True
-        if block_handle:
-            if text_in_file(block_handle + '\n', blocking_filename):
-                return True
+    account_index = _blocklist_index(blocking_filename)
+    if _blocklist_blocks_account(account_index,
+                                 block_nickname, block_domain,
+                                 block_handle):
+        return True
     return False
 
 
@@ -1313,16 +1375,10 @@ def mute_post(base_dir: str, nickname: str, domain: str, port: int,
     if recent_posts_cache.get('index'):
         post_id = \
             remove_id_ending(post_json_object['id']).replace('/', '#')
-        if post_id in recent_posts_cache['index']:
-            print('MUTE: ' + post_id + ' is in recent posts cache')
-        if recent_posts_cache.get('json'):
-            recent_posts_cache['json'][post_id] = json.dumps(post_json_object)
+        if update_post_in_cache(recent_posts_cache, post_id,
+                                post_json_object):
             print('MUTE: ' + post_id +
                   ' marked as muted in recent posts memory cache')
-        if recent_posts_cache.get('html'):
-            if recent_posts_cache['html'].get(post_id):
-                del recent_posts_cache['html'][post_id]
-                print('MUTE: ' + post_id + ' removed cached html')
 
     if also_update_post_id:
         post_filename = locate_post(base_dir, nickname, domain,
@@ -1344,16 +1400,7 @@ def mute_post(base_dir: str, nickname: str, domain: str, port: int,
                                   'MUTE cached referenced post not removed ' +
                                   cached_post_filename)
 
-        if recent_posts_cache.get('json'):
-            if recent_posts_cache['json'].get(also_update_post_id):
-                del recent_posts_cache['json'][also_update_post_id]
-                print('MUTE: ' + also_update_post_id +
-                      ' removed referenced json')
-        if recent_posts_cache.get('html'):
-            if recent_posts_cache['html'].get(also_update_post_id):
-                del recent_posts_cache['html'][also_update_post_id]
-                print('MUTE: ' + also_update_post_id +
-                      ' removed referenced html')
+        remove_post_id_from_cache(recent_posts_cache, also_update_post_id)
 
 
 def unmute_post(base_dir: str, nickname: str, domain: str, port: int,
@@ -1439,16 +1486,10 @@ def unmute_post(base_dir: str, nickname: str, domain: str, port: int,
     if recent_posts_cache.get('index'):
         post_id = \
             remove_id_ending(post_json_object['id']).replace('/', '#')
-        if post_id in recent_posts_cache['index']:
-            print('UNMUTE: ' + post_id + ' is in recent posts cache')
-        if recent_posts_cache.get('json'):
-            recent_posts_cache['json'][post_id] = json.dumps(post_json_object)
+        if update_post_in_cache(recent_posts_cache, post_id,
+                                post_json_object):
             print('UNMUTE: ' + post_id +
                   ' marked as unmuted in recent posts cache')
-        if recent_posts_cache.get('html'):
-            if recent_posts_cache['html'].get(post_id):
-                del recent_posts_cache['html'][post_id]
-                print('UNMUTE: ' + post_id + ' removed cached html')
     if also_update_post_id:
         post_filename = locate_post(base_dir, nickname, domain,
                                     also_update_post_id)
@@ -1469,16 +1510,7 @@ def unmute_post(base_dir: str, nickname: str, domain: str, port: int,
                                   'unmute_post cached ref post not removed ' +
                                   str(cached_post_filename))
 
-        if recent_posts_cache.get('json'):
-            if recent_posts_cache['json'].get(also_update_post_id):
-                del recent_posts_cache['json'][also_update_post_id]
-                print('UNMUTE: ' +
-                      also_update_post_id + ' removed referenced json')
-        if recent_posts_cache.get('html'):
-            if recent_posts_cache['html'].get(also_update_post_id):
-                del recent_posts_cache['html'][also_update_post_id]
-                print('UNMUTE: ' +
-                      also_update_post_id + ' removed referenced html')
+        remove_post_id_from_cache(recent_posts_cache, also_update_post_id)
 
 
 def outbox_mute(base_dir: str, http_prefix: str,
@@ -1609,7 +1641,7 @@ def broch_mode_is_active(base_dir: str) -> bool:
     """Returns true if broch mode is active
     """
     allow_filename = data_dir(base_dir) + '/allowedinstances.txt'
-    return os.path.isfile(allow_filename)
+    return _blocklist_index(allow_filename)['exists']
 
 
 def set_broch_mode(base_dir: str, domain_full: str, enabled: bool) -> None:
@@ -1631,6 +1663,7 @@ def set_broch_mode(base_dir: str, domain_full: str, enabled: bool) -> None:
             except OSError:
                 print('EX: set_broch_mode allow file not deleted ' +
                       str(allow_filename))
+            blocklist_changed(allow_filename)
             print('Broch mode turned off')
     else:
         if os.path.isfile(allow_filename):
@@ -1677,6 +1710,7 @@ def set_broch_mode(base_dir: str, domain_full: str, enabled: bool) -> None:
         except OSError as ex:
             print('EX: Broch mode not enabled due to file write ' + str(ex))
             return
+        blocklist_changed(allow_filename)
 
     set_config_param(base_dir, "brochMode", enabled)
 
@@ -1705,6 +1739,7 @@ def broch_modeLapses(base_dir: str, lapse_days: int) -> bool:
             print('EX: broch_modeLapses allow file not deleted ' +
                   str(allow_filename))
         if removed:
+            blocklist_changed(allow_filename)
             set_config_param(base_dir, "brochMode", False)
             print('Broch mode has elapsed')
             return True
@@ -1799,6 +1834,7 @@ def import_blocking_file(base_dir: str, nickname: str, domain: str,
         print('EX: ' +
               'unable to append imported blocks to ' +
               blocking_filename)
+    blocklist_changed(blocking_filename)
 
     try:
         with open(blocking_reasons_filename, 'a+',
@@ -2194,7 +2230,8 @@ def _update_federated_blocks(session, base_dir: str,
         print('DEBUG: federated blocklist endpoints: ' +
               str(block_federated_endpoints))
 
-    new_block_api_str = ''
+    # entries already added, so that each is only added once
+    block_federated_set = set()
     for endpoint in block_federated_endpoints:
         if not endpoint:
             continue
@@ -2224,9 +2261,8 @@ def _update_federated_blocks(session, base_dir: str,
                             handle = handle[1:]
                         if _valid_federated_blocklist_entry(handle,
                                                             domain):
-                            if handle not in new_block_api_str:
-                                new_block_api_str += handle + '\n'
-                            if handle not in block_federated:
+                            if handle not in block_federated_set:
+                                block_federated_set.add(handle)
                                 block_federated.append(handle)
                         continue
 
@@ -2243,14 +2279,21 @@ def _update_federated_blocks(session, base_dir: str,
                         if not _valid_federated_blocklist_entry(handle,
                                                                 domain):
                             continue
-                        if handle not in new_block_api_str:
-                            new_block_api_str += handle + '\n'
-                        if handle not in block_federated:
+                        if handle not in block_federated_set:
+                            block_federated_set.add(handle)
                             block_federated.append(handle)
 
+    save_federated_blocks(base_dir, block_federated)
+    return block_federated
+
+
+def save_federated_blocks(base_dir: str, block_federated: []) -> None:
+    """Saves the federated block list to block_api.txt, with one
+    handle or domain on each line
+    """
     block_api_filename = \
         data_dir(base_dir) + '/block_api.txt'
-    if not new_block_api_str:
+    if not block_federated:
         print('DEBUG: federated blocklist not loaded: ' + block_api_filename)
         if os.path.isfile(block_api_filename):
             try:
@@ -2261,11 +2304,11 @@ def _update_federated_blocks(session, base_dir: str,
         print('DEBUG: federated blocklist loaded: ' + str(block_federated))
         try:
             with open(block_api_filename, 'w+', encoding='utf-8') as fp_api:
-                fp_api.write(new_block_api_str)
+                for handle in block_federated:
+                    fp_api.write(handle + '\n')
         except OSError:
             print('EX: unable to write block_api.txt')
-
-    return block_federated
+    blocklist_changed(block_api_filename)
 
 
 def save_block_federated_endpoints(base_dir: str,
@@ -2301,6 +2344,7 @@ def save_block_federated_endpoints(base_dir: str,
                 os.remove(block_api_filename)
             except OSError:
                 print('EX: unable to delete block_api.txt')
+            blocklist_changed(block_api_filename)
     else:
         try:
             with open(block_api_endpoints_filename, 'w+',
@@ -2312,34 +2356,26 @@ def save_block_federated_endpoints(base_dir: str,
 
 
 def run_federated_blocks_daemon(base_dir: str, httpd, debug: bool) -> None:
-    """Runs the daemon used to update federated blocks
+    """Updates federated blocks. This is run periodically by the scheduler
     """
     if debug:
-        print('DEBUG: federated blocklist 0')
-    seconds_per_hour = 60 * 60
-    time.sleep(60)
+        print('DEBUG: federated blocklist 1')
+    if httpd.session:
+        session = httpd.session
+    else:
+        session = create_session(httpd.proxy_type)
 
-    session = None
-    while True:
+    if session:
         if debug:
-            print('DEBUG: federated blocklist 1')
-        if httpd.session:
-            session = httpd.session
-        else:
-            session = create_session(httpd.proxy_type)
-
-        if session:
-            if debug:
-                print('DEBUG: federated blocklist 2')
-            httpd.block_federated = \
-                _update_federated_blocks(httpd.session, base_dir,
-                                         httpd.http_prefix,
-                                         httpd.domain,
-                                         debug, httpd.project_version,
-                                         httpd.signing_priv_key_pem,
-                                         httpd.max_api_blocks,
-                                         httpd.mitm_servers)
-        time.sleep(seconds_per_hour * 6)
+            print('DEBUG: federated blocklist 2')
+        httpd.block_federated = \
+            _update_federated_blocks(httpd.session, base_dir,
+                                     httpd.http_prefix,
+                                     httpd.domain,
+                                     debug, httpd.project_version,
+                                     httpd.signing_priv_key_pem,
+                                     httpd.max_api_blocks,
+                                     httpd.mitm_servers)
 
 
 def sending_is_blocked2(base_dir: str, nickname: str, domain: str,
@@ -8,10 +8,14 @@ __status__ = "Production"
 __module_group__ = "Core"
 
 import os
+import json
+import threading
+import time
 from session import download_image
 from session import url_exists
 from session import get_json
 from session import get_json_valid
+from threads import thread_check_cancelled
 from flags import url_permitted
 from utils import remove_html
 from utils import get_url_from_post
@@ -26,9 +30,128 @@ from utils import save_json
 from utils import get_file_case_insensitive
 from utils import get_user_paths
 from utils import date_utcnow
-from utils import date_from_string_format
 from content import remove_script
 
+# Actors held in memory are kept in a dict of actor url -> entry, in
+# order from least to most recently used. When the number of actors
+# or their total size goes over budget the least recently used are
+# evicted, and actors expire some time after they were stored. The
+# fields which are never read from a cached actor are not held in
+# memory, although the full actor is still saved to file.
+
+# default maximum number of actors held in memory
+PERSON_CACHE_MAX_ENTRIES = 20000
+
+# default maximum total size of the actors held in memory
+PERSON_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# seconds after which an actor held in memory expires
+PERSON_CACHE_MAX_AGE_SECS = 2 * 24 * 60 * 60
+
+# actor fields which are not held in memory
+PERSON_CACHE_DROP_FIELDS = ('@context', 'signature')
+
+# budget for each actor cache
+PERSON_CACHE_BUDGET = {
+    "maxEntries": PERSON_CACHE_MAX_ENTRIES,
+    "maxBytes": PERSON_CACHE_MAX_BYTES
+}
+
+# The size and counters of each actor or webfinger cache are held
+# separately from its entries, keyed by the id of the cache dict.
+# The state holds a reference to its cache, so that the id can't be
+# reused by another cache while the state exists. The number of
+# caches tracked is bounded, since commands may create caches which
+# are then discarded
+CACHE_STATE_MAX_CACHES = 16
+PERSON_CACHE_STATE = {}
+PERSON_CACHE_LOCK = threading.Lock()
+
+# Webfinger results are kept in a dict of handle -> entry, also in
+# order from least to most recently used, and expire some time after
+# they were stored. Failed lookups are kept too, so that instances
+# which are down are not asked again for every post. The time before
+# trying again doubles with each failure, up to a maximum. The cache
+# is saved to file periodically and loaded again at startup.
+
+# maximum number of webfinger results held in memory
+WEBFINGER_CACHE_MAX_ENTRIES = 20000
+
+# seconds after which a webfinger result expires
+WEBFINGER_CACHE_MAX_AGE_SECS = 24 * 60 * 60
+
+# seconds before trying again after the first failure
+WEBFINGER_CACHE_RETRY_SECS = 60
+
+# maximum seconds before trying again after repeated failures
+WEBFINGER_CACHE_MAX_RETRY_SECS = 6 * 60 * 60
+
+# counters for each webfinger cache
+WEBFINGER_CACHE_STATE = {}
+WEBFINGER_CACHE_LOCK = threading.Lock()
+
+
+def person_cache_set_budget(max_entries: int, max_bytes: int) -> None:
+    """Sets the maximum number of actors and their total size
+    held in memory
+    """
+    if max_entries and max_entries > 0:
+        PERSON_CACHE_BUDGET['maxEntries'] = max_entries
+    if max_bytes and max_bytes > 0:
+        PERSON_CACHE_BUDGET['maxBytes'] = max_bytes
+
+
+def _cache_state_add(cache_states: {}, cache_id: int, state: {}) -> None:
+    """Adds the state of an actor or webfinger cache, removing the
+    state of the least recently added cache if needed.
+    This should be called with the lock held
+    """
+    cache_states.pop(cache_id, None)
+    while len(cache_states) >= CACHE_STATE_MAX_CACHES:
+        del cache_states[next(iter(cache_states))]
+    cache_states[cache_id] = state
+
+
+def _person_cache_state(person_cache: {}) -> {}:
+    """Returns the size and counters for the given actor cache.
+    This should be called with the lock held
+    """
+    cache_id = id(person_cache)
+    state = PERSON_CACHE_STATE.get(cache_id)
+    if state is None or state['cache'] is not person_cache:
+        cache_bytes = 0
+        for entry in person_cache.values():
+            cache_bytes += entry.get('size', 0)
+        state = {
+            "cache": person_cache,
+            "bytes": cache_bytes,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        _cache_state_add(PERSON_CACHE_STATE, cache_id, state)
+    return state
+
+
+def _person_cache_remove(person_cache: {}, state: {},
+                         person_url: str) -> bool:
+    """Removes an actor from memory.
+    This should be called with the lock held
+    """
+    entry = person_cache.pop(person_url, None)
+    if entry is None:
+        return False
+    state['bytes'] -= entry.get('size', 0)
+    return True
+
+
+def _person_cache_expired(entry: {}, curr_time: float) -> bool:
+    """Returns True if the given actor has been held for too long
+    """
+    return curr_time - entry.get('stored', curr_time) > \
+        PERSON_CACHE_MAX_AGE_SECS
+
 
 def remove_person_from_cache(base_dir: str, person_url: str,
                              person_cache: {}) -> bool:
@@ -41,8 +164,9 @@ def remove_person_from_cache(base_dir: str, person_url: str,
             os.remove(cache_filename)
         except OSError:
             print('EX: unable to delete cached actor ' + str(cache_filename))
-    if person_cache.get(person_url):
-        del person_cache[person_url]
+    with PERSON_CACHE_LOCK:
+        state = _person_cache_state(person_cache)
+        _person_cache_remove(person_cache, state, person_url)
 
 
 def clear_actor_cache(base_dir: str, person_cache: {},
@@ -85,6 +209,8 @@ def check_for_changed_actor(session, base_dir: str,
         return
     if url_exists(session, avatar_url, timeout_sec, http_prefix, domain_full):
         return
+    # stop here if this check was replaced by a newer one
+    thread_check_cancelled()
     remove_person_from_cache(base_dir, person_url, person_cache)
 
 
@@ -97,11 +223,40 @@ def store_person_in_cache(base_dir: str, person_url: str,
         # This is not an actor or person account
         return
 
+    # only the fields which are read are held in memory
+    cached_json = person_json
+    for field in PERSON_CACHE_DROP_FIELDS:
+        if field in person_json:
+            cached_json = {}
+            for key, value in person_json.items():
+                if key not in PERSON_CACHE_DROP_FIELDS:
+                    cached_json[key] = value
+            break
+    try:
+        cached_size = len(json.dumps(cached_json))
+    except (TypeError, ValueError):
+        return
+
     curr_time = date_utcnow()
-    person_cache[person_url] = {
-        "actor": person_json,
-        "timestamp": curr_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-    }
+    with PERSON_CACHE_LOCK:
+        state = _person_cache_state(person_cache)
+        _person_cache_remove(person_cache, state, person_url)
+        # evict the least recently used actors until there is room
+        max_entries = PERSON_CACHE_BUDGET['maxEntries']
+        max_bytes = PERSON_CACHE_BUDGET['maxBytes']
+        while person_cache and \
+            (len(person_cache) >= max_entries or
+             state['bytes'] + cached_size > max_bytes):
+            oldest_url = next(iter(person_cache))
+            _person_cache_remove(person_cache, state, oldest_url)
+            state['evictions'] += 1
+        person_cache[person_url] = {
+            "actor": cached_json,
+            "timestamp": curr_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "stored": time.time(),
+            "size": cached_size
+        }
+        state['bytes'] += cached_size
     if not base_dir:
         return
 
@@ -119,26 +274,38 @@ def get_person_from_cache(base_dir: str, person_url: str,
                           person_cache: {}) -> {}:
     """Get an actor from the cache
     """
-    # if the actor is not in memory then try to load it from file
-    loaded_from_file = False
-    if not person_cache.get(person_url):
-        # does the person exist as a cached file?
-        cache_filename = base_dir + '/cache/actors/' + \
-            person_url.replace('/', '#') + '.json'
-        actor_filename = get_file_case_insensitive(cache_filename)
-        if actor_filename:
-            person_json = load_json(actor_filename)
-            if person_json:
-                store_person_in_cache(base_dir, person_url, person_json,
-                                      person_cache, False)
-                loaded_from_file = True
+    with PERSON_CACHE_LOCK:
+        state = _person_cache_state(person_cache)
+        entry = person_cache.get(person_url)
+        if entry:
+            if _person_cache_expired(entry, time.time()):
+                _person_cache_remove(person_cache, state, person_url)
+                state['expired'] += 1
+            else:
+                # move to the most recently used end
+                del person_cache[person_url]
+                person_cache[person_url] = entry
+                # the last time the actor was retrieved
+                curr_time = date_utcnow()
+                entry['timestamp'] = curr_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                state['hits'] += 1
+                return entry['actor']
+        state['misses'] += 1
 
+    # the actor is not in memory so try to load it from file
+    if not base_dir:
+        return None
+    cache_filename = base_dir + '/cache/actors/' + \
+        person_url.replace('/', '#') + '.json'
+    actor_filename = get_file_case_insensitive(cache_filename)
+    if not actor_filename:
+        return None
+    person_json = load_json(actor_filename)
+    if not person_json:
+        return None
+    store_person_in_cache(base_dir, person_url, person_json,
+                          person_cache, False)
     if person_cache.get(person_url):
-        if not loaded_from_file:
-            # update the timestamp for the last time the actor was retrieved
-            curr_time = date_utcnow()
-            curr_time_str = curr_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            person_cache[person_url]['timestamp'] = curr_time_str
         return person_cache[person_url]['actor']
     return None
 
@@ -146,33 +313,255 @@ def get_person_from_cache(base_dir: str, person_url: str,
 def expire_person_cache(person_cache: {}):
     """Expires old entries from the cache in memory
     """
-    curr_time = date_utcnow()
+    curr_time = time.time()
     removals: list[str] = []
-    for person_url, cache_json in person_cache.items():
-        cache_time = date_from_string_format(cache_json['timestamp'],
-                                             ["%Y-%m-%dT%H:%M:%S%z"])
-        days_since_cached = (curr_time - cache_time).days
-        if days_since_cached > 2:
-            removals.append(person_url)
-    if len(removals) > 0:
+    with PERSON_CACHE_LOCK:
+        state = _person_cache_state(person_cache)
+        for person_url, entry in person_cache.items():
+            if _person_cache_expired(entry, curr_time):
+                removals.append(person_url)
         for person_url in removals:
-            del person_cache[person_url]
+            _person_cache_remove(person_cache, state, person_url)
+        state['expired'] += len(removals)
+    if len(removals) > 0:
         print(str(len(removals)) + ' actors were expired from the cache')
 
 
+def person_cache_metrics(person_cache: {}) -> {}:
+    """Returns the number and size of actors held in memory, and how
+    often they were found there
+    """
+    with PERSON_CACHE_LOCK:
+        state = _person_cache_state(person_cache)
+        metrics = {
+            "entries": len(person_cache),
+            "bytes": state['bytes'],
+            "maxEntries": PERSON_CACHE_BUDGET['maxEntries'],
+            "maxBytes": PERSON_CACHE_BUDGET['maxBytes'],
+            "hits": state['hits'],
+            "misses": state['misses'],
+            "evictions": state['evictions'],
+            "expired": state['expired']
+        }
+    hit_rate = 0
+    if metrics['hits'] + metrics['misses'] > 0:
+        hit_rate = \
+            metrics['hits'] * 100 / (metrics['hits'] + metrics['misses'])
+    metrics['hitRate'] = hit_rate
+    return metrics
+
+
+def _webfinger_cache_state(cached_webfingers: {}) -> {}:
+    """Returns the counters for the given webfinger cache.
+    This should be called with the lock held
+    """
+    cache_id = id(cached_webfingers)
+    state = WEBFINGER_CACHE_STATE.get(cache_id)
+    if state is None or state['cache'] is not cached_webfingers:
+        state = {
+            "cache": cached_webfingers,
+            "hits": 0,
+            "failureHits": 0,
+            "misses": 0,
+            "failures": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        _cache_state_add(WEBFINGER_CACHE_STATE, cache_id, state)
+    return state
+
+
+def _webfinger_cache_add(cached_webfingers: {}, state: {},
+                         handle: str, entry: {}) -> None:
+    """Adds an entry to the webfinger cache, evicting the least
+    recently used entries if needed.
+    This should be called with the lock held
+    """
+    cached_webfingers.pop(handle, None)
+    while cached_webfingers and \
+            len(cached_webfingers) >= WEBFINGER_CACHE_MAX_ENTRIES:
+        oldest_handle = next(iter(cached_webfingers))
+        del cached_webfingers[oldest_handle]
+        state['evictions'] += 1
+    cached_webfingers[handle] = entry
+
+
+def _webfinger_cache_entry(cached_webfingers: {}, state: {},
+                           handle: str, curr_time: float) -> {}:
+    """Returns the cache entry for a handle if it has not expired.
+    This should be called with the lock held
+    """
+    entry = cached_webfingers.get(handle)
+    if not entry:
+        return None
+    if curr_time >= entry['expires']:
+        del cached_webfingers[handle]
+        state['expired'] += 1
+        return None
+    return entry
+
+
 def store_webfinger_in_cache(handle: str, webfing,
                              cached_webfingers: {}) -> None:
     """Store a webfinger endpoint in the cache
     """
-    cached_webfingers[handle] = webfing
+    curr_time = time.time()
+    entry = {
+        "wf": webfing,
+        "stored": curr_time,
+        "expires": curr_time + WEBFINGER_CACHE_MAX_AGE_SECS,
+        "failures": 0
+    }
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        _webfinger_cache_add(cached_webfingers, state, handle, entry)
+
+
+def store_webfinger_failure_in_cache(handle: str,
+                                     cached_webfingers: {}) -> None:
+    """Store a failed webfinger lookup in the cache, so that it is not
+    tried again until after a time which doubles with each failure
+    """
+    curr_time = time.time()
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        state['failures'] += 1
+        failures = 1
+        prev_entry = cached_webfingers.get(handle)
+        if prev_entry:
+            if prev_entry['failures'] > 0:
+                failures = prev_entry['failures'] + 1
+            elif prev_entry['wf']:
+                # keep a previous result which has not expired
+                return
+        retry_secs = \
+            min(WEBFINGER_CACHE_RETRY_SECS * (2 ** min(failures - 1, 16)),
+                WEBFINGER_CACHE_MAX_RETRY_SECS)
+        entry = {
+            "wf": None,
+            "stored": curr_time,
+            "expires": curr_time + retry_secs,
+            "failures": failures
+        }
+        _webfinger_cache_add(cached_webfingers, state, handle, entry)
 
 
 def get_webfinger_from_cache(handle: str, cached_webfingers: {}) -> {}:
     """Get webfinger endpoint from the cache
     """
-    if cached_webfingers.get(handle):
-        return cached_webfingers[handle]
-    return None
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        entry = _webfinger_cache_entry(cached_webfingers, state,
+                                       handle, time.time())
+        if not entry:
+            state['misses'] += 1
+            return None
+        if not entry['wf']:
+            state['failureHits'] += 1
+            return None
+        # move to the most recently used end
+        del cached_webfingers[handle]
+        cached_webfingers[handle] = entry
+        state['hits'] += 1
+        return entry['wf']
+
+
+def webfinger_failed_recently(handle: str, cached_webfingers: {}) -> bool:
+    """Has a webfinger lookup for the given handle failed recently?
+    """
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        entry = _webfinger_cache_entry(cached_webfingers, state,
+                                       handle, time.time())
+        if entry:
+            if not entry['wf']:
+                return True
+    return False
+
+
+def save_webfinger_cache(base_dir: str, cached_webfingers: {}) -> None:
+    """Saves the webfinger cache to file, so that handles don't all
+    need to be looked up again after a restart
+    """
+    cache_dir = base_dir + '/cache'
+    if not os.path.isdir(cache_dir):
+        return
+    curr_time = time.time()
+    # entries are replaced rather than changed, so a copy of the
+    # cache can be written without holding up lookups
+    with WEBFINGER_CACHE_LOCK:
+        snapshot = {}
+        for handle, entry in cached_webfingers.items():
+            if curr_time < entry['expires']:
+                snapshot[handle] = entry
+    # write to a temporary file, so that a partly written
+    # cache is never loaded
+    cache_filename = cache_dir + '/webfingers.json'
+    if save_json(snapshot, cache_filename + '.new'):
+        try:
+            os.replace(cache_filename + '.new', cache_filename)
+        except OSError:
+            print('EX: save_webfinger_cache unable to replace ' +
+                  cache_filename)
+
+
+def load_webfinger_cache(base_dir: str, cached_webfingers: {}) -> int:
+    """Loads the webfinger cache from file and returns the number
+    of entries loaded
+    """
+    cache_filename = base_dir + '/cache/webfingers.json'
+    if not os.path.isfile(cache_filename):
+        return 0
+    snapshot = load_json(cache_filename)
+    if not isinstance(snapshot, dict):
+        return 0
+    curr_time = time.time()
+    loaded = 0
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        for handle, entry in snapshot.items():
+            if not isinstance(entry, dict):
+                continue
+            if not isinstance(entry.get('expires'), (int, float)):
+                continue
+            if curr_time >= entry['expires']:
+                continue
+            if 'wf' not in entry or \
+               not isinstance(entry.get('failures'), int):
+                continue
+            _webfinger_cache_add(cached_webfingers, state, handle, entry)
+            loaded += 1
+    return loaded
+
+
+def webfinger_cache_metrics(cached_webfingers: {}) -> {}:
+    """Returns the number of webfinger results held in memory, and how
+    often they were found there
+    """
+    with WEBFINGER_CACHE_LOCK:
+        state = _webfinger_cache_state(cached_webfingers)
+        failed_entries = 0
+        for entry in cached_webfingers.values():
+            if not entry['wf']:
+                failed_entries += 1
+        metrics = {
+            "entries": len(cached_webfingers),
+            "failedEntries": failed_entries,
+            "maxEntries": WEBFINGER_CACHE_MAX_ENTRIES,
+            "hits": state['hits'],
+            "failureHits": state['failureHits'],
+            "misses": state['misses'],
+            "failures": state['failures'],
+            "evictions": state['evictions'],
+            "expired": state['expired']
+        }
+    hit_rate = 0
+    lookups = metrics['hits'] + metrics['failureHits'] + metrics['misses']
+    if lookups > 0:
+        hit_rate = \
+            (metrics['hits'] + metrics['failureHits']) * 100 / lookups
+    metrics['hitRate'] = hit_rate
+    return metrics
 
 
 def get_actor_public_key_from_id(person_json: {}, key_id: str) -> (str, str):
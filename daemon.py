@@ -9,7 +9,6 @@ __module_group__ = "Daemon"
 
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer, HTTPServer
 import sys
-import time
 import os
 from socket import error as SocketError
 import errno
@@ -22,12 +21,21 @@ from person import create_shared_inbox
 from person import create_news_inbox
 from keys import get_instance_actor_key
 from posts import expire_cache
+from posts import restore_deliveries
+from cache import person_cache_set_budget
+from cache import load_webfinger_cache
+from cache import save_webfinger_cache
 from inbox import run_inbox_queue
-from inbox import run_inbox_queue_watchdog
+from inbox import supervise_inbox_queue
+from inbox_queue import new_inbox_queue
+from inbox_admission import new_inbox_admission
+from inbox_seen import new_inbox_seen
+from inbox_keys import new_inbox_keys
 from follow import create_initial_last_seen
 from threads import begin_thread
 from threads import thread_with_trace
 from threads import remove_dormant_threads
+from threads import thread_on_cancel
 from cwlists import load_cw_lists
 from blocking import run_federated_blocks_daemon
 from blocking import load_federated_blocks_endpoints
@@ -42,7 +50,7 @@ from webapp_utils import load_buy_sites
 from webapp_accesskeys import load_access_keys_for_accounts
 from webapp_media import load_peertube_instances
 from shares import run_federated_shares_daemon
-from shares import run_federated_shares_watchdog
+from shares import supervise_federated_shares_daemon
 from shares import create_shared_item_federation_token
 from shares import generate_shared_item_federation_tokens
 from shares import expire_shares
@@ -72,19 +80,24 @@ from theme import is_news_theme_name
 from theme import get_text_mode_banner
 from theme import set_news_avatar
 from schedule import run_post_schedule
-from schedule import run_post_schedule_watchdog
 from happening import dav_propfind_response
 from happening import dav_put_response
 from happening import dav_report_response
 from happening import dav_delete_response
 from newswire import load_hashtag_categories
-from newsdaemon import run_newswire_watchdog
+from newsdaemon import supervise_newswire_daemon
 from newsdaemon import run_newswire_daemon
-from fitnessFunctions import fitness_thread
+from fitnessFunctions import save_fitness
+from fitnessFunctions import collect_fitness_metrics
+from session import expire_session_pools
 from siteactive import load_unavailable_sites
+from siteactive import save_unavailable_sites_changed
 from crawlers import load_known_web_bots
 from qrcode import save_domain_qrcode
-from importFollowing import run_import_following_watchdog
+from importFollowing import run_import_following
+from scheduler import new_scheduler
+from scheduler import scheduler_add_job
+from scheduler import scheduler_start
 from relationships import update_moved_actors
 from daemon_get import daemon_http_get
 from daemon_post import daemon_http_post
@@ -422,7 +435,12 @@ class EpicyonServer(ThreadingHTTPServer):
     getreq_busy = False
     postreq_busy = False
     received_message = False
-    inbox_queue: list[dict] = []
+    inbox_queue = {}
+    inbox_admission = {}
+    inbox_seen = {}
+    inbox_keys = {}
+    domain_max_posts_per_day = 0
+    account_max_posts_per_day = 0
     send_threads = None
     post_log = []
     max_queue_length = 64
@@ -448,14 +466,9 @@ class EpicyonServer(ThreadingHTTPServer):
     theme_name = ''
     news_instance = False
     default_timeline = 'inbox'
-    thrFitness = None
     recent_posts_cache = {}
-    thrCache = None
     send_threads_timeout_mins = 3
-    thrPostsQueue = None
-    thrPostsWatchdog = None
-    thrSharesExpire = None
-    thrSharesExpireWatchdog = None
+    scheduler = None
     max_recent_posts = 1
     iconsCache = {}
     fontsCache = {}
@@ -466,19 +479,14 @@ class EpicyonServer(ThreadingHTTPServer):
     max_emoji = 10
     max_hashtags = 10
     thrInboxQueue = None
-    thrPostSchedule = None
+    thrInboxVerify = []
+    thrInboxKeyRefetch = None
     thrNewswireDaemon = None
     thrFederatedSharesDaemon = None
     restart_inbox_queue_in_progress = False
     restart_inbox_queue = False
     signing_priv_key_pem = ''
     thrCheckActor = {}
-    thrImportFollowing = None
-    thrWatchdog = None
-    thrWatchdogSchedule = None
-    thrNewswireWatchdog = None
-    thrFederatedSharesWatchdog = None
-    thrFederatedBlocksDaemon = None
     qrcode_scale = 6
     instance_description = ''
     instance_description_short = 'Epicyon'
@@ -507,56 +515,11 @@ class EpicyonServer(ThreadingHTTPServer):
             return HTTPServer.handle_error(self, request, client_address)
 
 
-def run_posts_queue(base_dir: str, send_threads: [], debug: bool,
-                    timeout_mins: int) -> None:
-    """Manages the threads used to send posts
+def run_shares_expire(base_dir: str, httpd) -> None:
+    """Expires shares as needed. This is run periodically by the scheduler
     """
-    while True:
-        time.sleep(1)
-        remove_dormant_threads(base_dir, send_threads, debug, timeout_mins)
-
-
-def run_shares_expire(version_number: str, base_dir: str, httpd) -> None:
-    """Expires shares as needed
-    """
-    while True:
-        time.sleep(120)
-        expire_shares(base_dir, httpd.max_shares_on_profile,
-                      httpd.person_cache)
-
-
-def run_posts_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the posts thread running even if it dies
-    """
-    print('THREAD: Starting posts queue watchdog')
-    posts_queue_original = httpd.thrPostsQueue.clone(run_posts_queue)
-    begin_thread(httpd.thrPostsQueue, 'run_posts_watchdog')
-    while True:
-        time.sleep(20)
-        if httpd.thrPostsQueue.is_alive():
-            continue
-        httpd.thrPostsQueue.kill()
-        print('THREAD: restarting posts queue')
-        httpd.thrPostsQueue = posts_queue_original.clone(run_posts_queue)
-        begin_thread(httpd.thrPostsQueue, 'run_posts_watchdog 2')
-        print('Restarting posts queue...')
-
-
-def run_shares_expire_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the shares expiry thread running even if it dies
-    """
-    print('THREAD: Starting shares expiry watchdog')
-    shares_expire_original = httpd.thrSharesExpire.clone(run_shares_expire)
-    begin_thread(httpd.thrSharesExpire, 'run_shares_expire_watchdog')
-    while True:
-        time.sleep(20)
-        if httpd.thrSharesExpire.is_alive():
-            continue
-        httpd.thrSharesExpire.kill()
-        print('THREAD: restarting shares watchdog')
-        httpd.thrSharesExpire = shares_expire_original.clone(run_shares_expire)
-        begin_thread(httpd.thrSharesExpire, 'run_shares_expire_watchdog 2')
-        print('Restarting shares expiry...')
+    expire_shares(base_dir, httpd.max_shares_on_profile,
+                  httpd.person_cache)
 
 
 def load_tokens(base_dir: str, tokens_dict: {}, tokens_lookup: {}) -> None:
@@ -1132,7 +1095,20 @@ def run_daemon(accounts_data_dir: str,
     httpd.base_dir = base_dir
     httpd.instance_id = instance_id
     httpd.person_cache = {}
+    # maximum number and total size of actors held in memory
+    person_cache_max_entries = \
+        get_config_param(base_dir, 'personCacheMaxEntries')
+    person_cache_max_mb = get_config_param(base_dir, 'personCacheMaxMb')
+    max_entries = 0
+    if str(person_cache_max_entries).isdigit():
+        max_entries = int(person_cache_max_entries)
+    max_bytes = 0
+    if str(person_cache_max_mb).isdigit():
+        max_bytes = int(person_cache_max_mb) * 1024 * 1024
+    person_cache_set_budget(max_entries, max_bytes)
+    # webfinger results are kept between restarts
     httpd.cached_webfingers = {}
+    load_webfinger_cache(base_dir, httpd.cached_webfingers)
     httpd.favicons_cache = {}
     httpd.proxy_type = proxy_type
     httpd.session = None
@@ -1143,7 +1119,16 @@ def run_daemon(accounts_data_dir: str,
     httpd.getreq_busy = False
     httpd.postreq_busy = False
     httpd.received_message = False
-    httpd.inbox_queue: list[dict] = []
+    httpd.inbox_queue = \
+        new_inbox_queue(data_dir(base_dir) + '/inboxjournal')
+    # quotas for posts received per day, checked at admission time
+    httpd.domain_max_posts_per_day = domain_max_posts_per_day
+    httpd.account_max_posts_per_day = account_max_posts_per_day
+    httpd.inbox_admission = new_inbox_admission(10000)
+    # recently received activities, so that duplicates aren't queued
+    httpd.inbox_seen = new_inbox_seen(50000, 60 * 60)
+    # public keys which could not be obtained, and items waiting for them
+    httpd.inbox_keys = new_inbox_keys(10000, 10000)
     httpd.send_threads = send_threads
     httpd.post_log: list[str] = []
     httpd.max_queue_length = 64
@@ -1244,58 +1229,60 @@ def run_daemon(accounts_data_dir: str,
         print('Creating shared item files directory')
         os.mkdir(base_dir + '/sharefiles')
 
-    print('THREAD: Creating fitness thread')
-    httpd.thrFitness = \
-        thread_with_trace(target=fitness_thread,
-                          args=(base_dir, httpd.fitness), daemon=True)
-    begin_thread(httpd.thrFitness, 'run_daemon thrFitness')
+    # periodic jobs, and checks that long running threads are still
+    # alive, are run by a single scheduler thread
+    httpd.scheduler = new_scheduler()
+
+    print('THREAD: Scheduling fitness saves')
+    fitness_args = (base_dir, httpd.fitness)
+    scheduler_add_job(httpd.scheduler, 'fitness', save_fitness,
+                      fitness_args, 60 * 10, 60 * 10, False)
 
     httpd.recent_posts_cache = {}
 
-    print('THREAD: Creating cache expiry thread')
-    httpd.thrCache = \
-        thread_with_trace(target=expire_cache,
-                          args=(base_dir, httpd.person_cache,
-                                httpd.http_prefix,
-                                archive_dir,
-                                httpd.recent_posts_cache,
-                                httpd.maxPostsInBox,
-                                httpd.maxCacheAgeDays), daemon=True)
-    begin_thread(httpd.thrCache, 'run_daemon thrCache')
+    print('THREAD: Scheduling cache expiry')
+    expire_cache_args = (base_dir, httpd.person_cache,
+                         httpd.http_prefix,
+                         archive_dir,
+                         httpd.recent_posts_cache,
+                         httpd.maxPostsInBox,
+                         httpd.maxCacheAgeDays)
+    scheduler_add_job(httpd.scheduler, 'expireCache', expire_cache,
+                      expire_cache_args, 60 * 60 * 24, 60 * 60 * 24, True)
+
+    print('THREAD: Scheduling webfinger cache saves')
+    webfinger_cache_args = (base_dir, httpd.cached_webfingers)
+    scheduler_add_job(httpd.scheduler, 'webfingerCache',
+                      save_webfinger_cache, webfinger_cache_args,
+                      60 * 15, 60 * 15, True)
+
+    print('THREAD: Scheduling closing of idle connections')
+    scheduler_add_job(httpd.scheduler, 'sessionPools',
+                      expire_session_pools, (), 30, 30, False)
+
+    print('THREAD: Scheduling collection of metrics')
+    metrics_args = (base_dir, httpd.fitness, httpd.person_cache,
+                    httpd.cached_webfingers, httpd.scheduler)
+    scheduler_add_job(httpd.scheduler, 'metrics', collect_fitness_metrics,
+                      metrics_args, 10, 10, False)
 
     # number of mins after which sending posts or updates will expire
     httpd.send_threads_timeout_mins = send_threads_timeout_mins
 
-    print('THREAD: Creating posts queue')
-    httpd.thrPostsQueue = \
-        thread_with_trace(target=run_posts_queue,
-                          args=(base_dir, httpd.send_threads, debug,
-                                httpd.send_threads_timeout_mins), daemon=True)
-    if not unit_test:
-        print('THREAD: run_posts_watchdog')
-        httpd.thrPostsWatchdog = \
-            thread_with_trace(target=run_posts_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrPostsWatchdog, 'run_daemon thrPostWatchdog')
-    else:
-        begin_thread(httpd.thrPostsQueue, 'run_daemon thrPostWatchdog 2')
-
-    print('THREAD: Creating expire thread for shared items')
-    httpd.thrSharesExpire = \
-        thread_with_trace(target=run_shares_expire,
-                          args=(project_version, base_dir,
-                                httpd),
-                          daemon=True)
-    if not unit_test:
-        print('THREAD: run_shares_expire_watchdog')
-        httpd.thrSharesExpireWatchdog = \
-            thread_with_trace(target=run_shares_expire_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrSharesExpireWatchdog,
-                     'run_daemon thrSharesExpireWatchdog')
-    else:
-        begin_thread(httpd.thrSharesExpire,
-                     'run_daemon thrSharesExpireWatchdog 2')
+    # resume any deliveries which were queued before a restart
+    restore_deliveries(base_dir, proxy_type, httpd.federation_list,
+                       httpd.post_log, debug)
+
+    print('THREAD: Scheduling posts queue')
+    posts_queue_args = (base_dir, httpd.send_threads, debug,
+                        httpd.send_threads_timeout_mins)
+    scheduler_add_job(httpd.scheduler, 'postsQueue', remove_dormant_threads,
+                      posts_queue_args, 1, 1, False)
+
+    print('THREAD: Scheduling expiry of shared items')
+    shares_expire_args = (base_dir, httpd)
+    scheduler_add_job(httpd.scheduler, 'sharesExpire', run_shares_expire,
+                      shares_expire_args, 120, 120, True)
 
     httpd.max_recent_posts = max_recent_posts
     httpd.iconsCache = {}
@@ -1321,6 +1308,10 @@ def run_daemon(accounts_data_dir: str,
     httpd.max_emoji = max_emoji
     httpd.max_hashtags = max_hashtags
 
+    # pool of threads which verify signatures ahead of the inbox queue
+    httpd.thrInboxVerify = []
+    httpd.thrInboxKeyRefetch = None
+
     print('THREAD: Creating inbox queue')
     httpd.thrInboxQueue = \
         thread_with_trace(target=run_inbox_queue,
@@ -1334,8 +1325,6 @@ def run_daemon(accounts_data_dir: str,
                                 port, proxy_type,
                                 httpd.federation_list,
                                 max_replies,
-                                domain_max_posts_per_day,
-                                account_max_posts_per_day,
                                 allow_deletion, debug,
                                 max_mentions, max_emoji,
                                 httpd.translate, unit_test,
@@ -1354,10 +1343,10 @@ def run_daemon(accounts_data_dir: str,
                                 httpd.cw_lists,
                                 httpd.max_hashtags), daemon=True)
 
-    print('THREAD: Creating scheduled post thread')
-    httpd.thrPostSchedule = \
-        thread_with_trace(target=run_post_schedule,
-                          args=(base_dir, httpd, 20), daemon=True)
+    print('THREAD: Scheduling scheduled posts')
+    post_schedule_args = (base_dir, httpd, 20)
+    scheduler_add_job(httpd.scheduler, 'postSchedule', run_post_schedule,
+                      post_schedule_args, 60, 60, True)
 
     print('THREAD: Creating newswire thread')
     httpd.thrNewswireDaemon = \
@@ -1392,55 +1381,53 @@ def run_daemon(accounts_data_dir: str,
     # avatar icon / person options
     httpd.thrCheckActor = {}
 
+    print('Starting inbox queue')
+    begin_thread(httpd.thrInboxQueue, 'run_daemon start inbox')
+    print('Starting federated shares daemon')
+    begin_thread(httpd.thrFederatedSharesDaemon,
+                 'run_daemon start federated shares')
+
     if not unit_test:
-        print('THREAD: Creating import following watchdog')
-        httpd.thrImportFollowing = \
-            thread_with_trace(target=run_import_following_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrImportFollowing,
-                     'run_daemon thrImportFollowing')
-
-        print('THREAD: Creating inbox queue watchdog')
-        httpd.thrWatchdog = \
-            thread_with_trace(target=run_inbox_queue_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrWatchdog, 'run_daemon thrWatchdog')
-
-        print('THREAD: Creating scheduled post watchdog')
-        httpd.thrWatchdogSchedule = \
-            thread_with_trace(target=run_post_schedule_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrWatchdogSchedule,
-                     'run_daemon thrWatchdogSchedule')
-
-        print('THREAD: Creating newswire watchdog')
-        httpd.thrNewswireWatchdog = \
-            thread_with_trace(target=run_newswire_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrNewswireWatchdog,
-                     'run_daemon thrNewswireWatchdog')
-
-        print('THREAD: Creating federated shares watchdog')
-        httpd.thrFederatedSharesWatchdog = \
-            thread_with_trace(target=run_federated_shares_watchdog,
-                              args=(project_version, httpd), daemon=True)
-        begin_thread(httpd.thrFederatedSharesWatchdog,
-                     'run_daemon thrFederatedSharesWatchdog')
-        print('THREAD: Creating federated blocks thread')
-        httpd.thrFederatedBlocksDaemon = \
-            thread_with_trace(target=run_federated_blocks_daemon,
-                              args=(base_dir, httpd, debug), daemon=True)
-        begin_thread(httpd.thrFederatedBlocksDaemon,
-                     'run_daemon thrFederatedBlocksDaemon')
-    else:
-        print('Starting inbox queue')
-        begin_thread(httpd.thrInboxQueue, 'run_daemon start inbox')
-        print('Starting scheduled posts daemon')
-        begin_thread(httpd.thrPostSchedule,
-                     'run_daemon start scheduled posts')
-        print('Starting federated shares daemon')
-        begin_thread(httpd.thrFederatedSharesDaemon,
-                     'run_daemon start federated shares')
+        print('Starting newswire daemon')
+        begin_thread(httpd.thrNewswireDaemon, 'run_daemon start newswire')
+
+        # restart long running threads if they die
+        print('THREAD: Scheduling inbox queue supervision')
+        supervise_args = (httpd,)
+        scheduler_add_job(httpd.scheduler, 'inboxQueue',
+                          supervise_inbox_queue,
+                          supervise_args, 20, 20, False)
+        print('THREAD: Scheduling newswire supervision')
+        scheduler_add_job(httpd.scheduler, 'newswire',
+                          supervise_newswire_daemon,
+                          supervise_args, 50, 50, False)
+        print('THREAD: Scheduling federated shares supervision')
+        scheduler_add_job(httpd.scheduler, 'federatedShares',
+                          supervise_federated_shares_daemon,
+                          supervise_args, 55, 55, False)
+
+        print('THREAD: Scheduling unavailable sites saves')
+        unavailable_sites_args = \
+            (base_dir, httpd.sites_unavailable,
+             httpd.sites_unavailable.copy())
+        scheduler_add_job(httpd.scheduler, 'unavailableSites',
+                          save_unavailable_sites_changed,
+                          unavailable_sites_args, 20, 20, False)
+
+        print('THREAD: Scheduling import following')
+        import_following_args = (base_dir, httpd)
+        scheduler_add_job(httpd.scheduler, 'importFollowing',
+                          run_import_following,
+                          import_following_args, 20, 20, True)
+
+        print('THREAD: Scheduling federated blocks')
+        federated_blocks_args = (base_dir, httpd, debug)
+        scheduler_add_job(httpd.scheduler, 'federatedBlocks',
+                          run_federated_blocks_daemon,
+                          federated_blocks_args, 60 * 60 * 6, 60, True)
+
+    print('THREAD: Starting scheduler')
+    scheduler_start(httpd.scheduler)
 
     update_memorial_flags(base_dir, httpd.person_cache)
 
@@ -1451,4 +1438,7 @@ def run_daemon(accounts_data_dir: str,
         print('Running ActivityPub server on ' +
               domain + ' port ' + str(proxy_port))
     httpd.starting_daemon = False
+    # stop serving and running jobs if this thread is cancelled
+    thread_on_cancel(httpd.shutdown)
+    thread_on_cancel(httpd.scheduler['thread'].kill)
     httpd.serve_forever()
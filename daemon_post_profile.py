@@ -132,6 +132,8 @@ from donate import set_donation_url
 from person import get_featured_hashtags
 from person import set_featured_hashtags
 from blocking import save_block_federated_endpoints
+from blocking import save_federated_blocks
+from blocking import blocklist_changed
 from blocking import import_blocking_file
 from blocking import add_account_blocks
 from blocking import set_broch_mode
@@ -301,6 +303,7 @@ def _profile_post_block_federated(base_dir: str, fields: {}, self) -> None:
                                            block_ep_new)
         if not block_ep_new:
             self.server.block_federated = []
+            save_federated_blocks(base_dir, [])
 
 
 def _profile_post_robots_txt(base_dir: str, fields: {}, self) -> None:
@@ -454,6 +457,7 @@ def _profile_post_allowed_instances(base_dir: str, nickname: str, domain: str,
                 print('EX: _profile_edit ' +
                       'unable to delete ' +
                       allowed_instances_filename)
+    blocklist_changed(allowed_instances_filename)
 
 
 def _profile_post_dm_instances(base_dir: str, nickname: str, domain: str,
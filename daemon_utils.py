@@ -17,10 +17,22 @@ from city import get_spoofed_city
 from httpcodes import http_404
 from httpcodes import http_503
 from httpcodes import http_400
+from httpcodes import http_429
 from httpcodes import write2
 from context import has_valid_context
 from inbox import save_post_to_inbox_queue
 from inbox import clear_queue_items
+from inbox_queue import inbox_queue_add
+from inbox_queue import inbox_queue_contains
+from inbox_queue import inbox_queue_length
+from inbox_admission import inbox_admission_check
+from inbox_admission import inbox_admission_refund
+from inbox_seen import inbox_seen_key
+from inbox_seen import inbox_seen_contains
+from inbox_seen import inbox_seen_inflight
+from inbox_seen import inbox_seen_begin
+from inbox_seen import inbox_seen_forget
+from inbox_seen import INBOX_SEEN_RETRY_SECS
 from blocking import update_blocked_cache
 from blocking import is_blocked_nickname
 from blocking import is_blocked_domain
@@ -169,16 +181,6 @@ def _get_outbox_thread_index(self, nickname: str,
         index = 0
 
     self.server.outbox_thread_index[account_outbox_thread_name] = index
-
-    # remove any existing thread from the current index in the buffer
-    acct = account_outbox_thread_name
-    if self.server.outboxThread.get(acct):
-        if len(self.server.outboxThread[acct]) > index:
-            try:
-                if self.server.outboxThread[acct][index].is_alive():
-                    self.server.outboxThread[acct][index].kill()
-            except BaseException:
-                pass
     return index
 
 
@@ -192,6 +194,19 @@ def post_to_outbox_thread(self, message_json: {},
 
     index = _get_outbox_thread_index(self, account_outbox_thread_name, 8)
 
+    # If the thread at this index in the buffer is still running then
+    # all of the outbox threads for the account are busy. Rather than
+    # starting another, send the post from this thread
+    outbox_thread = \
+        self.server.outboxThread[account_outbox_thread_name][index]
+    if outbox_thread:
+        if outbox_thread.is_alive():
+            print('Outbox threads busy for ' + account_outbox_thread_name)
+            message_json_copy = message_json.copy()
+            return post_to_outbox(self, message_json_copy,
+                                  self.server.project_version, None,
+                                  curr_session, proxy_type)
+
     print('Creating outbox thread ' +
           account_outbox_thread_name + '/' +
           str(self.server.outbox_thread_index[account_outbox_thread_name]))
@@ -209,6 +224,17 @@ def post_to_outbox_thread(self, message_json: {},
     return True
 
 
+def _refund_inbox_quota(self, message_domain: str,
+                        message_handle: str) -> None:
+    """Refunds the quota taken for a post which was admitted
+    but not then accepted into the inbox queue
+    """
+    inbox_admission_refund(self.server.inbox_admission,
+                           message_domain, message_handle,
+                           self.server.domain_max_posts_per_day,
+                           self.server.account_max_posts_per_day)
+
+
 def update_inbox_queue(self, nickname: str, message_json: {},
                        message_bytes: str, debug: bool) -> int:
     """Update the inbox queue
@@ -429,10 +455,32 @@ def update_inbox_queue(self, nickname: str, message_json: {},
         self.server.postreq_busy = False
         return 3
 
+    # has this activity already been received recently? eg. via
+    # the shared inbox and also a personal inbox, or a sender retry
+    curr_time = time.time()
+    activity_id = message_json.get('id')
+    seen_key = inbox_seen_key(activity_id, message_bytes)
+    if inbox_seen_contains(self.server.inbox_seen, seen_key, curr_time):
+        if debug:
+            print('INBOX: duplicate activity ' + activity_id)
+        self.send_response(202)
+        self.end_headers()
+        self.server.postreq_busy = False
+        return 0
+    # if another copy is being verified then it isn't yet known whether
+    # that copy is genuine, so ask the sender to try again later
+    if inbox_seen_inflight(self.server.inbox_seen, seen_key, curr_time):
+        if debug:
+            print('INBOX: activity in flight ' + activity_id)
+        http_429(self, INBOX_SEEN_RETRY_SECS)
+        self.server.postreq_busy = False
+        return 2
+
     # if the inbox queue is full then return a busy code
     if debug:
         print('INBOX: checking for full queue')
-    if len(self.server.inbox_queue) >= self.server.max_queue_length:
+    if inbox_queue_length(self.server.inbox_queue) >= \
+       self.server.max_queue_length:
         if message_domain:
             print('INBOX: Queue: ' +
                   'Inbox queue is full. Incoming post from ' +
@@ -446,6 +494,25 @@ def update_inbox_queue(self, nickname: str, message_json: {},
         self.server.postreq_busy = False
         return 2
 
+    # apply the per domain and per account quotas before anything
+    # is written to the inbox queue. If the post is then not accepted
+    # the tokens taken are refunded
+    if debug:
+        print('INBOX: checking quotas for ' + actor_url)
+    message_handle = message_nickname + '@' + message_domain
+    retry_after_secs = \
+        inbox_admission_check(self.server.inbox_admission,
+                              message_domain, message_handle,
+                              self.server.domain_max_posts_per_day,
+                              self.server.account_max_posts_per_day,
+                              curr_time)
+    if retry_after_secs > 0:
+        print('INBOX: Quota exceeded for ' + message_handle +
+              ', retry after ' + str(retry_after_secs) + ' seconds')
+        http_429(self, retry_after_secs)
+        self.server.postreq_busy = False
+        return 2
+
     # follower synchronization endpoint information
     if self.headers.get('Collection-Synchronization'):
         if debug:
@@ -496,7 +563,7 @@ def update_inbox_queue(self, nickname: str, message_json: {},
 
     if debug:
         print('INBOX: saving post to queue')
-    queue_filename = \
+    queue_item = \
         save_post_to_inbox_queue(self.server.base_dir,
                                  self.server.http_prefix,
                                  nickname,
@@ -511,19 +578,44 @@ def update_inbox_queue(self, nickname: str, message_json: {},
                                  self.server.system_language,
                                  mitm,
                                  self.server.maxMessageLength)
-    if queue_filename:
-        # add json to the queue
-        if queue_filename not in self.server.inbox_queue:
-            self.server.inbox_queue.append(queue_filename)
+    if queue_item:
+        # so that the activity is remembered once it has been verified
+        queue_item['seenKey'] = seen_key
+        if not inbox_seen_begin(self.server.inbox_seen, seen_key,
+                                begin_save_time):
+            _refund_inbox_quota(self, message_domain, message_handle)
+            http_429(self, INBOX_SEEN_RETRY_SECS)
+            self.server.postreq_busy = False
+            return 2
+        # add json to the queue journal, which wakes up the
+        # inbox queue thread
+        if not inbox_queue_add(self.server.inbox_queue, queue_item,
+                               begin_save_time):
+            inbox_seen_forget(self.server.inbox_seen, seen_key)
+            _refund_inbox_quota(self, message_domain, message_handle)
+            if inbox_queue_contains(self.server.inbox_queue,
+                                    queue_item['filename']):
+                # the same item is already queued
+                self.send_response(202)
+                self.end_headers()
+                self.server.postreq_busy = False
+                return 0
+            # the item could not be written to the journal, so
+            # ask the sender to try again later
+            http_503(self)
+            self.server.postreq_busy = False
+            return 1
         if debug:
             time_diff = int((time.time() - begin_save_time) * 1000)
             if time_diff > 200:
                 print('SLOW: slow save of inbox queue item ' +
-                      queue_filename + ' took ' + str(time_diff) + ' mS')
+                      queue_item['filename'] + ' took ' +
+                      str(time_diff) + ' mS')
         self.send_response(201)
         self.end_headers()
         self.server.postreq_busy = False
         return 0
+    _refund_inbox_quota(self, message_domain, message_handle)
     http_503(self)
     self.server.postreq_busy = False
     return 1
@@ -0,0 +1,672 @@
+__filename__ = "delivery.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "ActivityPub"
+
+# Delivery of outgoing posts to remote inboxes.
+# Rather than a thread being created for every recipient, deliveries
+# are placed into a queue for each destination host and a fixed pool
+# of worker threads takes them in turn from each host. The number of
+# deliveries in progress to any one host, and in total, is limited so
+# that a large fan-out can't overwhelm either this instance or the
+# receiving ones. Deliveries which need to be retried are held until
+# their retry time without occupying a worker, with a jittered
+# exponential backoff, and are abandoned once they reach a maximum age.
+# Each host also has a token bucket which limits the rate at which
+# deliveries are made to it, so that many hosts can be sent to in
+# parallel while each one is still treated politely.
+# The deliveries of a post to many inboxes can be grouped into a fan-out,
+# so that the time taken to reach all recipients can be reported.
+# If the same activity is added again for an inbox to which it was
+# recently queued, eg. because it was sent to followers and also to
+# mentioned accounts which share the same shared inbox, then it is
+# coalesced with the earlier delivery rather than being sent twice.
+# Only identical bodies are coalesced, since an edit or an update of
+# poll votes keeps the id of the original activity.
+# Each delivery can also be stored as a file within a queue directory,
+# updated after every attempt, so that deliveries resume after
+# a restart. The body of a post sent to many inboxes is stored only
+# once, within the bodies subdirectory, and is removed when none of
+# its deliveries remain.
+
+import os
+import json
+import hashlib
+import heapq
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+from threads import thread_with_trace
+from threads import begin_thread
+
+# seconds before the first retry of a delivery
+DELIVERY_BACKOFF_SECS = 30
+
+# maximum seconds between attempts to make a delivery
+DELIVERY_MAX_BACKOFF_SECS = 6 * 60 * 60
+
+# deliveries older than this are abandoned
+DELIVERY_MAX_AGE_SECS = 3 * 24 * 60 * 60
+
+# minimum average seconds between deliveries to the same host
+DELIVERY_HOST_INTERVAL_SECS = 0.5
+
+# number of deliveries which can be made to a host in quick succession
+DELIVERY_HOST_BURST = 4
+
+# maximum number of hosts for which rate limits are held
+DELIVERY_MAX_BUCKETS = 4096
+
+# maximum number of fan-outs which are in progress
+DELIVERY_MAX_FANOUTS = 1024
+
+# seconds during which the same activity is only sent once to an inbox
+DELIVERY_COALESCE_SECS = 10 * 60
+
+# maximum number of recent deliveries remembered for coalescing
+DELIVERY_MAX_COALESCE = 100000
+
+
+def new_delivery_engine(max_workers: int, max_per_host: int,
+                        max_in_flight: int, max_queued: int,
+                        backoff_secs: int, max_backoff_secs: int,
+                        max_age_secs: int, host_interval_secs: float,
+                        host_burst: int, coalesce_secs: int) -> {}:
+    """Returns a new delivery engine with the given number of worker
+    threads, maximum deliveries in progress to each host and in total,
+    maximum number of queued deliveries, initial and maximum time
+    between attempts, maximum age of a delivery, the rate limit
+    for each host and the time during which the same activity is only
+    delivered once to an inbox. If host_interval_secs is zero then
+    deliveries to a host are not rate limited
+    """
+    return {
+        "hosts": {},
+        "buckets": {},
+        "fanouts": {},
+        "recent": {},
+        "bodies": {},
+        "bodiesLock": threading.Lock(),
+        "delayed": [],
+        "inFlight": {},
+        "totalInFlight": 0,
+        "queued": 0,
+        "sequence": 0,
+        "maxWorkers": max_workers,
+        "maxPerHost": max_per_host,
+        "maxInFlight": max_in_flight,
+        "maxQueued": max_queued,
+        "backoffSecs": backoff_secs,
+        "maxBackoffSecs": max_backoff_secs,
+        "maxAgeSecs": max_age_secs,
+        "hostIntervalSecs": host_interval_secs,
+        "hostBurst": host_burst,
+        "coalesceSecs": coalesce_secs,
+        "workers": [],
+        "completed": 0,
+        "dropped": 0,
+        "latencyTotal": 0.0,
+        "latencyCount": 0,
+        "rateLimited": 0,
+        "coalesced": 0,
+        "fanoutTotal": 0.0,
+        "fanoutCount": 0,
+        "fanoutLast": 0.0,
+        "condition": threading.Condition()
+    }
+
+
+def _delivery_host(inbox_url: str) -> str:
+    """Returns the host to which the given inbox url belongs
+    """
+    try:
+        host = urlparse(inbox_url).netloc
+    except ValueError:
+        host = None
+    if not host:
+        return inbox_url
+    return host
+
+
+def _delivery_start_workers(engine: {}) -> None:
+    """Starts worker threads until the pool is full, replacing any
+    which have stopped
+    """
+    engine['workers'] = \
+        [thr for thr in engine['workers'] if thr.is_alive()]
+    while len(engine['workers']) < engine['maxWorkers']:
+        worker_index = len(engine['workers'])
+        thr = thread_with_trace(target=_run_delivery_worker,
+                                args=(engine, worker_index), daemon=True)
+        if not begin_thread(thr, '_delivery_start_workers'):
+            break
+        engine['workers'].append(thr)
+
+
+def _delivery_body_filename(queue_dir: str, body_digest: str) -> str:
+    """Returns the filename used to store a body with the given digest
+    """
+    body_hash = hashlib.sha256(body_digest.encode('utf-8')).hexdigest()
+    return queue_dir + '/bodies/' + body_hash + '.body'
+
+
+def _delivery_save_body(engine: {}, job: {}) -> bool:
+    """Stores the body of a delivery, unless it has already been stored
+    for another delivery of the same post.
+    Returns True if the body is stored
+    """
+    if job.get('bodyFilename'):
+        return True
+    record = job['record']
+    filename = _delivery_body_filename(job['queueDir'], record['bodyDigest'])
+    with engine['bodiesLock']:
+        if filename not in engine['bodies']:
+            if not os.path.isfile(filename):
+                try:
+                    os.makedirs(job['queueDir'] + '/bodies', exist_ok=True)
+                    with open(filename + '.new', 'w+',
+                              encoding='utf-8') as fp_body:
+                        fp_body.write(record['body'])
+                    os.replace(filename + '.new', filename)
+                except OSError:
+                    print('EX: _delivery_save_body unable to save ' +
+                          filename)
+                    return False
+            engine['bodies'][filename] = 0
+        engine['bodies'][filename] += 1
+    job['bodyFilename'] = filename
+    return True
+
+
+def _delivery_remove_body(engine: {}, job: {}) -> None:
+    """Removes the stored body of a delivery if no other deliveries
+    are using it
+    """
+    filename = job.get('bodyFilename')
+    if not filename:
+        return
+    job['bodyFilename'] = None
+    with engine['bodiesLock']:
+        engine['bodies'][filename] -= 1
+        if engine['bodies'][filename] > 0:
+            return
+        del engine['bodies'][filename]
+        try:
+            os.remove(filename)
+        except OSError:
+            print('EX: _delivery_remove_body unable to delete ' + filename)
+
+
+def _delivery_save(engine: {}, job: {}) -> None:
+    """Saves a delivery to its queue directory, if it has one.
+    If the delivery has a body together with its digest then the body
+    is stored separately, so that it is only written once for all of
+    the deliveries of a post
+    """
+    if not job['queueDir']:
+        return
+    record = job['record']
+    if isinstance(record.get('body'), str) and record.get('bodyDigest'):
+        if _delivery_save_body(engine, job):
+            record = record.copy()
+            del record['body']
+    filename = job['queueDir'] + '/' + record['id'] + '.json'
+    try:
+        with open(filename + '.new', 'w+', encoding='utf-8') as fp_record:
+            fp_record.write(json.dumps(record))
+        os.replace(filename + '.new', filename)
+    except OSError:
+        print('EX: _delivery_save unable to save ' + filename)
+
+
+def _delivery_remove(engine: {}, job: {}) -> None:
+    """Removes a completed delivery from its queue directory
+    """
+    if not job['queueDir']:
+        return
+    _delivery_remove_body(engine, job)
+    filename = job['queueDir'] + '/' + job['record']['id'] + '.json'
+    if not os.path.isfile(filename):
+        return
+    try:
+        os.remove(filename)
+    except OSError:
+        print('EX: _delivery_remove unable to delete ' + filename)
+
+
+def delivery_load(queue_dir: str) -> []:
+    """Returns the deliveries stored within the given queue directory,
+    oldest first, together with their bodies. Any stored bodies which
+    no longer belong to a delivery are removed
+    """
+    records = []
+    if not os.path.isdir(queue_dir):
+        return records
+    bodies = {}
+    for filename in os.listdir(queue_dir):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(queue_dir + '/' + filename, 'r',
+                      encoding='utf-8') as fp_record:
+                record = json.loads(fp_record.read())
+        except (OSError, ValueError):
+            print('EX: delivery_load unable to load ' + filename)
+            continue
+        if not isinstance(record, dict) or \
+           not record.get('id') or not record.get('inboxUrl'):
+            continue
+        if 'body' not in record and record.get('bodyDigest'):
+            body_filename = \
+                _delivery_body_filename(queue_dir, record['bodyDigest'])
+            if body_filename not in bodies:
+                bodies[body_filename] = None
+                try:
+                    with open(body_filename, 'r',
+                              encoding='utf-8') as fp_body:
+                        bodies[body_filename] = fp_body.read()
+                except OSError:
+                    print('EX: delivery_load unable to load ' +
+                          body_filename)
+            if bodies[body_filename] is None:
+                # the delivery can't be made without its body
+                try:
+                    os.remove(queue_dir + '/' + filename)
+                except OSError:
+                    print('EX: delivery_load unable to delete ' + filename)
+                continue
+            record['body'] = bodies[body_filename]
+        records.append(record)
+    records.sort(key=lambda record: record.get('queued', 0))
+
+    # remove bodies which are not used by any delivery
+    bodies_dir = queue_dir + '/bodies'
+    if os.path.isdir(bodies_dir):
+        for filename in os.listdir(bodies_dir):
+            body_filename = bodies_dir + '/' + filename
+            if body_filename in bodies:
+                continue
+            try:
+                os.remove(body_filename)
+            except OSError:
+                print('EX: delivery_load unable to delete ' + body_filename)
+    return records
+
+
+def delivery_add(engine: {}, inbox_url: str, function, args: (),
+                 record: {}, queue_dir: str) -> bool:
+    """Adds a delivery to the queue for the host of the given inbox.
+    The function is called with the given arguments followed by the
+    number of previous attempts, and returns True if the delivery
+    should be tried again later.
+    record contains any details needed to resume the delivery after
+    a restart, and is saved within queue_dir if that is not None.
+    If the record has a coalesce field, typically containing the
+    activity id, then a delivery with the same value and the same
+    bodyDigest which was recently added for the same inbox is not
+    made again.
+    Returns False if the queue is full or the delivery is too old
+    """
+    curr_time = time.time()
+    if not record.get('id'):
+        record['id'] = secrets.token_hex(16)
+    if not record.get('queued'):
+        record['queued'] = curr_time
+    if not record.get('attempts'):
+        record['attempts'] = []
+    record['inboxUrl'] = inbox_url
+    job = {
+        "host": _delivery_host(inbox_url),
+        "inboxUrl": inbox_url,
+        "function": function,
+        "args": args,
+        "record": record,
+        "queueDir": queue_dir
+    }
+    if curr_time - record['queued'] > engine['maxAgeSecs']:
+        print('WARN: delivery_add abandoning old delivery to ' + inbox_url)
+        _delivery_remove(engine, job)
+        return False
+    with engine['condition']:
+        if _delivery_coalesce(engine, record, curr_time):
+            return True
+        if engine['queued'] >= engine['maxQueued']:
+            engine['dropped'] += 1
+            print('WARN: delivery_add queue is full, not sending to ' +
+                  inbox_url)
+            return False
+        engine['queued'] += 1
+        fanout = engine['fanouts'].get(record.get('fanout'))
+        if fanout:
+            fanout['pending'] += 1
+            fanout['deliveries'] += 1
+    if queue_dir:
+        if not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir, exist_ok=True)
+        _delivery_save(engine, job)
+    with engine['condition']:
+        next_attempt = record.get('nextAttempt', 0)
+        if next_attempt > curr_time:
+            # resuming a delivery which is waiting to be retried
+            engine['sequence'] += 1
+            heapq.heappush(engine['delayed'],
+                           (next_attempt, engine['sequence'], job))
+        else:
+            host = job['host']
+            if not engine['hosts'].get(host):
+                engine['hosts'][host] = deque()
+            engine['hosts'][host].append(job)
+        _delivery_start_workers(engine)
+        engine['condition'].notify()
+    return True
+
+
+def _delivery_coalesce(engine: {}, record: {}, curr_time: float) -> bool:
+    """Returns True if the same activity with the same body was
+    recently added for the same inbox, otherwise remembers it.
+    This should be called with the lock held
+    """
+    if not record.get('coalesce') or engine['coalesceSecs'] <= 0:
+        return False
+    recent = engine['recent']
+    # forget deliveries which were added before the time window
+    while recent:
+        oldest_key = next(iter(recent))
+        if curr_time - recent[oldest_key] < engine['coalesceSecs'] and \
+           len(recent) < DELIVERY_MAX_COALESCE:
+            break
+        del recent[oldest_key]
+    coalesce_key = record['coalesce'] + ' ' + \
+        record.get('bodyDigest', '') + ' ' + record['inboxUrl']
+    if coalesce_key in recent:
+        engine['coalesced'] += 1
+        return True
+    recent[coalesce_key] = curr_time
+    return False
+
+
+def delivery_rejected(http_code: int) -> bool:
+    """Returns True if the given http code means that the receiving
+    instance won't accept the delivery, eg. because the inbox is gone,
+    so that trying again later would make no difference
+    """
+    if not isinstance(http_code, int):
+        return False
+    if http_code < 400 or http_code >= 500:
+        return False
+    # timeouts and rate limits are temporary
+    return http_code not in (408, 425, 429)
+
+
+def delivery_backoff_secs(engine: {}, attempts: int) -> float:
+    """Returns the number of seconds to wait before trying a delivery
+    again after the given number of attempts. This doubles after
+    each attempt, and is jittered so that retries to a host which
+    was unavailable don't all arrive at the same time
+    """
+    backoff_secs = engine['backoffSecs'] * (2 ** min(attempts - 1, 30))
+    backoff_secs = min(backoff_secs, engine['maxBackoffSecs'])
+    return backoff_secs * random.uniform(0.5, 1.0)
+
+
+def _delivery_rate_wait(engine: {}, host: str, curr_time: float) -> float:
+    """Returns the number of seconds until a delivery can be made to
+    the given host, or zero if one can be made now, in which case a token
+    is taken from the host's bucket. This should be called with the
+    lock held
+    """
+    interval_secs = engine['hostIntervalSecs']
+    if interval_secs <= 0:
+        return 0
+    buckets = engine['buckets']
+    bucket = buckets.get(host)
+    if not bucket:
+        if len(buckets) >= DELIVERY_MAX_BUCKETS:
+            # forget hosts whose buckets have refilled
+            full_secs = interval_secs * engine['hostBurst']
+            for bucket_host in list(buckets.keys()):
+                if curr_time - buckets[bucket_host]['updated'] >= full_secs:
+                    del buckets[bucket_host]
+            while len(buckets) >= DELIVERY_MAX_BUCKETS:
+                del buckets[next(iter(buckets))]
+        bucket = {
+            "tokens": engine['hostBurst'],
+            "updated": curr_time
+        }
+        buckets[host] = bucket
+    else:
+        elapsed_secs = curr_time - bucket['updated']
+        if elapsed_secs > 0:
+            bucket['tokens'] = min(engine['hostBurst'],
+                                   bucket['tokens'] +
+                                   elapsed_secs / interval_secs)
+            bucket['updated'] = curr_time
+    if bucket['tokens'] < 1:
+        return (1 - bucket['tokens']) * interval_secs
+    bucket['tokens'] -= 1
+    return 0
+
+
+def delivery_fanout_begin(engine: {}, description: str) -> str:
+    """Begins a fan-out, which groups the deliveries of a post to
+    many inboxes so that the time taken to reach all of them can be
+    reported. Deliveries belong to the fan-out if their record has a
+    fanout field containing the returned id
+    """
+    fanout_id = secrets.token_hex(8)
+    with engine['condition']:
+        fanouts = engine['fanouts']
+        while len(fanouts) >= DELIVERY_MAX_FANOUTS:
+            del fanouts[next(iter(fanouts))]
+        fanouts[fanout_id] = {
+            "description": description,
+            "started": time.time(),
+            "pending": 0,
+            "deliveries": 0,
+            "open": True
+        }
+    return fanout_id
+
+
+def _delivery_fanout_check(engine: {}, fanout_id: str,
+                           curr_time: float) -> None:
+    """Reports the time taken by a fan-out once no more deliveries
+    are being added to it and all of them have been completed or
+    abandoned. This should be called with the lock held
+    """
+    fanout = engine['fanouts'].get(fanout_id)
+    if not fanout:
+        return
+    if fanout['open'] or fanout['pending'] > 0:
+        return
+    del engine['fanouts'][fanout_id]
+    fanout_secs = curr_time - fanout['started']
+    engine['fanoutTotal'] += fanout_secs
+    engine['fanoutCount'] += 1
+    engine['fanoutLast'] = fanout_secs
+    print('Fan-out of ' + fanout['description'] + ' to ' +
+          str(fanout['deliveries']) + ' inboxes took ' +
+          str(int(fanout_secs)) + ' secs')
+
+
+def delivery_fanout_end(engine: {}, fanout_id: str) -> None:
+    """Called when all of the deliveries of a fan-out have been added
+    """
+    if not fanout_id:
+        return
+    with engine['condition']:
+        fanout = engine['fanouts'].get(fanout_id)
+        if not fanout:
+            return
+        fanout['open'] = False
+        _delivery_fanout_check(engine, fanout_id, time.time())
+
+
+def _delivery_release_delayed(engine: {}, curr_time: float) -> float:
+    """Moves delayed deliveries whose retry time has arrived back onto
+    their host queues. This should be called with the lock held.
+    Returns the number of seconds until the next delayed delivery
+    """
+    delayed = engine['delayed']
+    while delayed:
+        retry_time, _, job = delayed[0]
+        if retry_time > curr_time:
+            return retry_time - curr_time
+        heapq.heappop(delayed)
+        host = job['host']
+        if not engine['hosts'].get(host):
+            engine['hosts'][host] = deque()
+        engine['hosts'][host].append(job)
+    return None
+
+
+def _delivery_take(engine: {}, timeout_secs: float) -> {}:
+    """Returns the next delivery from a host which is below its limit,
+    taking hosts in turn, or None if there is nothing to deliver
+    within the timeout
+    """
+    end_time = time.time() + timeout_secs
+    with engine['condition']:
+        while True:
+            curr_time = time.time()
+            wait_secs = _delivery_release_delayed(engine, curr_time)
+            if engine['totalInFlight'] < engine['maxInFlight']:
+                for host in list(engine['hosts'].keys()):
+                    jobs = engine['hosts'][host]
+                    if engine['inFlight'].get(host, 0) >= \
+                       engine['maxPerHost']:
+                        continue
+                    rate_wait_secs = \
+                        _delivery_rate_wait(engine, host, curr_time)
+                    if rate_wait_secs > 0:
+                        engine['rateLimited'] += 1
+                        if wait_secs is None or rate_wait_secs < wait_secs:
+                            wait_secs = rate_wait_secs
+                        continue
+                    job = jobs.popleft()
+                    # move the host to the back of the turn order
+                    del engine['hosts'][host]
+                    if jobs:
+                        engine['hosts'][host] = jobs
+                    engine['inFlight'][host] = \
+                        engine['inFlight'].get(host, 0) + 1
+                    engine['totalInFlight'] += 1
+                    return job
+            remaining_secs = end_time - curr_time
+            if remaining_secs <= 0:
+                return None
+            if wait_secs is not None:
+                remaining_secs = min(remaining_secs, wait_secs)
+            engine['condition'].wait(remaining_secs)
+
+
+def _delivery_done(engine: {}, job: {}, retry: bool) -> None:
+    """Called when a delivery attempt has completed, and schedules
+    a retry if needed
+    """
+    curr_time = time.time()
+    record = job['record']
+    record['attempts'].append(curr_time)
+    retry_time = None
+    if retry:
+        retry_time = \
+            curr_time + delivery_backoff_secs(engine, len(record['attempts']))
+        if retry_time - record['queued'] > engine['maxAgeSecs']:
+            print('WARN: _delivery_done abandoning delivery to ' +
+                  job['inboxUrl'] + ' after ' +
+                  str(len(record['attempts'])) + ' attempts')
+            retry_time = None
+    if retry_time:
+        record['nextAttempt'] = retry_time
+        _delivery_save(engine, job)
+    else:
+        _delivery_remove(engine, job)
+    with engine['condition']:
+        host = job['host']
+        engine['inFlight'][host] -= 1
+        if engine['inFlight'][host] <= 0:
+            del engine['inFlight'][host]
+        engine['totalInFlight'] -= 1
+        if retry_time:
+            engine['sequence'] += 1
+            heapq.heappush(engine['delayed'],
+                           (retry_time, engine['sequence'], job))
+        else:
+            engine['queued'] -= 1
+            engine['completed'] += 1
+            engine['latencyTotal'] += curr_time - record['queued']
+            engine['latencyCount'] += 1
+            fanout_id = record.get('fanout')
+            fanout = engine['fanouts'].get(fanout_id)
+            if fanout:
+                fanout['pending'] -= 1
+                _delivery_fanout_check(engine, fanout_id, curr_time)
+        engine['condition'].notify_all()
+
+
+def _run_delivery_worker(engine: {}, worker_index: int) -> None:
+    """Worker thread which makes deliveries
+    """
+    while True:
+        job = _delivery_take(engine, 60)
+        if not job:
+            continue
+        retry = False
+        try:
+            tries = len(job['record']['attempts'])
+            args = job['args'] + (tries,)
+            retry = job['function'](*args)
+        except BaseException as ex:
+            print('EX: _run_delivery_worker ' + str(worker_index) +
+                  ' delivery to ' + job['inboxUrl'] + ' failed ' + str(ex))
+        _delivery_done(engine, job, retry)
+
+
+def delivery_metrics(engine: {}) -> {}:
+    """Returns the number of queued deliveries, the number in progress,
+    the greatest queue depth for any host, the mean time taken from
+    queueing until a delivery is completed or abandoned and the time
+    taken by fan-outs
+    """
+    with engine['condition']:
+        max_host_depth = 0
+        for jobs in engine['hosts'].values():
+            max_host_depth = max(max_host_depth, len(jobs))
+        mean_latency = 0
+        if engine['latencyCount'] > 0:
+            mean_latency = engine['latencyTotal'] / engine['latencyCount']
+        mean_fanout = 0
+        if engine['fanoutCount'] > 0:
+            mean_fanout = engine['fanoutTotal'] / engine['fanoutCount']
+        return {
+            "queued": engine['queued'],
+            "delayed": len(engine['delayed']),
+            "hosts": len(engine['hosts']),
+            "maxHostDepth": max_host_depth,
+            "inFlight": engine['totalInFlight'],
+            "workers": len(engine['workers']),
+            "completed": engine['completed'],
+            "dropped": engine['dropped'],
+            "meanLatencySecs": mean_latency,
+            "rateLimited": engine['rateLimited'],
+            "coalesced": engine['coalesced'],
+            "fanouts": len(engine['fanouts']),
+            "fanoutsCompleted": engine['fanoutCount'],
+            "meanFanoutSecs": mean_fanout,
+            "lastFanoutSecs": engine['fanoutLast']
+        }
+
+
+# Deliveries made by this instance
+DELIVERY_ENGINE = \
+    new_delivery_engine(16, 2, 16, 100000,
+                        DELIVERY_BACKOFF_SECS, DELIVERY_MAX_BACKOFF_SECS,
+                        DELIVERY_MAX_AGE_SECS, DELIVERY_HOST_INTERVAL_SECS,
+                        DELIVERY_HOST_BURST, DELIVERY_COALESCE_SECS)
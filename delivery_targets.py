@@ -0,0 +1,267 @@
+__filename__ = "delivery_targets.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "ActivityPub"
+
+# Resolved delivery targets for the recipients of outgoing posts.
+# Finding the inbox of a follower needs a webfinger lookup followed
+# by fetching their actor, and finding whether a domain has a shared
+# inbox needs another webfinger lookup. Rather than doing these for
+# every recipient of every post, the results are held in a table of
+# handle -> inbox and domain -> shared inbox, which is saved so that
+# it survives a restart. Entries are updated when an actor update is
+# received, forgotten when an actor moves or is deleted, and expire
+# after a while so that they are eventually looked up again.
+
+import os
+import json
+import threading
+import time
+from utils import data_dir
+
+# seconds after which a delivery target is looked up again
+DELIVERY_TARGETS_MAX_AGE_SECS = 7 * 24 * 60 * 60
+
+# maximum number of handles and domains held
+DELIVERY_TARGETS_MAX_ENTRIES = 100000
+
+# delivery targets for each instance directory
+DELIVERY_TARGETS = {}
+DELIVERY_TARGETS_LOCK = threading.Lock()
+
+
+def _delivery_targets_filename(base_dir: str) -> str:
+    """Returns the filename where delivery targets are saved
+    """
+    return data_dir(base_dir) + '/deliveryTargets.json'
+
+
+def _delivery_targets_get(base_dir: str) -> {}:
+    """Returns the delivery targets for the given instance,
+    loading them from file the first time
+    """
+    with DELIVERY_TARGETS_LOCK:
+        targets = DELIVERY_TARGETS.get(base_dir)
+        if targets:
+            return targets
+        targets = {
+            "handles": {},
+            "actors": {},
+            "domains": {},
+            "changed": False,
+            "hits": 0,
+            "misses": 0,
+            "lock": threading.Lock()
+        }
+        filename = _delivery_targets_filename(base_dir)
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as fp_targets:
+                    saved = json.loads(fp_targets.read())
+                targets['handles'] = saved.get('handles', {})
+                targets['domains'] = saved.get('domains', {})
+            except (OSError, ValueError, AttributeError):
+                print('EX: _delivery_targets_get unable to load ' + filename)
+        for handle, target in targets['handles'].items():
+            if target.get('actor'):
+                targets['actors'][target['actor']] = handle
+        DELIVERY_TARGETS[base_dir] = targets
+        return targets
+
+
+def _delivery_targets_expired(entry: {}, curr_time: float) -> bool:
+    """Returns True if the given entry should be looked up again
+    """
+    return curr_time - entry.get('updated', 0) > \
+        DELIVERY_TARGETS_MAX_AGE_SECS
+
+
+def delivery_targets_inbox(base_dir: str, handle: str) -> {}:
+    """Returns the inbox, shared inbox and actor for the given handle
+    as a dict, or None if they are not known
+    """
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        target = targets['handles'].get(handle)
+        if target:
+            if not _delivery_targets_expired(target, time.time()):
+                targets['hits'] += 1
+                return target
+        targets['misses'] += 1
+    return None
+
+
+def delivery_targets_set_inbox(base_dir: str, handle: str,
+                               inbox_url: str, shared_inbox_url: str,
+                               actor: str, domain: str) -> None:
+    """Stores the inbox, shared inbox and actor for the given handle.
+    If there is a shared inbox then it is also stored for the domain
+    """
+    curr_time = time.time()
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        handles = targets['handles']
+        previous = handles.pop(handle, None)
+        if previous and previous.get('actor'):
+            targets['actors'].pop(previous['actor'], None)
+        while len(handles) >= DELIVERY_TARGETS_MAX_ENTRIES:
+            oldest_handle = next(iter(handles))
+            oldest = handles.pop(oldest_handle)
+            if oldest.get('actor'):
+                targets['actors'].pop(oldest['actor'], None)
+        handles[handle] = {
+            "inbox": inbox_url,
+            "sharedInbox": shared_inbox_url,
+            "actor": actor,
+            "updated": curr_time
+        }
+        if actor:
+            targets['actors'][actor] = handle
+        if shared_inbox_url and domain:
+            _delivery_targets_set_domain(targets, domain,
+                                         shared_inbox_url, curr_time)
+        targets['changed'] = True
+
+
+def _delivery_targets_set_domain(targets: {}, domain: str,
+                                 shared_inbox_url: str,
+                                 curr_time: float) -> None:
+    """Stores the shared inbox for a domain, which is an empty string
+    if it doesn't have one. This should be called with the lock held
+    """
+    domains = targets['domains']
+    domains.pop(domain, None)
+    while len(domains) >= DELIVERY_TARGETS_MAX_ENTRIES:
+        del domains[next(iter(domains))]
+    domains[domain] = {
+        "sharedInbox": shared_inbox_url,
+        "updated": curr_time
+    }
+
+
+def delivery_targets_shared_inbox(base_dir: str, domain: str) -> str:
+    """Returns the shared inbox for the given domain, an empty string
+    if it is known not to have one, or None if this is not known
+    """
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        entry = targets['domains'].get(domain)
+        if entry:
+            if not _delivery_targets_expired(entry, time.time()):
+                targets['hits'] += 1
+                return entry['sharedInbox']
+        targets['misses'] += 1
+    return None
+
+
+def delivery_targets_set_shared_inbox(base_dir: str, domain: str,
+                                      shared_inbox_url: str) -> None:
+    """Stores the shared inbox for the given domain, or an empty
+    string if it doesn't have one
+    """
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        _delivery_targets_set_domain(targets, domain,
+                                     shared_inbox_url, time.time())
+        targets['changed'] = True
+
+
+def delivery_targets_update_actor(base_dir: str, actor_json: {}) -> None:
+    """Updates the inbox for an actor when an update to it is received.
+    If the actor has moved then it is forgotten
+    """
+    actor = actor_json.get('id')
+    if not actor or not isinstance(actor, str):
+        return
+    if actor_json.get('movedTo'):
+        delivery_targets_forget_actor(base_dir, actor)
+        return
+    inbox_url = actor_json.get('inbox')
+    if not inbox_url or not isinstance(inbox_url, str):
+        return
+    shared_inbox_url = None
+    if isinstance(actor_json.get('endpoints'), dict):
+        shared_inbox_url = actor_json['endpoints'].get('sharedInbox')
+        if not isinstance(shared_inbox_url, str):
+            shared_inbox_url = None
+    if inbox_url.endswith('/actor/inbox') or \
+       inbox_url.endswith('/instance.actor/inbox'):
+        if not shared_inbox_url:
+            return
+        inbox_url = shared_inbox_url
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        handle = targets['actors'].get(actor)
+        if not handle:
+            return
+        target = targets['handles'].pop(handle, None)
+        if not target:
+            return
+        target['inbox'] = inbox_url
+        if shared_inbox_url:
+            target['sharedInbox'] = shared_inbox_url
+        target['updated'] = time.time()
+        targets['handles'][handle] = target
+        targets['changed'] = True
+
+
+def delivery_targets_forget_actor(base_dir: str, actor: str) -> None:
+    """Forgets the delivery target for an actor which has moved
+    or been deleted
+    """
+    if not actor:
+        return
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        handle = targets['actors'].pop(actor, None)
+        if not handle:
+            return
+        targets['handles'].pop(handle, None)
+        targets['changed'] = True
+
+
+def delivery_targets_save(base_dir: str) -> None:
+    """Saves the delivery targets if they have changed
+    """
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        if not targets['changed']:
+            return
+        saved_str = json.dumps({
+            "handles": targets['handles'],
+            "domains": targets['domains']
+        })
+        targets['changed'] = False
+    filename = _delivery_targets_filename(base_dir)
+    try:
+        with open(filename + '.new', 'w+', encoding='utf-8') as fp_targets:
+            fp_targets.write(saved_str)
+        os.replace(filename + '.new', filename)
+    except OSError:
+        print('EX: delivery_targets_save unable to save ' + filename)
+
+
+def delivery_targets_metrics(base_dir: str) -> {}:
+    """Returns the number of delivery targets and the percentage
+    of lookups which were found
+    """
+    targets = _delivery_targets_get(base_dir)
+    with targets['lock']:
+        hits = targets['hits']
+        misses = targets['misses']
+        handles = len(targets['handles'])
+        domains = len(targets['domains'])
+    hit_rate = 0
+    if hits + misses > 0:
+        hit_rate = hits * 100 / (hits + misses)
+    return {
+        "handles": handles,
+        "domains": domains,
+        "hits": hits,
+        "misses": misses,
+        "hitRate": hit_rate
+    }
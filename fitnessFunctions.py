@@ -14,6 +14,14 @@ from webapp_utils import html_footer
 from utils import data_dir
 from utils import get_config_param
 from utils import save_json
+from utils import config_metrics
+from delivery import DELIVERY_ENGINE
+from delivery import delivery_metrics
+from delivery_targets import delivery_targets_metrics
+from session import session_pool_metrics
+from cache import person_cache_metrics
+from cache import webfinger_cache_metrics
+from scheduler import scheduler_metrics
 
 
 def fitness_performance(start_time, fitness_state: {},
@@ -50,6 +58,18 @@ def fitness_performance(start_time, fitness_state: {},
               watch_point + '/' + str(total * 1000 / ctr))
 
 
+def fitness_queue_metrics(fitness_state: {}, fitness_id: str,
+                          metrics: {}) -> None:
+    """Stores the current metrics for a queue, such as the depth
+    of each lane and how long items have been waiting
+    """
+    if fitness_state is None:
+        return
+    if 'queues' not in fitness_state:
+        fitness_state['queues'] = {}
+    fitness_state['queues'][fitness_id] = metrics
+
+
 def sorted_watch_points(fitness: {}, fitness_id: str) -> []:
     """Returns a sorted list of watchpoints
     times are in mS
@@ -125,11 +145,35 @@ def html_watch_points_graph(base_dir: str, fitness: {}, fitness_id: str,
     return html_str
 
 
-def fitness_thread(base_dir: str, fitness: {}) -> None:
-    """Thread used to save fitness function scores
+def save_fitness(base_dir: str, fitness: {}) -> None:
+    """Saves fitness function scores. This is run periodically
+    by the scheduler
     """
     fitness_filename = data_dir(base_dir) + '/fitness.json'
-    while True:
-        # every 10 mins
-        time.sleep(60 * 10)
-        save_json(fitness, fitness_filename)
+    save_json(fitness, fitness_filename)
+
+
+def collect_fitness_metrics(base_dir: str, fitness: {}, person_cache: {},
+                            cached_webfingers: {}, scheduler: {}) -> None:
+    """Stores the current metrics for outgoing deliveries, connection
+    pools, caches, the configuration and periodic jobs. This is run
+    periodically by the scheduler
+    """
+    # depth and latency of outgoing deliveries
+    fitness_queue_metrics(fitness, 'DELIVERY',
+                          delivery_metrics(DELIVERY_ENGINE))
+    # how often the inboxes of recipients were already known
+    fitness_queue_metrics(fitness, 'DELIVERY_TARGETS',
+                          delivery_targets_metrics(base_dir))
+    # how often connections are reused
+    fitness_queue_metrics(fitness, 'SESSION_POOLS', session_pool_metrics())
+    # number and size of actors held in memory
+    fitness_queue_metrics(fitness, 'PERSON_CACHE',
+                          person_cache_metrics(person_cache))
+    # webfinger results held in memory, including failures
+    fitness_queue_metrics(fitness, 'WEBFINGER_CACHE',
+                          webfinger_cache_metrics(cached_webfingers))
+    # how often config.json has been reloaded after changing
+    fitness_queue_metrics(fitness, 'CONFIG', config_metrics(base_dir))
+    # run time and lateness of periodic jobs
+    fitness_queue_metrics(fitness, 'SCHEDULER', scheduler_metrics(scheduler))
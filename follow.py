@@ -23,6 +23,8 @@ from utils import get_domain_from_actor
 from utils import get_nickname_from_actor
 from utils import get_status_number
 from utils import follow_person
+from utils import get_follows_index
+from utils import update_follows_index
 from posts import send_signed_json
 from posts import get_person_box
 from utils import load_json
@@ -186,15 +188,15 @@ def is_following_actor(base_dir: str,
     The actor can also be a handle: nickname@domain
     """
     domain = remove_domain_port(domain)
-    accounts_dir = acct_dir(base_dir, nickname, domain)
-    if not os.path.isdir(accounts_dir):
-        return False
-    following_file = accounts_dir + '/following.txt'
-    if not os.path.isfile(following_file):
+    following_file = acct_dir(base_dir, nickname, domain) + '/following.txt'
+    following_index = get_follows_index(following_file)
+    if not following_index['exists']:
         return False
     if actor.startswith('@'):
         actor = actor[1:]
-    if text_in_file(actor, following_file, False):
+    actor = actor.lower()
+    if actor in following_index['entries'] or \
+       actor in following_index['handles']:
         return True
     following_nickname = get_nickname_from_actor(actor)
     if not following_nickname:
@@ -207,7 +209,7 @@ def is_following_actor(base_dir: str,
     following_handle = \
         get_full_domain(following_nickname + '@' + following_domain,
                         following_port)
-    if text_in_file(following_handle, following_file, False):
+    if following_handle.lower() in following_index['handles']:
         return True
     return False
 
@@ -229,25 +231,7 @@ def get_follower_domains(base_dir: str, nickname: str, domain: str) -> []:
     """
     domain = remove_domain_port(domain)
     followers_file = acct_dir(base_dir, nickname, domain) + '/followers.txt'
-    if not os.path.isfile(followers_file):
-        return []
-
-    lines: list[str] = []
-    try:
-        with open(followers_file, 'r', encoding='utf-8') as fp_foll:
-            lines = fp_foll.readlines()
-    except OSError:
-        print('EX: get_follower_domains ' + followers_file)
-
-    domains_list: list[str] = []
-    for handle in lines:
-        handle = remove_eol(handle)
-        follower_domain, _ = get_domain_from_actor(handle)
-        if not follower_domain:
-            continue
-        if follower_domain not in domains_list:
-            domains_list.append(follower_domain)
-    return domains_list
+    return list(get_follows_index(followers_file)['domains'].keys())
 
 
 def is_follower_of_person(base_dir: str, nickname: str, domain: str,
@@ -263,34 +247,9 @@ def is_follower_of_person(base_dir: str, nickname: str, domain: str,
         return False
     domain = remove_domain_port(domain)
     followers_file = acct_dir(base_dir, nickname, domain) + '/followers.txt'
-    if not os.path.isfile(followers_file):
-        return False
     handle = follower_nickname + '@' + follower_domain
-
-    already_following = False
-
-    followers_str = ''
-    try:
-        with open(followers_file, 'r', encoding='utf-8') as fp_foll:
-            followers_str = fp_foll.read()
-    except OSError:
-        print('EX: is_follower_of_person ' + followers_file)
-
-    if handle in followers_str:
-        already_following = True
-    else:
-        paths = get_user_paths()
-        for user_path in paths:
-            url = '://' + follower_domain + user_path + follower_nickname
-            if url in followers_str:
-                already_following = True
-                break
-        if not already_following:
-            url = '://' + follower_domain + '/' + follower_nickname
-            if url in followers_str:
-                already_following = True
-
-    return already_following
+    # followers stored as actor urls are also indexed by handle
+    return handle.lower() in get_follows_index(followers_file)['handles']
 
 
 def unfollow_account(base_dir: str, nickname: str, domain: str,
@@ -410,30 +369,7 @@ def _get_no_of_follows(base_dir: str, nickname: str, domain: str,
     #     return 9999
     accounts_dir = acct_dir(base_dir, nickname, domain)
     filename = accounts_dir + '/' + follow_file
-    if not os.path.isfile(filename):
-        return 0
-    ctr = 0
-    lines: list[str] = []
-    try:
-        with open(filename, 'r', encoding='utf-8') as fp_foll:
-            lines = fp_foll.readlines()
-    except OSError:
-        print('EX: _get_no_of_follows ' + filename)
-    if lines:
-        for line in lines:
-            if '#' in line:
-                continue
-            if '@' in line and \
-               '.' in line and \
-               not line.startswith('http'):
-                ctr += 1
-            elif ((line.startswith('http') or
-                   line.startswith('ipfs') or
-                   line.startswith('ipns') or
-                   line.startswith('hyper')) and
-                  has_users_path(line)):
-                ctr += 1
-    return ctr
+    return get_follows_index(filename)['count']
 
 
 def get_no_of_followers(base_dir: str, nickname: str, domain: str) -> int:
@@ -821,7 +757,7 @@ def followed_account_accepts(session, base_dir: str, http_prefix: str,
                             group_account, signing_priv_key_pem,
                             7856837, curr_domain, onion_domain, i2p_domain,
                             extra_headers, sites_unavailable,
-                            system_language, mitm_servers)
+                            system_language, mitm_servers, None)
 
 
 def followed_account_rejects(session, session_onion, session_i2p,
@@ -908,7 +844,7 @@ def followed_account_rejects(session, session_onion, session_i2p,
                             6393063,
                             domain, onion_domain, i2p_domain,
                             extra_headers, sites_unavailable,
-                            system_language, mitm_servers)
+                            system_language, mitm_servers, None)
 
 
 def send_follow_request(session, base_dir: str,
@@ -1015,7 +951,7 @@ def send_follow_request(session, base_dir: str,
                      signing_priv_key_pem, 8234389,
                      curr_domain, onion_domain, i2p_domain,
                      extra_headers, sites_unavailable,
-                     system_language, mitm_servers)
+                     system_language, mitm_servers, None)
 
     return new_follow_json
 
@@ -1586,6 +1522,8 @@ def remove_follower(base_dir: str,
     except OSError:
         print('EX: remove_follower unable to write followers ' +
               followers_filename)
+        return True
+    update_follows_index(followers_filename, new_followers_str)
     return True
 
 
@@ -27,8 +27,10 @@ def write2(self, msg) -> bool:
     return False
 
 
-def _http_return_code(self, http_code: int, http_description: str,
-                      long_description: str, etag: str) -> None:
+def _http_return_code_html(http_code: int, http_description: str,
+                           long_description: str) -> bytes:
+    """Returns the html page shown for a http return code
+    """
     msg = \
         '<html><head><title>' + str(http_code) + '</title></head>' + \
         '<body bgcolor="linen" text="black">' + \
@@ -40,7 +42,13 @@ def _http_return_code(self, http_code: int, http_description: str,
         '</p></div>' + \
         '<div style="text-align: center;" aria-live="polite">' + \
         str(long_description) + '</div></body></html>'
-    msg = msg.encode('utf-8')
+    return msg.encode('utf-8')
+
+
+def _http_return_code(self, http_code: int, http_description: str,
+                      long_description: str, etag: str) -> None:
+    msg = _http_return_code_html(http_code, http_description,
+                                 long_description)
     self.send_response(http_code)
     self.send_header('Content-Type', 'text/html; charset=utf-8')
     msg_len_str = str(len(msg))
@@ -175,3 +183,19 @@ def http_503(self) -> None:
         _http_return_code(self, 503, 'Unavailable',
                           'The server is busy. Please try again ' +
                           'later', None)
+
+
+def http_429(self, retry_after_secs: int) -> None:
+    """Too many requests. The sender may try again after the given
+    number of seconds
+    """
+    msg = _http_return_code_html(429, 'Too Many Requests',
+                                 'Please try again later')
+    self.send_response(429)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Retry-After', str(retry_after_secs))
+    msg_len_str = str(len(msg))
+    self.send_header('Content-Length', msg_len_str)
+    self.end_headers()
+    if not write2(self, msg):
+        print('Error when showing 429')
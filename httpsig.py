@@ -20,6 +20,8 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import utils as hazutils
 import base64
+import hashlib
+import threading
 from time import gmtime, strftime
 from utils import get_full_domain
 from utils import get_sha_256
@@ -29,6 +31,76 @@ from utils import date_utcnow
 from utils import date_epoch
 from utils import date_from_string_format
 
+# Loaded key objects, keyed by a digest of their PEM, so that keys
+# don't need to be decoded for every signature which is created or
+# checked. Keys are held in least recently used order
+KEY_CACHE = {
+    "keys": {},
+    "maxKeys": 4096,
+    "hits": 0,
+    "misses": 0,
+    "lock": threading.Lock()
+}
+
+
+def _load_cached_key(key_pem: str, private: bool):
+    """Returns the key object for the given PEM, loading it only if
+    it is not already cached
+    """
+    key_pem_bytes = key_pem.encode('utf-8')
+    cache_key = hashlib.sha256(key_pem_bytes).hexdigest()
+    if private:
+        cache_key = 'private ' + cache_key
+    with KEY_CACHE['lock']:
+        key = KEY_CACHE['keys'].pop(cache_key, None)
+        if key is not None:
+            KEY_CACHE['keys'][cache_key] = key
+            KEY_CACHE['hits'] += 1
+            return key
+        KEY_CACHE['misses'] += 1
+    if private:
+        key = load_pem_private_key(key_pem_bytes,
+                                   None, backend=default_backend())
+    else:
+        key = load_pem_public_key(key_pem_bytes,
+                                  backend=default_backend())
+    with KEY_CACHE['lock']:
+        while len(KEY_CACHE['keys']) >= KEY_CACHE['maxKeys']:
+            del KEY_CACHE['keys'][next(iter(KEY_CACHE['keys']))]
+        KEY_CACHE['keys'][cache_key] = key
+    return key
+
+
+def load_cached_private_key(private_key_pem: str):
+    """Returns the private key object for the given PEM
+    """
+    return _load_cached_key(private_key_pem, True)
+
+
+def load_cached_public_key(public_key_pem: str):
+    """Returns the public key object for the given PEM
+    """
+    return _load_cached_key(public_key_pem, False)
+
+
+def key_cache_metrics() -> {}:
+    """Returns the number of cached keys and the hit rate
+    as a percentage
+    """
+    with KEY_CACHE['lock']:
+        hits = KEY_CACHE['hits']
+        misses = KEY_CACHE['misses']
+        no_of_keys = len(KEY_CACHE['keys'])
+    hit_rate = 0
+    if hits + misses > 0:
+        hit_rate = hits * 100 / (hits + misses)
+    return {
+        "keys": no_of_keys,
+        "hits": hits,
+        "misses": misses,
+        "hitRate": hit_rate
+    }
+
 
 def message_content_digest(message_body_json_str: str,
                            digest_algorithm: str) -> str:
@@ -70,9 +142,10 @@ def sign_post_headers(date_str: str, private_key_pem: str,
                       path: str, http_prefix: str,
                       message_body_json_str: str,
                       content_type: str, algorithm: str,
-                      digest_algorithm: str) -> str:
+                      digest_algorithm: str, body_digest: str) -> str:
     """Returns a raw signature string that can be plugged into a header and
     used to verify the authenticity of an HTTP transmission.
+    body_digest can be given if the message body digest is already known
     """
     domain = get_full_domain(domain, port)
 
@@ -94,8 +167,10 @@ def sign_post_headers(date_str: str, private_key_pem: str,
             'accept': content_type
         }
     else:
-        body_digest = \
-            message_content_digest(message_body_json_str, digest_algorithm)
+        if not body_digest:
+            body_digest = \
+                message_content_digest(message_body_json_str,
+                                       digest_algorithm)
         digest_prefix = get_digest_prefix(digest_algorithm)
         content_length = len(message_body_json_str)
         headers = {
@@ -106,8 +181,7 @@ def sign_post_headers(date_str: str, private_key_pem: str,
             'content-type': 'application/activity+json',
             'content-length': str(content_length)
         }
-    key = load_pem_private_key(private_key_pem.encode('utf-8'),
-                               None, backend=default_backend())
+    key = load_cached_private_key(private_key_pem)
     # headers.update({
     #     '(request-target)': f'post {path}',
     # })
@@ -194,8 +268,7 @@ def sign_post_headers_new(date_str: str, private_key_pem: str,
             'content-type': 'application/activity+json',
             'content-length': str(content_length)
         }
-    key = load_pem_private_key(private_key_pem.encode('utf-8'),
-                               None, backend=default_backend())
+    key = load_cached_private_key(private_key_pem)
     # build a digest for signing
     signed_header_keys = headers.keys()
     signed_header_text = ''
@@ -247,8 +320,9 @@ def create_signed_header(date_str: str, private_key_pem: str, nickname: str,
                          to_domain: str, to_port: int,
                          path: str, http_prefix: str, with_digest: bool,
                          message_body_json_str: str,
-                         content_type: str) -> {}:
+                         content_type: str, body_digest: str) -> {}:
     """Note that the domain is the destination, not the sender
+    body_digest can be given if the message body digest is already known
     """
     algorithm = 'rsa-sha256'
     digest_algorithm = 'rsa-sha256'
@@ -273,10 +347,11 @@ def create_signed_header(date_str: str, private_key_pem: str, nickname: str,
             sign_post_headers(date_str, private_key_pem, nickname,
                               domain, port, to_domain, to_port,
                               path, http_prefix, None, content_type,
-                              algorithm, None)
+                              algorithm, None, None)
     else:
-        body_digest = message_content_digest(message_body_json_str,
-                                             digest_algorithm)
+        if not body_digest:
+            body_digest = message_content_digest(message_body_json_str,
+                                                 digest_algorithm)
         digest_prefix = get_digest_prefix(digest_algorithm)
         content_length = len(message_body_json_str)
         headers = {
@@ -292,7 +367,8 @@ def create_signed_header(date_str: str, private_key_pem: str, nickname: str,
                               domain, port,
                               to_domain, to_port,
                               path, http_prefix, message_body_json_str,
-                              content_type, algorithm, digest_algorithm)
+                              content_type, algorithm, digest_algorithm,
+                              body_digest)
     headers['signature'] = signature_header
     return headers
 
@@ -349,8 +425,7 @@ def verify_post_headers(http_prefix: str,
         print('verify_post_headers message_body_json_str: ' +
               str(message_body_json_str))
 
-    pubkey = load_pem_public_key(public_key_pem.encode('utf-8'),
-                                 backend=default_backend())
+    pubkey = load_cached_public_key(public_key_pem)
     # Build a dictionary of the signature values
     if headers.get('Signature-Input') or headers.get('signature-input'):
         if headers.get('Signature-Input'):
@@ -8,7 +8,6 @@ __status__ = "Production"
 __module_group__ = "Core"
 
 import os
-import time
 import random
 from utils import data_dir
 from utils import get_full_domain
@@ -19,7 +18,6 @@ from follow import is_following_actor
 from follow import send_follow_request
 from session import create_session
 from session import set_session_for_sender
-from threads import begin_thread
 from person import set_person_notes
 
 
@@ -184,60 +182,38 @@ def _update_import_following(base_dir: str,
 
 
 def run_import_following(base_dir: str, httpd):
-    """Sends out follow requests for imported following csv files
+    """Sends out follow requests for imported following csv files.
+    This is run periodically by the scheduler
     """
     dir_str = data_dir(base_dir)
-    while True:
-        time.sleep(20)
 
-        # get a list of accounts on the instance, in random sequence
-        accounts_list: list[str] = []
-        for _, dirs, _ in os.walk(dir_str):
-            for account in dirs:
-                if '@' not in account:
-                    continue
-                if not is_account_dir(account):
-                    continue
-                accounts_list.append(account)
-            break
-        if not accounts_list:
-            continue
-
-        # check if each accounts has an import csv
-        random.shuffle(accounts_list)
-        for account in accounts_list:
-            account_dir = dir_str + '/' + account
-            import_filename = account_dir + '/import_following.csv'
-
-            if not os.path.isfile(import_filename):
+    # get a list of accounts on the instance, in random sequence
+    accounts_list: list[str] = []
+    for _, dirs, _ in os.walk(dir_str):
+        for account in dirs:
+            if '@' not in account:
                 continue
-            if not _update_import_following(base_dir, account, httpd,
-                                            import_filename):
-                try:
-                    os.remove(import_filename)
-                except OSError:
-                    print('EX: unable to remove import file ' +
-                          import_filename)
-            else:
-                break
-
-
-def run_import_following_watchdog(project_version: str, httpd) -> None:
-    """Imports following lists from csv for every account on the instance
-    """
-    print('THREAD: Starting import following watchdog ' + project_version)
-    import_following_original = \
-        httpd.thrImportFollowing.clone(run_import_following)
-    begin_thread(httpd.thrImportFollowing,
-                 'run_import_following_watchdog')
-    while True:
-        time.sleep(50)
-        if httpd.thrImportFollowing.is_alive():
+            if not is_account_dir(account):
+                continue
+            accounts_list.append(account)
+        break
+    if not accounts_list:
+        return
+
+    # check if each accounts has an import csv
+    random.shuffle(accounts_list)
+    for account in accounts_list:
+        account_dir = dir_str + '/' + account
+        import_filename = account_dir + '/import_following.csv'
+
+        if not os.path.isfile(import_filename):
             continue
-        httpd.thrImportFollowing.kill()
-        print('THREAD: restarting import following watchdog')
-        httpd.thrImportFollowing = \
-            import_following_original.clone(run_import_following)
-        begin_thread(httpd.thrImportFollowing,
-                     'run_import_following_watchdog 2')
-        print('Restarting import following...')
+        if not _update_import_following(base_dir, account, httpd,
+                                        import_filename):
+            try:
+                os.remove(import_filename)
+            except OSError:
+                print('EX: unable to remove import file ' +
+                      import_filename)
+        else:
+            break
@@ -14,6 +14,30 @@ import time
 import random
 from shutil import copyfile
 from linked_data_sig import verify_json_signature
+from linked_data_sig import verified_cache_metrics
+from inbox_queue import inbox_queue_add
+from inbox_queue import inbox_queue_take
+from inbox_queue import inbox_queue_verified
+from inbox_queue import inbox_queue_next_verified
+from inbox_queue import inbox_queue_clear
+from inbox_queue import inbox_queue_length
+from inbox_queue import inbox_queue_wait
+from inbox_queue import inbox_queue_done
+from inbox_queue import inbox_queue_commit
+from inbox_queue import inbox_queue_restore
+from inbox_queue import inbox_queue_set_lanes
+from inbox_queue import inbox_queue_lane_metrics
+from inbox_queue import inbox_queue_park
+from inbox_queue import inbox_queue_unpark
+from inbox_queue import inbox_queue_requeue
+from inbox_seen import inbox_seen_add
+from inbox_seen import inbox_seen_forget
+from inbox_keys import inbox_keys_failing
+from inbox_keys import inbox_keys_failed
+from inbox_keys import inbox_keys_park
+from inbox_keys import inbox_keys_due
+from inbox_keys import inbox_keys_fetched
+from inbox_seen import inbox_seen_metrics
 from flags import is_system_account
 from flags import is_blog_post
 from flags import is_recent_post
@@ -111,9 +135,13 @@ from conversation import update_conversation
 from webapp_hashtagswarm import store_hash_tags
 from person import valid_sending_actor
 from fitnessFunctions import fitness_performance
+from fitnessFunctions import fitness_queue_metrics
 from content import reject_twitter_summary
 from content import load_dogwhistles
+from threads import thread_with_trace
 from threads import begin_thread
+from threads import thread_sleep
+from threads import thread_check_cancelled
 from reading import store_book_events
 from inbox_receive import inbox_update_index
 from inbox_receive import receive_edit_to_post
@@ -132,6 +160,9 @@ from inbox_receive_undo import receive_undo_bookmark
 from inbox_receive_undo import receive_undo_announce
 from inbox_receive_undo import receive_undo
 
+# seconds to wait for the inbox queue thread to stop before it is restarted
+INBOX_QUEUE_STOP_SECS = 5
+
 
 def _store_last_post_id(base_dir: str, nickname: str, domain: str,
                         post_json_object: {}) -> None:
@@ -399,9 +430,10 @@ def save_post_to_inbox_queue(base_dir: str, http_prefix: str,
                              block_federated: [],
                              system_language: str,
                              mitm: bool,
-                             max_message_bytes: int) -> str:
-    """Saves the given json to the inbox queue for the person
-    key_id specifies the actor sending the post
+                             max_message_bytes: int) -> {}:
+    """Creates an inbox queue item for the given json, for the person.
+    The item is written to the inbox queue journal when it is added
+    to the queue. Returns None if the post was rejected
     """
     if len(message_bytes) > max_message_bytes:
         print('REJECT: inbox message too long ' +
@@ -608,8 +640,7 @@ def save_post_to_inbox_queue(base_dir: str, http_prefix: str,
 
     if debug:
         print('Inbox queue item created')
-    save_json(new_queue_item, filename)
-    return filename
+    return new_queue_item
 
 
 def _inbox_post_recipients_add(base_dir: str, to_list: [],
@@ -1395,7 +1426,7 @@ def _bounce_dm(sender_post_id: str, session, http_prefix: str,
                      signing_priv_key_pem, 7238634,
                      curr_domain, onion_domain, i2p_domain,
                      extra_headers, sites_unavailable, system_language,
-                     mitm_servers)
+                     mitm_servers, None)
     return True
 
 
@@ -2611,11 +2642,11 @@ def _inbox_after_initial(server, inbox_start_time,
     return True
 
 
-def clear_queue_items(base_dir: str, queue: []) -> None:
+def clear_queue_items(base_dir: str, queue: {}) -> None:
     """Clears the queue for each account
     """
     ctr = 0
-    queue.clear()
+    inbox_queue_clear(queue)
     dir_str = data_dir(base_dir)
     for _, dirs, _ in os.walk(dir_str):
         for account in dirs:
@@ -2636,10 +2667,13 @@ def clear_queue_items(base_dir: str, queue: []) -> None:
         print('Removed ' + str(ctr) + ' inbox queue items')
 
 
-def _restore_queue_items(base_dir: str, queue: []) -> None:
-    """Checks the queue for each account and appends filenames
+def _restore_queue_items(base_dir: str, queue: {}) -> None:
+    """Restores any items from the inbox queue journal which were not
+    applied, and imports any queue files which were saved individually
+    by earlier versions
     """
-    queue.clear()
+    restore_time = time.time()
+    restored = inbox_queue_restore(queue, restore_time)
     dir_str = data_dir(base_dir)
     for _, dirs, _ in os.walk(dir_str):
         for account in dirs:
@@ -2648,136 +2682,53 @@ def _restore_queue_items(base_dir: str, queue: []) -> None:
                 continue
             for _, _, queuefiles in os.walk(queue_dir):
                 for qfile in queuefiles:
-                    queue.append(os.path.join(queue_dir, qfile))
-                break
-        break
-    if len(queue) > 0:
-        print('Restored ' + str(len(queue)) + ' inbox queue items')
-
-
-def run_inbox_queue_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the inbox thread running even if it dies
-    """
-    print('THREAD: Starting inbox queue watchdog ' + project_version)
-    inbox_queue_original = httpd.thrInboxQueue.clone(run_inbox_queue)
-    begin_thread(httpd.thrInboxQueue, 'run_inbox_queue_watchdog')
-    while True:
-        time.sleep(20)
-        if not httpd.thrInboxQueue.is_alive() or httpd.restart_inbox_queue:
-            httpd.restart_inbox_queue_in_progress = True
-            httpd.thrInboxQueue.kill()
-            print('THREAD: restarting inbox queue watchdog')
-            httpd.thrInboxQueue = inbox_queue_original.clone(run_inbox_queue)
-            httpd.inbox_queue.clear()
-            begin_thread(httpd.thrInboxQueue, 'run_inbox_queue_watchdog 2')
-            print('Restarting inbox queue...')
-            httpd.restart_inbox_queue_in_progress = False
-            httpd.restart_inbox_queue = False
-
-
-def _inbox_quota_exceeded(queue: {}, queue_filename: str,
-                          queue_json: {}, quotas_daily: {}, quotas_per_min: {},
-                          domain_max_posts_per_day: int,
-                          account_max_posts_per_day: int,
-                          debug: bool) -> bool:
-    """limit the number of posts which can arrive per domain per day
-    """
-    post_domain = queue_json['postDomain']
-    if not post_domain:
-        return False
-
-    if domain_max_posts_per_day > 0:
-        if quotas_daily['domains'].get(post_domain):
-            if quotas_daily['domains'][post_domain] > \
-               domain_max_posts_per_day:
-                print('Queue: Quota per day - Maximum posts for ' +
-                      post_domain + ' reached (' +
-                      str(domain_max_posts_per_day) + ')')
-                if len(queue) > 0:
+                    if not qfile.endswith('.json'):
+                        continue
+                    queue_filename = os.path.join(queue_dir, qfile)
                     try:
-                        os.remove(queue_filename)
+                        arrival_time = os.path.getmtime(queue_filename)
                     except OSError:
-                        print('EX: _inbox_quota_exceeded unable to delete 1 ' +
-                              str(queue_filename))
-                    if len(queue) > 0:
-                        queue.pop(0)
-                return True
-            quotas_daily['domains'][post_domain] += 1
-        else:
-            quotas_daily['domains'][post_domain] = 1
-
-        if quotas_per_min['domains'].get(post_domain):
-            domain_max_posts_per_min = \
-                int(domain_max_posts_per_day / (24 * 60))
-            if domain_max_posts_per_min < 5:
-                domain_max_posts_per_min = 5
-            if quotas_per_min['domains'][post_domain] > \
-               domain_max_posts_per_min:
-                print('Queue: Quota per min - Maximum posts for ' +
-                      post_domain + ' reached (' +
-                      str(domain_max_posts_per_min) + ')')
-                if len(queue) > 0:
+                        continue
+                    queue_json = load_json(queue_filename)
+                    if queue_json:
+                        queue_json['filename'] = queue_filename
+                        if inbox_queue_add(queue, queue_json, arrival_time):
+                            restored += 1
                     try:
                         os.remove(queue_filename)
                     except OSError:
-                        print('EX: _inbox_quota_exceeded unable to delete 2 ' +
-                              str(queue_filename))
-                    if len(queue) > 0:
-                        queue.pop(0)
-                return True
-            quotas_per_min['domains'][post_domain] += 1
-        else:
-            quotas_per_min['domains'][post_domain] = 1
-
-    if account_max_posts_per_day > 0:
-        post_handle = queue_json['postNickname'] + '@' + post_domain
-        if quotas_daily['accounts'].get(post_handle):
-            if quotas_daily['accounts'][post_handle] > \
-               account_max_posts_per_day:
-                print('Queue: Quota account posts per day -' +
-                      ' Maximum posts for ' +
-                      post_handle + ' reached (' +
-                      str(account_max_posts_per_day) + ')')
-                if len(queue) > 0:
-                    try:
-                        os.remove(queue_filename)
-                    except OSError:
-                        print('EX: _inbox_quota_exceeded unable to delete 3 ' +
-                              str(queue_filename))
-                    if len(queue) > 0:
-                        queue.pop(0)
-                return True
-            quotas_daily['accounts'][post_handle] += 1
-        else:
-            quotas_daily['accounts'][post_handle] = 1
-
-        if quotas_per_min['accounts'].get(post_handle):
-            account_max_posts_per_min = \
-                int(account_max_posts_per_day / (24 * 60))
-            account_max_posts_per_min = max(account_max_posts_per_min, 5)
-            if quotas_per_min['accounts'][post_handle] > \
-               account_max_posts_per_min:
-                print('Queue: Quota account posts per min -' +
-                      ' Maximum posts for ' +
-                      post_handle + ' reached (' +
-                      str(account_max_posts_per_min) + ')')
-                if len(queue) > 0:
-                    try:
-                        os.remove(queue_filename)
-                    except OSError:
-                        print('EX: _inbox_quota_exceeded unable to delete 4 ' +
-                              str(queue_filename))
-                    if len(queue) > 0:
-                        queue.pop(0)
-                return True
-            quotas_per_min['accounts'][post_handle] += 1
-        else:
-            quotas_per_min['accounts'][post_handle] = 1
+                        print('EX: _restore_queue_items unable to delete ' +
+                              queue_filename)
+                break
+        break
+    if restored > 0:
+        print('Restored ' + str(restored) + ' inbox queue items')
 
-    if debug:
-        if account_max_posts_per_day > 0 or domain_max_posts_per_day > 0:
-            pprint(quotas_daily)
-    return False
+
+def supervise_inbox_queue(httpd) -> None:
+    """Restarts the inbox thread if it has died or a restart was
+    requested. This is run periodically by the scheduler
+    """
+    if httpd.thrInboxQueue.is_alive() and not httpd.restart_inbox_queue:
+        return
+    httpd.restart_inbox_queue_in_progress = True
+    httpd.thrInboxQueue.kill()
+    # the thread stops at its next cancellation point. Until then it may
+    # still be applying an item, and the new thread restores every item
+    # which has not been applied from the journal, so starting it now
+    # could apply the same item twice
+    httpd.thrInboxQueue.join(INBOX_QUEUE_STOP_SECS)
+    if httpd.thrInboxQueue.is_alive():
+        print('THREAD: inbox queue has not stopped yet, ' +
+              'restart will be tried again')
+        httpd.restart_inbox_queue = True
+        return
+    print('THREAD: restarting inbox queue')
+    httpd.thrInboxQueue = httpd.thrInboxQueue.clone(run_inbox_queue)
+    begin_thread(httpd.thrInboxQueue, 'supervise_inbox_queue')
+    print('Restarting inbox queue...')
+    httpd.restart_inbox_queue_in_progress = False
+    httpd.restart_inbox_queue = False
 
 
 def _check_json_signature(base_dir: str, queue_json: {}) -> (bool, bool):
@@ -3144,18 +3095,428 @@ def _receive_follow_request(session, session_onion, session_i2p,
                                     system_language, mitm_servers)
 
 
+def _inbox_park_queue_item(server, queue: {}, ticket: int,
+                           key_id: str, queue_json: {}) -> None:
+    """Parks an inbox queue item until the public key with which it
+    was signed has been obtained. It remains within the journal so
+    that it isn't lost if there is a restart while it is parked
+    """
+    sequence = inbox_queue_park(queue, ticket)
+    if sequence is None:
+        return
+    queue_json['parkedSequence'] = sequence
+    if not inbox_keys_park(server.inbox_keys, key_id, queue_json):
+        print('Queue: unable to park item waiting for key ' + key_id)
+        inbox_queue_unpark(queue, sequence)
+
+
+def _inbox_drop_parked_items(queue: {}, dropped_items: []) -> None:
+    """Marks parked items which have been dropped as consumed
+    within the journal
+    """
+    for queue_json in dropped_items:
+        inbox_queue_unpark(queue, queue_json.get('parkedSequence'))
+
+
+def _inbox_verify_queue_item(server, queue: {}, ticket: int,
+                             queue_json: {},
+                             proxy_type: str, session,
+                             session_onion, session_i2p,
+                             base_dir: str, http_prefix: str,
+                             person_cache: {}, domain: str,
+                             onion_domain: str, i2p_domain: str,
+                             project_version: str,
+                             verify_all_signatures: bool,
+                             signing_priv_key_pem: str,
+                             debug: bool) -> {}:
+    """Obtains the public key of the sender of an inbox queue item
+    and checks the http and json signatures.
+    Returns the verified item, or None if it was rejected or parked
+    until the public key can be obtained
+    """
+    inbox_start_time = time.time()
+    if debug:
+        print('Verifying queue item ' + str(queue_json.get('filename')))
+
+    sender_actor = queue_json.get('actor')
+    curr_session = \
+        _inbox_session_for_actor(sender_actor, proxy_type,
+                                 session, session_onion, session_i2p)
+
+    if debug and queue_json.get('actor'):
+        print('Obtaining public key for actor ' + queue_json['actor'])
+
+    fitness_performance(inbox_start_time, server.fitness,
+                        'INBOX', 'start_get_pubkey', debug)
+    inbox_start_time = time.time()
+    key_id = None
+    signature_params = \
+        queue_json['httpHeaders']['signature'].split(',')
+    for signature_item in signature_params:
+        if signature_item.startswith('keyId='):
+            if '"' in signature_item:
+                key_id = signature_item.split('"')[1]
+                break
+    if not key_id:
+        print('Queue: No keyId in signature: ' +
+              queue_json['httpHeaders']['signature'])
+        return None
+
+    # if this key could not be obtained recently then park the item
+    # until the key has been fetched again
+    if inbox_keys_failing(server.inbox_keys, key_id):
+        _inbox_park_queue_item(server, queue, ticket, key_id, queue_json)
+        if debug:
+            print('Queue: item parked waiting for key ' + key_id)
+        return None
+
+    pub_key = \
+        get_person_pub_key(base_dir, curr_session, key_id,
+                           person_cache, debug,
+                           project_version, http_prefix,
+                           domain, onion_domain, i2p_domain,
+                           signing_priv_key_pem,
+                           server.mitm_servers)
+    fitness_performance(inbox_start_time, server.fitness,
+                        'INBOX', 'get_person_pub_key', debug)
+    inbox_start_time = time.time()
+    if isinstance(pub_key, dict):
+        if debug:
+            print('DEBUG: http code error for public key: ' +
+                  str(pub_key))
+        # don't ask for this key again until its backoff has elapsed
+        dropped_items = \
+            inbox_keys_failed(server.inbox_keys, key_id, inbox_start_time)
+        _inbox_drop_parked_items(queue, dropped_items)
+        return None
+    if not pub_key:
+        # rather than retrying here, which would hold up the queue,
+        # park the item and fetch the key again in the background
+        print('Queue: public key could not be obtained from ' + key_id)
+        dropped_items = \
+            inbox_keys_failed(server.inbox_keys, key_id, inbox_start_time)
+        _inbox_drop_parked_items(queue, dropped_items)
+        _inbox_park_queue_item(server, queue, ticket, key_id, queue_json)
+        return None
+    if debug:
+        print('DEBUG: public key: ' + str(pub_key))
+
+    # check the http header signature
+    fitness_performance(inbox_start_time, server.fitness,
+                        'INBOX', 'begin_check_signature', debug)
+    inbox_start_time = time.time()
+    if debug:
+        print('DEBUG: checking http header signature')
+        pprint(queue_json['httpHeaders'])
+    post_str = json.dumps(queue_json['post'])
+    http_signature_failed = False
+    if not verify_post_headers(http_prefix, pub_key,
+                               queue_json['httpHeaders'],
+                               queue_json['path'], False,
+                               queue_json['digest'],
+                               post_str, debug):
+        http_signature_failed = True
+        print('Queue: Header signature check failed')
+        pprint(queue_json['httpHeaders'])
+    else:
+        if debug:
+            print('DEBUG: http header signature check success')
+    fitness_performance(inbox_start_time, server.fitness,
+                        'INBOX', 'verify_post_headers', debug)
+    inbox_start_time = time.time()
+
+    # check if a json signature exists on this post
+    has_json_signature, jwebsig_type = \
+        _check_json_signature(base_dir, queue_json)
+    fitness_performance(inbox_start_time, server.fitness,
+                        'INBOX', '_check_json_signature', debug)
+    inbox_start_time = time.time()
+
+    # strict enforcement of json signatures
+    if not has_json_signature:
+        if http_signature_failed:
+            if jwebsig_type:
+                print('Queue: Header signature check failed and does ' +
+                      'not have a recognised jsonld signature type ' +
+                      jwebsig_type)
+            else:
+                print('Queue: Header signature check failed and ' +
+                      'does not have jsonld signature')
+            if debug:
+                pprint(queue_json['httpHeaders'])
+
+        if verify_all_signatures:
+            original_json = queue_json['original']
+            print('Queue: inbox post does not have a jsonld signature ' +
+                  key_id + ' ' + str(original_json))
+
+        if http_signature_failed or verify_all_signatures:
+            return None
+    else:
+        if http_signature_failed or verify_all_signatures:
+            # use the original json message received, not one which
+            # may have been modified along the way
+            original_json = queue_json['original']
+            if not verify_json_signature(original_json, pub_key):
+                if debug:
+                    print('WARN: jsonld inbox signature check failed ' +
+                          key_id + ' ' + pub_key + ' ' +
+                          str(original_json))
+                else:
+                    print('WARN: jsonld inbox signature check failed ' +
+                          key_id)
+                fitness_performance(inbox_start_time, server.fitness,
+                                    'INBOX', 'not_verify_signature',
+                                    debug)
+                return None
+
+            if http_signature_failed:
+                print('jsonld inbox signature check success ' +
+                      'via relay ' + key_id)
+            else:
+                print('jsonld inbox signature check success ' + key_id)
+            fitness_performance(inbox_start_time, server.fitness,
+                                'INBOX', 'verify_signature_success',
+                                debug)
+
+    return {
+        "filename": queue_json['filename'],
+        "queueJson": queue_json,
+        "keyId": key_id
+    }
+
+
+def _inbox_session_for_actor(actor: str, proxy_type: str,
+                             session, session_onion, session_i2p):
+    """Returns the session to use when contacting the given actor
+    """
+    if not isinstance(actor, str):
+        return session
+    sender_domain, _ = get_domain_from_actor(actor)
+    if not sender_domain:
+        return session
+    if sender_domain.endswith('.onion') and \
+       session_onion and proxy_type != 'tor':
+        return session_onion
+    if sender_domain.endswith('.i2p') and \
+       session_i2p and proxy_type != 'i2p':
+        return session_i2p
+    return session
+
+
+def _run_inbox_verify(server, queue: {}, base_dir: str, http_prefix: str,
+                      person_cache: {}, domain: str,
+                      onion_domain: str, i2p_domain: str,
+                      proxy_type: str, project_version: str,
+                      verify_all_signatures: bool,
+                      signing_priv_key_pem: str, debug: bool) -> None:
+    """Signature verification thread. A pool of these runs ahead of the
+    inbox queue thread, taking items from the queue, obtaining public
+    keys and checking signatures, so that the network and cpu bound
+    work happens concurrently. Verified items are then applied in order
+    by the inbox queue thread
+    """
+    session = None
+    session_onion = None
+    session_i2p = None
+    session_last_update = 0
+    session_restart_interval_secs = random.randrange(18000, 20000)
+    last_config_check = int(time.time())
+    while True:
+        thread_check_cancelled()
+        if not inbox_queue_wait(queue, 60):
+            continue
+        curr_time = int(time.time())
+
+        # check if the json signature enforcement has changed
+        if curr_time - last_config_check > 60:
+            verify_all_sigs = get_config_param(base_dir, "verifyAllSignatures")
+            if verify_all_sigs is not None:
+                verify_all_signatures = verify_all_sigs
+            last_config_check = curr_time
+
+        # recreate the sessions periodically
+        time_diff = curr_time - session_last_update
+        if not session or time_diff > session_restart_interval_secs:
+            session = create_session(proxy_type)
+            if not session:
+                print('WARN: inbox verify session not created')
+                thread_sleep(1)
+                continue
+            if proxy_type != 'tor' and onion_domain:
+                session_onion = create_session('tor')
+            if proxy_type != 'i2p' and i2p_domain:
+                session_i2p = create_session('i2p')
+            session_last_update = curr_time
+
+        ticket = None
+        queue_json = None
+        verified_item = None
+        try:
+            ticket, queue_json = inbox_queue_take(queue)
+            if queue_json:
+                verified_item = \
+                    _inbox_verify_queue_item(server, queue, ticket,
+                                             queue_json,
+                                             proxy_type, session,
+                                             session_onion, session_i2p,
+                                             base_dir, http_prefix,
+                                             person_cache, domain,
+                                             onion_domain, i2p_domain,
+                                             project_version,
+                                             verify_all_signatures,
+                                             signing_priv_key_pem, debug)
+        finally:
+            # always hand on a result, even if verification failed,
+            # otherwise the inbox queue thread would wait for it forever
+            if ticket is not None:
+                inbox_queue_verified(queue, ticket, verified_item)
+            # only remember activities whose signatures were verified,
+            # so that a forged copy can't cause a genuine one to be
+            # treated as a duplicate
+            if queue_json:
+                seen_key = queue_json.get('seenKey')
+                if verified_item:
+                    inbox_seen_add(server.inbox_seen, seen_key, time.time())
+                else:
+                    inbox_seen_forget(server.inbox_seen, seen_key)
+
+
+def _run_inbox_key_refetch(server, queue: {},
+                           base_dir: str, http_prefix: str,
+                           person_cache: {}, domain: str,
+                           onion_domain: str, i2p_domain: str,
+                           proxy_type: str, project_version: str,
+                           signing_priv_key_pem: str, debug: bool) -> None:
+    """Fetches public keys which could not be obtained earlier, once
+    their backoff time has elapsed, and puts any inbox items which were
+    parked waiting for them back onto the inbox queue
+    """
+    session = None
+    session_onion = None
+    session_i2p = None
+    session_last_update = 0
+    session_restart_interval_secs = random.randrange(18000, 20000)
+    while True:
+        thread_sleep(1)
+        curr_time = time.time()
+        due_key_ids = inbox_keys_due(server.inbox_keys, curr_time)
+        if not due_key_ids:
+            continue
+
+        # recreate the sessions periodically
+        time_diff = curr_time - session_last_update
+        if not session or time_diff > session_restart_interval_secs:
+            session = create_session(proxy_type)
+            if not session:
+                print('WARN: inbox key refetch session not created')
+                continue
+            if proxy_type != 'tor' and onion_domain:
+                session_onion = create_session('tor')
+            if proxy_type != 'i2p' and i2p_domain:
+                session_i2p = create_session('i2p')
+            session_last_update = curr_time
+
+        for key_id in due_key_ids:
+            curr_session = \
+                _inbox_session_for_actor(key_id, proxy_type,
+                                         session, session_onion, session_i2p)
+            pub_key = \
+                get_person_pub_key(base_dir, curr_session, key_id,
+                                   person_cache, debug,
+                                   project_version, http_prefix,
+                                   domain, onion_domain, i2p_domain,
+                                   signing_priv_key_pem,
+                                   server.mitm_servers)
+            if pub_key and not isinstance(pub_key, dict):
+                parked_items = inbox_keys_fetched(server.inbox_keys, key_id)
+                for queue_json in parked_items:
+                    sequence = queue_json.pop('parkedSequence', None)
+                    inbox_queue_requeue(queue, queue_json, sequence,
+                                        time.time())
+                print('Queue: public key obtained for ' + key_id + ', ' +
+                      str(len(parked_items)) + ' items requeued')
+                continue
+            dropped_items = \
+                inbox_keys_failed(server.inbox_keys, key_id, time.time())
+            _inbox_drop_parked_items(queue, dropped_items)
+            if dropped_items:
+                print('Queue: public key could not be obtained for ' +
+                      key_id + ', ' + str(len(dropped_items)) +
+                      ' items dropped')
+            elif debug:
+                print('DEBUG: public key could not be refetched for ' +
+                      key_id)
+
+
+def _start_inbox_verify_threads(server, queue: {},
+                                base_dir: str, http_prefix: str,
+                                person_cache: {}, domain: str,
+                                onion_domain: str, i2p_domain: str,
+                                proxy_type: str, project_version: str,
+                                verify_all_signatures: bool,
+                                signing_priv_key_pem: str,
+                                debug: bool) -> None:
+    """Starts the pool of signature verification threads and the public
+    key refetch thread, or restarts any which have stopped. The number
+    of verification threads can be set with inboxVerifyThreads within
+    config.json
+    """
+    no_of_threads = get_config_param(base_dir, 'inboxVerifyThreads')
+    if not no_of_threads:
+        no_of_threads = 4
+    no_of_threads = min(max(int(no_of_threads), 1), 64)
+
+    # remove any threads beyond the number configured
+    while len(server.thrInboxVerify) > no_of_threads:
+        server.thrInboxVerify.pop().kill()
+
+    for index in range(no_of_threads):
+        if index < len(server.thrInboxVerify):
+            if server.thrInboxVerify[index].is_alive():
+                continue
+            server.thrInboxVerify[index].kill()
+        verify_thread = \
+            thread_with_trace(target=_run_inbox_verify,
+                              args=(server, queue, base_dir, http_prefix,
+                                    person_cache, domain,
+                                    onion_domain, i2p_domain,
+                                    proxy_type, project_version,
+                                    verify_all_signatures,
+                                    signing_priv_key_pem, debug),
+                              daemon=True)
+        if index < len(server.thrInboxVerify):
+            server.thrInboxVerify[index] = verify_thread
+        else:
+            server.thrInboxVerify.append(verify_thread)
+        begin_thread(verify_thread, '_start_inbox_verify_threads')
+
+    # thread which fetches public keys which could not be obtained
+    if server.thrInboxKeyRefetch:
+        if server.thrInboxKeyRefetch.is_alive():
+            return
+        server.thrInboxKeyRefetch.kill()
+    server.thrInboxKeyRefetch = \
+        thread_with_trace(target=_run_inbox_key_refetch,
+                          args=(server, queue, base_dir, http_prefix,
+                                person_cache, domain,
+                                onion_domain, i2p_domain,
+                                proxy_type, project_version,
+                                signing_priv_key_pem, debug),
+                          daemon=True)
+    begin_thread(server.thrInboxKeyRefetch, '_start_inbox_verify_threads 2')
+
+
 def run_inbox_queue(server,
                     recent_posts_cache: {}, max_recent_posts: int,
                     project_version: str,
                     base_dir: str, http_prefix: str,
                     send_threads: [], post_log: [],
-                    cached_webfingers: {}, person_cache: {}, queue: [],
+                    cached_webfingers: {}, person_cache: {}, queue: {},
                     domain: str,
                     onion_domain: str, i2p_domain: str,
                     port: int, proxy_type: str,
                     federation_list: [], max_replies: int,
-                    domain_max_posts_per_day: int,
-                    account_max_posts_per_day: int,
                     allow_deletion: bool, debug: bool, max_mentions: int,
                     max_emoji: int, translate: {}, unit_test: bool,
                     yt_replace_domain: str,
@@ -3207,6 +3568,10 @@ def run_inbox_queue(server,
     if debug:
         print('DEBUG: Inbox queue running')
 
+    # lanes into which incoming items are classified
+    lanes_config = get_config_param(base_dir, 'inboxLanes')
+    inbox_queue_set_lanes(queue, lanes_config)
+
     # if queue processing was interrupted (eg server crash)
     # then this loads any outstanding items back into the queue
     _restore_queue_items(base_dir, queue)
@@ -3214,20 +3579,7 @@ def run_inbox_queue(server,
                         'INBOX', '_restore_queue_items', debug)
     inbox_start_time = time.time()
 
-    # keep track of numbers of incoming posts per day
-    quotas_last_update_daily = int(time.time())
-    quotas_daily = {
-        'domains': {},
-        'accounts': {}
-    }
-    quotas_last_update_per_min = int(time.time())
-    quotas_per_min = {
-        'domains': {},
-        'accounts': {}
-    }
-
-    heart_beat_ctr = 0
-    queue_restore_ctr = 0
+    last_heart_beat = time.time()
     curr_mitm_servers: list[str] = []
 
     # time when the last DM bounce message was sent
@@ -3238,110 +3590,75 @@ def run_inbox_queue(server,
     # how long it takes for broch mode to lapse
     broch_lapse_days = random.randrange(7, 14)
 
+    # start the pool of signature verification threads
+    _start_inbox_verify_threads(server, queue, base_dir, http_prefix,
+                                person_cache, domain,
+                                onion_domain, i2p_domain,
+                                proxy_type, project_version,
+                                verify_all_signatures,
+                                signing_priv_key_pem, debug)
+
     fitness_performance(inbox_start_time, server.fitness,
                         'INBOX', 'while_loop_start', debug)
     inbox_start_time = time.time()
+    # journal sequence number of the item most recently applied
+    applied_sequence = None
     while True:
-        time.sleep(1)
+        # mark the previous item as consumed within the journal. This
+        # happens here so that it applies on every exit path of the
+        # loop below
+        if applied_sequence is not None:
+            inbox_queue_done(queue, applied_sequence)
+            applied_sequence = None
+        thread_check_cancelled()
+
         inbox_start_time = time.time()
         fitness_performance(inbox_start_time, server.fitness,
                             'INBOX', 'while_loop_itteration', debug)
         inbox_start_time = time.time()
 
         # heartbeat to monitor whether the inbox queue is running
-        heart_beat_ctr += 1
-        if heart_beat_ctr >= 10:
+        if inbox_start_time - last_heart_beat >= 10:
             # turn off broch mode after it has timed out
             if broch_modeLapses(base_dir, broch_lapse_days):
                 broch_lapse_days = random.randrange(7, 14)
             fitness_performance(inbox_start_time, server.fitness,
                                 'INBOX', 'broch_modeLapses', debug)
             inbox_start_time = time.time()
-            print('>>> Heartbeat Q:' + str(len(queue)) + ' ' +
+            print('>>> Heartbeat Q:' + str(inbox_queue_length(queue)) + ' ' +
                   '{:%F %T}'.format(datetime.datetime.now()))
-            heart_beat_ctr = 0
+            last_heart_beat = inbox_start_time
 
             # save MITM servers list if it has changed
             if str(server.mitm_servers) != str(curr_mitm_servers):
                 curr_mitm_servers = server.mitm_servers.copy()
                 save_mitm_servers(base_dir, curr_mitm_servers)
 
-        if len(queue) == 0:
-            # restore any remaining queue items
-            queue_restore_ctr += 1
-            if queue_restore_ctr >= 30:
-                queue_restore_ctr = 0
-                _restore_queue_items(base_dir, queue)
-            fitness_performance(inbox_start_time, server.fitness,
-                                'INBOX', 'restore_queue', debug)
-            inbox_start_time = time.time()
-            continue
-
-        # oldest item first
-        queue.sort()
-        queue_filename = queue[0]
-        if not os.path.isfile(queue_filename):
-            print("Queue: queue item rejected because it has no file: " +
-                  queue_filename)
-            if len(queue) > 0:
-                queue.pop(0)
-            continue
-
-        if debug:
-            print('Loading queue item ' + queue_filename)
-
-        # Load the queue json
-        queue_json = load_json(queue_filename)
-        fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', 'load_queue_json', debug)
-        inbox_start_time = time.time()
-        if not queue_json:
-            print('Queue: run_inbox_queue failed to load inbox queue item ' +
-                  queue_filename)
-            # Assume that the file is probably corrupt/unreadable
-            if len(queue) > 0:
-                queue.pop(0)
-            # delete the queue file
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 1 unable to delete ' +
-                          str(queue_filename))
-            continue
+            # update the lanes if they have changed, and store the
+            # depth and waiting time of each lane
+            lanes_config = get_config_param(base_dir, 'inboxLanes')
+            inbox_queue_set_lanes(queue, lanes_config)
+            lane_metrics = inbox_queue_lane_metrics(queue)
+            fitness_queue_metrics(server.fitness, 'INBOX', lane_metrics)
+            # how many duplicate activities were suppressed
+            seen_metrics = inbox_seen_metrics(server.inbox_seen)
+            fitness_queue_metrics(server.fitness, 'INBOX_SEEN',
+                                  seen_metrics)
+            # how many json signature checks were previously verified
+            verified_metrics = verified_cache_metrics()
+            fitness_queue_metrics(server.fitness, 'INBOX_JSONLD_VERIFIED',
+                                  verified_metrics)
+
+            # restart any verification threads which have stopped
+            _start_inbox_verify_threads(server, queue, base_dir, http_prefix,
+                                        person_cache, domain,
+                                        onion_domain, i2p_domain,
+                                        proxy_type, project_version,
+                                        verify_all_signatures,
+                                        signing_priv_key_pem, debug)
 
         curr_time = int(time.time())
 
-        # clear the daily quotas for maximum numbers of received posts
-        if curr_time - quotas_last_update_daily > 60 * 60 * 24:
-            quotas_daily = {
-                'domains': {},
-                'accounts': {}
-            }
-            quotas_last_update_daily = curr_time
-
-        if curr_time - quotas_last_update_per_min > 60:
-            # clear the per minute quotas for maximum numbers of received posts
-            quotas_per_min = {
-                'domains': {},
-                'accounts': {}
-            }
-            # also check if the json signature enforcement has changed
-            verify_all_sigs = get_config_param(base_dir, "verifyAllSignatures")
-            if verify_all_sigs is not None:
-                verify_all_signatures = verify_all_sigs
-            # change the last time that this was done
-            quotas_last_update_per_min = curr_time
-
-        if _inbox_quota_exceeded(queue, queue_filename,
-                                 queue_json, quotas_daily, quotas_per_min,
-                                 domain_max_posts_per_day,
-                                 account_max_posts_per_day, debug):
-            continue
-        fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', '_inbox_quota_exceeded', debug)
-        inbox_start_time = time.time()
-
         # recreate the session periodically
         time_diff = curr_time - session_last_update
         if not session or time_diff > session_restart_interval_secs:
@@ -3351,6 +3668,7 @@ def run_inbox_queue(server,
                 session_last_update = curr_time
             else:
                 print('WARN: inbox session not created')
+                thread_sleep(1)
                 continue
         if onion_domain:
             time_diff = curr_time - session_last_update_onion
@@ -3361,6 +3679,7 @@ def run_inbox_queue(server,
                     session_last_update_onion = curr_time
                 else:
                     print('WARN: inbox onion session not created')
+                    thread_sleep(1)
                     continue
         if i2p_domain:
             time_diff = curr_time - session_last_update_i2p
@@ -3371,181 +3690,35 @@ def run_inbox_queue(server,
                     session_last_update_i2p = curr_time
                 else:
                     print('WARN: inbox i2p session not created')
+                    thread_sleep(1)
                     continue
         fitness_performance(inbox_start_time, server.fitness,
                             'INBOX', 'recreate_session', debug)
         inbox_start_time = time.time()
 
-        curr_session = session
-        if queue_json.get('actor'):
-            if isinstance(queue_json['actor'], str):
-                sender_domain, _ = get_domain_from_actor(queue_json['actor'])
-                if sender_domain:
-                    if sender_domain.endswith('.onion') and \
-                       session_onion and proxy_type != 'tor':
-                        curr_session = session_onion
-                    elif (sender_domain.endswith('.i2p') and
-                          session_i2p and proxy_type != 'i2p'):
-                        curr_session = session_i2p
-
-        if debug and queue_json.get('actor'):
-            print('Obtaining public key for actor ' + queue_json['actor'])
-
-        fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', 'start_get_pubkey', debug)
-        inbox_start_time = time.time()
-        # Try a few times to obtain the public key
-        pub_key = None
-        key_id = None
-        for tries in range(8):
-            key_id = None
-            signature_params = \
-                queue_json['httpHeaders']['signature'].split(',')
-            for signature_item in signature_params:
-                if signature_item.startswith('keyId='):
-                    if '"' in signature_item:
-                        key_id = signature_item.split('"')[1]
-                        break
-            if not key_id:
-                print('Queue: No keyId in signature: ' +
-                      queue_json['httpHeaders']['signature'])
-                pub_key = None
-                break
-
-            pub_key = \
-                get_person_pub_key(base_dir, curr_session, key_id,
-                                   person_cache, debug,
-                                   project_version, http_prefix,
-                                   domain, onion_domain, i2p_domain,
-                                   signing_priv_key_pem,
-                                   server.mitm_servers)
-            fitness_performance(inbox_start_time, server.fitness,
-                                'INBOX', 'get_person_pub_key', debug)
-            inbox_start_time = time.time()
-            if pub_key:
-                if not isinstance(pub_key, dict):
-                    if debug:
-                        print('DEBUG: public key: ' + str(pub_key))
-                else:
-                    if debug:
-                        print('DEBUG: http code error for public key: ' +
-                              str(pub_key))
-                    pub_key = None
-                break
-
-            if debug:
-                print('DEBUG: Retry ' + str(tries+1) +
-                      ' obtaining public key for ' + key_id)
-            time.sleep(1)
-
-        if not pub_key:
-            if debug:
-                print('Queue: public key could not be obtained from ' + key_id)
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 2 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
+        # wait for the next verified item, in order of arrival. This
+        # wakes up as soon as an item is ready, and otherwise times out
+        # so that the periodic checks above still happen
+        item_ready, verified_item, applied_sequence = \
+            inbox_queue_next_verified(queue, 1)
+        if not item_ready:
+            # nothing to do, so commit the journal offset
+            inbox_queue_commit(queue)
             continue
-
-        # check the http header signature
-        fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', 'begin_check_signature', debug)
-        inbox_start_time = time.time()
-        if debug:
-            print('DEBUG: checking http header signature')
-            pprint(queue_json['httpHeaders'])
-        post_str = json.dumps(queue_json['post'])
-        http_signature_failed = False
-        if not verify_post_headers(http_prefix, pub_key,
-                                   queue_json['httpHeaders'],
-                                   queue_json['path'], False,
-                                   queue_json['digest'],
-                                   post_str, debug):
-            http_signature_failed = True
-            print('Queue: Header signature check failed')
-            pprint(queue_json['httpHeaders'])
-        else:
-            if debug:
-                print('DEBUG: http header signature check success')
-        fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', 'verify_post_headers', debug)
-        inbox_start_time = time.time()
-
-        # check if a json signature exists on this post
-        has_json_signature, jwebsig_type = \
-            _check_json_signature(base_dir, queue_json)
+        if not verified_item:
+            # the item was rejected by signature verification
+            continue
+        queue_filename = verified_item['filename']
+        queue_json = verified_item['queueJson']
+        key_id = verified_item['keyId']
         fitness_performance(inbox_start_time, server.fitness,
-                            'INBOX', '_check_json_signature', debug)
+                            'INBOX', 'next_verified', debug)
         inbox_start_time = time.time()
 
-        # strict enforcement of json signatures
-        if not has_json_signature:
-            if http_signature_failed:
-                if jwebsig_type:
-                    print('Queue: Header signature check failed and does ' +
-                          'not have a recognised jsonld signature type ' +
-                          jwebsig_type)
-                else:
-                    print('Queue: Header signature check failed and ' +
-                          'does not have jsonld signature')
-                if debug:
-                    pprint(queue_json['httpHeaders'])
-
-            if verify_all_signatures:
-                original_json = queue_json['original']
-                print('Queue: inbox post does not have a jsonld signature ' +
-                      key_id + ' ' + str(original_json))
-
-            if http_signature_failed or verify_all_signatures:
-                if os.path.isfile(queue_filename):
-                    try:
-                        os.remove(queue_filename)
-                    except OSError:
-                        print('EX: run_inbox_queue 3 unable to delete ' +
-                              str(queue_filename))
-                if len(queue) > 0:
-                    queue.pop(0)
-                continue
-        else:
-            if http_signature_failed or verify_all_signatures:
-                # use the original json message received, not one which
-                # may have been modified along the way
-                original_json = queue_json['original']
-                if not verify_json_signature(original_json, pub_key):
-                    if debug:
-                        print('WARN: jsonld inbox signature check failed ' +
-                              key_id + ' ' + pub_key + ' ' +
-                              str(original_json))
-                    else:
-                        print('WARN: jsonld inbox signature check failed ' +
-                              key_id)
-                    if os.path.isfile(queue_filename):
-                        try:
-                            os.remove(queue_filename)
-                        except OSError:
-                            print('EX: run_inbox_queue 4 unable to delete ' +
-                                  str(queue_filename))
-                    if len(queue) > 0:
-                        queue.pop(0)
-                    fitness_performance(inbox_start_time, server.fitness,
-                                        'INBOX', 'not_verify_signature',
-                                        debug)
-                    inbox_start_time = time.time()
-                    continue
-
-                if http_signature_failed:
-                    print('jsonld inbox signature check success ' +
-                          'via relay ' + key_id)
-                else:
-                    print('jsonld inbox signature check success ' + key_id)
-                fitness_performance(inbox_start_time, server.fitness,
-                                    'INBOX', 'verify_signature_success',
-                                    debug)
-                inbox_start_time = time.time()
+        sender_actor = queue_json.get('actor')
+        curr_session = \
+            _inbox_session_for_actor(sender_actor, proxy_type,
+                                     session, session_onion, session_i2p)
 
         dogwhistles_filename = data_dir(base_dir) + '/dogwhistles.txt'
         if not os.path.isfile(dogwhistles_filename):
@@ -3560,14 +3733,6 @@ def run_inbox_queue(server,
         if receive_undo(base_dir, queue_json['post'],
                         debug, domain, onion_domain, i2p_domain):
             print('Queue: Undo accepted from ' + key_id)
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 5 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             fitness_performance(inbox_start_time, server.fitness,
                                 'INBOX', '_receive_undo',
                                 debug)
@@ -3591,14 +3756,6 @@ def run_inbox_queue(server,
                                    server.followers_sync_cache,
                                    server.sites_unavailable,
                                    server.mitm_servers):
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 6 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             print('Queue: Follow activity for ' + key_id +
                   ' removed from queue')
             fitness_performance(inbox_start_time, server.fitness,
@@ -3614,14 +3771,6 @@ def run_inbox_queue(server,
                                  federation_list, debug,
                                  domain, onion_domain, i2p_domain):
             print('Queue: Accept/Reject received from ' + key_id)
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 7 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             fitness_performance(inbox_start_time, server.fitness,
                                 'INBOX', 'receive_accept_reject',
                                 debug)
@@ -3648,14 +3797,6 @@ def run_inbox_queue(server,
                                  server.mitm_servers):
             if debug:
                 print('Queue: _receive_move_activity ' + key_id)
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 8 unable to receive move ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             fitness_performance(inbox_start_time, server.fitness,
                                 'INBOX', '_receive_move_activity',
                                 debug)
@@ -3689,14 +3830,6 @@ def run_inbox_queue(server,
                                    i2p_domain, server.mitm_servers):
             if debug:
                 print('Queue: Update accepted from ' + key_id)
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 8 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             fitness_performance(inbox_start_time, server.fitness,
                                 'INBOX', '_receive_update_activity',
                                 debug)
@@ -3713,14 +3846,6 @@ def run_inbox_queue(server,
             if debug:
                 print('Queue: no recipients were resolved ' +
                       'for post arriving in inbox')
-            if os.path.isfile(queue_filename):
-                try:
-                    os.remove(queue_filename)
-                except OSError:
-                    print('EX: run_inbox_queue 9 unable to delete ' +
-                          str(queue_filename))
-            if len(queue) > 0:
-                queue.pop(0)
             continue
         fitness_performance(inbox_start_time, server.fitness,
                             'INBOX', '_post_recipients',
@@ -3825,11 +3950,3 @@ def run_inbox_queue(server,
             if debug:
                 pprint(queue_json['post'])
                 print('Queue: Queue post accepted')
-        if os.path.isfile(queue_filename):
-            try:
-                os.remove(queue_filename)
-            except OSError:
-                print('EX: run_inbox_queue 10 unable to delete ' +
-                      str(queue_filename))
-        if len(queue) > 0:
-            queue.pop(0)
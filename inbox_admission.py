@@ -0,0 +1,158 @@
+__filename__ = "inbox_admission.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Security"
+
+# Admission control for incoming posts to the inbox.
+# Each sending domain and each sending actor has a token bucket, which
+# enforces the maximum number of posts per day and also limits how many
+# can arrive in bursts. Buckets are held in dicts in least recently used
+# order, so that the number of senders tracked is bounded and a post
+# which is over quota can be rejected with a single lookup, before
+# anything is written to the inbox queue.
+
+import threading
+
+
+def new_inbox_admission(max_senders: int) -> {}:
+    """Returns a new set of token buckets for inbox admission
+    tracking up to the given number of domains and actors
+    """
+    return {
+        "domains": {},
+        "actors": {},
+        "maxSenders": max_senders,
+        "admitted": 0,
+        "rejected": 0,
+        "lock": threading.Lock()
+    }
+
+
+def _admission_limits(max_posts_per_day: int) -> []:
+    """Returns the token bucket limits for the given daily quota, as
+    a list of (capacity, tokens added per second).
+    The per minute limit allows bursts of at least 5 posts
+    """
+    max_posts_per_min = max(int(max_posts_per_day / (24 * 60)), 5)
+    return [
+        (max_posts_per_day, max_posts_per_day / (24 * 60 * 60)),
+        (max_posts_per_min, max_posts_per_min / 60)
+    ]
+
+
+def _admission_bucket(buckets: {}, key: str, limits: [],
+                      max_senders: int, curr_time: float) -> {}:
+    """Returns the refilled token bucket for the given key, moving it
+    to the most recently used position
+    """
+    bucket = buckets.pop(key, None)
+    if bucket is None:
+        # evict the least recently used sender
+        while len(buckets) >= max_senders:
+            del buckets[next(iter(buckets))]
+        bucket = {
+            "tokens": [capacity for capacity, _ in limits],
+            "updated": curr_time
+        }
+    else:
+        elapsed = max(curr_time - bucket['updated'], 0)
+        for index, limit in enumerate(limits):
+            capacity, refill_per_sec = limit
+            bucket['tokens'][index] = \
+                min(bucket['tokens'][index] + elapsed * refill_per_sec,
+                    capacity)
+        bucket['updated'] = curr_time
+    buckets[key] = bucket
+    return bucket
+
+
+def _admission_wait_secs(bucket: {}, limits: []) -> float:
+    """Returns the number of seconds until a token is available
+    within every level of the given bucket
+    """
+    wait_secs = 0
+    for index, limit in enumerate(limits):
+        tokens = bucket['tokens'][index]
+        if tokens >= 1:
+            continue
+        refill_per_sec = limit[1]
+        if refill_per_sec <= 0:
+            return 24 * 60 * 60
+        wait_secs = max(wait_secs, (1 - tokens) / refill_per_sec)
+    return wait_secs
+
+
+def _admission_checks(admission: {},
+                      post_domain: str, post_handle: str,
+                      domain_max_posts_per_day: int,
+                      account_max_posts_per_day: int) -> []:
+    """Returns the buckets, key and limits for each quota which
+    applies to a post
+    """
+    checks = []
+    if domain_max_posts_per_day > 0:
+        checks.append((admission['domains'], post_domain,
+                       _admission_limits(domain_max_posts_per_day)))
+    if account_max_posts_per_day > 0:
+        checks.append((admission['actors'], post_handle,
+                       _admission_limits(account_max_posts_per_day)))
+    return checks
+
+
+def inbox_admission_check(admission: {},
+                          post_domain: str, post_handle: str,
+                          domain_max_posts_per_day: int,
+                          account_max_posts_per_day: int,
+                          curr_time: float) -> int:
+    """Checks whether a post from the given domain and actor handle
+    can be admitted to the inbox queue.
+    Returns zero if it was admitted, otherwise the number of seconds
+    after which the sender may retry
+    """
+    checks = _admission_checks(admission, post_domain, post_handle,
+                               domain_max_posts_per_day,
+                               account_max_posts_per_day)
+    with admission['lock']:
+        wait_secs = 0
+        buckets_list = []
+        for buckets, key, limits in checks:
+            bucket = _admission_bucket(buckets, key, limits,
+                                       admission['maxSenders'],
+                                       curr_time)
+            wait_secs = max(wait_secs, _admission_wait_secs(bucket, limits))
+            buckets_list.append(bucket)
+        if wait_secs > 0:
+            admission['rejected'] += 1
+            # round up so that a retry does not arrive too early
+            return int(wait_secs) + 1
+        # only take tokens once all of the checks have passed
+        for bucket in buckets_list:
+            for index in range(len(bucket['tokens'])):
+                bucket['tokens'][index] -= 1
+        admission['admitted'] += 1
+    return 0
+
+
+def inbox_admission_refund(admission: {},
+                           post_domain: str, post_handle: str,
+                           domain_max_posts_per_day: int,
+                           account_max_posts_per_day: int) -> None:
+    """Returns the tokens taken for a post which was admitted but then
+    not accepted, eg. because it could not be queued
+    """
+    checks = _admission_checks(admission, post_domain, post_handle,
+                               domain_max_posts_per_day,
+                               account_max_posts_per_day)
+    with admission['lock']:
+        for buckets, key, limits in checks:
+            bucket = buckets.get(key)
+            if not bucket:
+                continue
+            for index, limit in enumerate(limits):
+                bucket['tokens'][index] = \
+                    min(bucket['tokens'][index] + 1, limit[0])
+        admission['admitted'] -= 1
@@ -0,0 +1,280 @@
+__filename__ = "inbox_journal.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Timeline"
+
+# Write-ahead journal for the inbox queue.
+# Each received item is appended as a line of json to the current
+# journal segment, rather than being written to its own file.
+# Items have a sequence number, and the consumer offset is the sequence
+# number below which everything has been processed. The offset, together
+# with any entries beyond it which were consumed out of order, is
+# fsync'd once per batch, and after a crash only the remaining
+# entries are replayed. Segments are removed once all
+# of their entries have been consumed.
+# Appends to a segment are flushed to the operating system but not
+# fsync'd, so received items survive the process crashing but not
+# a power failure or a crash of the operating system.
+
+import os
+import json
+import threading
+
+
+def new_inbox_journal(journal_dir: str) -> {}:
+    """Returns a new inbox journal stored within the given directory
+    """
+    return {
+        "dir": journal_dir,
+        "lock": threading.Lock(),
+        "fp": None,
+        "segment": 0,
+        "segmentBytes": 0,
+        "maxSegmentBytes": 4 * 1024 * 1024,
+        "segments": {},
+        "sequence": 0,
+        "committed": 0,
+        "consumed": set(),
+        "uncommitted": 0,
+        "batchSize": 64
+    }
+
+
+def _journal_segment_filename(journal: {}, segment: int) -> str:
+    """Returns the filename for a journal segment
+    """
+    return journal['dir'] + '/' + str(segment).zfill(8) + '.journal'
+
+
+def _journal_segment_numbers(journal: {}) -> []:
+    """Returns the existing segment numbers in ascending order
+    """
+    segments: list[int] = []
+    if not os.path.isdir(journal['dir']):
+        return segments
+    for _, _, files in os.walk(journal['dir']):
+        for fname in files:
+            if not fname.endswith('.journal'):
+                continue
+            segment_str = fname.split('.')[0]
+            if segment_str.isdigit():
+                segments.append(int(segment_str))
+        break
+    segments.sort()
+    return segments
+
+
+def _journal_load_offset(journal: {}) -> (int, []):
+    """Returns the committed consumer offset and the sequence numbers
+    beyond it which have already been consumed
+    """
+    offset_filename = journal['dir'] + '/offset'
+    if not os.path.isfile(offset_filename):
+        return 0, []
+    offset_json = None
+    try:
+        with open(offset_filename, 'r', encoding='utf-8') as fp_offset:
+            offset_json = json.loads(fp_offset.read())
+    except OSError:
+        print('EX: _journal_load_offset unable to read ' + offset_filename)
+    except json.decoder.JSONDecodeError:
+        print('EX: _journal_load_offset unable to decode ' + offset_filename)
+    if not isinstance(offset_json, dict):
+        return 0, []
+    offset = offset_json.get('committed')
+    consumed = offset_json.get('consumed')
+    if not isinstance(offset, int):
+        return 0, []
+    if not isinstance(consumed, list):
+        consumed = []
+    return offset, consumed
+
+
+def _journal_close_segment(journal: {}) -> None:
+    """Closes the current segment
+    """
+    if not journal['fp']:
+        return
+    try:
+        journal['fp'].close()
+    except OSError:
+        print('EX: _journal_close_segment unable to close segment ' +
+              str(journal['segment']))
+    journal['fp'] = None
+
+
+def _journal_remove_consumed_segments(journal: {}) -> None:
+    """Removes segments which contain only consumed entries
+    """
+    for segment, last_sequence in list(journal['segments'].items()):
+        if segment == journal['segment'] and journal['fp']:
+            continue
+        if last_sequence >= journal['committed']:
+            continue
+        segment_filename = _journal_segment_filename(journal, segment)
+        if os.path.isfile(segment_filename):
+            try:
+                os.remove(segment_filename)
+            except OSError:
+                print('EX: _journal_remove_consumed_segments ' +
+                      'unable to delete ' + segment_filename)
+        del journal['segments'][segment]
+
+
+def inbox_journal_recover(journal: {}) -> []:
+    """Reads the journal and returns the entries which have not yet been
+    consumed, as a list of (sequence number, item) in journal order.
+    Appends afterwards go to a new segment.
+    """
+    entries = []
+    with journal['lock']:
+        _journal_close_segment(journal)
+        offset, consumed = _journal_load_offset(journal)
+        if offset > journal['committed']:
+            journal['committed'] = offset
+        for sequence in consumed:
+            if isinstance(sequence, int) and \
+               sequence >= journal['committed']:
+                journal['consumed'].add(sequence)
+        journal['segments'] = {}
+        segments = _journal_segment_numbers(journal)
+        for segment in segments:
+            segment_filename = _journal_segment_filename(journal, segment)
+            last_sequence = -1
+            try:
+                with open(segment_filename, 'r',
+                          encoding='utf-8') as fp_segment:
+                    for line in fp_segment:
+                        try:
+                            entry = json.loads(line)
+                        except json.decoder.JSONDecodeError:
+                            # incomplete write, eg. after a crash
+                            continue
+                        if not isinstance(entry, dict):
+                            continue
+                        sequence = entry.get('seq')
+                        if not isinstance(sequence, int):
+                            continue
+                        last_sequence = max(last_sequence, sequence)
+                        if sequence >= journal['sequence']:
+                            journal['sequence'] = sequence + 1
+                        if sequence < journal['committed']:
+                            continue
+                        if sequence in journal['consumed']:
+                            continue
+                        if entry.get('item'):
+                            entries.append((sequence, entry['item']))
+            except OSError:
+                print('EX: inbox_journal_recover unable to read ' +
+                      segment_filename)
+            journal['segments'][segment] = last_sequence
+        if segments:
+            journal['segment'] = segments[-1] + 1
+        # if every segment was consumed and removed then the sequence
+        # continues from the offset, so that new entries are not
+        # mistaken for ones which have already been consumed
+        journal['sequence'] = \
+            max([journal['sequence'], journal['committed']] +
+                [sequence + 1 for sequence in journal['consumed']])
+        _journal_remove_consumed_segments(journal)
+    return entries
+
+
+def inbox_journal_append(journal: {}, item: {}) -> int:
+    """Appends an item to the journal and returns its sequence number
+    """
+    with journal['lock']:
+        sequence = journal['sequence']
+        line = json.dumps({"seq": sequence, "item": item}) + '\n'
+        if journal['fp'] and \
+           journal['segmentBytes'] + len(line) > journal['maxSegmentBytes']:
+            # start a new segment
+            _journal_close_segment(journal)
+            journal['segment'] += 1
+        if not journal['fp']:
+            if not os.path.isdir(journal['dir']):
+                os.makedirs(journal['dir'])
+            segment_filename = \
+                _journal_segment_filename(journal, journal['segment'])
+            try:
+                journal['fp'] = open(segment_filename, 'a+',
+                                     encoding='utf-8')
+            except OSError:
+                print('EX: inbox_journal_append unable to open ' +
+                      segment_filename)
+                return None
+            journal['segmentBytes'] = 0
+        try:
+            journal['fp'].write(line)
+            journal['fp'].flush()
+        except OSError:
+            print('EX: inbox_journal_append unable to write segment ' +
+                  str(journal['segment']))
+            return None
+        journal['segmentBytes'] += len(line)
+        journal['segments'][journal['segment']] = sequence
+        journal['sequence'] += 1
+    return sequence
+
+
+def inbox_journal_commit(journal: {}) -> None:
+    """Writes the consumer offset and any entries consumed beyond it
+    to file, and removes any segments which have been fully consumed
+    """
+    with journal['lock']:
+        if journal['uncommitted'] == 0:
+            return
+        if not os.path.isdir(journal['dir']):
+            # nothing has been journalled
+            journal['uncommitted'] = 0
+            return
+        offset_filename = journal['dir'] + '/offset'
+        try:
+            with open(offset_filename + '.new', 'w+',
+                      encoding='utf-8') as fp_offset:
+                offset_json = {
+                    "committed": journal['committed'],
+                    "consumed": sorted(journal['consumed'])
+                }
+                fp_offset.write(json.dumps(offset_json))
+                fp_offset.flush()
+                os.fsync(fp_offset.fileno())
+            os.replace(offset_filename + '.new', offset_filename)
+        except OSError:
+            print('EX: inbox_journal_commit unable to write ' +
+                  offset_filename)
+            return
+        journal['uncommitted'] = 0
+        _journal_remove_consumed_segments(journal)
+
+
+def inbox_journal_consumed(journal: {}, sequence: int) -> None:
+    """Marks an entry as consumed. The offset is committed once
+    per batch of consumed entries
+    """
+    with journal['lock']:
+        if sequence < journal['committed']:
+            return
+        journal['consumed'].add(sequence)
+        # advance the offset past any contiguous consumed entries
+        while journal['committed'] in journal['consumed']:
+            journal['consumed'].remove(journal['committed'])
+            journal['committed'] += 1
+        journal['uncommitted'] += 1
+        batch_complete = journal['uncommitted'] >= journal['batchSize']
+    if batch_complete:
+        inbox_journal_commit(journal)
+
+
+def inbox_journal_clear(journal: {}) -> None:
+    """Marks everything within the journal as consumed
+    """
+    with journal['lock']:
+        journal['consumed'].clear()
+        journal['committed'] = journal['sequence']
+        journal['uncommitted'] += 1
+    inbox_journal_commit(journal)
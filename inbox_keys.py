@@ -0,0 +1,135 @@
+__filename__ = "inbox_keys.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Security"
+
+# Public keys which could not be obtained when verifying inbox items.
+# Rather than retrying while the inbox queue waits, the key id is put
+# into a negative cache with exponential backoff, and any items signed
+# with that key are parked. A background thread then tries to fetch
+# the key again when its backoff has elapsed, and if successful the
+# parked items are put back onto the inbox queue. If the key can't be
+# obtained after several tries then the parked items are dropped.
+
+import threading
+
+# seconds to wait before the first retry
+INBOX_KEYS_INITIAL_BACKOFF = 5
+
+# maximum seconds between retries
+INBOX_KEYS_MAX_BACKOFF = 60 * 60
+
+# number of failed attempts before giving up on a key
+INBOX_KEYS_MAX_FAILURES = 10
+
+
+def new_inbox_keys(max_keys: int, max_parked: int) -> {}:
+    """Returns a new negative cache for public keys, holding up to
+    the given number of key ids and parked inbox items
+    """
+    return {
+        "failed": {},
+        "parked": {},
+        "parkedCount": 0,
+        "maxKeys": max_keys,
+        "maxParked": max_parked,
+        "lock": threading.Lock()
+    }
+
+
+def _inbox_keys_remove(keys: {}, key_id: str) -> []:
+    """Removes a key from the negative cache and returns any items
+    which were parked for it. This should be called with the lock held
+    """
+    keys['failed'].pop(key_id, None)
+    parked_items = keys['parked'].pop(key_id, [])
+    keys['parkedCount'] -= len(parked_items)
+    return parked_items
+
+
+def inbox_keys_failing(keys: {}, key_id: str) -> bool:
+    """Returns True if the given key could not be obtained recently
+    and is waiting to be fetched again
+    """
+    with keys['lock']:
+        return key_id in keys['failed']
+
+
+def inbox_keys_failed(keys: {}, key_id: str, curr_time: float) -> []:
+    """Records a failure to obtain the given key and sets the time
+    when it will next be tried.
+    Returns any parked items which were dropped because the maximum
+    number of failures was reached, or because the oldest key was
+    removed to make room
+    """
+    dropped_items = []
+    with keys['lock']:
+        failed = keys['failed'].pop(key_id, None)
+        if failed is None:
+            failed = {
+                "failures": 0,
+                "retryTime": curr_time
+            }
+            # keep the number of keys bounded by removing the oldest
+            while len(keys['failed']) >= keys['maxKeys']:
+                oldest_key_id = next(iter(keys['failed']))
+                dropped_items += _inbox_keys_remove(keys, oldest_key_id)
+        failed['failures'] += 1
+        if failed['failures'] >= INBOX_KEYS_MAX_FAILURES:
+            return dropped_items + _inbox_keys_remove(keys, key_id)
+        backoff_secs = \
+            INBOX_KEYS_INITIAL_BACKOFF * (2 ** (failed['failures'] - 1))
+        failed['retryTime'] = \
+            curr_time + min(backoff_secs, INBOX_KEYS_MAX_BACKOFF)
+        keys['failed'][key_id] = failed
+    return dropped_items
+
+
+def inbox_keys_park(keys: {}, key_id: str, queue_json: {}) -> bool:
+    """Parks an inbox item until the key with which it was signed
+    has been obtained.
+    Returns False if there is no room to park the item
+    """
+    with keys['lock']:
+        if key_id not in keys['failed']:
+            return False
+        if keys['parkedCount'] >= keys['maxParked']:
+            return False
+        if not keys['parked'].get(key_id):
+            keys['parked'][key_id] = []
+        for parked_json in keys['parked'][key_id]:
+            if parked_json['filename'] == queue_json['filename']:
+                return True
+        keys['parked'][key_id].append(queue_json)
+        keys['parkedCount'] += 1
+    return True
+
+
+def inbox_keys_due(keys: {}, curr_time: float) -> []:
+    """Returns the key ids which are due to be fetched again because
+    items are parked for them. Keys which are due but have no parked
+    items are removed, so that they will be fetched again when the
+    next item signed with them arrives
+    """
+    due = []
+    with keys['lock']:
+        for key_id, failed in list(keys['failed'].items()):
+            if failed['retryTime'] > curr_time:
+                continue
+            if keys['parked'].get(key_id):
+                due.append(key_id)
+            else:
+                del keys['failed'][key_id]
+    return due
+
+
+def inbox_keys_fetched(keys: {}, key_id: str) -> []:
+    """Called when a key has been obtained. Removes it from the negative
+    cache and returns any items which were parked for it
+    """
+    with keys['lock']:
+        return _inbox_keys_remove(keys, key_id)
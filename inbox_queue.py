@@ -0,0 +1,467 @@
+__filename__ = "inbox_queue.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Timeline"
+
+# The inbox queue is a set of lanes, each of which is a priority heap of
+# queue items ordered by arrival time. Items are classified into lanes
+# when they are added, by activity type and by whether they mention
+# a local account, so that a flood of likes and announces doesn't delay
+# follows, deletes and DMs. Lanes are chosen by smooth weighted round
+# robin, so that lower priority lanes are never starved.
+#
+# Items are added by the http POST handler threads and taken by
+# a pool of verifier threads, which sleep on a condition variable
+# rather than polling, so that items are processed as soon as they
+# arrive.
+#
+# Each item taken by a verifier is given a ticket number. Verified
+# items are held until all items with earlier tickets have been
+# verified, so that the inbox queue thread applies them in the same
+# order in which they were taken from the queue.
+#
+# Items are written to a journal when they are added, and marked as
+# consumed once they have been applied, so that any outstanding items
+# can be recovered after a restart. Items which are parked while the
+# public key of their sender is fetched again remain unconsumed within
+# the journal until they are put back onto the queue or dropped, so
+# that they are also recovered after a restart.
+
+import heapq
+import time
+import threading
+from inbox_journal import new_inbox_journal
+from inbox_journal import inbox_journal_append
+from inbox_journal import inbox_journal_consumed
+from inbox_journal import inbox_journal_commit
+from inbox_journal import inbox_journal_clear
+from inbox_journal import inbox_journal_recover
+
+# Default lanes. Items which mention a local account go into the lane
+# having "mentions", and anything not matching a lane goes into "normal".
+# This can be changed with inboxLanes within config.json
+DEFAULT_INBOX_LANES = {
+    "priority": {
+        "weight": 8,
+        "mentions": True,
+        "types": ["Follow", "Accept", "Reject", "Delete",
+                  "Block", "Move", "Flag"]
+    },
+    "normal": {
+        "weight": 4,
+        "types": []
+    },
+    "bulk": {
+        "weight": 1,
+        "types": ["Like", "EmojiReact", "Announce", "Update",
+                  "Add", "Remove", "View", "Read"]
+    }
+}
+
+
+def _new_inbox_lane(weight: int, mentions: bool, types: []) -> {}:
+    """Returns a new empty lane
+    """
+    return {
+        "heap": [],
+        "weight": weight,
+        "mentions": mentions,
+        "types": types,
+        "credit": 0,
+        "waitTotal": float(0),
+        "waitCtr": int(0)
+    }
+
+
+def _new_inbox_lanes(lanes_config: {}) -> {}:
+    """Returns empty lanes for the given lanes configuration
+    """
+    lanes = {}
+    for lane_name, lane_config in lanes_config.items():
+        if not isinstance(lane_config, dict):
+            continue
+        weight = lane_config.get('weight')
+        if not isinstance(weight, int) or weight < 1:
+            weight = 1
+        types = lane_config.get('types')
+        if not isinstance(types, list):
+            types = []
+        mentions = lane_config.get('mentions') is True
+        lanes[lane_name] = _new_inbox_lane(weight, mentions, types)
+    if 'normal' not in lanes:
+        lanes['normal'] = _new_inbox_lane(1, False, [])
+    return lanes
+
+
+def new_inbox_queue(journal_dir: str) -> {}:
+    """Returns a new empty inbox queue, journalled within
+    the given directory
+    """
+    return {
+        "lanes": _new_inbox_lanes(DEFAULT_INBOX_LANES),
+        "lanesConfig": DEFAULT_INBOX_LANES,
+        "queued": 0,
+        "filenames": set(),
+        "ticketsIssued": 0,
+        "ticketsApplied": 0,
+        "verified": {},
+        "inflight": {},
+        "parked": set(),
+        "journal": new_inbox_journal(journal_dir),
+        "condition": threading.Condition()
+    }
+
+
+def inbox_queue_length(queue: {}) -> int:
+    """Returns the number of items within the inbox queue,
+    including any which are being verified or applied
+    """
+    return len(queue['filenames'])
+
+
+def inbox_queue_contains(queue: {}, filename: str) -> bool:
+    """Returns True if the item with the given filename is within
+    the inbox queue
+    """
+    with queue['condition']:
+        return filename in queue['filenames']
+
+
+def _inbox_item_mentions(queue_json: {}) -> bool:
+    """Does the given queue item address or mention an account on
+    the receiving instance?
+    """
+    post_json = queue_json.get('post')
+    if not isinstance(post_json, dict):
+        return False
+    if post_json.get('type') != 'Create':
+        return False
+    object_json = post_json.get('object')
+    if not isinstance(object_json, dict):
+        return False
+    if not isinstance(queue_json.get('domain'), str):
+        return False
+    local_str = '://' + queue_json['domain'] + '/'
+    for field_name in ('to', 'cc'):
+        recipients = object_json.get(field_name)
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if not isinstance(recipients, list):
+            continue
+        for recipient in recipients:
+            if isinstance(recipient, str) and local_str in recipient:
+                return True
+    tags = object_json.get('tag')
+    if isinstance(tags, list):
+        for tag in tags:
+            if not isinstance(tag, dict):
+                continue
+            if tag.get('type') != 'Mention':
+                continue
+            if isinstance(tag.get('href'), str) and \
+               local_str in tag['href']:
+                return True
+    return False
+
+
+def _inbox_queue_lane(queue: {}, queue_json: {}) -> str:
+    """Returns the name of the lane for the given queue item
+    """
+    post_json = queue_json.get('post')
+    activity_type = None
+    if isinstance(post_json, dict):
+        activity_type = post_json.get('type')
+    mentions = None
+    for lane_name, lane in queue['lanes'].items():
+        if activity_type in lane['types']:
+            return lane_name
+        if lane['mentions']:
+            if mentions is None:
+                mentions = _inbox_item_mentions(queue_json)
+            if mentions:
+                return lane_name
+    return 'normal'
+
+
+def _inbox_queue_push(queue: {}, queue_json: {}, arrival_time: float,
+                      sequence: int) -> None:
+    """Pushes an item onto the heap for its lane. This should be called
+    with the queue condition held
+    """
+    queue['filenames'].add(queue_json['filename'])
+    lane_name = _inbox_queue_lane(queue, queue_json)
+    # the journal sequence number keeps items which arrived at the
+    # same time in the order that they were added
+    heapq.heappush(queue['lanes'][lane_name]['heap'],
+                   (arrival_time, sequence, queue_json))
+    queue['queued'] += 1
+    queue['condition'].notify_all()
+
+
+def _inbox_queue_next_lane(queue: {}) -> {}:
+    """Returns the lane to take the next item from, using smooth
+    weighted round robin over the lanes which have items, so that
+    each lane gets a share of the items taken in proportion to
+    its weight. This should be called with the queue condition held
+    """
+    total_weight = 0
+    next_lane = None
+    for lane in queue['lanes'].values():
+        if not lane['heap']:
+            continue
+        lane['credit'] += lane['weight']
+        total_weight += lane['weight']
+        if next_lane is None or lane['credit'] > next_lane['credit']:
+            next_lane = lane
+    if next_lane:
+        next_lane['credit'] -= total_weight
+    return next_lane
+
+
+def inbox_queue_add(queue: {}, queue_json: {},
+                    arrival_time: float) -> bool:
+    """Adds an item to the inbox queue, writes it to the journal and
+    wakes up the verifier threads.
+    Returns False if the item is already queued or could not be
+    written to the journal
+    """
+    with queue['condition']:
+        if queue_json['filename'] in queue['filenames']:
+            return False
+        sequence = inbox_journal_append(queue['journal'], queue_json)
+        if sequence is None:
+            return False
+        _inbox_queue_push(queue, queue_json, arrival_time, sequence)
+    return True
+
+
+def inbox_queue_take(queue: {}) -> (int, {}):
+    """Removes the oldest queue item for verification and
+    returns it together with its ticket number.
+    Returns None, None if the queue is empty
+    """
+    with queue['condition']:
+        lane = _inbox_queue_next_lane(queue)
+        if not lane:
+            return None, None
+        arrival_time, sequence, queue_json = heapq.heappop(lane['heap'])
+        queue['queued'] -= 1
+        # average time spent waiting within the lane
+        lane['waitTotal'] += max(time.time() - arrival_time, 0)
+        lane['waitCtr'] += 1
+        if lane['waitCtr'] >= 1024:
+            lane['waitTotal'] /= 2
+            lane['waitCtr'] = int(lane['waitCtr'] / 2)
+        ticket = queue['ticketsIssued']
+        queue['ticketsIssued'] += 1
+        # the item remains known to the queue until it has been
+        # applied, so that it can't be added twice
+        queue['inflight'][ticket] = (sequence, queue_json['filename'])
+    return ticket, queue_json
+
+
+def inbox_queue_verified(queue: {}, ticket: int, verified_item: {}) -> None:
+    """Hands on the result of verifying the item with the given ticket.
+    verified_item is None if the item was rejected
+    """
+    with queue['condition']:
+        if ticket < queue['ticketsApplied']:
+            # the queue was cleared while this item was being verified
+            return
+        queue['verified'][ticket] = verified_item
+        queue['condition'].notify_all()
+
+
+def inbox_queue_next_verified(queue: {},
+                              timeout_secs: float) -> (bool, {}, int):
+    """Waits for the next verified item, in the order in which items
+    were taken from the queue.
+    Returns True, the verified item, which is None if it was rejected,
+    and its journal sequence number, which should be passed to
+    inbox_queue_done once the item has been applied.
+    Returns False if nothing was ready before the timeout
+    """
+    with queue['condition']:
+        ready = queue['condition'].wait_for(
+            lambda: queue['ticketsApplied'] in queue['verified'],
+            timeout_secs)
+        if not ready:
+            return False, None, None
+        ticket = queue['ticketsApplied']
+        verified_item = queue['verified'].pop(ticket)
+        sequence = queue['inflight'][ticket][0]
+        queue['ticketsApplied'] += 1
+    return True, verified_item, sequence
+
+
+def inbox_queue_done(queue: {}, sequence: int) -> None:
+    """Called when an item has been applied, so that it is removed from
+    the queue and marked as consumed within the journal. Parked items
+    are removed from the queue but not consumed
+    """
+    with queue['condition']:
+        for ticket, inflight in queue['inflight'].items():
+            if inflight[0] != sequence:
+                continue
+            queue['filenames'].discard(inflight[1])
+            del queue['inflight'][ticket]
+            break
+        if sequence in queue['parked']:
+            return
+    inbox_journal_consumed(queue['journal'], sequence)
+
+
+def inbox_queue_park(queue: {}, ticket: int) -> int:
+    """Called when the item with the given ticket is being verified and
+    is to be parked until the public key of its sender is obtained.
+    Its journal entry is not consumed when it is done, so that it can be
+    recovered after a restart.
+    Returns the journal sequence number of the item, which should be
+    passed to inbox_queue_requeue or inbox_queue_unpark
+    """
+    with queue['condition']:
+        inflight = queue['inflight'].get(ticket)
+        if not inflight:
+            return None
+        queue['parked'].add(inflight[0])
+        return inflight[0]
+
+
+def inbox_queue_unpark(queue: {}, sequence: int) -> None:
+    """Called when a parked item is dropped, so that it is marked as
+    consumed within the journal
+    """
+    with queue['condition']:
+        if sequence not in queue['parked']:
+            # the queue was restored from the journal or cleared
+            # since the item was parked
+            return
+        queue['parked'].remove(sequence)
+    inbox_journal_consumed(queue['journal'], sequence)
+
+
+def inbox_queue_requeue(queue: {}, queue_json: {}, sequence: int,
+                        arrival_time: float) -> bool:
+    """Puts a parked item back onto the queue. It is written to the
+    journal again before its previous entry is consumed, so that it
+    can't be lost if there is a crash in between.
+    Returns False if the item was not requeued
+    """
+    with queue['condition']:
+        if sequence not in queue['parked']:
+            # the queue was restored from the journal or cleared
+            # since the item was parked
+            return False
+        if queue_json['filename'] in queue['filenames']:
+            # still being applied, so leave it within the journal to be
+            # recovered after a restart
+            return False
+        new_sequence = inbox_journal_append(queue['journal'], queue_json)
+        if new_sequence is None:
+            return False
+        _inbox_queue_push(queue, queue_json, arrival_time, new_sequence)
+        queue['parked'].remove(sequence)
+    inbox_journal_consumed(queue['journal'], sequence)
+    return True
+
+
+def inbox_queue_commit(queue: {}) -> None:
+    """Commits the journal offset, eg. when the queue becomes idle
+    """
+    inbox_journal_commit(queue['journal'])
+
+
+def _inbox_queue_reset(queue: {}) -> None:
+    """Removes all items from memory and abandons any which are
+    currently being verified. This should be called with the queue
+    condition held
+    """
+    for lane in queue['lanes'].values():
+        lane['heap'].clear()
+        lane['credit'] = 0
+    queue['queued'] = 0
+    queue['filenames'].clear()
+    queue['verified'].clear()
+    queue['inflight'].clear()
+    queue['parked'].clear()
+    queue['ticketsApplied'] = queue['ticketsIssued']
+
+
+def inbox_queue_clear(queue: {}) -> None:
+    """Discards all items within the inbox queue and its journal
+    """
+    with queue['condition']:
+        _inbox_queue_reset(queue)
+        inbox_journal_clear(queue['journal'])
+
+
+def inbox_queue_restore(queue: {}, arrival_time: float) -> int:
+    """Restores any items within the journal which have not yet been
+    applied, eg. after a crash or a restart of the inbox queue thread.
+    Returns the number of items restored
+    """
+    restored = 0
+    with queue['condition']:
+        _inbox_queue_reset(queue)
+        entries = inbox_journal_recover(queue['journal'])
+        for sequence, queue_json in entries:
+            if not queue_json.get('filename') or \
+               queue_json['filename'] in queue['filenames']:
+                inbox_journal_consumed(queue['journal'], sequence)
+                continue
+            _inbox_queue_push(queue, queue_json, arrival_time, sequence)
+            restored += 1
+    return restored
+
+
+def inbox_queue_wait(queue: {}, timeout_secs: float) -> bool:
+    """Waits until there is something in the inbox queue, or until
+    the timeout is reached.
+    Returns True if the queue is not empty
+    """
+    with queue['condition']:
+        return queue['condition'].wait_for(
+            lambda: queue['queued'] > 0, timeout_secs)
+
+
+def inbox_queue_set_lanes(queue: {}, lanes_config: {}) -> None:
+    """Changes the lanes configuration, moving any queued items
+    into the new lanes
+    """
+    if not isinstance(lanes_config, dict):
+        lanes_config = DEFAULT_INBOX_LANES
+    with queue['condition']:
+        if lanes_config == queue['lanesConfig']:
+            return
+        entries = []
+        for lane in queue['lanes'].values():
+            entries += lane['heap']
+        queue['lanes'] = _new_inbox_lanes(lanes_config)
+        queue['lanesConfig'] = lanes_config
+        queue['queued'] = 0
+        for arrival_time, sequence, queue_json in entries:
+            lane_name = _inbox_queue_lane(queue, queue_json)
+            heapq.heappush(queue['lanes'][lane_name]['heap'],
+                           (arrival_time, sequence, queue_json))
+            queue['queued'] += 1
+
+
+def inbox_queue_lane_metrics(queue: {}) -> {}:
+    """Returns the depth of each lane and the average time in seconds
+    which items have waited within it
+    """
+    metrics = {}
+    with queue['condition']:
+        for lane_name, lane in queue['lanes'].items():
+            wait_secs = 0
+            if lane['waitCtr'] > 0:
+                wait_secs = lane['waitTotal'] / lane['waitCtr']
+            metrics[lane_name] = {
+                "depth": len(lane['heap']),
+                "waitSecs": wait_secs
+            }
+    return metrics
@@ -76,6 +76,8 @@ from announce import is_self_announce
 from speaker import update_speaker
 from webapp_post import individual_post_as_html
 from webapp_hashtagswarm import store_hash_tags
+from delivery_targets import delivery_targets_update_actor
+from delivery_targets import delivery_targets_forget_actor
 
 
 def inbox_update_index(boxname: str, base_dir: str, handle: str,
@@ -238,6 +240,8 @@ def _person_receive_update(base_dir: str,
     # save to cache in memory
     store_person_in_cache(base_dir, idx, person_json,
                           person_cache, True)
+    # update the inbox to which posts are delivered
+    delivery_targets_update_actor(base_dir, person_json)
     # save to cache on file
     if save_json(person_json, actor_filename):
         if debug:
@@ -579,6 +583,9 @@ def receive_move_activity(session, base_dir: str,
     if not previous_actor:
         print('INBOX: Move activity previous actor not found: ' +
               str(message_json))
+    else:
+        # posts should no longer be delivered to the previous actor
+        delivery_targets_forget_actor(base_dir, previous_actor)
     moved_actor = message_json['target']
     # are we following the previous actor?
     if not is_following_actor(base_dir, nickname, domain, previous_actor):
@@ -1574,6 +1581,9 @@ def receive_delete(handle: str, base_dir: str,
     domain_full = get_full_domain(domain, port)
     delete_prefix = http_prefix + '://' + domain_full + '/'
     actor_url = get_actor_from_post(message_json)
+    if message_json['object'] == actor_url:
+        # an account was deleted, so don't deliver posts to it
+        delivery_targets_forget_actor(base_dir, actor_url)
     if (not allow_deletion and
         (not message_json['object'].startswith(delete_prefix) or
          not actor_url.startswith(delete_prefix))):
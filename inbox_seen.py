@@ -0,0 +1,165 @@
+__filename__ = "inbox_seen.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Timeline"
+
+# Recently received activities, so that copies of the same activity
+# arriving via the shared inbox and personal inboxes, from relays or
+# as retries by the sender can be acknowledged without being queued.
+# Activities are keyed by their id together with a digest of the
+# message body. Keys are held in two generations, which rotate when
+# the time window has elapsed or the current generation is full, so
+# that memory is bounded and lookups are a couple of dict accesses.
+# An activity is only remembered once its signature has been verified,
+# so that a forged copy can't cause the genuine one to be dropped.
+# While a copy is being verified it is in flight, and any other copies
+# are asked to try again later rather than being queued or acknowledged.
+
+import hashlib
+import threading
+
+# seconds after which other copies may try again while a copy is
+# in flight
+INBOX_SEEN_RETRY_SECS = 30
+
+# seconds after which an activity is no longer considered to be in
+# flight, eg. if it was discarded when the queue was cleared
+INBOX_SEEN_INFLIGHT_SECS = 5 * 60
+
+
+def new_inbox_seen(max_entries: int, window_secs: int) -> {}:
+    """Returns a new set of recently received activities
+    """
+    return {
+        "current": {},
+        "previous": {},
+        "inflight": {},
+        "rotated": 0,
+        "maxEntries": max_entries,
+        "windowSecs": window_secs,
+        "received": 0,
+        "suppressed": 0,
+        "deferred": 0,
+        "lock": threading.Lock()
+    }
+
+
+def inbox_seen_key(activity_id: str, message_bytes: bytes) -> str:
+    """Returns the key for an activity with the given id and body
+    """
+    if not activity_id:
+        return None
+    digest = hashlib.sha256(message_bytes).hexdigest()
+    return activity_id + ' ' + digest
+
+
+def _inbox_seen_rotate(seen: {}, curr_time: float) -> None:
+    """Starts a new generation if the time window has elapsed or
+    the current generation is full. This should be called with
+    the lock held
+    """
+    if curr_time - seen['rotated'] < seen['windowSecs'] and \
+       len(seen['current']) < seen['maxEntries']:
+        return
+    seen['previous'] = seen['current']
+    seen['current'] = {}
+    seen['rotated'] = curr_time
+    for key, inflight_time in list(seen['inflight'].items()):
+        if curr_time - inflight_time >= INBOX_SEEN_INFLIGHT_SECS:
+            del seen['inflight'][key]
+
+
+def inbox_seen_contains(seen: {}, key: str, curr_time: float) -> bool:
+    """Returns True if an activity with the given key was
+    received recently
+    """
+    if not key:
+        return False
+    with seen['lock']:
+        _inbox_seen_rotate(seen, curr_time)
+        seen['received'] += 1
+        if key in seen['current'] or key in seen['previous']:
+            seen['suppressed'] += 1
+            return True
+    return False
+
+
+def inbox_seen_inflight(seen: {}, key: str, curr_time: float) -> bool:
+    """Returns True if a copy of the activity with the given key
+    is currently being verified
+    """
+    if not key:
+        return False
+    with seen['lock']:
+        inflight_time = seen['inflight'].get(key)
+        if inflight_time is None:
+            return False
+        if curr_time - inflight_time >= INBOX_SEEN_INFLIGHT_SECS:
+            return False
+        seen['deferred'] += 1
+    return True
+
+
+def inbox_seen_begin(seen: {}, key: str, curr_time: float) -> bool:
+    """Called when a copy of an activity is about to be queued.
+    Returns False if another copy is already in flight
+    """
+    if not key:
+        return True
+    with seen['lock']:
+        inflight_time = seen['inflight'].get(key)
+        if inflight_time is not None and \
+           curr_time - inflight_time < INBOX_SEEN_INFLIGHT_SECS:
+            seen['deferred'] += 1
+            return False
+        if len(seen['inflight']) < seen['maxEntries']:
+            seen['inflight'][key] = curr_time
+    return True
+
+
+def inbox_seen_add(seen: {}, key: str, curr_time: float) -> None:
+    """Remembers that an activity with the given key has been received
+    and its signature verified
+    """
+    if not key:
+        return
+    with seen['lock']:
+        _inbox_seen_rotate(seen, curr_time)
+        seen['inflight'].pop(key, None)
+        seen['current'][key] = True
+
+
+def inbox_seen_forget(seen: {}, key: str) -> None:
+    """Called when a copy of an activity which was in flight was
+    rejected, parked or not queued, so that other copies are accepted
+    """
+    if not key:
+        return
+    with seen['lock']:
+        seen['inflight'].pop(key, None)
+
+
+def inbox_seen_metrics(seen: {}) -> {}:
+    """Returns the number of activities received, the percentage
+    of them which were suppressed as duplicates and the number of
+    copies which were asked to try again while another was in flight
+    """
+    with seen['lock']:
+        received = seen['received']
+        suppressed = seen['suppressed']
+        deferred = seen['deferred']
+        inflight = len(seen['inflight'])
+    suppression_rate = 0
+    if received > 0:
+        suppression_rate = suppressed * 100 / received
+    return {
+        "received": received,
+        "suppressed": suppressed,
+        "suppressionRate": suppression_rate,
+        "deferred": deferred,
+        "inflight": inflight
+    }
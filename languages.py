@@ -167,7 +167,7 @@ def libretranslate_languages(url: str, api_key: str) -> []:
     req = request.Request(url, data=url_params.encode())
 
     response_str = ''
-    with request.urlopen(req) as response:
+    with request.urlopen(req, timeout=30) as response:
         response_str = response.read().decode()
 
     try:
@@ -282,7 +282,7 @@ def libretranslate(url: str, text: str,
     req = request.Request(url, data=url_params.encode())
     response_str = None
     try:
-        with request.urlopen(req) as response:
+        with request.urlopen(req, timeout=30) as response:
             response_str = response.read().decode()
     except BaseException as ex:
         print('EX: Unable to translate: ' + text + ' ' + str(ex))
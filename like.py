@@ -156,7 +156,7 @@ def _create_like(recent_posts_cache: {},
                          signing_priv_key_pem, 7367374,
                          curr_domain, onion_domain, i2p_domain,
                          extra_headers, sites_unavailable,
-                         system_language, mitm_servers)
+                         system_language, mitm_servers, None)
 
     return new_like_json
 
@@ -9,20 +9,34 @@ __email__ = "bob@libreserver.org"
 __status__ = "Production"
 __module_group__ = "Security"
 
+import json
 import random
 import base64
 import hashlib
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
+import threading
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import utils as hazutils
 from pyjsonld import normalize
+from pyjsonld import JsonLdError
 from context import has_valid_context
+from httpsig import load_cached_private_key
+from httpsig import load_cached_public_key
 from utils import get_sha_256
 from utils import date_utcnow
 
+# Results of previous json signature verifications, keyed by the
+# creator key id, a digest of the document and the signature value.
+# Retries and duplicates arriving via shared inboxes or relays can
+# then be checked without normalizing the document again
+VERIFIED_CACHE = {
+    "results": {},
+    "maxResults": 4096,
+    "hits": 0,
+    "misses": 0,
+    "lock": threading.Lock()
+}
+
 
 def _options_hash(doc: {}) -> str:
     """Returns a hash of the signature, with a few fields removed
@@ -72,11 +86,45 @@ def verify_json_signature(doc: {}, public_key_pem: str) -> bool:
     """
     if not has_valid_context(doc):
         return False
-    pubkey = load_pem_public_key(public_key_pem.encode('utf-8'),
-                                 backend=default_backend())
-    to_be_signed = _options_hash(doc) + _doc_hash(doc)
     signature = doc["signature"]["signatureValue"]
 
+    # has this document been verified previously?
+    doc_str = json.dumps(doc, sort_keys=True) + public_key_pem
+    doc_digest = hashlib.sha256(doc_str.encode("utf-8")).hexdigest()
+    cache_key = \
+        str(doc["signature"].get("creator")) + ' ' + doc_digest + ' ' + \
+        str(signature)
+    with VERIFIED_CACHE['lock']:
+        verified = VERIFIED_CACHE['results'].pop(cache_key, None)
+        if verified is not None:
+            VERIFIED_CACHE['results'][cache_key] = verified
+            VERIFIED_CACHE['hits'] += 1
+            return verified
+        VERIFIED_CACHE['misses'] += 1
+
+    verified = _verify_json_signature(doc, public_key_pem, signature)
+
+    with VERIFIED_CACHE['lock']:
+        while len(VERIFIED_CACHE['results']) >= \
+                VERIFIED_CACHE['maxResults']:
+            oldest_key = next(iter(VERIFIED_CACHE['results']))
+            del VERIFIED_CACHE['results'][oldest_key]
+        VERIFIED_CACHE['results'][cache_key] = verified
+    return verified
+
+
+def _verify_json_signature(doc: {}, public_key_pem: str,
+                           signature: str) -> bool:
+    """Returns True if the given signature of the document
+    can be verified with the public key
+    """
+    try:
+        to_be_signed = _options_hash(doc) + _doc_hash(doc)
+    except JsonLdError as ex:
+        print('EX: verify_json_signature unable to normalize ' + str(ex))
+        return False
+    pubkey = load_cached_public_key(public_key_pem)
+
     digest = get_sha_256(to_be_signed.encode("utf-8"))
     base64sig = base64.b64decode(signature)
 
@@ -92,6 +140,25 @@ def verify_json_signature(doc: {}, public_key_pem: str) -> bool:
         return False
 
 
+def verified_cache_metrics() -> {}:
+    """Returns the number of cached json signature verifications
+    and the hit rate as a percentage
+    """
+    with VERIFIED_CACHE['lock']:
+        hits = VERIFIED_CACHE['hits']
+        misses = VERIFIED_CACHE['misses']
+        no_of_results = len(VERIFIED_CACHE['results'])
+    hit_rate = 0
+    if hits + misses > 0:
+        hit_rate = hits * 100 / (hits + misses)
+    return {
+        "results": no_of_results,
+        "hits": hits,
+        "misses": misses,
+        "hitRate": hit_rate
+    }
+
+
 def generate_json_signature(doc: {}, private_key_pem: str,
                             debug: bool) -> None:
     """Adds a json signature to the given ActivityPub post
@@ -113,8 +180,7 @@ def generate_json_signature(doc: {}, private_key_pem: str,
     doc["signature"] = options
     to_be_signed = _options_hash(doc) + _doc_hash(doc)
 
-    key = load_pem_private_key(private_key_pem.encode('utf-8'),
-                               None, backend=default_backend())
+    key = load_cached_private_key(private_key_pem)
     if debug:
         print('DEBUG: generate_json_signature get_sha_256')
     digest = get_sha_256(to_be_signed.encode("utf-8"))
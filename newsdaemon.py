@@ -14,7 +14,6 @@ __module_group__ = "Web Interface Columns"
 # if #unwantedtag then block
 
 import os
-import time
 import html
 from shutil import rmtree
 from subprocess import Popen
@@ -39,6 +38,7 @@ from utils import text_in_file
 from utils import data_dir
 from session import create_session
 from threads import begin_thread
+from threads import thread_sleep
 from webapp_hashtagswarm import store_hash_tags
 
 
@@ -814,7 +814,7 @@ def run_newswire_daemon(base_dir: str, httpd,
 
     print('Starting newswire daemon')
     # initial sleep to allow the system to start up
-    time.sleep(50)
+    thread_sleep(50)
     while True:
         # has the session been created yet?
         if not httpd.session:
@@ -822,7 +822,7 @@ def run_newswire_daemon(base_dir: str, httpd,
             httpd.session = create_session(httpd.proxy_type)
             if not httpd.session:
                 print('Newswire daemon has no session')
-                time.sleep(60)
+                thread_sleep(60)
                 continue
             print('Newswire daemon session established')
 
@@ -883,7 +883,7 @@ def run_newswire_daemon(base_dir: str, httpd,
 
         # wait a while before the next feeds update
         for _ in range(360):
-            time.sleep(10)
+            thread_sleep(10)
             # if a new blog post has been created then stop
             # waiting and recalculate the newswire
             if not os.path.isfile(refresh_filename):
@@ -896,20 +896,15 @@ def run_newswire_daemon(base_dir: str, httpd,
             break
 
 
-def run_newswire_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the newswire update thread running even if it dies
+def supervise_newswire_daemon(httpd) -> None:
+    """Restarts the newswire update thread if it has died.
+    This is run periodically by the scheduler
     """
-    print('THREAD: Starting newswire watchdog')
-    newswire_original = \
-        httpd.thrPostSchedule.clone(run_newswire_daemon)
-    begin_thread(httpd.thrNewswireDaemon, 'run_newswire_watchdog')
-    while True:
-        time.sleep(50)
-        if httpd.thrNewswireDaemon.is_alive():
-            continue
-        httpd.thrNewswireDaemon.kill()
-        print('THREAD: restarting newswire watchdog')
-        httpd.thrNewswireDaemon = \
-            newswire_original.clone(run_newswire_daemon)
-        begin_thread(httpd.thrNewswireDaemon, 'run_newswire_watchdog 2')
-        print('Restarting newswire daemon...')
+    if httpd.thrNewswireDaemon.is_alive():
+        return
+    httpd.thrNewswireDaemon.kill()
+    print('THREAD: restarting newswire daemon')
+    httpd.thrNewswireDaemon = \
+        httpd.thrNewswireDaemon.clone(run_newswire_daemon)
+    begin_thread(httpd.thrNewswireDaemon, 'supervise_newswire_daemon')
+    print('Restarting newswire daemon...')
@@ -13,12 +13,12 @@ import datetime
 import os
 import shutil
 import sys
-import time
 import random
 from time import gmtime, strftime
 from collections import OrderedDict
 from threads import thread_with_trace
 from threads import begin_thread
+from threads import thread_check_cancelled
 from cache import get_actor_public_key_from_id
 from cache import store_person_in_cache
 from cache import get_person_from_cache
@@ -32,6 +32,18 @@ from session import post_image
 from session import get_json_valid
 from webfinger import webfinger_handle
 from httpsig import create_signed_header
+from httpsig import message_content_digest
+from delivery import DELIVERY_ENGINE
+from delivery import delivery_add
+from delivery import delivery_load
+from delivery import delivery_rejected
+from delivery import delivery_fanout_begin
+from delivery import delivery_fanout_end
+from delivery_targets import delivery_targets_inbox
+from delivery_targets import delivery_targets_set_inbox
+from delivery_targets import delivery_targets_shared_inbox
+from delivery_targets import delivery_targets_set_shared_inbox
+from delivery_targets import delivery_targets_save
 from siteactive import site_is_active
 from languages import understood_post_language
 from flags import is_evil
@@ -70,6 +82,7 @@ from utils import get_base_content_from_post
 from utils import remove_domain_port
 from utils import get_port_from_domain
 from utils import has_object_dict
+from utils import get_recent_cached_post
 from utils import reject_post_id
 from utils import remove_invalid_chars
 from utils import file_last_modified
@@ -2958,111 +2971,232 @@ def _remove_send_block(base_dir: str, nickname: str, domain: str,
                   send_block_filename)
 
 
-def thread_send_post(session, post_json_str: str, federation_list: [],
-                     inbox_url: str, base_dir: str,
-                     signature_header_json: {},
-                     signature_header_json_ld: {},
-                     post_log: [], debug: bool,
-                     http_prefix: str, domain_full: str,
-                     nickname: str, domain: str) -> None:
-    """Sends a with retries
+def _delivery_signed_headers(delivery: {}, private_key_pem: str,
+                             content_type: str) -> {}:
+    """Returns the http signature headers for an attempt to make
+    a delivery. These are created for each attempt, so that the
+    date is current
     """
-    tries = 0
-    send_interval_sec = 30
-    for _ in range(20):
+    signature_header_json = \
+        create_signed_header(None, private_key_pem, delivery['nickname'],
+                             delivery['domain'], delivery['port'],
+                             delivery['toDomain'], delivery['toPort'],
+                             delivery['postPath'], delivery['httpPrefix'],
+                             True, delivery['body'], content_type,
+                             delivery['bodyDigest'])
+    extra_headers = delivery['extraHeaders']
+    if content_type == 'application/ld+json':
+        extra_headers = delivery['extraHeadersLd']
+    for header_title, header_text in extra_headers.items():
+        signature_header_json[header_title] = header_text
+    return signature_header_json
+
+
+def _add_delivery(session, post_json_str: str, body_digest: str,
+                  inbox_url: str, base_dir: str,
+                  nickname: str, domain: str, port: int,
+                  account_domain: str,
+                  to_domain: str, to_port: int, post_path: str,
+                  http_prefix: str, extra_headers: {},
+                  extra_headers_ld: {}, private_key_pem: str,
+                  federation_list: [], post_log: [], debug: bool,
+                  fanout_id: str, activity_id: str) -> bool:
+    """Adds a post to the delivery queue for the host of the given inbox.
+    The delivery is stored so that it can resume after a restart.
+    If the same activity with the same body was recently queued for
+    the same inbox, eg. a shared inbox of followers of several local
+    accounts, then it is not sent again
+    """
+    if not body_digest:
+        body_digest = message_content_digest(post_json_str, 'rsa-sha256')
+    delivery = {
+        "body": post_json_str,
+        "bodyDigest": body_digest,
+        "baseDir": base_dir,
+        "nickname": nickname,
+        "domain": domain,
+        "port": port,
+        "accountDomain": account_domain,
+        "toDomain": to_domain,
+        "toPort": to_port,
+        "postPath": post_path,
+        "httpPrefix": http_prefix,
+        "extraHeaders": extra_headers,
+        "extraHeadersLd": extra_headers_ld
+    }
+    if fanout_id:
+        delivery['fanout'] = fanout_id
+    if activity_id and isinstance(activity_id, str):
+        delivery['coalesce'] = activity_id
+    delivery_args = (session, delivery, private_key_pem,
+                     federation_list, post_log, debug)
+    queue_dir = data_dir(base_dir) + '/deliveries'
+    return delivery_add(DELIVERY_ENGINE, inbox_url, deliver_post,
+                        delivery_args, delivery, queue_dir)
+
+
+def restore_deliveries(base_dir: str, proxy_type: str,
+                       federation_list: [], post_log: [],
+                       debug: bool) -> int:
+    """Resumes deliveries which were queued before a restart.
+    Returns the number of deliveries resumed
+    """
+    queue_dir = data_dir(base_dir) + '/deliveries'
+    sessions = {}
+    private_keys = {}
+    ctr = 0
+    for delivery in delivery_load(queue_dir):
+        inbox_url = delivery['inboxUrl']
+        session_type = proxy_type
+        if delivery.get('toDomain', '').endswith('.onion'):
+            session_type = 'tor'
+        elif delivery.get('toDomain', '').endswith('.i2p'):
+            session_type = 'i2p'
+        if session_type not in sessions:
+            sessions[session_type] = create_session(session_type)
+        nickname = delivery.get('nickname', '')
+        account_domain = delivery.get('accountDomain', '')
+        account_handle = nickname + '@' + account_domain
+        if account_handle not in private_keys:
+            private_keys[account_handle] = \
+                get_person_key(nickname, account_domain,
+                               base_dir, 'private', debug)
+        delivery_args = (sessions[session_type], delivery,
+                         private_keys[account_handle],
+                         federation_list, post_log, debug)
+        if delivery_add(DELIVERY_ENGINE, inbox_url, deliver_post,
+                        delivery_args, delivery, queue_dir):
+            ctr += 1
+    if ctr > 0:
+        print('Resumed ' + str(ctr) + ' deliveries')
+    return ctr
+
+
+def deliver_post(session, delivery: {}, private_key_pem: str,
+                 federation_list: [], post_log: [], debug: bool,
+                 tries: int) -> bool:
+    """Makes an attempt to send a post to an inbox.
+    This is called by the delivery engine, and tries is the number of
+    previous attempts.
+    Returns True if the post should be sent again later. It isn't sent
+    again if the inbox is gone or the post was not accepted
+    """
+    inbox_url = delivery['inboxUrl']
+    post_json_str = delivery['body']
+    base_dir = delivery['baseDir']
+    http_prefix = delivery['httpPrefix']
+    nickname = delivery['nickname']
+    domain = delivery['domain']
+    domain_full = get_full_domain(domain, delivery['port'])
+    if not private_key_pem:
+        print('WARN: deliver_post no private key for ' +
+              nickname + '@' + delivery['accountDomain'])
+        return False
+    signature_header_json = \
+        _delivery_signed_headers(delivery, private_key_pem,
+                                 'application/activity+json')
+    post_result = None
+    unauthorized = False
+    if debug:
+        print('Getting post_json_string for ' + inbox_url)
+    try:
+        post_result, unauthorized, return_code = \
+            post_json_string(session, post_json_str, federation_list,
+                             inbox_url, signature_header_json,
+                             debug, http_prefix, domain_full)
+        if return_code in range(500, 600):
+            # if an instance is returning a code which indicates that
+            # it might have a runtime error, like 503, then try again
+            # later
+            return True
+        if not unauthorized and delivery_rejected(return_code):
+            print('WARN: deliver_post: Post rejected by ' + inbox_url +
+                  ' code ' + str(return_code))
+            return False
+        if debug:
+            print('Obtained post_json_string for ' + inbox_url +
+                  ' unauthorized: ' + str(unauthorized))
+    except BaseException as ex:
+        print('ERROR: post_json_string failed ' + str(ex))
+
+    if unauthorized:
+        # try again with application/ld+json header
         post_result = None
         unauthorized = False
         if debug:
-            print('Getting post_json_string for ' + inbox_url)
+            print('Getting ld post_json_string for ' + inbox_url)
+        signature_header_json_ld = \
+            _delivery_signed_headers(delivery, private_key_pem,
+                                     'application/ld+json')
         try:
             post_result, unauthorized, return_code = \
                 post_json_string(session, post_json_str, federation_list,
-                                 inbox_url, signature_header_json,
+                                 inbox_url, signature_header_json_ld,
                                  debug, http_prefix, domain_full)
             if return_code in range(500, 600):
                 # if an instance is returning a code which indicates that
-                # it might have a runtime error, like 503, then don't
-                # continue to post to it
-                break
+                # it might have a runtime error, like 503, then try again
+                # later
+                return True
+            if not unauthorized and delivery_rejected(return_code):
+                print('WARN: deliver_post: Post rejected by ' + inbox_url +
+                      ' code ' + str(return_code))
+                return False
             if debug:
-                print('Obtained post_json_string for ' + inbox_url +
+                print('Obtained ld post_json_string for ' + inbox_url +
                       ' unauthorized: ' + str(unauthorized))
         except BaseException as ex:
-            print('ERROR: post_json_string failed ' + str(ex))
+            print('ERROR: ld post_json_string failed ' + str(ex))
 
-        if unauthorized:
-            # try again with application/ld+json header
-            post_result = None
-            unauthorized = False
-            if debug:
-                print('Getting ld post_json_string for ' + inbox_url)
+    if unauthorized:
+        _add_send_block(base_dir, nickname, domain, inbox_url)
+        if debug:
+            print('WARN: deliver_post: Post is unauthorized ' +
+                  inbox_url + ' ' + post_json_str)
+        else:
+            print('WARN: deliver_post: Post is unauthorized ' +
+                  inbox_url)
+        return False
+    if post_result:
+        log_str = 'Success on try ' + str(tries) + ': ' + post_json_str
+    else:
+        log_str = 'Retry ' + str(tries) + ': ' + post_json_str
+    post_log.append(log_str)
+    # keep the length of the log finite
+    # Don't accumulate massive files on systems with limited resources
+    while len(post_log) > 16:
+        post_log.pop(0)
+    if debug:
+        # save the log file
+        post_log_filename = base_dir + '/post.log'
+        if os.path.isfile(post_log_filename):
             try:
-                post_result, unauthorized, return_code = \
-                    post_json_string(session, post_json_str, federation_list,
-                                     inbox_url, signature_header_json_ld,
-                                     debug, http_prefix, domain_full)
-                if return_code in range(500, 600):
-                    # if an instance is returning a code which indicates that
-                    # it might have a runtime error, like 503, then don't
-                    # continue to post to it
-                    break
-                if debug:
-                    print('Obtained ld post_json_string for ' + inbox_url +
-                          ' unauthorized: ' + str(unauthorized))
-            except BaseException as ex:
-                print('ERROR: ld post_json_string failed ' + str(ex))
-
-        if unauthorized:
-            _add_send_block(base_dir, nickname, domain, inbox_url)
-            if debug:
-                print('WARN: thread_send_post: Post is unauthorized ' +
-                      inbox_url + ' ' + post_json_str)
-            else:
-                print('WARN: thread_send_post: Post is unauthorized ' +
-                      inbox_url)
-            break
-        if post_result:
-            log_str = 'Success on try ' + str(tries) + ': ' + post_json_str
+                with open(post_log_filename, 'a+',
+                          encoding='utf-8') as fp_log:
+                    fp_log.write(log_str + '\n')
+            except OSError:
+                print('EX: deliver_post unable to append ' +
+                      post_log_filename)
         else:
-            log_str = 'Retry ' + str(tries) + ': ' + post_json_str
-        post_log.append(log_str)
-        # keep the length of the log finite
-        # Don't accumulate massive files on systems with limited resources
-        while len(post_log) > 16:
-            post_log.pop(0)
-        if debug:
-            # save the log file
-            post_log_filename = base_dir + '/post.log'
-            if os.path.isfile(post_log_filename):
-                try:
-                    with open(post_log_filename, 'a+',
-                              encoding='utf-8') as fp_log:
-                        fp_log.write(log_str + '\n')
-                except OSError:
-                    print('EX: thread_send_post unable to append ' +
-                          post_log_filename)
-            else:
-                try:
-                    with open(post_log_filename, 'w+',
-                              encoding='utf-8') as fp_log:
-                        fp_log.write(log_str + '\n')
-                except OSError:
-                    print('EX: thread_send_post unable to write ' +
-                          post_log_filename)
+            try:
+                with open(post_log_filename, 'w+',
+                          encoding='utf-8') as fp_log:
+                    fp_log.write(log_str + '\n')
+            except OSError:
+                print('EX: deliver_post unable to write ' +
+                      post_log_filename)
 
-        if post_result:
-            _remove_send_block(base_dir, nickname, domain, inbox_url)
-            if debug:
-                print('DEBUG: successful json post to ' + inbox_url)
-            # our work here is done
-            break
+    if post_result:
+        _remove_send_block(base_dir, nickname, domain, inbox_url)
         if debug:
-            print(post_json_str)
-            print('DEBUG: json post to ' + inbox_url +
-                  ' failed. Waiting for ' +
-                  str(send_interval_sec) + ' seconds.')
-        time.sleep(send_interval_sec)
-        tries += 1
+            print('DEBUG: successful json post to ' + inbox_url)
+        # our work here is done
+        return False
+    if debug:
+        print(post_json_str)
+        print('DEBUG: json post to ' + inbox_url +
+              ' failed. It will be tried again later.')
+    return True
 
 
 def _get_destination_inbox_domain(inbox_url: str, to_domain: str) -> str:
@@ -3106,7 +3240,6 @@ def send_post(signing_priv_key_pem: str, project_version: str,
               mitm_servers: []) -> int:
     """Post to another inbox. Used by unit tests.
     """
-    with_digest = True
     conversation_id = None
     convthread_id = None
 
@@ -3233,29 +3366,15 @@ def send_post(signing_priv_key_pem: str, project_version: str,
     # subsequent conversions after creating message body digest
     post_json_str = json.dumps(post_json_object)
 
-    # construct the http header, including the message body digest
-    signature_header_json = \
-        create_signed_header(None, private_key_pem, nickname, domain, port,
-                             to_domain, to_port,
-                             post_path, http_prefix, with_digest,
-                             post_json_str, 'application/activity+json')
-    signature_header_json_ld = \
-        create_signed_header(None, private_key_pem, nickname, domain, port,
-                             to_domain, to_port,
-                             post_path, http_prefix, with_digest,
-                             post_json_str, 'application/ld+json')
-
     # if the "to" domain is within the shared items
     # federation list then send the token for this domain
     # so that it can request a catalog
+    extra_headers = {}
     domain_full = get_full_domain(domain, port)
     if to_domain in shared_items_federated_domains:
         if shared_item_federation_tokens.get(domain_full):
-            signature_header_json['Origin'] = domain_full
-            signature_header_json_ld['Origin'] = domain_full
-            signature_header_json['SharesCatalog'] = \
-                shared_item_federation_tokens[domain_full]
-            signature_header_json_ld['SharesCatalog'] = \
+            extra_headers['Origin'] = domain_full
+            extra_headers['SharesCatalog'] = \
                 shared_item_federation_tokens[domain_full]
             if debug:
                 print('SharesCatalog added to header')
@@ -3265,29 +3384,18 @@ def send_post(signing_priv_key_pem: str, project_version: str,
         print(to_domain + ' not in shared_items_federated_domains ' +
               str(shared_items_federated_domains))
 
-    if debug:
-        print('signature_header_json: ' + str(signature_header_json))
-
-    # Keep the number of threads being used small
-    while len(send_threads) > 1000:
-        print('WARN: Maximum threads reached - killing send thread')
-        send_threads[0].kill()
-        send_threads.pop(0)
-        print('WARN: thread killed')
-    print('THREAD: thread_send_post')
-    thr = \
-        thread_with_trace(target=thread_send_post,
-                          args=(session,
-                                post_json_str,
-                                federation_list,
-                                inbox_url, base_dir,
-                                signature_header_json.copy(),
-                                signature_header_json_ld.copy(),
-                                post_log, debug, http_prefix,
-                                domain_full,
-                                nickname, domain), daemon=True)
-    send_threads.append(thr)
-    begin_thread(thr, 'send_post')
+    # add to the delivery queue for the destination host.
+    # The http signature headers are created when the post is sent
+    extra_headers_ld = extra_headers.copy()
+    activity_id = post_json_object.get('id')
+    if not _add_delivery(session, post_json_str, None,
+                         inbox_url, base_dir,
+                         nickname, domain, port, domain,
+                         to_domain, to_port, post_path,
+                         http_prefix, extra_headers, extra_headers_ld,
+                         private_key_pem, federation_list, post_log, debug,
+                         None, activity_id):
+        return 10
     return 0
 
 
@@ -3523,6 +3631,24 @@ def _add_followers_to_public_post(post_json_object: {}) -> None:
             [actor_url + '/followers']
 
 
+def new_signing_context() -> {}:
+    """Returns a new signing context, used when the same post is sent
+    to many recipients, so that the sender's private key is loaded,
+    the post is JSON-LD signed, serialised and its body digest
+    calculated once rather than once per recipient.
+    fanout is the delivery fan-out to which the sends belong, if any,
+    and inboxes are those which the post has already been added to,
+    so that it is only sent once to each
+    """
+    return {
+        "signedPost": None,
+        "bodies": {},
+        "privateKeys": {},
+        "fanout": None,
+        "inboxes": {}
+    }
+
+
 def send_signed_json(post_json_object: {}, session, base_dir: str,
                      nickname: str, domain: str, port: int,
                      to_nickname: str, to_domain: str,
@@ -3536,15 +3662,16 @@ def send_signed_json(post_json_object: {}, session, base_dir: str,
                      onion_domain: str, i2p_domain: str,
                      extra_headers: {}, sites_unavailable: [],
                      system_language: str,
-                     mitm_servers: []) -> int:
+                     mitm_servers: [], signing_context: {}) -> int:
     """Sends a signed json object to an inbox/outbox
+    signing_context is obtained from new_signing_context, and can be
+    shared between calls which send the same post to different recipients
     """
     if debug:
         print('DEBUG: send_signed_json start')
     if not session:
         print('WARN: No session specified for send_signed_json')
         return 8
-    with_digest = True
 
     if to_domain.endswith('.onion') or to_domain.endswith('.i2p'):
         http_prefix = 'http'
@@ -3578,43 +3705,56 @@ def send_signed_json(post_json_object: {}, session, base_dir: str,
     elif to_domain.endswith('.i2p'):
         ua_domain = i2p_domain
 
-    # lookup the inbox for the To handle
-    wf_request = webfinger_handle(session, handle, http_prefix,
-                                  cached_webfingers,
-                                  ua_domain, project_version, debug,
-                                  group_account, signing_priv_key_pem,
-                                  mitm_servers)
-    if not wf_request:
-        if debug:
-            print('DEBUG: send_signed_json webfinger for ' +
-                  handle + ' failed')
-        return 1
-    if not isinstance(wf_request, dict):
-        print('WARN: send_signed_json webfinger for ' + handle +
-              ' did not return a dict. ' + str(wf_request))
-        return 1
-
-    if wf_request.get('errors'):
-        if debug:
-            print('DEBUG: send_signed_json webfinger for ' + handle +
-                  ' failed with errors ' + str(wf_request['errors']))
-
+    # has the inbox for the To handle previously been resolved?
+    target_handle = to_nickname + '@' + to_domain
+    if group_account:
+        target_handle = '!' + target_handle
+    target = None
     if not client_to_server:
-        post_to_box = 'inbox'
+        target = delivery_targets_inbox(base_dir, target_handle)
+    origin_domain = domain
+    if target:
+        inbox_url = target['inbox']
+        shared_inbox_url = target['sharedInbox']
+        to_person_id = target['actor']
+        pub_key = None
     else:
-        post_to_box = 'outbox'
+        # lookup the inbox for the To handle
+        wf_request = webfinger_handle(session, handle, http_prefix,
+                                      cached_webfingers,
+                                      ua_domain, project_version, debug,
+                                      group_account, signing_priv_key_pem,
+                                      mitm_servers)
+        if not wf_request:
+            if debug:
+                print('DEBUG: send_signed_json webfinger for ' +
+                      handle + ' failed')
+            return 1
+        if not isinstance(wf_request, dict):
+            print('WARN: send_signed_json webfinger for ' + handle +
+                  ' did not return a dict. ' + str(wf_request))
+            return 1
+
+        if wf_request.get('errors'):
+            if debug:
+                print('DEBUG: send_signed_json webfinger for ' + handle +
+                      ' failed with errors ' + str(wf_request['errors']))
 
-    # get the actor inbox/outbox for the To handle
-    origin_domain = domain
-    (inbox_url, _, pub_key, to_person_id, shared_inbox_url, _,
-     _, _) = get_person_box(signing_priv_key_pem,
-                            origin_domain,
-                            base_dir, session, wf_request,
-                            person_cache,
-                            project_version, http_prefix,
-                            nickname, domain, post_to_box,
-                            source_id, system_language,
-                            mitm_servers)
+        if not client_to_server:
+            post_to_box = 'inbox'
+        else:
+            post_to_box = 'outbox'
+
+        # get the actor inbox/outbox for the To handle
+        (inbox_url, _, pub_key, to_person_id, shared_inbox_url, _,
+         _, _) = get_person_box(signing_priv_key_pem,
+                                origin_domain,
+                                base_dir, session, wf_request,
+                                person_cache,
+                                project_version, http_prefix,
+                                nickname, domain, post_to_box,
+                                source_id, system_language,
+                                mitm_servers)
 
     print("send_signed_json inbox_url: " + str(inbox_url))
     print("send_signed_json to_person_id: " + str(to_person_id))
@@ -3632,7 +3772,7 @@ def send_signed_json(post_json_object: {}, session, base_dir: str,
     if debug:
         print('DEBUG: send_signed_json sending to endpoint ' + inbox_url)
 
-    if not pub_key:
+    if not pub_key and not target:
         if debug:
             print('DEBUG: send_signed_json missing pubkey')
         return 4
@@ -3642,16 +3782,49 @@ def send_signed_json(post_json_object: {}, session, base_dir: str,
         return 5
     # shared_inbox is optional
 
+    if not target and not client_to_server:
+        delivery_targets_set_inbox(base_dir, target_handle,
+                                   inbox_url, shared_inbox_url,
+                                   to_person_id, to_domain)
+
+    if signing_context is None:
+        signing_context = new_signing_context()
+    return _send_signed_json_to_inbox(post_json_object, session, base_dir,
+                                      nickname, origin_domain, port,
+                                      to_domain, to_port, http_prefix,
+                                      inbox_url, federation_list, post_log,
+                                      debug, shared_items_token,
+                                      curr_domain, onion_domain, i2p_domain,
+                                      extra_headers, signing_context)
+
+
+def _send_signed_json_to_inbox(post_json_object: {}, session,
+                               base_dir: str, nickname: str, domain: str,
+                               port: int, to_domain: str, to_port: int,
+                               http_prefix: str, inbox_url: str,
+                               federation_list: [], post_log: [],
+                               debug: bool, shared_items_token: str,
+                               curr_domain: str, onion_domain: str,
+                               i2p_domain: str, extra_headers: {},
+                               signing_context: {}) -> int:
+    """Signs a json object and adds it to the delivery queue for the
+    given inbox, which has already been resolved
+    """
     # get the senders private key
-    account_domain = origin_domain
+    account_domain = domain
     if onion_domain:
         if account_domain == onion_domain:
             account_domain = curr_domain
     if i2p_domain:
         if account_domain == i2p_domain:
             account_domain = curr_domain
-    private_key_pem = \
-        get_person_key(nickname, account_domain, base_dir, 'private', debug)
+    account_handle = nickname + '@' + account_domain
+    private_key_pem = signing_context['privateKeys'].get(account_handle)
+    if private_key_pem is None:
+        private_key_pem = \
+            get_person_key(nickname, account_domain, base_dir, 'private',
+                           debug)
+        signing_context['privateKeys'][account_handle] = private_key_pem
     if len(private_key_pem) == 0:
         if debug:
             print('DEBUG: send_signed_json private key not found for ' +
@@ -3673,89 +3846,85 @@ def send_signed_json(post_json_object: {}, session, base_dir: str,
     # remove the domain to leave the path on its own
     post_path = inbox_url.split(to_domain, 1)[1]
 
-    _add_followers_to_public_post(post_json_object)
+    if signing_context['signedPost'] is None:
+        _add_followers_to_public_post(post_json_object)
 
-    if not post_json_object.get('signature'):
-        try:
-            signed_post_json_object = post_json_object.copy()
-            generate_json_signature(signed_post_json_object,
-                                    private_key_pem, debug)
-            post_json_object = signed_post_json_object
-        except BaseException as ex:
-            print('WARN: send_signed_json failed to JSON-LD sign post, ' +
-                  str(ex))
-            pprint(signed_post_json_object)
+        if not post_json_object.get('signature'):
+            try:
+                signed_post_json_object = post_json_object.copy()
+                generate_json_signature(signed_post_json_object,
+                                        private_key_pem, debug)
+                post_json_object = signed_post_json_object
+            except BaseException as ex:
+                print('WARN: send_signed_json failed to JSON-LD sign post, ' +
+                      str(ex))
+                pprint(signed_post_json_object)
+        signing_context['signedPost'] = post_json_object
+    else:
+        post_json_object = signing_context['signedPost']
 
-    # convert json to string so that there are no
-    # subsequent conversions after creating message body digest
-    post_json_str = json.dumps(post_json_object)
+    # the message body depends upon the origin domain, which may be
+    # clearnet, onion or i2p
+    body_key = domain + ' ' + curr_domain
+    if signing_context['bodies'].get(body_key):
+        post_json_str, body_digest = signing_context['bodies'][body_key]
+    else:
+        # convert json to string so that there are no
+        # subsequent conversions after creating message body digest
+        post_json_str = json.dumps(post_json_object)
 
-    # if the sender domain has changed from clearnet to onion or i2p
-    # then change the content of the post accordingly
-    if debug:
-        print('send_signed_json checking for changed origin domain: ' +
-              domain + ' ' + curr_domain)
-    if domain != curr_domain:
-        if not curr_domain.endswith('.onion') and \
-           not curr_domain.endswith('.i2p'):
-            if debug:
-                print('send_signed_json ' +
-                      'changing post content sender domain from ' +
-                      curr_domain + ' to ' + domain)
-            post_json_str = \
-                post_json_str.replace(curr_domain, domain)
+        # if the sender domain has changed from clearnet to onion or i2p
+        # then change the content of the post accordingly
+        if debug:
+            print('send_signed_json checking for changed origin domain: ' +
+                  domain + ' ' + curr_domain)
+        if domain != curr_domain:
+            if not curr_domain.endswith('.onion') and \
+               not curr_domain.endswith('.i2p'):
+                if debug:
+                    print('send_signed_json ' +
+                          'changing post content sender domain from ' +
+                          curr_domain + ' to ' + domain)
+                post_json_str = \
+                    post_json_str.replace(curr_domain, domain)
+        body_digest = message_content_digest(post_json_str, 'rsa-sha256')
+        signing_context['bodies'][body_key] = (post_json_str, body_digest)
 
-    # construct the http header, including the message body digest
-    signature_header_json = \
-        create_signed_header(None, private_key_pem, nickname, domain, port,
-                             to_domain, to_port,
-                             post_path, http_prefix, with_digest,
-                             post_json_str,
-                             'application/activity+json')
-    signature_header_json_ld = \
-        create_signed_header(None, private_key_pem, nickname, domain, port,
-                             to_domain, to_port,
-                             post_path, http_prefix, with_digest,
-                             post_json_str,
-                             'application/ld+json')
     # optionally add a token so that the receiving instance may access
     # your shared items catalog
+    delivery_headers = {}
     if shared_items_token:
-        signature_header_json['Origin'] = get_full_domain(domain, port)
-        signature_header_json['SharesCatalog'] = shared_items_token
+        delivery_headers['Origin'] = get_full_domain(domain, port)
+        delivery_headers['SharesCatalog'] = shared_items_token
     elif debug:
         print('send_signed_json not sending shared items federation token')
 
     # add any extra headers
     for header_title, header_text in extra_headers.items():
-        signature_header_json[header_title] = header_text
+        delivery_headers[header_title] = header_text
 
-    # Keep the number of threads being used small
-    while len(send_threads) > 1000:
-        print('WARN: send_signed_json maximum threads reached - ' +
-              'killing send thread')
-        send_threads[0].kill()
-        send_threads.pop(0)
-        print('WARN: send_signed_json thread killed')
+    # has this post already been sent to the same inbox?
+    if signing_context['inboxes'].get(inbox_url):
+        if debug:
+            print('DEBUG: send_signed_json already sent to ' + inbox_url)
+        return 0
+    signing_context['inboxes'][inbox_url] = True
 
     if debug:
-        print('DEBUG: send_signed_json starting thread to send post')
+        print('DEBUG: send_signed_json adding post to delivery queue')
         pprint(post_json_object)
-    domain_full = get_full_domain(domain, port)
-    print('THREAD: send_signed_json thread_send_post 2')
-    thr = \
-        thread_with_trace(target=thread_send_post,
-                          args=(session,
-                                post_json_str,
-                                federation_list,
-                                inbox_url, base_dir,
-                                signature_header_json.copy(),
-                                signature_header_json_ld.copy(),
-                                post_log, debug,
-                                http_prefix, domain_full,
-                                nickname, domain), daemon=True)
-    send_threads.append(thr)
-    # begin_thread(thr, 'send_signed_json')
+    # add to the delivery queue for the destination host.
+    # The http signature covers the destination host and path, so it
+    # is created for each recipient when the post is sent
+    activity_id = post_json_object.get('id')
+    if not _add_delivery(session, post_json_str, body_digest,
+                         inbox_url, base_dir,
+                         nickname, domain, port, account_domain,
+                         to_domain, to_port, post_path,
+                         http_prefix, delivery_headers, {},
+                         private_key_pem, federation_list, post_log, debug,
+                         signing_context['fanout'], activity_id):
+        return 10
     return 0
 
 
@@ -3951,7 +4120,13 @@ def _send_to_named_addresses(server, session, session_onion, session_i2p,
     random.shuffle(recipients)
     # this is after the message has arrived at the server
     client_to_server = False
+    # sign the post once for all recipients
+    signing_context = new_signing_context()
+    signing_context['fanout'] = \
+        delivery_fanout_begin(DELIVERY_ENGINE,
+                              str(post_json_object.get('id')))
     for address in recipients:
+        thread_check_cancelled()
         to_nickname = get_nickname_from_actor(address)
         if not to_nickname:
             continue
@@ -4058,7 +4233,9 @@ def _send_to_named_addresses(server, session, session_onion, session_i2p,
                          signing_priv_key_pem, 34436782,
                          domain, onion_domain, i2p_domain,
                          extra_headers, sites_unavailable,
-                         system_language, mitm_servers)
+                         system_language, mitm_servers, signing_context)
+    delivery_fanout_end(DELIVERY_ENGINE, signing_context['fanout'])
+    delivery_targets_save(base_dir)
 
 
 def send_to_named_addresses_thread(server, session, session_onion, session_i2p,
@@ -4140,6 +4317,117 @@ def _sending_profile_update(post_json_object: {}) -> bool:
     return False
 
 
+def _followers_inboxes(base_dir: str, grouped: {},
+                       profile_update: bool) -> ({}, {}):
+    """Returns the unique inboxes of followers which have previously
+    been resolved, as a dict of inbox url -> follower domain, and the
+    followers whose inboxes are not yet known, grouped by domain
+    """
+    inboxes = {}
+    unresolved = {}
+    for follower_domain, follower_handles in grouped.items():
+        # if there is more than one follower on the domain, or this is
+        # a profile update, then send to the shared inbox
+        use_shared_inbox = len(follower_handles) > 1 or profile_update
+        if use_shared_inbox:
+            shared_inbox_url = \
+                delivery_targets_shared_inbox(base_dir, follower_domain)
+            if shared_inbox_url:
+                inboxes[shared_inbox_url] = follower_domain
+                continue
+        for handle in follower_handles:
+            target = delivery_targets_inbox(base_dir, handle)
+            if not target:
+                if not unresolved.get(follower_domain):
+                    unresolved[follower_domain] = [handle]
+                else:
+                    unresolved[follower_domain].append(handle)
+                continue
+            inbox_url = target['inbox']
+            if use_shared_inbox and target.get('sharedInbox'):
+                inbox_url = target['sharedInbox']
+            if inbox_url:
+                inboxes[inbox_url] = follower_domain
+    return inboxes, unresolved
+
+
+def _followers_session(server, session, session_onion, session_i2p,
+                       domain: str, onion_domain: str, i2p_domain: str,
+                       port: int, http_prefix: str,
+                       follower_domain: str) -> (object, str, str, int):
+    """Returns the session, sending domain, http prefix and port
+    to use when sending to the given follower domain
+    """
+    curr_session = session
+    curr_proxy_type = None
+    if domain.endswith('.onion'):
+        curr_proxy_type = 'tor'
+    elif domain.endswith('.i2p'):
+        curr_proxy_type = 'i2p'
+    session_type = 'default'
+
+    # if we are sending to an onion domain and we
+    # have an alt onion domain then use the alt
+    from_domain = domain
+    from_http_prefix = http_prefix
+    from_port = port
+    if onion_domain:
+        if follower_domain.endswith('.onion'):
+            curr_session = session_onion
+            from_domain = onion_domain
+            from_http_prefix = 'http'
+            from_port = 80
+            curr_proxy_type = 'tor'
+            session_type = 'tor'
+    if i2p_domain:
+        if follower_domain.endswith('.i2p'):
+            curr_session = session_i2p
+            from_domain = i2p_domain
+            from_http_prefix = 'http'
+            from_port = 80
+            curr_proxy_type = 'i2p'
+            session_type = 'i2p'
+
+    if not curr_session:
+        curr_session = create_session(curr_proxy_type)
+        if server:
+            if session_type == 'tor':
+                server.session_onion = curr_session
+            elif session_type == 'i2p':
+                server.session_i2p = curr_session
+            else:
+                server.session = curr_session
+    return curr_session, from_domain, from_http_prefix, from_port
+
+
+def _followers_to_port(to_domain: str, to_port: int,
+                       onion_domain: str, i2p_domain: str) -> int:
+    """Returns the port to send to, which is 80 if sending from
+    an onion or i2p domain
+    """
+    if onion_domain:
+        if to_domain.endswith('.onion'):
+            return 80
+    if i2p_domain:
+        if to_domain.endswith('.i2p'):
+            return 80
+    return to_port
+
+
+def _followers_shared_items_token(follower_domain: str, domain: str,
+                                  port: int,
+                                  shared_items_federated_domains: [],
+                                  shared_item_federation_tokens: {}) -> str:
+    """If the followers domain is within the shared items federation
+    list then returns the token for this domain, so that it can
+    request a catalog
+    """
+    if follower_domain not in shared_items_federated_domains:
+        return None
+    domain_full = get_full_domain(domain, port)
+    return shared_item_federation_tokens.get(domain_full)
+
+
 def send_to_followers(server, session, session_onion, session_i2p,
                       base_dir: str, nickname: str, domain: str,
                       onion_domain: str, i2p_domain: str, port: int,
@@ -4177,43 +4465,93 @@ def send_to_followers(server, session, session_onion, session_i2p,
     # this is after the message has arrived at the server
     client_to_server = False
 
-    curr_proxy_type = None
-    if domain.endswith('.onion'):
-        curr_proxy_type = 'tor'
-    elif domain.endswith('.i2p'):
-        curr_proxy_type = 'i2p'
-
     sending_start_time = date_utcnow()
     print('Sending post to followers begins ' +
           sending_start_time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-    sending_ctr = 0
+
+    # sign the post once for all followers
+    signing_context = new_signing_context()
+    signing_context['fanout'] = \
+        delivery_fanout_begin(DELIVERY_ENGINE,
+                              str(post_json_object.get('id')) +
+                              ' to followers')
+
+    profile_update = False
+    if post_json_object.get('type'):
+        profile_update = _sending_profile_update(post_json_object)
+
+    # the post is sent once to each unique inbox which has previously
+    # been resolved. Followers whose inboxes are not yet known are
+    # resolved below
+    inboxes, unresolved = \
+        _followers_inboxes(base_dir, grouped, profile_update)
+
+    # randomize the order of sending, so that we are not favoring
+    # any particular instance in terms of its delivery time
+    inbox_urls = list(inboxes.keys())
+    random.shuffle(inbox_urls)
+    print('Sending post to followers, ' + str(len(inbox_urls)) +
+          ' known inboxes')
+    for inbox_url in inbox_urls:
+        thread_check_cancelled()
+        follower_domain = inboxes[inbox_url]
+        if follower_domain in sites_unavailable:
+            print('Sending post to followers domain is unavailable: ' +
+                  follower_domain)
+            continue
+        shared_items_token = \
+            _followers_shared_items_token(follower_domain, domain, port,
+                                          shared_items_federated_domains,
+                                          shared_item_federation_tokens)
+        curr_session, from_domain, from_http_prefix, from_port = \
+            _followers_session(server, session, session_onion, session_i2p,
+                               domain, onion_domain, i2p_domain,
+                               port, http_prefix, follower_domain)
+        if not curr_session:
+            continue
+        to_port = port
+        if ':' in follower_domain:
+            to_port = get_port_from_domain(follower_domain)
+        to_domain = remove_domain_port(follower_domain)
+        if to_domain.endswith('.onion') or to_domain.endswith('.i2p'):
+            from_http_prefix = 'http'
+        to_port = _followers_to_port(to_domain, to_port,
+                                     onion_domain, i2p_domain)
+        to_domain = get_full_domain(to_domain, to_port)
+        print('Sending post to followers from ' +
+              nickname + '@' + domain + ' to ' + inbox_url)
+        _send_signed_json_to_inbox(post_json_object, curr_session, base_dir,
+                                   nickname, from_domain, from_port,
+                                   to_domain, to_port, from_http_prefix,
+                                   inbox_url, federation_list, post_log,
+                                   debug, shared_items_token,
+                                   domain, onion_domain, i2p_domain,
+                                   extra_headers, signing_context)
 
     # randomize the order of sending to instances
     randomized_instances: list[str] = []
-    for follower_domain, follower_handles in grouped.items():
+    for follower_domain, follower_handles in unresolved.items():
         randomized_instances.append([follower_domain, follower_handles])
     random.shuffle(randomized_instances)
 
-    # send out to each instance
+    # send out to each instance with followers whose inboxes are not known
+    sending_ctr = 0
     for group_send in randomized_instances:
+        thread_check_cancelled()
         follower_domain = group_send[0]
         follower_handles = group_send[1]
         print('Sending post to followers progress ' +
-              str(int(sending_ctr * 100 / len(grouped.items()))) + '% ' +
+              str(int(sending_ctr * 100 / len(unresolved.items()))) + '% ' +
               follower_domain)
         sending_ctr += 1
 
         if debug:
             pprint(follower_handles)
 
-        # if the followers domain is within the shared items
-        # federation list then send the token for this domain
-        # so that it can request a catalog
-        shared_items_token = None
-        if follower_domain in shared_items_federated_domains:
-            domain_full = get_full_domain(domain, port)
-            if shared_item_federation_tokens.get(domain_full):
-                shared_items_token = shared_item_federation_tokens[domain_full]
+        shared_items_token = \
+            _followers_shared_items_token(follower_domain, domain, port,
+                                          shared_items_federated_domains,
+                                          shared_item_federation_tokens)
 
         # check that the follower's domain is active
         follower_domain_url = http_prefix + '://' + follower_domain
@@ -4225,16 +4563,10 @@ def send_to_followers(server, session, session_onion, session_i2p,
               follower_domain_url)
 
         # select the appropriate session
-        curr_session = session
-        curr_http_prefix = http_prefix
-        if onion_domain:
-            if follower_domain.endswith('.onion'):
-                curr_session = session_onion
-                curr_http_prefix = 'http'
-        if i2p_domain:
-            if follower_domain.endswith('.i2p'):
-                curr_session = session_i2p
-                curr_http_prefix = 'http'
+        curr_session, from_domain, from_http_prefix, from_port = \
+            _followers_session(server, session, session_onion, session_i2p,
+                               domain, onion_domain, i2p_domain,
+                               port, http_prefix, follower_domain)
 
         # get the domain showin by the user agent
         ua_domain = domain
@@ -4243,10 +4575,20 @@ def send_to_followers(server, session, session_onion, session_i2p,
         elif follower_domain.endswith('.i2p'):
             ua_domain = i2p_domain
 
-        with_shared_inbox = \
-            _has_shared_inbox(curr_session, curr_http_prefix, follower_domain,
-                              debug, signing_priv_key_pem, ua_domain,
-                              mitm_servers)
+        # has the shared inbox for the domain previously been resolved?
+        shared_inbox_url = \
+            delivery_targets_shared_inbox(base_dir, follower_domain)
+        if shared_inbox_url is not None:
+            with_shared_inbox = shared_inbox_url != ''
+        else:
+            with_shared_inbox = \
+                _has_shared_inbox(curr_session, from_http_prefix,
+                                  follower_domain, debug,
+                                  signing_priv_key_pem, ua_domain,
+                                  mitm_servers)
+            if not with_shared_inbox:
+                delivery_targets_set_shared_inbox(base_dir,
+                                                  follower_domain, '')
         if debug:
             if with_shared_inbox:
                 print(follower_domain + ' has shared inbox')
@@ -4260,38 +4602,8 @@ def send_to_followers(server, session, session_onion, session_i2p,
         if ':' in to_domain:
             to_port = get_port_from_domain(to_domain)
             to_domain = remove_domain_port(to_domain)
-
-        # if we are sending to an onion domain and we
-        # have an alt onion domain then use the alt
-        from_domain = domain
-        from_http_prefix = http_prefix
-        session_type = 'default'
-        if onion_domain:
-            if to_domain.endswith('.onion'):
-                from_domain = onion_domain
-                from_http_prefix = 'http'
-                port = 80
-                to_port = 80
-                curr_proxy_type = 'tor'
-                session_type = 'tor'
-        if i2p_domain:
-            if to_domain.endswith('.i2p'):
-                from_domain = i2p_domain
-                from_http_prefix = 'http'
-                port = 80
-                to_port = 80
-                curr_proxy_type = 'i2p'
-                session_type = 'i2p'
-
-        if not curr_session:
-            curr_session = create_session(curr_proxy_type)
-            if server:
-                if session_type == 'tor':
-                    server.session_onion = curr_session
-                elif session_type == 'i2p':
-                    server.session_i2p = curr_session
-                else:
-                    server.session = curr_session
+        to_port = _followers_to_port(to_domain, to_port,
+                                     onion_domain, i2p_domain)
 
         if with_shared_inbox:
             to_nickname = follower_handles[index].split('@')[0]
@@ -4303,21 +4615,15 @@ def send_to_followers(server, session, session_onion, session_i2p,
 
             # if there are more than one followers on the domain
             # then send the post to the shared inbox
-            if len(follower_handles) > 1:
+            if len(grouped[follower_domain]) > 1 or profile_update:
                 to_nickname = 'inbox'
 
-            if to_nickname != 'inbox' and post_json_object.get('type'):
-                if _sending_profile_update(post_json_object):
-                    print('Sending post to followers ' +
-                          'shared inbox of ' + to_domain)
-                    to_nickname = 'inbox'
-
             print('Sending post to followers from ' +
                   nickname + '@' + domain +
                   ' to ' + to_nickname + '@' + to_domain)
 
             send_signed_json(post_json_object, curr_session, base_dir,
-                             nickname, from_domain, port,
+                             nickname, from_domain, from_port,
                              to_nickname, to_domain, to_port,
                              from_http_prefix,
                              client_to_server, federation_list,
@@ -4327,7 +4633,8 @@ def send_to_followers(server, session, session_onion, session_i2p,
                              signing_priv_key_pem, 639342,
                              domain, onion_domain, i2p_domain,
                              extra_headers, sites_unavailable,
-                             system_language, mitm_servers)
+                             system_language, mitm_servers,
+                             signing_context)
         else:
             # randomize the order of handles, so that we are not
             # favoring any particular account in terms of its delivery time
@@ -4352,7 +4659,7 @@ def send_to_followers(server, session, session_onion, session_i2p,
                           to_nickname + '@' + to_domain)
 
                 send_signed_json(post_json_object, curr_session, base_dir,
-                                 nickname, from_domain, port,
+                                 nickname, from_domain, from_port,
                                  to_nickname, to_domain, to_port,
                                  from_http_prefix,
                                  client_to_server, federation_list,
@@ -4362,17 +4669,22 @@ def send_to_followers(server, session, session_onion, session_i2p,
                                  signing_priv_key_pem, 634219,
                                  domain, onion_domain, i2p_domain,
                                  extra_headers, sites_unavailable,
-                                 system_language, mitm_servers)
+                                 system_language, mitm_servers,
+                                 signing_context)
 
-        time.sleep(4)
+    # deliveries to each host are rate limited by the delivery engine,
+    # which reports the time taken once they have all been made
+    delivery_fanout_end(DELIVERY_ENGINE, signing_context['fanout'])
+    delivery_targets_save(base_dir)
 
     if debug:
         print('DEBUG: End of send_to_followers')
 
     sending_end_time = date_utcnow()
-    sending_mins = \
-        int((sending_end_time - sending_start_time).total_seconds() / 60)
-    print('Sending post to followers ends ' + str(sending_mins) + ' mins')
+    sending_secs = \
+        int((sending_end_time - sending_start_time).total_seconds())
+    print('Sending post to followers queued in ' +
+          str(sending_secs) + ' secs')
 
 
 def send_to_followers_thread(server, session, session_onion, session_i2p,
@@ -4652,6 +4964,18 @@ def _add_post_string_to_timeline(post_str: str, boxname: str,
                                  posts_in_box: [], box_actor: str) -> bool:
     """ is this a valid timeline post?
     """
+    if not _is_timeline_post_string(post_str, boxname, box_actor):
+        return False
+    # add the post to the dictionary
+    posts_in_box.append(post_str)
+    return True
+
+
+def _is_timeline_post_string(post_str: str, boxname: str,
+                             box_actor: str) -> bool:
+    """Returns True if the given post json string belongs
+    within the given timeline
+    """
     # must be a recognized ActivityPub type
     if (string_contains(post_str,
                         ('"Note"', '"EncryptedMessage"', '"ChatMessage"',
@@ -4678,8 +5002,6 @@ def _add_post_string_to_timeline(post_str: str, boxname: str,
                      'video/' not in post_str and
                      'audio/' not in post_str)):
                     return False
-        # add the post to the dictionary
-        posts_in_box.append(post_str)
         return True
     return False
 
@@ -4888,20 +5210,20 @@ def _create_box_items(base_dir: str,
                     continue
 
                 # is the post cached in memory?
-                if recent_posts_cache.get('index'):
-                    if post_url in recent_posts_cache['index']:
-                        if recent_posts_cache['json'].get(post_url):
-                            url = recent_posts_cache['json'][post_url]
-                            if _add_post_string_to_timeline(url,
-                                                            boxname,
-                                                            posts_in_box,
-                                                            box_actor):
-                                total_posts_count += 1
-                                posts_added_to_timeline += 1
-                                post_urls_in_box.append(post_url)
-                                continue
-                            print('REJECT: Post not added to timeline ' +
-                                  post_url)
+                cached_post = \
+                    get_recent_cached_post(recent_posts_cache, post_url)
+                if cached_post:
+                    if _is_timeline_post_string(cached_post['json'],
+                                                boxname, box_actor):
+                        # the parsed post is added, so that it
+                        # doesn't need to be parsed again
+                        posts_in_box.append(cached_post['parsed'])
+                        total_posts_count += 1
+                        posts_added_to_timeline += 1
+                        post_urls_in_box.append(post_url)
+                        continue
+                    print('REJECT: Post not added to timeline ' +
+                          post_url)
 
                 # read the post from file
                 full_post_filename = \
@@ -5109,6 +5431,20 @@ def _create_box_indexed(recent_posts_cache: {},
         return box_header
 
     for post_str in posts_in_box:
+        if isinstance(post_str, dict):
+            # parsed post from the recent posts cache. Copy the parts
+            # which may be changed, so that the cache is not altered
+            pst = post_str.copy()
+            if has_object_dict(pst):
+                pst['object'] = pst['object'].copy()
+            pst['hasReplies'] = False
+            pst['mitm'] = False
+            if not authorized:
+                if not remove_post_interactions(pst, False):
+                    continue
+            box_items['orderedItems'].append(pst)
+            continue
+
         # Check if the post has replies
         has_replies = False
         if post_str.endswith('<hasReplies>'):
@@ -5152,14 +5488,12 @@ def expire_cache(base_dir: str, person_cache: {},
                  recent_posts_cache: {},
                  max_posts_in_box: int,
                  max_cache_age_days: int):
-    """Thread used to expire actors from the cache and archive old posts
+    """Expires actors from the cache and archives old posts.
+    This is run daily by the scheduler
     """
-    while True:
-        # once per day
-        time.sleep(60 * 60 * 24)
-        expire_person_cache(person_cache)
-        archive_posts(base_dir, http_prefix, archive_dir, recent_posts_cache,
-                      max_posts_in_box, max_cache_age_days)
+    expire_person_cache(person_cache)
+    archive_posts(base_dir, http_prefix, archive_dir, recent_posts_cache,
+                  max_posts_in_box, max_cache_age_days)
 
 
 def _expire_announce_cache_for_person(base_dir: str,
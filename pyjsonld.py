@@ -34,6 +34,7 @@ import socket
 import ssl
 import string
 import sys
+import threading
 import traceback
 from collections import deque, namedtuple
 from numbers import Integral, Real
@@ -116,6 +117,11 @@ RDF_NIL = RDF + 'nil'
 RDF_TYPE = RDF + 'type'
 RDF_LANGSTRING = RDF + 'lang_string'
 
+# Normalization limits, so that pathological documents are rejected
+# rather than taking factorial time
+NORMALIZE_MAX_BLANK_NODES = 256
+NORMALIZE_MAX_PERMUTATIONS = 10000
+
 # JSON-LD keywords
 KEYWORDS = [
     '@base',
@@ -255,6 +261,10 @@ def normalize(input_: {}, options=None):
         'application/nquads' for N-Quads.
       [documentLoader(url)] the document loader
         (default: _default_document_loader).
+      [maxBlankNodes] the maximum number of blank nodes
+        (default: NORMALIZE_MAX_BLANK_NODES).
+      [maxPermutations] the maximum number of blank node permutations
+        which may be tried (default: NORMALIZE_MAX_PERMUTATIONS).
 
     :return: the normalized JSON-LD output.
     """
@@ -366,6 +376,97 @@ def parse_link_header(header):
     return rval
 
 
+# Names of bundled contexts, keyed by their urls
+_BUNDLED_CONTEXT_URLS = {
+    'https://w3id.org/identity/v1': 'identity/v1',
+    'https://w3id.org/security/v1': 'security/v1',
+    'https://www.w3.org/ns/activitystreams': 'activitystreams',
+    'https://w3id.org/security/multikey/v1': 'multikey/v1',
+    'https://w3id.org/security/data-integrity/v1': 'data-integrity/v1',
+    'https://litepub.social/litepub/context.jsonld': 'litepub.social',
+    'https://www.w3.org/ns/did/v1': 'did/v1'
+}
+
+# Names of bundled contexts, keyed by the endings of their urls
+_BUNDLED_CONTEXT_SUFFIXES = (
+    ('/apschema/v1.9', 'apschema/v1.9'),
+    ('/apschema/v1.10', 'apschema/v1.10'),
+    ('/apschema/v1.20', 'apschema/v1.20'),
+    ('/apschema/v1.21', 'apschema/v1.21'),
+    ('/litepub-0.1.jsonld', 'litepub-0.1'),
+    ('/socialweb/webfinger', 'webfinger'),
+    ('/socialweb/webfinger.jsonld', 'webfinger'),
+    ('/vc-data-integrity/contexts/multikey/v1.jsonld', 'multikey/v1'),
+    ('/contexts/data-integrity/v1.jsonld', 'data-integrity/v1')
+)
+
+# Bundled contexts, parsed once, keyed by name
+_BUNDLED_CONTEXTS = {}
+
+
+def _bundled_context(url):
+    """
+    Returns the precompiled bundled context for the given URL.
+
+    :param url: the URL of the context.
+
+    :return: the context document, or None if it is not bundled.
+    """
+    name = _BUNDLED_CONTEXT_URLS.get(url)
+    if name is None:
+        for suffix, suffix_name in _BUNDLED_CONTEXT_SUFFIXES:
+            if url.endswith(suffix):
+                name = suffix_name
+                break
+    if name is None:
+        return None
+    return _BUNDLED_CONTEXTS.get(name)
+
+
+def _precompile_contexts():
+    """
+    Parses the bundled contexts once. Any context URLs within them
+    which refer to other bundled contexts are replaced by those
+    contexts, so that the documents don't need to be changed when
+    they are used. Each context is also registered with the active
+    context cache so that it can be looked up without serializing it.
+    """
+    _BUNDLED_CONTEXTS['identity/v1'] = get_v1schema()
+    _BUNDLED_CONTEXTS['security/v1'] = get_v1security_schema()
+    _BUNDLED_CONTEXTS['activitystreams'] = get_activitystreams_schema()
+    _BUNDLED_CONTEXTS['apschema/v1.9'] = getApschemaV1_9()
+    _BUNDLED_CONTEXTS['apschema/v1.10'] = getApschemaV1_10()
+    _BUNDLED_CONTEXTS['apschema/v1.20'] = getApschemaV1_20()
+    _BUNDLED_CONTEXTS['apschema/v1.21'] = getApschemaV1_21()
+    _BUNDLED_CONTEXTS['litepub-0.1'] = getLitepubV0_1()
+    _BUNDLED_CONTEXTS['webfinger'] = get_webfinger_schema()
+    _BUNDLED_CONTEXTS['multikey/v1'] = get_multikey_v1_schema()
+    _BUNDLED_CONTEXTS['data-integrity/v1'] = get_data_integrity_v1_schema()
+    _BUNDLED_CONTEXTS['litepub.social'] = get_litepub_social()
+    _BUNDLED_CONTEXTS['did/v1'] = get_did_v1_schema()
+    for document in _BUNDLED_CONTEXTS.values():
+        ctx = document.get('@context')
+        if not _is_array(ctx):
+            continue
+        resolved = []
+        for entry in ctx:
+            if _is_string(entry):
+                bundled = _bundled_context(entry)
+                if bundled is not None and '@context' in bundled:
+                    entry = bundled['@context']
+            resolved.append(entry)
+        document['@context'] = resolved
+    for name, document in _BUNDLED_CONTEXTS.items():
+        ctx = document.get('@context')
+        if _is_object(ctx):
+            _cache['activeCtx'].register_context(ctx, name)
+        elif _is_array(ctx):
+            for index, entry in enumerate(ctx):
+                if _is_object(entry):
+                    _cache['activeCtx'].register_context(
+                        entry, name + ' ' + str(index))
+
+
 def load_document(url):
     """
     Retrieves JSON-LD at the given URL.
@@ -387,98 +488,14 @@ def load_document(url):
                 'jsonld.InvalidUrl', {'url': url},
                 code='loading document failed')
 
-        if url == 'https://w3id.org/identity/v1':
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_v1schema()
-            }
-            return doc
-        if url == 'https://w3id.org/security/v1':
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_v1security_schema()
-            }
-            return doc
-        elif url == 'https://www.w3.org/ns/activitystreams':
+        # contexts which are bundled are precompiled, and are shared
+        # between documents so must not be modified
+        document = _bundled_context(url)
+        if document is not None:
             doc = {
                 'contextUrl': None,
                 'documentUrl': url,
-                'document': get_activitystreams_schema()
-            }
-            return doc
-        elif url.endswith('/apschema/v1.9'):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': getApschemaV1_9()
-            }
-            return doc
-        elif url.endswith('/apschema/v1.10'):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': getApschemaV1_10()
-            }
-            return doc
-        elif url.endswith('/apschema/v1.20'):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': getApschemaV1_20()
-            }
-            return doc
-        elif url.endswith('/apschema/v1.21'):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': getApschemaV1_21()
-            }
-            return doc
-        elif url.endswith('/litepub-0.1.jsonld'):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': getLitepubV0_1()
-            }
-            return doc
-        elif (url.endswith('/socialweb/webfinger') or
-              url.endswith('/socialweb/webfinger.jsonld')):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_webfinger_schema()
-            }
-            return doc
-        elif (url == "https://w3id.org/security/multikey/v1" or
-              url.endswith("/vc-data-integrity/contexts/multikey/v1.jsonld")):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_multikey_v1_schema()
-            }
-            return doc
-        elif (url == "https://w3id.org/security/data-integrity/v1" or
-              url.endswith("/contexts/data-integrity/v1.jsonld")):
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_data_integrity_v1_schema()
-            }
-            return doc
-        elif url == 'https://litepub.social/litepub/context.jsonld':
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_litepub_social()
-            }
-            return doc
-        elif url == 'https://www.w3.org/ns/did/v1':
-            doc = {
-                'contextUrl': None,
-                'documentUrl': url,
-                'document': get_did_v1_schema()
+                'document': document
             }
             return doc
         return None
@@ -688,6 +705,8 @@ class JsonLdProcessor(object):
         """
         # processor-specific RDF parsers
         self.rdf_parsers = None
+        # blank node permutations which may be tried during normalization
+        self.permutations_remaining = NORMALIZE_MAX_PERMUTATIONS
 
     def compact(self, input_, ctx, options):
         """
@@ -1068,6 +1087,10 @@ class JsonLdProcessor(object):
             'application/nquads' for N-Quads.
           [documentLoader(url)] the document loader
             (default: _default_document_loader).
+          [maxBlankNodes] the maximum number of blank nodes
+            (default: NORMALIZE_MAX_BLANK_NODES).
+          [maxPermutations] the maximum number of blank node permutations
+            which may be tried (default: NORMALIZE_MAX_PERMUTATIONS).
 
         :return: the normalized output.
         """
@@ -1075,6 +1098,8 @@ class JsonLdProcessor(object):
         options = options or {}
         options.setdefault('base', input_ if _is_string(input_) else '')
         options.setdefault('documentLoader', _default_document_loader)
+        options.setdefault('maxBlankNodes', NORMALIZE_MAX_BLANK_NODES)
+        options.setdefault('maxPermutations', NORMALIZE_MAX_PERMUTATIONS)
 
         try:
             # convert to RDF dataset then do normalization
@@ -2383,6 +2408,17 @@ class JsonLdProcessor(object):
                         bnodes.setdefault(id_, {}).setdefault(
                             'quads', []).append(quad)
 
+        # limit the amount of work done on pathological documents,
+        # since the number of permutations is factorial in the size
+        # of groups of similar blank nodes
+        if len(bnodes) > options.get('maxBlankNodes',
+                                     NORMALIZE_MAX_BLANK_NODES):
+            raise JsonLdError(
+                'Too many blank nodes to normalize.',
+                'jsonld.NormalizeError', {'blankNodes': len(bnodes)})
+        self.permutations_remaining = \
+            options.get('maxPermutations', NORMALIZE_MAX_PERMUTATIONS)
+
         # mapping complete, start canonical naming
         namer = UniqueNamer('_:c14n')
 
@@ -2435,6 +2471,8 @@ class JsonLdProcessor(object):
                 try:
                     bnode_path = self._hash_paths(
                         bnode, bnodes, namer, path_namer)
+                except JsonLdError:
+                    raise
                 except BaseException:
                     print('WARN: jsonld bnode_path failed')
                 if bnode_path:
@@ -3666,6 +3704,11 @@ class JsonLdProcessor(object):
             chosen_path = None
             chosen_namer = None
             for permutation in permutations(group):
+                self.permutations_remaining -= 1
+                if self.permutations_remaining < 0:
+                    raise JsonLdError(
+                        'Too many blank node permutations to normalize.',
+                        'jsonld.NormalizeError')
                 path_namer_copy = copy.deepcopy(path_namer)
 
                 # build adjacent path
@@ -4470,7 +4513,9 @@ class JsonLdProcessor(object):
         if active_ctx['inverse']:
             return active_ctx['inverse']
 
-        inverse = active_ctx['inverse'] = {}
+        # the active context may be shared, so only assign the
+        # inverse context once it is complete
+        inverse = {}
 
         # handle default language
         default_language = active_ctx.get('@language', '@none')
@@ -4514,6 +4559,7 @@ class JsonLdProcessor(object):
                     entry['@type'].setdefault('@none', term)
                     entry['@language'].setdefault('@none', term)
 
+        active_ctx['inverse'] = inverse
         return inverse
 
     def _clone_active_context(self, active_ctx):
@@ -4655,8 +4701,9 @@ def permutations(elements):
                 k, pos = e, i
 
         # no more permutations
+        # (raising StopIteration within a generator is an error, PEP 479)
         if k is None:
-            raise StopIteration
+            return
 
         # swap k and the element it is looking at
         swap = pos - 1 if left[k] else pos + 1
@@ -4912,27 +4959,66 @@ def _is_absolute_iri(v):
 class ActiveContextCache(object):
     """
     An ActiveContextCache caches active contexts so they can be reused without
-    the overhead of recomputing them.
+    the overhead of recomputing them. The cache is shared between
+    threads, and cached active contexts are not copied, so they must
+    not be modified. Contexts which have a known key, such as bundled
+    contexts and active contexts within the cache, are looked up by
+    identity rather than by serializing them.
     """
 
     def __init__(self, size: int = 100):
         self.order = deque()
         self.cache = {}
         self.size = size
+        # known keys for contexts, keyed by id
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def register_context(self, ctx, key):
+        """
+        Registers a key for a context which will not be modified.
+        """
+        with self.lock:
+            self.keys[id(ctx)] = (ctx, 'registered ' + key)
+
+    def _context_key(self, ctx):
+        entry = self.keys.get(id(ctx))
+        if entry is not None and entry[0] is ctx:
+            return entry[1]
+        return json.dumps(ctx)
 
     def get(self, active_ctx, local_ctx):
-        key1 = json.dumps(active_ctx)
-        key2 = json.dumps(local_ctx)
-        return self.cache.get(key1, {}).get(key2)
+        with self.lock:
+            key1 = self._context_key(active_ctx)
+            key2 = self._context_key(local_ctx)
+            rval = self.cache.get(key1, {}).get(key2)
+            if rval is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rval
 
     def set(self, active_ctx, local_ctx, result):
-        if len(self.order) == self.size:
-            entry = self.order.popleft()
-            del self.cache[entry['activeCtx']][entry['localCtx']]
-        key1 = json.dumps(active_ctx)
-        key2 = json.dumps(local_ctx)
-        self.order.append({'activeCtx': key1, 'localCtx': key2})
-        self.cache.setdefault(key1, {})[key2] = json.loads(json.dumps(result))
+        with self.lock:
+            key1 = self._context_key(active_ctx)
+            key2 = self._context_key(local_ctx)
+            if key2 in self.cache.get(key1, {}):
+                return
+            if len(self.order) == self.size:
+                entry = self.order.popleft()
+                evicted = self.cache[entry['activeCtx']].pop(
+                    entry['localCtx'], None)
+                if not self.cache[entry['activeCtx']]:
+                    del self.cache[entry['activeCtx']]
+                if evicted is not None:
+                    self.keys.pop(id(evicted), None)
+            self.order.append({'activeCtx': key1, 'localCtx': key2})
+            self.cache.setdefault(key1, {})[key2] = result
+            result_key = \
+                hashlib.sha256((key1 + ' ' + key2).encode('utf-8')).hexdigest()
+            self.keys[id(result)] = (result, 'active ' + result_key)
 
 
 class VerifiedHTTPSConnection(HTTPSConnection):
@@ -4989,3 +5075,5 @@ for path in _possible_trust_root_certificates:
 _cache = {
     'activeCtx': ActiveContextCache()
 }
+
+_precompile_contexts()
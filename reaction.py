@@ -158,7 +158,7 @@ def _reactionpost(recent_posts_cache: {},
                          signing_priv_key_pem, 7165392,
                          curr_domain, onion_domain, i2p_domain,
                          extra_headers, sites_unavailable,
-                         system_language, mitm_servers)
+                         system_language, mitm_servers, None)
 
     return new_reaction_json
 
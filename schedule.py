@@ -8,7 +8,6 @@ __status__ = "Production"
 __module_group__ = "Calendar"
 
 import os
-import time
 from utils import data_dir
 from utils import date_from_string_format
 from utils import date_epoch
@@ -22,8 +21,6 @@ from utils import remove_eol
 from utils import date_utcnow
 from outbox import post_message_to_outbox
 from session import create_session
-from threads import begin_thread
-from siteactive import save_unavailable_sites
 
 
 def _update_post_schedule(base_dir: str, handle: str, httpd,
@@ -202,52 +199,24 @@ def _update_post_schedule(base_dir: str, handle: str, httpd,
 
 
 def run_post_schedule(base_dir: str, httpd, max_scheduled_posts: int):
-    """Dispatches scheduled posts
+    """Dispatches scheduled posts. This is run periodically by the scheduler
     """
-    while True:
-        time.sleep(60)
-        # for each account
-        dir_str = data_dir(base_dir)
-        for _, dirs, _ in os.walk(dir_str):
-            for account in dirs:
-                if '@' not in account:
-                    continue
-                if not is_account_dir(account):
-                    continue
-                # scheduled posts index for this account
-                schedule_index_filename = \
-                    dir_str + '/' + account + '/schedule.index'
-                if not os.path.isfile(schedule_index_filename):
-                    continue
-                _update_post_schedule(base_dir, account,
-                                      httpd, max_scheduled_posts)
-            break
-
-
-def run_post_schedule_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the scheduled post thread running even if it dies
-    """
-    print('THREAD: Starting scheduled post watchdog ' + project_version)
-    post_schedule_original = \
-        httpd.thrPostSchedule.clone(run_post_schedule)
-    begin_thread(httpd.thrPostSchedule, 'run_post_schedule_watchdog')
-    curr_sites_unavailable = httpd.sites_unavailable.copy()
-    while True:
-        time.sleep(20)
-
-        # save the list of unavailable sites
-        if str(curr_sites_unavailable) != str(httpd.sites_unavailable):
-            save_unavailable_sites(httpd.base_dir, httpd.sites_unavailable)
-            curr_sites_unavailable = httpd.sites_unavailable.copy()
-
-        if httpd.thrPostSchedule.is_alive():
-            continue
-        httpd.thrPostSchedule.kill()
-        print('THREAD: restarting scheduled post watchdog')
-        httpd.thrPostSchedule = \
-            post_schedule_original.clone(run_post_schedule)
-        begin_thread(httpd.thrPostSchedule, 'run_post_schedule_watchdog')
-        print('Restarting scheduled posts...')
+    # for each account
+    dir_str = data_dir(base_dir)
+    for _, dirs, _ in os.walk(dir_str):
+        for account in dirs:
+            if '@' not in account:
+                continue
+            if not is_account_dir(account):
+                continue
+            # scheduled posts index for this account
+            schedule_index_filename = \
+                dir_str + '/' + account + '/schedule.index'
+            if not os.path.isfile(schedule_index_filename):
+                continue
+            _update_post_schedule(base_dir, account,
+                                  httpd, max_scheduled_posts)
+        break
 
 
 def remove_scheduled_posts(base_dir: str, nickname: str, domain: str) -> None:
@@ -0,0 +1,205 @@
+__filename__ = "scheduler.py"
+__author__ = "Bob Mottram"
+__license__ = "AGPL3+"
+__version__ = "1.6.0"
+__maintainer__ = "Bob Mottram"
+__email__ = "bob@libreserver.org"
+__status__ = "Production"
+__module_group__ = "Core"
+
+# Periodic jobs, such as expiring caches, dispatching scheduled posts
+# and checking that long running threads are still alive, are run by
+# a single supervisor thread rather than each having its own thread
+# which loops and sleeps. Jobs are held in a heap ordered by the time
+# when they are next due, and the supervisor sleeps until the earliest
+# one. Short jobs run on the supervisor thread itself, and longer ones
+# are run within their own thread, which is not started again while a
+# previous run is still going. If a job fails then it runs again at
+# its next interval. For each job the run time and the lateness, how
+# long after it was due it actually started, are recorded.
+
+import heapq
+import threading
+import time
+from threads import thread_with_trace
+from threads import begin_thread
+from threads import thread_check_cancelled
+
+
+def new_scheduler() -> {}:
+    """Returns a new scheduler with no jobs
+    """
+    return {
+        "jobs": {},
+        "heap": [],
+        "sequence": 0,
+        "thread": None,
+        "wake": threading.Event(),
+        "lock": threading.Lock()
+    }
+
+
+def _scheduler_push(scheduler: {}, job: {}) -> None:
+    """Adds a job to the heap at the time when it is next due.
+    This should be called with the lock held
+    """
+    scheduler['sequence'] += 1
+    heapq.heappush(scheduler['heap'],
+                   (job['dueTime'], scheduler['sequence'], job['name']))
+
+
+def scheduler_add_job(scheduler: {}, name: str, function, args: (),
+                      interval_secs: float, delay_secs: float,
+                      threaded: bool) -> None:
+    """Adds a job which calls the given function with the given
+    arguments every interval, the first time being after the delay.
+    Threaded jobs run within their own thread, otherwise they run on
+    the scheduler thread and should be brief
+    """
+    job = {
+        "name": name,
+        "function": function,
+        "args": args,
+        "intervalSecs": interval_secs,
+        "threaded": threaded,
+        "dueTime": time.time() + delay_secs,
+        "thread": None,
+        "running": False,
+        "runs": 0,
+        "failures": 0,
+        "overlaps": 0,
+        "totalRunSecs": 0.0,
+        "lastRunSecs": 0.0,
+        "maxRunSecs": 0.0,
+        "lastLatenessSecs": 0.0,
+        "maxLatenessSecs": 0.0
+    }
+    with scheduler['lock']:
+        scheduler['jobs'][name] = job
+        _scheduler_push(scheduler, job)
+    # the supervisor may be sleeping until a later job
+    scheduler['wake'].set()
+
+
+def _scheduler_call(scheduler: {}, job: {}) -> None:
+    """Calls the function of a job and records how long it took and
+    whether it failed
+    """
+    start_time = time.time()
+    success = True
+    try:
+        job['function'](*job['args'])
+    except Exception as ex:
+        success = False
+        print('EX: _scheduler_call job ' + job['name'] +
+              ' failed ' + str(ex))
+    finally:
+        run_secs = time.time() - start_time
+        with scheduler['lock']:
+            job['running'] = False
+            job['runs'] += 1
+            if not success:
+                job['failures'] += 1
+            job['totalRunSecs'] += run_secs
+            job['lastRunSecs'] = run_secs
+            job['maxRunSecs'] = max(job['maxRunSecs'], run_secs)
+
+
+def _scheduler_start_job(scheduler: {}, job: {}, curr_time: float) -> None:
+    """Starts a job which is due, then schedules its next run
+    """
+    lateness_secs = max(0.0, curr_time - job['dueTime'])
+    # the next run is at a fixed rate, but runs which were missed,
+    # eg. because the system was suspended, are not caught up
+    next_time = job['dueTime'] + job['intervalSecs']
+    if next_time <= curr_time:
+        next_time = curr_time + job['intervalSecs']
+
+    start = True
+    with scheduler['lock']:
+        if job['running']:
+            # the previous run has not finished yet
+            job['overlaps'] += 1
+            start = False
+        else:
+            job['running'] = True
+            job['lastLatenessSecs'] = lateness_secs
+            job['maxLatenessSecs'] = \
+                max(job['maxLatenessSecs'], lateness_secs)
+
+    if start:
+        if job['threaded']:
+            job['thread'] = \
+                thread_with_trace(target=_scheduler_call,
+                                  args=(scheduler, job), daemon=True)
+            if not begin_thread(job['thread'], '_scheduler_start_job'):
+                with scheduler['lock']:
+                    job['running'] = False
+        else:
+            _scheduler_call(scheduler, job)
+
+    with scheduler['lock']:
+        job['dueTime'] = next_time
+        _scheduler_push(scheduler, job)
+
+
+def _run_scheduler(scheduler: {}, thread_name: str) -> None:
+    """Supervisor thread which runs jobs when they are due
+    """
+    print('THREAD: Starting ' + thread_name)
+    while True:
+        thread_check_cancelled()
+        scheduler['wake'].clear()
+        curr_time = time.time()
+        due_jobs = []
+        wait_secs = None
+        with scheduler['lock']:
+            heap = scheduler['heap']
+            while heap and heap[0][0] <= curr_time:
+                _, _, name = heapq.heappop(heap)
+                due_jobs.append(scheduler['jobs'][name])
+            if heap:
+                wait_secs = heap[0][0] - curr_time
+        for job in due_jobs:
+            _scheduler_start_job(scheduler, job, curr_time)
+        if due_jobs:
+            continue
+        # sleep until the next job is due, a job is added or the
+        # thread is cancelled
+        scheduler['wake'].wait(wait_secs)
+
+
+def scheduler_start(scheduler: {}) -> None:
+    """Starts the supervisor thread which runs the jobs
+    """
+    scheduler['thread'] = \
+        thread_with_trace(target=_run_scheduler,
+                          args=(scheduler, 'scheduler'), daemon=True)
+    # wake the supervisor so that it stops when cancelled
+    scheduler['thread'].cancel_callbacks.append(scheduler['wake'].set)
+    begin_thread(scheduler['thread'], 'scheduler_start')
+
+
+def scheduler_metrics(scheduler: {}) -> {}:
+    """Returns the number of runs and failures of each job, together
+    with how long the runs took and how late they started
+    """
+    jobs_metrics = {}
+    with scheduler['lock']:
+        for name, job in scheduler['jobs'].items():
+            mean_run_secs = 0
+            if job['runs'] > 0:
+                mean_run_secs = job['totalRunSecs'] / job['runs']
+            jobs_metrics[name] = {
+                "intervalSecs": job['intervalSecs'],
+                "running": job['running'],
+                "runs": job['runs'],
+                "failures": job['failures'],
+                "overlaps": job['overlaps'],
+                "lastRunSecs": job['lastRunSecs'],
+                "meanRunSecs": mean_run_secs,
+                "maxRunSecs": job['maxRunSecs'],
+                "lastLatenessSecs": job['lastLatenessSecs'],
+                "maxLatenessSecs": job['maxLatenessSecs']
+            }
+    return jobs_metrics
@@ -11,8 +11,13 @@ import os
 import requests
 import json
 import errno
+import threading
+import time
+from urllib.parse import urlparse
 from socket import error as SocketError
 from http.client import HTTPConnection
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flags import is_image_file
 from flags import url_permitted
 from utils import text_in_file
@@ -24,6 +29,160 @@ from utils import get_domain_from_actor
 from httpsig import create_signed_header
 
 
+# Connections are pooled for each network, and the pools are shared
+# between all sessions, so that deliveries and lookups to the same host
+# reuse existing connections rather than making a new TCP and TLS
+# handshake each time. For each network this is the number of hosts
+# for which connections are kept and the number kept for each host
+SESSION_POOL_SIZES = {
+    "clearnet": (64, 4),
+    "tor": (16, 2),
+    "i2p": (16, 2)
+}
+
+# seconds after which the connections to an unused host are closed
+SESSION_POOL_IDLE_SECS = 2 * 60
+
+# connection pools and their statistics for each network
+SESSION_POOLS = {}
+SESSION_POOLS_LOCK = threading.Lock()
+
+
+def _session_pool(network: str) -> {}:
+    """Returns the connection pool for the given network,
+    creating it the first time
+    """
+    with SESSION_POOLS_LOCK:
+        pool = SESSION_POOLS.get(network)
+        if pool:
+            return pool
+        pool_hosts, pool_per_host = \
+            SESSION_POOL_SIZES.get(network, SESSION_POOL_SIZES['clearnet'])
+        # retry once if a connection can't be made. Requests which
+        # have been sent are not retried, since they may not be idempotent
+        retries = Retry(total=1, connect=1, read=False, status=0,
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_hosts,
+                              pool_maxsize=pool_per_host,
+                              max_retries=retries)
+        pool = {
+            "adapter": adapter,
+            "lastUsed": {},
+            "evicted": 0,
+            "evictedConnections": 0,
+            "evictedRequests": 0
+        }
+        SESSION_POOLS[network] = pool
+        return pool
+
+
+def _session_pool_used(response, *args, **kwargs) -> None:
+    """Response hook which records when each host was last used
+    """
+    url = response.request.url
+    try:
+        host = urlparse(url).hostname
+    except ValueError:
+        return
+    if not host:
+        return
+    with SESSION_POOLS_LOCK:
+        for pool in SESSION_POOLS.values():
+            if response.connection is not pool['adapter']:
+                continue
+            pool['lastUsed'].pop(host, None)
+            pool['lastUsed'][host] = time.time()
+            break
+
+
+def _session_pool_managers(adapter) -> []:
+    """Returns the pool managers of an adapter, including those
+    used with a proxy
+    """
+    managers = [adapter.poolmanager]
+    for proxy_manager in list(adapter.proxy_manager.values()):
+        managers.append(proxy_manager)
+    return managers
+
+
+def session_pools_evict_idle(curr_time: float) -> int:
+    """Closes the connections to hosts which have not been used
+    recently. Returns the number of connection pools closed
+    """
+    evicted = 0
+    with SESSION_POOLS_LOCK:
+        for pool in SESSION_POOLS.values():
+            idle_hosts = {}
+            last_used = pool['lastUsed']
+            while last_used:
+                host = next(iter(last_used))
+                if curr_time - last_used[host] < SESSION_POOL_IDLE_SECS:
+                    break
+                del last_used[host]
+                idle_hosts[host] = True
+            if not idle_hosts:
+                continue
+            for manager in _session_pool_managers(pool['adapter']):
+                for pool_key in list(manager.pools.keys()):
+                    if not idle_hosts.get(pool_key.key_host):
+                        continue
+                    host_pool = manager.pools.get(pool_key)
+                    if host_pool is None:
+                        continue
+                    pool['evictedConnections'] += \
+                        getattr(host_pool, 'num_connections', 0)
+                    pool['evictedRequests'] += \
+                        getattr(host_pool, 'num_requests', 0)
+                    # removing the pool closes its connections
+                    del manager.pools[pool_key]
+                    pool['evicted'] += 1
+                    evicted += 1
+    return evicted
+
+
+def expire_session_pools() -> None:
+    """Closes the connections to hosts which are no longer being used.
+    This is run periodically by the scheduler
+    """
+    session_pools_evict_idle(time.time())
+
+
+def session_pool_metrics() -> {}:
+    """Returns the number of hosts with connection pools, connections
+    made, requests sent and idle connections for each network
+    """
+    metrics = {}
+    with SESSION_POOLS_LOCK:
+        for network, pool in SESSION_POOLS.items():
+            host_pools = 0
+            connections = pool['evictedConnections']
+            pool_requests = pool['evictedRequests']
+            idle_connections = 0
+            for manager in _session_pool_managers(pool['adapter']):
+                for pool_key in list(manager.pools.keys()):
+                    host_pool = manager.pools.get(pool_key)
+                    if host_pool is None:
+                        continue
+                    host_pools += 1
+                    connections += getattr(host_pool, 'num_connections', 0)
+                    pool_requests += getattr(host_pool, 'num_requests', 0)
+                    if getattr(host_pool, 'pool', None) is not None:
+                        idle_connections += host_pool.pool.qsize()
+            reuse_rate = 0
+            if pool_requests > 0:
+                reuse_rate = \
+                    max(0, pool_requests - connections) * 100 / pool_requests
+            metrics[network] = {
+                "hosts": host_pools,
+                "connections": connections,
+                "requests": pool_requests,
+                "idleConnections": idle_connections,
+                "reuseRate": reuse_rate,
+                "evicted": pool['evicted']
+            }
+    return metrics
+
+
 def create_session(proxy_type: str):
     """ Creates a new session
     """
@@ -61,6 +220,14 @@ def create_session(proxy_type: str):
     elif proxy_type in ('ipfs', 'ipns'):
         session.proxies = {}
         session.proxies['ipfs'] = 'socks5h://localhost:4001'
+    # use the shared connection pool for the network
+    network = 'clearnet'
+    if proxy_type in ('tor', 'i2p'):
+        network = proxy_type
+    pool = _session_pool(network)
+    session.mount('http://', pool['adapter'])
+    session.mount('https://', pool['adapter'])
+    session.hooks['response'].append(_session_pool_used)
     # print('New session created with proxy ' + str(proxy_type))
     return session
 
@@ -273,7 +440,7 @@ def _get_json_signed(session, url: str, domain_full: str, session_headers: {},
     signature_header_json = \
         create_signed_header(None, signing_priv_key_pem, 'actor', domain, port,
                              to_domain, to_port, path, http_prefix,
-                             with_digest, message_str, content_type)
+                             with_digest, message_str, content_type, None)
     if debug:
         print('Signed GET signature_header_json ' + str(signature_header_json))
     # update the session headers from the signature headers
@@ -770,7 +937,8 @@ def post_image(session, attach_image_filename: str, federation_list: [],
 
         try:
             post_result = session.post(url=inbox_url, data=media_binary,
-                                       headers=headers, allow_redirects=True)
+                                       headers=headers, timeout=60,
+                                       allow_redirects=True)
         except requests.exceptions.RequestException as ex:
             print('EX: error during post_image requests ' + str(ex))
             return None
@@ -832,7 +1000,7 @@ def download_image(session, url: str, image_filename: str, debug: bool,
                 print('Downloading image url: ' + url)
             result = session.get(url,
                                  headers=session_headers,
-                                 params=None,
+                                 params=None, timeout=20,
                                  allow_redirects=True)
             if result.status_code < 200 or \
                result.status_code > 202:
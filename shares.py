@@ -56,6 +56,7 @@ from siteactive import site_is_active
 from content import get_price_from_string
 from blocking import is_blocked
 from threads import begin_thread
+from threads import thread_sleep
 from cache import remove_person_from_cache
 from cache import store_person_in_cache
 
@@ -1779,29 +1780,22 @@ def _update_federated_shares_cache(session, shared_items_federated_domains: [],
                 save_json(shares_json, shares_filename)
                 print('Converted shares catalog for ' + federated_domain_full)
         else:
-            time.sleep(2)
+            thread_sleep(2)
 
 
-def run_federated_shares_watchdog(project_version: str, httpd) -> None:
-    """This tries to keep the federated shares update thread
-    running even if it dies
+def supervise_federated_shares_daemon(httpd) -> None:
+    """Restarts the federated shares update thread if it has died.
+    This is run periodically by the scheduler
     """
-    print('THREAD: Starting federated shares watchdog')
-    federated_shares_original = \
-        httpd.thrPostSchedule.clone(run_federated_shares_daemon)
+    if httpd.thrFederatedSharesDaemon.is_alive():
+        return
+    httpd.thrFederatedSharesDaemon.kill()
+    print('THREAD: restarting federated shares daemon')
+    httpd.thrFederatedSharesDaemon = \
+        httpd.thrFederatedSharesDaemon.clone(run_federated_shares_daemon)
     begin_thread(httpd.thrFederatedSharesDaemon,
-                 'run_federated_shares_watchdog')
-    while True:
-        time.sleep(55)
-        if httpd.thrFederatedSharesDaemon.is_alive():
-            continue
-        httpd.thrFederatedSharesDaemon.kill()
-        print('THREAD: restarting federated shares watchdog')
-        httpd.thrFederatedSharesDaemon = \
-            federated_shares_original.clone(run_federated_shares_daemon)
-        begin_thread(httpd.thrFederatedSharesDaemon,
-                     'run_federated_shares_watchdog 2')
-        print('Restarting federated shares daemon...')
+                 'supervise_federated_shares_daemon')
+    print('Restarting federated shares daemon...')
 
 
 def _generate_next_shares_token_update(base_dir: str,
@@ -1900,7 +1894,7 @@ def run_federated_shares_daemon(base_dir: str, httpd, http_prefix: str,
     """
     seconds_per_hour = 60 * 60
     file_check_interval_sec = 120
-    time.sleep(60)
+    thread_sleep(60)
     # the token for this instance will be changed every 7-14 days
     min_days = 7
     max_days = 14
@@ -1910,7 +1904,7 @@ def run_federated_shares_daemon(base_dir: str, httpd, http_prefix: str,
         shared_items_federated_domains_str = \
             get_config_param(base_dir, 'sharedItemsFederatedDomains')
         if not shared_items_federated_domains_str:
-            time.sleep(file_check_interval_sec)
+            thread_sleep(file_check_interval_sec)
             continue
 
         # occasionally change the federated shared items token
@@ -1925,18 +1919,18 @@ def run_federated_shares_daemon(base_dir: str, httpd, http_prefix: str,
         for shared_fed_domain in fed_domains_list:
             shared_items_federated_domains.append(shared_fed_domain.strip())
         if not shared_items_federated_domains:
-            time.sleep(file_check_interval_sec)
+            thread_sleep(file_check_interval_sec)
             continue
 
         # load the tokens
         tokens_filename = \
             data_dir(base_dir) + '/sharedItemsFederationTokens.json'
         if not os.path.isfile(tokens_filename):
-            time.sleep(file_check_interval_sec)
+            thread_sleep(file_check_interval_sec)
             continue
         tokens_json = load_json(tokens_filename)
         if not tokens_json:
-            time.sleep(file_check_interval_sec)
+            thread_sleep(file_check_interval_sec)
             continue
 
         session = create_session(proxy_type)
@@ -1947,7 +1941,7 @@ def run_federated_shares_daemon(base_dir: str, httpd, http_prefix: str,
                                            tokens_json, debug, system_language,
                                            shares_file_type, sites_unavailable,
                                            mitm_servers)
-        time.sleep(seconds_per_hour * 6)
+        thread_sleep(seconds_per_hour * 6)
 
 
 def _dfc_to_shares_format(catalog_json: {},
@@ -155,7 +155,7 @@ def referer_is_active(http_prefix: str,
                           sites_unavailable)
 
 
-def save_unavailable_sites(base_dir: str, sites_unavailable: []) -> None:
+def _save_unavailable_sites(base_dir: str, sites_unavailable: []) -> None:
     """Save a list of unavailable sites
     """
     unavailable_sites_filename = data_dir(base_dir) + '/unavailable_sites.txt'
@@ -170,6 +170,18 @@ def save_unavailable_sites(base_dir: str, sites_unavailable: []) -> None:
         print('EX: unable to save unavailable sites')
 
 
+def save_unavailable_sites_changed(base_dir: str, sites_unavailable: [],
+                                   saved_sites: []) -> None:
+    """Saves the list of unavailable sites if it has changed since it
+    was last saved. saved_sites is the list as it was last saved
+    """
+    if str(saved_sites) == str(sites_unavailable):
+        return
+    _save_unavailable_sites(base_dir, sites_unavailable)
+    saved_sites.clear()
+    saved_sites.extend(sites_unavailable)
+
+
 def load_unavailable_sites(base_dir: str) -> []:
     """load a list of unavailable sites
     """
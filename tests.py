@@ -14,11 +14,21 @@ from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric import utils as hazutils
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+from cryptography import x509
+from cryptography.x509.oid import NameOID
 import time
+import threading
 import os
 import shutil
 import json
 import datetime
+import ipaddress
+import functools
+import ssl
+from http.server import ThreadingHTTPServer
+from http.server import SimpleHTTPRequestHandler
 from shutil import copyfile
 from random import randint
 from time import gmtime, strftime
@@ -30,14 +40,46 @@ from httpsig import sign_post_headers
 from httpsig import sign_post_headers_new
 from httpsig import verify_post_headers
 from httpsig import message_content_digest
+from httpsig import load_cached_private_key
+from httpsig import load_cached_public_key
+from httpsig import key_cache_metrics
+from httpsig import KEY_CACHE
 from cache import cache_svg_images
 from cache import store_person_in_cache
 from cache import get_person_from_cache
+from cache import expire_person_cache
+from cache import store_webfinger_in_cache
+from cache import store_webfinger_failure_in_cache
+from cache import get_webfinger_from_cache
+from cache import webfinger_failed_recently
+from cache import save_webfinger_cache
+from cache import load_webfinger_cache
+from cache import webfinger_cache_metrics
+from cache import WEBFINGER_CACHE_MAX_ENTRIES
+from cache import person_cache_set_budget
+from cache import person_cache_metrics
+from cache import PERSON_CACHE_MAX_ENTRIES
+from cache import PERSON_CACHE_MAX_BYTES
+from cache import PERSON_CACHE_MAX_AGE_SECS
 from threads import thread_with_trace
+from threads import thread_sleep
+from threads import thread_check_cancelled
+from threads import thread_cancelled
+from threads import thread_on_cancel
 from daemon import run_daemon
 from session import get_json_valid
 from session import create_session
+from session import session_pools_evict_idle
+from session import expire_session_pools
+from scheduler import new_scheduler
+from scheduler import scheduler_add_job
+from scheduler import scheduler_start
+from scheduler import scheduler_metrics
+from fitnessFunctions import collect_fitness_metrics
+from session import session_pool_metrics
+from session import SESSION_POOL_IDLE_SECS
 from session import get_json
+from posts import new_signing_context
 from posts import json_post_allows_comments
 from posts import convert_post_content_to_html
 from posts import get_actor_from_in_reply_to
@@ -63,6 +105,19 @@ from flags import is_group_account
 from flags import is_right_to_left_text
 from utils import replace_strings
 from utils import valid_content_warning
+from blocking import add_global_block
+from blocking import remove_global_block
+from blocking import add_block
+from blocking import remove_block
+from blocking import is_blocked
+from blocking import is_blocked_domain
+from blocking import is_blocked_nickname
+from blocking import is_blocked_hashtag
+from blocking import broch_mode_is_active
+from blocking import set_broch_mode
+from blocking import blocklist_changed
+from blocking import save_federated_blocks
+from blocking import BLOCKLISTS
 from utils import data_dir
 from utils import data_dir_testing
 from utils import remove_link_tracking
@@ -87,6 +142,10 @@ from utils import get_actor_languages_list
 from utils import get_category_types
 from utils import get_supported_languages
 from utils import set_config_param
+from utils import get_config_param
+from utils import config_metrics
+from utils import CONFIG_SNAPSHOTS
+from utils import config_changed
 from utils import date_string_to_seconds
 from utils import date_seconds_to_string
 from utils import valid_password
@@ -98,7 +157,11 @@ from utils import valid_nickname
 from utils import first_paragraph_from_string
 from utils import remove_id_ending
 from utils import update_recent_posts_cache
+from utils import get_recent_cached_post
+from utils import update_post_in_cache
+from utils import remove_post_id_from_cache
 from utils import follow_person
+from utils import get_followers_list
 from utils import get_nickname_from_actor
 from utils import get_domain_from_actor
 from utils import copytree
@@ -112,6 +175,11 @@ from utils import dangerous_markup
 from utils import acct_dir
 from pgp import extract_pgp_public_key
 from pgp import pgp_public_key_upload
+from follow import is_follower_of_person
+from follow import is_following_actor
+from follow import get_no_of_followers
+from follow import get_follower_domains
+from follow import remove_follower
 from follow import add_follower_of_person
 from follow import unfollow_account
 from follow import unfollower_of_account
@@ -122,7 +190,7 @@ from person import create_person
 from person import create_group
 from person import set_display_nickname
 from person import set_bio
-# from person import generate_rsa_key
+from person import generate_rsa_key
 from skills import set_skill_level
 from skills import actor_skill_value
 from skills import set_skills_from_dict
@@ -183,6 +251,28 @@ from theme import set_css_param
 from theme import scan_themes_for_scripts
 from linked_data_sig import generate_json_signature
 from linked_data_sig import verify_json_signature
+from linked_data_sig import verified_cache_metrics
+from pyjsonld import normalize
+from delivery import new_delivery_engine
+from delivery import delivery_rejected
+from delivery import delivery_add
+from delivery import delivery_metrics
+from delivery import delivery_load
+from delivery import delivery_backoff_secs
+from delivery import delivery_fanout_begin
+from delivery import delivery_fanout_end
+from delivery_targets import DELIVERY_TARGETS
+from delivery_targets import delivery_targets_inbox
+from delivery_targets import delivery_targets_set_inbox
+from delivery_targets import delivery_targets_shared_inbox
+from delivery_targets import delivery_targets_set_shared_inbox
+from delivery_targets import delivery_targets_update_actor
+from delivery_targets import delivery_targets_forget_actor
+from delivery_targets import delivery_targets_save
+from delivery_targets import delivery_targets_metrics
+from pyjsonld import load_document
+from pyjsonld import JsonLdError
+from pyjsonld import NORMALIZE_MAX_BLANK_NODES
 from newsdaemon import hashtag_rule_tree
 from newsdaemon import hashtag_rule_resolve
 from newswire import get_link_from_rss_item
@@ -227,6 +317,40 @@ from reading import get_reading_status
 from reading import store_book_events
 from conversation import conversation_tag_to_convthread_id
 from conversation import convthread_id_to_conversation_tag
+from inbox_admission import new_inbox_admission
+from inbox_admission import inbox_admission_check
+from inbox_admission import inbox_admission_refund
+from inbox_keys import new_inbox_keys
+from inbox_keys import inbox_keys_failing
+from inbox_keys import inbox_keys_failed
+from inbox_keys import inbox_keys_park
+from inbox_keys import inbox_keys_due
+from inbox_keys import inbox_keys_fetched
+from inbox_seen import new_inbox_seen
+from inbox_seen import inbox_seen_key
+from inbox_seen import inbox_seen_contains
+from inbox_seen import inbox_seen_add
+from inbox_seen import inbox_seen_forget
+from inbox_seen import inbox_seen_inflight
+from inbox_seen import inbox_seen_begin
+from inbox_seen import inbox_seen_metrics
+from inbox_queue import new_inbox_queue
+from inbox_queue import inbox_queue_add
+from inbox_queue import inbox_queue_contains
+from inbox_queue import inbox_queue_take
+from inbox_queue import inbox_queue_verified
+from inbox_queue import inbox_queue_next_verified
+from inbox_queue import inbox_queue_length
+from inbox_queue import inbox_queue_clear
+from inbox_queue import inbox_queue_wait
+from inbox_queue import inbox_queue_done
+from inbox_queue import inbox_queue_commit
+from inbox_queue import inbox_queue_restore
+from inbox_queue import inbox_queue_park
+from inbox_queue import inbox_queue_unpark
+from inbox_queue import inbox_queue_requeue
+from inbox_queue import inbox_queue_set_lanes
+from inbox_queue import inbox_queue_lane_metrics
 
 
 TEST_SERVER_GROUP_RUNNING = False
@@ -311,6 +435,7 @@ def _test_http_signed_get(base_dir: str):
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
 
     nickname = 'testactor'
@@ -347,7 +472,7 @@ def _test_http_signed_get(base_dir: str):
                              domain, port,
                              host_domain, port,
                              boxpath, http_prefix, False,
-                             None, accept)
+                             None, accept, None)
 
     headers['signature'] = signature_header['signature']
     getreq_method = not with_digest
@@ -591,6 +716,7 @@ def _test_httpsig_base(with_digest: bool, base_dir: str):
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
 
     algorithm = 'rsa-sha256'
@@ -634,7 +760,7 @@ def _test_httpsig_base(with_digest: bool, base_dir: str):
                               domain, port,
                               host_domain, port,
                               boxpath, http_prefix, None, content_type,
-                              algorithm, None)
+                              algorithm, None, None)
     else:
         digest_prefix = get_digest_prefix(digest_algorithm)
         body_digest = \
@@ -653,7 +779,8 @@ def _test_httpsig_base(with_digest: bool, base_dir: str):
                               domain, port,
                               host_domain, port,
                               boxpath, http_prefix, message_body_json_str,
-                              content_type, algorithm, digest_algorithm)
+                              content_type, algorithm, digest_algorithm,
+                              None)
 
     headers['signature'] = signature_header
     getreq_method = not with_digest
@@ -724,10 +851,82 @@ def _test_cache():
     assert result['id'] == 123456
     assert result['test'] == 'This is a test'
 
+    # fields which are not read are not held in memory
+    person_json['@context'] = ['https://www.w3.org/ns/activitystreams']
+    store_person_in_cache(None, person_url, person_json, person_cache, True)
+    result = get_person_from_cache(None, person_url, person_cache)
+    assert '@context' not in result
+    assert '@context' in person_json
+    assert result['test'] == 'This is a test'
+
+    # the least recently used actors are evicted
+    person_cache = {}
+    person_cache_set_budget(3, 0)
+    for index in range(3):
+        actor_json = {
+            "id": index,
+            "test": "This is a test"
+        }
+        actor_url = 'actor' + str(index)
+        store_person_in_cache(None, actor_url, actor_json,
+                              person_cache, False)
+    assert get_person_from_cache(None, 'actor0', person_cache)
+    store_person_in_cache(None, 'actor3', person_json, person_cache, False)
+    assert len(person_cache) == 3
+    assert not get_person_from_cache(None, 'actor1', person_cache)
+    assert get_person_from_cache(None, 'actor0', person_cache)
+    metrics = person_cache_metrics(person_cache)
+    assert metrics['entries'] == 3
+    assert metrics['evictions'] == 1
+    assert metrics['hits'] == 2
+    assert metrics['misses'] == 1
+    entry_bytes = metrics['bytes']
+    assert entry_bytes > 0
+
+    # the total size of actors is bounded
+    person_cache_set_budget(100, entry_bytes)
+    store_person_in_cache(None, 'actor4', person_json, person_cache, False)
+    metrics = person_cache_metrics(person_cache)
+    assert metrics['bytes'] <= entry_bytes
+    assert metrics['entries'] < 3
+    assert get_person_from_cache(None, 'actor4', person_cache)
+
+    # actors expire after a while
+    person_cache[person_url] = person_cache.pop('actor4')
+    person_cache[person_url]['stored'] -= PERSON_CACHE_MAX_AGE_SECS + 1
+    assert not get_person_from_cache(None, person_url, person_cache)
+    store_person_in_cache(None, person_url, person_json, person_cache, False)
+    person_cache[person_url]['stored'] -= PERSON_CACHE_MAX_AGE_SECS + 1
+    expire_person_cache(person_cache)
+    assert person_url not in person_cache
+    metrics = person_cache_metrics(person_cache)
+    assert metrics['expired'] == 2
+    total_bytes = 0
+    for entry in person_cache.values():
+        total_bytes += entry['size']
+    assert metrics['bytes'] == total_bytes
+
+    # the counters belong to the cache which they were counted for
+    new_person_cache = {}
+    metrics = person_cache_metrics(new_person_cache)
+    assert metrics['entries'] == 0
+    assert metrics['hits'] == 0
+    assert metrics['expired'] == 0
+    assert person_cache_metrics(person_cache)['expired'] == 2
+    person_cache_set_budget(PERSON_CACHE_MAX_ENTRIES, PERSON_CACHE_MAX_BYTES)
+
 
 def _test_threads_function(param1: str, param2: str):
     for _ in range(10000):
-        time.sleep(2)
+        thread_sleep(2)
+
+
+def _test_threads_cancel_function(thread_state: {},
+                                  thread_name: str) -> None:
+    thread_on_cancel(thread_state['cancelled'].set)
+    while True:
+        thread_state['loops'] += 1
+        thread_check_cancelled()
 
 
 def _test_threads():
@@ -739,9 +938,36 @@ def _test_threads():
     thr.start()
     assert thr.is_alive() is True
     time.sleep(1)
+    # the thread stops while sleeping, without waiting for the sleep
+    # to end
+    kill_time = time.time()
+    thr.kill()
+    thr.join()
+    assert thr.is_alive() is False
+    assert time.time() - kill_time < 1
+
+    # a thread stops at a cancellation point, and functions
+    # registered to be called when it is cancelled are called
+    thread_state = {
+        "loops": 0,
+        "cancelled": threading.Event()
+    }
+    thr = \
+        thread_with_trace(target=_test_threads_cancel_function,
+                          args=(thread_state, 'cancel test'),
+                          daemon=True)
+    thr.start()
+    time.sleep(0.1)
     thr.kill()
     thr.join()
     assert thr.is_alive() is False
+    assert thread_state['loops'] > 0
+    assert thread_state['cancelled'].wait(5)
+
+    # outside of a cancellable thread, sleeping is unchanged
+    assert not thread_cancelled()
+    thread_sleep(0.01)
+    thread_check_cancelled()
 
 
 def create_server_alice(path: str, domain: str, port: int,
@@ -752,6 +978,7 @@ def create_server_alice(path: str, domain: str, port: int,
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
     shared_items_federated_domains: list[str] = []
     system_language = 'en'
@@ -949,6 +1176,7 @@ def create_server_bob(path: str, domain: str, port: int,
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
     shared_items_federated_domains: list[str] = []
     system_language = 'en'
@@ -1145,6 +1373,7 @@ def create_server_eve(path: str, domain: str, port: int, federation_list: [],
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
     shared_items_federated_domains: list[str] = []
     nickname = 'eve'
@@ -1267,6 +1496,7 @@ def create_server_group(path: str, domain: str, port: int,
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
     shared_items_federated_domains: list[str] = []
     # system_language = 'en'
@@ -4196,6 +4426,92 @@ def _test_recent_posts_cache():
     assert len(recent_posts_cache['index']) == max_recent_posts
     assert len(recent_posts_cache['json'].items()) == max_recent_posts
     assert len(recent_posts_cache['html'].items()) == max_recent_posts
+    assert len(recent_posts_cache['parsed'].items()) == max_recent_posts
+
+    # the least recently used post is removed
+    post_id = 'https:##somesite.whatever#users#someuser#statuses#2'
+    cached_post = get_recent_cached_post(recent_posts_cache, post_id)
+    assert cached_post
+    assert cached_post['parsed']['id'] == post_id.replace('#', '/')
+    assert json.loads(cached_post['json']) == cached_post['parsed']
+    post_json_object = {
+        "id": "https://somesite.whatever/users/someuser/statuses/5"
+    }
+    update_recent_posts_cache(recent_posts_cache, max_recent_posts,
+                              post_json_object, html_str)
+    assert list(recent_posts_cache['index'].keys()) == [
+        'https:##somesite.whatever#users#someuser#statuses#4',
+        post_id,
+        'https:##somesite.whatever#users#someuser#statuses#5'
+    ]
+    # changes to the post being rendered don't alter the cache
+    post_json_object['content'] = 'changed'
+    post_id5 = 'https:##somesite.whatever#users#someuser#statuses#5'
+    assert 'content' not in recent_posts_cache['parsed'][post_id5]
+
+    # updating a post removes its html
+    post_json_object['muted'] = True
+    assert update_post_in_cache(recent_posts_cache, post_id5,
+                                post_json_object)
+    assert recent_posts_cache['parsed'][post_id5]['muted'] is True
+    assert post_id5 not in recent_posts_cache['html']
+    update_recent_posts_cache(recent_posts_cache, max_recent_posts,
+                              post_json_object, html_str)
+    assert recent_posts_cache['html'][post_id5] == html_str
+
+    # removed posts are no longer cached
+    remove_post_id_from_cache(recent_posts_cache, post_id)
+    assert not get_recent_cached_post(recent_posts_cache, post_id)
+    for field in ('index', 'json', 'parsed', 'html'):
+        assert len(recent_posts_cache[field]) == 2
+
+
+def _test_recent_posts_cache_benchmark() -> None:
+    print('recent posts cache benchmark')
+    html_str = '<div class="post">' + ('x' * 1000) + '</div>'
+    page_size = 30
+    for max_recent_posts in (512, 4096, 32768):
+        recent_posts_cache = {}
+        post_ids = []
+        start_time = time.time()
+        for index in range(max_recent_posts * 2):
+            post_json_object = {
+                "id": "https://somesite.whatever/users/someuser/" +
+                "statuses/" + str(index) + "/activity",
+                "type": "Create",
+                "object": {
+                    "id": "https://somesite.whatever/users/someuser/" +
+                    "statuses/" + str(index),
+                    "type": "Note",
+                    "content": "Post number " + str(index)
+                }
+            }
+            update_recent_posts_cache(recent_posts_cache, max_recent_posts,
+                                      post_json_object, html_str)
+            post_ids.append('https:##somesite.whatever#users#someuser#' +
+                            'statuses#' + str(index))
+        insert_time = max(time.time() - start_time, 0.000001)
+        assert len(recent_posts_cache['index']) == max_recent_posts
+
+        # assemble pages of the timeline from the cached posts
+        pages = 200
+        start_time = time.time()
+        for page in range(pages):
+            timeline = []
+            for index in range(page_size):
+                post_id = post_ids[-1 - ((page * page_size + index) %
+                                         max_recent_posts)]
+                cached_post = \
+                    get_recent_cached_post(recent_posts_cache, post_id)
+                assert cached_post
+                timeline.append(cached_post['parsed'].copy())
+            assert len(timeline) == page_size
+        assemble_time = max(time.time() - start_time, 0.000001)
+        print(str(max_recent_posts) + ' posts ' +
+              str(int(max_recent_posts * 2 / insert_time)) +
+              ' inserts per second, ' +
+              str(int(pages / assemble_time)) +
+              ' timeline pages per second')
 
 
 def _test_remove_txt_formatting():
@@ -5929,26 +6245,35 @@ def _test_functions():
         'remove_value',
         'normalize',
         'get_document_loader',
-        'run_inbox_queue_watchdog',
+        'supervise_inbox_queue',
         'run_inbox_queue',
+        '_run_inbox_verify',
+        '_run_inbox_key_refetch',
+        '_session_pool_used',
+        '_test_threads_cancel_function',
         'run_import_following',
-        'run_import_following_watchdog',
         'run_post_schedule',
-        'run_post_schedule_watchdog',
         'str2bool',
         'run_federated_blocks_daemon',
         'run_newswire_daemon',
-        'run_newswire_watchdog',
-        'run_federated_shares_watchdog',
+        'supervise_newswire_daemon',
+        'supervise_federated_shares_daemon',
         'run_federated_shares_daemon',
-        'fitness_thread',
-        'thread_send_post',
+        'save_fitness',
+        'collect_fitness_metrics',
+        'expire_session_pools',
+        'save_unavailable_sites_changed',
+        'remove_dormant_threads',
+        '_run_scheduler',
+        '_scheduler_call',
+        '_test_scheduler_job',
+        '_test_scheduler_failing_job',
+        'deliver_post',
+        '_run_delivery_worker',
+        '_test_delivery_function',
         'send_to_followers',
         'expire_cache',
-        'run_posts_queue',
         'run_shares_expire',
-        'run_posts_watchdog',
-        'run_shares_expire_watchdog',
         'get_this_weeks_events',
         'get_availability',
         '_test_threads_function',
@@ -7472,6 +7797,7 @@ def _test_httpsig_base_new(with_digest: bool, base_dir: str,
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=False)
     os.mkdir(path)
+    config_changed(path)
     os.chdir(path)
 
     content_type = 'application/activity+json'
@@ -9168,6 +9494,1531 @@ def _test_conversation_to_convthread() -> None:
     assert conversation_id2 == conversation_id
 
 
+def _test_inbox_queue(base_dir: str) -> None:
+    print('inbox queue')
+    journal_dir = base_dir + '/.testInboxQueue'
+    if os.path.isdir(journal_dir):
+        shutil.rmtree(journal_dir, ignore_errors=False)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_length(queue) == 0
+    ticket, queue_json = inbox_queue_take(queue)
+    assert ticket is None
+    assert queue_json is None
+    assert not inbox_queue_wait(queue, 0.01)
+
+    # items are taken in order of arrival
+    assert inbox_queue_add(queue, {"filename": 'c.json'}, 30.0)
+    assert inbox_queue_add(queue, {"filename": 'a.json'}, 10.0)
+    assert inbox_queue_add(queue, {"filename": 'b.json'}, 20.0)
+    assert inbox_queue_add(queue, {"filename": 'd.json'}, 20.0)
+    # duplicates are not added
+    assert not inbox_queue_add(queue, {"filename": 'a.json'}, 40.0)
+    assert inbox_queue_contains(queue, 'a.json')
+    assert not inbox_queue_contains(queue, 'z.json')
+    assert inbox_queue_length(queue) == 4
+    assert inbox_queue_wait(queue, 0.01)
+    tickets = {}
+    for expected_filename in ('a.json', 'b.json', 'd.json', 'c.json'):
+        ticket, queue_json = inbox_queue_take(queue)
+        assert queue_json['filename'] == expected_filename
+        tickets[expected_filename] = ticket
+    # items which are being verified are still within the queue
+    assert inbox_queue_length(queue) == 4
+    assert not inbox_queue_add(queue, {"filename": 'b.json'}, 50.0)
+    assert not inbox_queue_wait(queue, 0.01)
+
+    # verified items are applied in the order in which they were taken,
+    # even if verification completes in a different order
+    inbox_queue_verified(queue, tickets['d.json'], {"filename": 'd.json'})
+    inbox_queue_verified(queue, tickets['b.json'], None)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert not item_ready
+    inbox_queue_verified(queue, tickets['a.json'], {"filename": 'a.json'})
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert item_ready
+    assert verified_item['filename'] == 'a.json'
+    inbox_queue_done(queue, sequence)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert item_ready
+    assert verified_item is None
+    inbox_queue_done(queue, sequence)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert item_ready
+    assert verified_item['filename'] == 'd.json'
+    inbox_queue_done(queue, sequence)
+    assert inbox_queue_length(queue) == 1
+
+    # after a restart only the items which were not applied are replayed
+    inbox_queue_commit(queue)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 60.0) == 1
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'c.json'
+
+    # clearing abandons items which are being verified
+    inbox_queue_clear(queue)
+    assert inbox_queue_length(queue) == 0
+    inbox_queue_verified(queue, ticket, {"filename": 'c.json'})
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert not item_ready
+    assert inbox_queue_add(queue, {"filename": 'c.json'}, 50.0)
+    inbox_queue_clear(queue)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 60.0) == 0
+
+    # parked items are not consumed, so they are recovered after
+    # a restart
+    assert inbox_queue_add(queue, {"filename": 'p.json'}, 60.0)
+    ticket, queue_json = inbox_queue_take(queue)
+    parked_sequence = inbox_queue_park(queue, ticket)
+    inbox_queue_verified(queue, ticket, None)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    assert item_ready
+    assert sequence == parked_sequence
+    inbox_queue_done(queue, sequence)
+    assert inbox_queue_length(queue) == 0
+    inbox_queue_commit(queue)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 60.0) == 1
+
+    # a parked item which is put back onto the queue is then applied
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'p.json'
+    parked_sequence = inbox_queue_park(queue, ticket)
+    inbox_queue_verified(queue, ticket, None)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    inbox_queue_done(queue, sequence)
+    assert inbox_queue_requeue(queue, queue_json, parked_sequence, 70.0)
+    assert not inbox_queue_requeue(queue, queue_json, parked_sequence, 70.0)
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'p.json'
+    inbox_queue_verified(queue, ticket, queue_json)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    inbox_queue_done(queue, sequence)
+
+    # a parked item which is dropped is consumed
+    assert inbox_queue_add(queue, {"filename": 'q.json'}, 80.0)
+    ticket, queue_json = inbox_queue_take(queue)
+    parked_sequence = inbox_queue_park(queue, ticket)
+    inbox_queue_verified(queue, ticket, None)
+    item_ready, verified_item, sequence = \
+        inbox_queue_next_verified(queue, 0.01)
+    inbox_queue_done(queue, sequence)
+    inbox_queue_unpark(queue, parked_sequence)
+    inbox_queue_commit(queue)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 90.0) == 0
+
+    # throughput at different queue depths
+    for queue_depth in (1000, 10000, 100000):
+        start_time = time.time()
+        for index in range(queue_depth):
+            queue_item = {"filename": str(index) + '.json'}
+            arrival_time = float(index)
+            inbox_queue_add(queue, queue_item, arrival_time)
+        prev_index = -1
+        while inbox_queue_length(queue) > 0:
+            ticket, queue_json = inbox_queue_take(queue)
+            inbox_queue_verified(queue, ticket, queue_json)
+            item_ready, verified_item, sequence = \
+                inbox_queue_next_verified(queue, 0)
+            assert item_ready
+            index = int(verified_item['filename'].split('.')[0])
+            assert index > prev_index
+            prev_index = index
+            inbox_queue_done(queue, sequence)
+        time_taken = max(time.time() - start_time, 0.000001)
+        print('Inbox queue depth ' + str(queue_depth) + ': ' +
+              str(int(queue_depth / time_taken)) + ' items per second')
+    # all segments have been consumed
+    inbox_queue_commit(queue)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 60.0) == 0
+
+    # items added after the segments were removed survive a restart
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 60.0) == 0
+    assert inbox_queue_add(queue, {"filename": 'e.json'}, 70.0)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 80.0) == 1
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'e.json'
+    assert inbox_queue_add(queue, {"filename": 'f.json'}, 90.0)
+    queue = new_inbox_queue(journal_dir)
+    assert inbox_queue_restore(queue, 100.0) == 2
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'e.json'
+    ticket, queue_json = inbox_queue_take(queue)
+    assert queue_json['filename'] == 'f.json'
+    shutil.rmtree(journal_dir, ignore_errors=False)
+
+
+def _test_inbox_admission() -> None:
+    print('inbox admission')
+    admission = new_inbox_admission(2)
+    curr_time = 1000.0
+
+    # a burst up to the per minute limit is admitted
+    for _ in range(6):
+        assert inbox_admission_check(admission, 'a.domain', 'x@a.domain',
+                                     0, 8640, curr_time) == 0
+    retry_after_secs = \
+        inbox_admission_check(admission, 'a.domain', 'x@a.domain',
+                              0, 8640, curr_time)
+    assert retry_after_secs == 11
+    # another actor on the same domain is not affected
+    assert inbox_admission_check(admission, 'a.domain', 'y@a.domain',
+                                 0, 8640, curr_time) == 0
+    # tokens are added over time
+    curr_time += 10
+    assert inbox_admission_check(admission, 'a.domain', 'x@a.domain',
+                                 0, 8640, curr_time) == 0
+
+    # the daily quota applies once the burst has been used up
+    for _ in range(5):
+        assert inbox_admission_check(admission, 'b.domain', 'x@b.domain',
+                                     10, 0, curr_time) == 0
+    curr_time += 60
+    for _ in range(5):
+        assert inbox_admission_check(admission, 'b.domain', 'x@b.domain',
+                                     10, 0, curr_time) == 0
+    curr_time += 60
+    retry_after_secs = \
+        inbox_admission_check(admission, 'b.domain', 'x@b.domain',
+                              10, 0, curr_time)
+    assert retry_after_secs > 60 * 60
+    # a rejected post does not use up the quota of the other bucket
+    assert inbox_admission_check(admission, 'b.domain', 'x@b.domain',
+                                 10, 8640, curr_time) > 0
+    assert admission['actors']['x@b.domain']['tokens'][1] == 6
+    assert admission['rejected'] == 3
+
+    # a post which was admitted but not queued gets its tokens back
+    assert inbox_admission_check(admission, 'a.domain', 'x@a.domain',
+                                 0, 8640, curr_time) == 0
+    tokens = admission['actors']['x@a.domain']['tokens'].copy()
+    assert inbox_admission_check(admission, 'a.domain', 'x@a.domain',
+                                 0, 8640, curr_time) == 0
+    admitted = admission['admitted']
+    inbox_admission_refund(admission, 'a.domain', 'x@a.domain', 0, 8640)
+    assert admission['actors']['x@a.domain']['tokens'] == tokens
+    assert admission['admitted'] == admitted - 1
+
+    # the number of senders tracked is bounded
+    assert len(admission['actors']) == 2
+    assert 'y@a.domain' not in admission['actors']
+    assert inbox_admission_check(admission, 'c.domain', 'x@c.domain',
+                                 10, 8640, curr_time) == 0
+    assert len(admission['domains']) == 2
+    assert 'b.domain' in admission['domains']
+    assert 'c.domain' in admission['domains']
+
+
+def _test_inbox_queue_lanes(base_dir: str) -> None:
+    print('inbox queue lanes')
+    journal_dir = base_dir + '/.testInboxQueueLanes'
+    if os.path.isdir(journal_dir):
+        shutil.rmtree(journal_dir, ignore_errors=False)
+    queue = new_inbox_queue(journal_dir)
+    arrival_time = 0.0
+    for index in range(20):
+        arrival_time += 1
+        queue_item = {
+            "filename": 'like' + str(index) + '.json',
+            "domain": 'local.domain',
+            "post": {"type": 'Like'}
+        }
+        assert inbox_queue_add(queue, queue_item, arrival_time)
+    # a public post which doesn't mention anyone here
+    queue_item = {
+        "filename": 'public.json',
+        "domain": 'local.domain',
+        "post": {
+            "type": 'Create',
+            "object": {
+                "to": ['https://www.w3.org/ns/activitystreams#Public'],
+                "cc": ['https://remote.domain/users/someone/followers']
+            }
+        }
+    }
+    assert inbox_queue_add(queue, queue_item, arrival_time + 1)
+    # a reply which mentions a local account
+    queue_item = {
+        "filename": 'reply.json',
+        "domain": 'local.domain',
+        "post": {
+            "type": 'Create',
+            "object": {
+                "to": ['https://www.w3.org/ns/activitystreams#Public'],
+                "tag": [{
+                    "type": 'Mention',
+                    "href": 'https://local.domain/users/alice'
+                }]
+            }
+        }
+    }
+    assert inbox_queue_add(queue, queue_item, arrival_time + 2)
+    queue_item = {
+        "filename": 'follow.json',
+        "domain": 'local.domain',
+        "post": {"type": 'Follow'}
+    }
+    assert inbox_queue_add(queue, queue_item, arrival_time + 3)
+
+    metrics = inbox_queue_lane_metrics(queue)
+    assert metrics['bulk']['depth'] == 20
+    assert metrics['normal']['depth'] == 1
+    assert metrics['priority']['depth'] == 2
+
+    # later items in higher priority lanes overtake earlier likes,
+    # but likes are not starved
+    filenames = []
+    for _ in range(8):
+        ticket, queue_json = inbox_queue_take(queue)
+        filenames.append(queue_json['filename'])
+    assert filenames.index('reply.json') < filenames.index('follow.json')
+    assert 'public.json' in filenames[:3]
+    assert 'follow.json' in filenames[:3]
+    assert 'like0.json' in filenames
+    assert 'like5.json' not in filenames
+    metrics = inbox_queue_lane_metrics(queue)
+    assert metrics['priority']['depth'] == 0
+    assert metrics['normal']['depth'] == 0
+    assert metrics['priority']['waitSecs'] > 0
+
+    # with all lanes busy, items are taken in proportion to the weights
+    inbox_queue_clear(queue)
+    lanes_config = {
+        "fast": {
+            "weight": 3,
+            "types": ['Follow']
+        },
+        "normal": {
+            "weight": 1
+        }
+    }
+    inbox_queue_set_lanes(queue, lanes_config)
+    for index in range(40):
+        queue_item = {
+            "filename": 'follow' + str(index) + '.json',
+            "post": {"type": 'Follow'}
+        }
+        inbox_queue_add(queue, queue_item, float(index))
+        queue_item = {
+            "filename": 'like' + str(index) + '.json',
+            "post": {"type": 'Like'}
+        }
+        inbox_queue_add(queue, queue_item, float(index))
+    follows = 0
+    for _ in range(40):
+        ticket, queue_json = inbox_queue_take(queue)
+        if queue_json['filename'].startswith('follow'):
+            follows += 1
+    assert follows == 30
+    inbox_queue_clear(queue)
+    shutil.rmtree(journal_dir, ignore_errors=False)
+
+
+def _test_inbox_seen() -> None:
+    print('inbox seen')
+    seen = new_inbox_seen(3, 60)
+    message_bytes = b'{"id": "https://remote.domain/activities/1"}'
+    key1 = inbox_seen_key('https://remote.domain/activities/1', message_bytes)
+    assert key1
+    assert not inbox_seen_key(None, message_bytes)
+    # the same id with a different body is a different activity
+    key2 = inbox_seen_key('https://remote.domain/activities/1', b'{}')
+    assert key1 != key2
+
+    curr_time = 1000.0
+    assert not inbox_seen_contains(seen, key1, curr_time)
+    inbox_seen_add(seen, key1, curr_time)
+    assert inbox_seen_contains(seen, key1, curr_time + 1)
+    assert not inbox_seen_contains(seen, key2, curr_time + 1)
+    assert not inbox_seen_contains(seen, None, curr_time + 1)
+
+    # while a copy is being verified other copies are deferred
+    assert inbox_seen_begin(seen, key2, curr_time)
+    assert not inbox_seen_contains(seen, key2, curr_time + 1)
+    assert inbox_seen_inflight(seen, key2, curr_time + 1)
+    assert not inbox_seen_begin(seen, key2, curr_time + 1)
+    # rejected copies are forgotten, so that a genuine copy is accepted
+    inbox_seen_forget(seen, key2)
+    assert not inbox_seen_inflight(seen, key2, curr_time + 1)
+    assert not inbox_seen_contains(seen, key2, curr_time + 1)
+    # copies in flight which are never verified or rejected expire
+    assert inbox_seen_begin(seen, key2, curr_time)
+    assert not inbox_seen_inflight(seen, key2, curr_time + 600)
+    assert inbox_seen_begin(seen, key2, curr_time + 600)
+    inbox_seen_forget(seen, key2)
+
+    # keys are remembered for at least the time window
+    assert inbox_seen_contains(seen, key1, curr_time + 90)
+    assert not inbox_seen_contains(seen, key1, curr_time + 200)
+
+    # the number of keys is bounded
+    curr_time += 200
+    for index in range(10):
+        key = str(index)
+        inbox_seen_add(seen, key, curr_time)
+    assert len(seen['current']) <= 3
+    assert len(seen['previous']) <= 3
+    assert inbox_seen_contains(seen, '9', curr_time)
+    assert not inbox_seen_contains(seen, '0', curr_time)
+
+    metrics = inbox_seen_metrics(seen)
+    assert metrics['received'] == 9
+    assert metrics['suppressed'] == 3
+    assert int(metrics['suppressionRate']) == 33
+    assert metrics['deferred'] == 2
+    assert metrics['inflight'] == 0
+
+
+def _test_inbox_keys() -> None:
+    print('inbox keys')
+    keys = new_inbox_keys(2, 3)
+    key_id = 'https://dead.domain/users/someone#main-key'
+    curr_time = 1000.0
+    assert not inbox_keys_failing(keys, key_id)
+    # items can only be parked for keys which have failed
+    assert not inbox_keys_park(keys, key_id, {"filename": '1.json'})
+
+    assert not inbox_keys_failed(keys, key_id, curr_time)
+    assert inbox_keys_failing(keys, key_id)
+    assert inbox_keys_park(keys, key_id, {"filename": '1.json'})
+    assert inbox_keys_park(keys, key_id, {"filename": '1.json'})
+    assert inbox_keys_park(keys, key_id, {"filename": '2.json'})
+    assert keys['parkedCount'] == 2
+
+    # exponential backoff
+    assert not inbox_keys_due(keys, curr_time + 4)
+    assert inbox_keys_due(keys, curr_time + 5) == [key_id]
+    curr_time += 5
+    assert not inbox_keys_failed(keys, key_id, curr_time)
+    assert not inbox_keys_due(keys, curr_time + 9)
+    assert inbox_keys_due(keys, curr_time + 10) == [key_id]
+
+    # parked items are returned once the key has been obtained
+    parked_items = inbox_keys_fetched(keys, key_id)
+    assert len(parked_items) == 2
+    assert parked_items[0]['filename'] == '1.json'
+    assert not inbox_keys_failing(keys, key_id)
+    assert keys['parkedCount'] == 0
+
+    # parked items are dropped after too many failures
+    inbox_keys_failed(keys, key_id, curr_time)
+    assert inbox_keys_park(keys, key_id, {"filename": '3.json'})
+    dropped_items = []
+    for _ in range(20):
+        dropped_items = inbox_keys_failed(keys, key_id, curr_time)
+        if dropped_items:
+            break
+    assert len(dropped_items) == 1
+    assert not inbox_keys_failing(keys, key_id)
+
+    # keys with no parked items expire rather than being refetched
+    inbox_keys_failed(keys, key_id, curr_time)
+    assert not inbox_keys_due(keys, curr_time + 5)
+    assert not inbox_keys_failing(keys, key_id)
+
+    # the number of keys and parked items is bounded
+    for index in range(3):
+        other_key_id = 'https://dead' + str(index) + '.domain/actor#main-key'
+        dropped_items = inbox_keys_failed(keys, other_key_id, curr_time)
+        queue_item = {"filename": str(index) + '.json'}
+        assert inbox_keys_park(keys, other_key_id, queue_item)
+    # items parked for the oldest key were dropped to make room
+    assert len(dropped_items) == 1
+    assert dropped_items[0]['filename'] == '0.json'
+    assert len(keys['failed']) == 2
+    assert keys['parkedCount'] == 2
+    assert inbox_keys_park(keys, other_key_id, {"filename": 'a.json'})
+    assert not inbox_keys_park(keys, other_key_id, {"filename": 'b.json'})
+
+
+def _test_key_cache() -> None:
+    print('key cache')
+    private_key_pem, public_key_pem = generate_rsa_key()
+    assert load_cached_private_key(private_key_pem) is \
+        load_cached_private_key(private_key_pem)
+    assert load_cached_public_key(public_key_pem) is \
+        load_cached_public_key(public_key_pem)
+    metrics = key_cache_metrics()
+    assert metrics['hits'] >= 2
+    assert metrics['hitRate'] > 0
+
+    # signs and verifies per second, with keys loaded each time
+    # as before, and with cached keys
+    algorithm = 'rsa-sha256'
+    digest_algorithm = 'rsa-sha256'
+    content_type = 'application/activity+json'
+    http_prefix = 'https'
+    message_body_json_str = json.dumps({"hello": "world"})
+    body_digest = \
+        message_content_digest(message_body_json_str, digest_algorithm)
+    digest_prefix = get_digest_prefix(digest_algorithm)
+    date_str = strftime("%a, %d %b %Y %H:%M:%S %Z", gmtime())
+    headers = {
+        'host': 'someother.instance',
+        'date': date_str,
+        'digest': f'{digest_prefix}={body_digest}',
+        'content-type': content_type,
+        'content-length': str(len(message_body_json_str))
+    }
+    iterations = 100
+    for cached in (False, True):
+        start_time = time.time()
+        for _ in range(iterations):
+            if not cached:
+                KEY_CACHE['keys'].clear()
+            headers['signature'] = \
+                sign_post_headers(date_str, private_key_pem, 'socrates',
+                                  'argumentative.social', 443,
+                                  'someother.instance', 443,
+                                  '/inbox', http_prefix,
+                                  message_body_json_str,
+                                  content_type, algorithm, digest_algorithm,
+                                  None)
+        sign_time = max(time.time() - start_time, 0.000001)
+        start_time = time.time()
+        for _ in range(iterations):
+            if not cached:
+                KEY_CACHE['keys'].clear()
+            assert verify_post_headers(http_prefix, public_key_pem, headers,
+                                       '/inbox', False, None,
+                                       message_body_json_str, False)
+        verify_time = max(time.time() - start_time, 0.000001)
+        cached_str = 'uncached'
+        if cached:
+            cached_str = 'cached'
+        print('Keys ' + cached_str + ': ' +
+              str(int(iterations / sign_time)) + ' signs per second, ' +
+              str(int(iterations / verify_time)) + ' verifies per second')
+
+
+def _test_signing_context() -> None:
+    print('signing context')
+    signing_context = new_signing_context()
+    assert signing_context['signedPost'] is None
+    assert not signing_context['bodies']
+    assert not signing_context['privateKeys']
+
+    private_key_pem, public_key_pem = generate_rsa_key()
+    http_prefix = 'https'
+    content_type = 'application/activity+json'
+    message_body_json_str = json.dumps({"hello": "world"})
+    body_digest = \
+        message_content_digest(message_body_json_str, 'rsa-sha256')
+
+    # headers created with a known body digest are the same as
+    # those where the digest is calculated
+    date_str = strftime("%a, %d %b %Y %H:%M:%S %Z", gmtime())
+    headers1 = \
+        create_signed_header(date_str, private_key_pem, 'socrates',
+                             'argumentative.social', 443,
+                             'someother.instance', 443,
+                             '/inbox', http_prefix, True,
+                             message_body_json_str, content_type, None)
+    headers2 = \
+        create_signed_header(date_str, private_key_pem, 'socrates',
+                             'argumentative.social', 443,
+                             'someother.instance', 443,
+                             '/inbox', http_prefix, True,
+                             message_body_json_str, content_type,
+                             body_digest)
+    assert headers1['digest'] == headers2['digest']
+    assert headers1['signature'] == headers2['signature']
+    assert verify_post_headers(http_prefix, public_key_pem, headers2,
+                               '/inbox', False, None,
+                               message_body_json_str, False)
+
+
+def _test_jsonld_verified_cache() -> None:
+    print('json-ld verified cache')
+    private_key_pem, public_key_pem = generate_rsa_key()
+    jld_document = {
+        "@context": [
+            'https://www.w3.org/ns/activitystreams',
+            'https://w3id.org/security/v1'
+        ],
+        "actor": "https://somesite.net/users/gerbil",
+        "description": "Cached json document",
+        "object": {
+            "content": "Some content"
+        }
+    }
+    generate_json_signature(jld_document, private_key_pem, False)
+    hits = verified_cache_metrics()['hits']
+    assert verify_json_signature(jld_document, public_key_pem)
+    assert verified_cache_metrics()['hits'] == hits
+    # verified again from the cache
+    assert verify_json_signature(jld_document, public_key_pem)
+    assert verified_cache_metrics()['hits'] == hits + 1
+    # a changed document is not taken from the cache
+    forged_document = json.loads(json.dumps(jld_document))
+    forged_document['object']['content'] = 'forged content'
+    assert not verify_json_signature(forged_document, public_key_pem)
+    assert not verify_json_signature(forged_document, public_key_pem)
+    assert verified_cache_metrics()['hits'] == hits + 2
+
+    # normalizing pathological documents fails quickly
+    options = {
+        "algorithm": "URDNA2015",
+        "format": "application/nquads"
+    }
+    attachments = []
+    for _ in range(NORMALIZE_MAX_BLANK_NODES + 1):
+        attachments.append({"type": "Note", "content": "x"})
+    pathological = {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "type": "Note",
+        "attachment": attachments
+    }
+    start_time = time.time()
+    normalize_failed = False
+    try:
+        normalize(pathological, options.copy())
+    except JsonLdError:
+        normalize_failed = True
+    assert normalize_failed
+    assert time.time() - start_time < 10
+
+    # identical notes with identical attachments result in
+    # a factorial number of permutations
+    note = {
+        "type": "Note",
+        "attachment": attachments[:5]
+    }
+    pathological = {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "@graph": [note, note.copy()]
+    }
+    assert normalize(pathological, options.copy())
+    limited_options = options.copy()
+    limited_options['maxPermutations'] = 100
+    normalize_failed = False
+    try:
+        normalize(pathological, limited_options)
+    except JsonLdError:
+        normalize_failed = True
+    assert normalize_failed
+
+
+def _test_jsonld_normalize_benchmark() -> None:
+    print('json-ld normalize benchmark')
+    # bundled contexts are only parsed once
+    url = 'https://www.w3.org/ns/activitystreams'
+    assert load_document(url)['document'] is load_document(url)['document']
+    litepub_url = 'https://litepub.social/litepub/context.jsonld'
+    litepub_context = load_document(litepub_url)['document']['@context']
+    for ctx in litepub_context:
+        assert isinstance(ctx, dict)
+
+    mastodon_activity = {
+        "@context": [
+            "https://www.w3.org/ns/activitystreams",
+            "https://w3id.org/security/v1",
+            {
+                "ostatus": "http://ostatus.org#",
+                "atomUri": "ostatus:atomUri",
+                "conversation": "ostatus:conversation",
+                "sensitive": "as:sensitive",
+                "toot": "http://joinmastodon.org/ns#",
+                "Hashtag": "as:Hashtag"
+            }
+        ],
+        "id": "https://mastodon.net/users/alice/statuses/1/activity",
+        "type": "Create",
+        "actor": "https://mastodon.net/users/alice",
+        "published": "2024-01-01T00:00:00Z",
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "cc": ["https://mastodon.net/users/alice/followers"],
+        "object": {
+            "id": "https://mastodon.net/users/alice/statuses/1",
+            "type": "Note",
+            "published": "2024-01-01T00:00:00Z",
+            "attributedTo": "https://mastodon.net/users/alice",
+            "to": ["https://www.w3.org/ns/activitystreams#Public"],
+            "cc": ["https://mastodon.net/users/alice/followers"],
+            "sensitive": False,
+            "atomUri": "https://mastodon.net/users/alice/statuses/1",
+            "content": "<p>Hello <a href=\"https://mastodon.net/tags/test\">" +
+            "#test</a></p>",
+            "tag": [{
+                "type": "Hashtag",
+                "href": "https://mastodon.net/tags/test",
+                "name": "#test"
+            }]
+        }
+    }
+    pleroma_activity = {
+        "@context": [
+            "https://www.w3.org/ns/activitystreams",
+            "https://pleroma.site/schemas/litepub-0.1.jsonld",
+            {
+                "@language": "und"
+            }
+        ],
+        "id": "https://pleroma.site/activities/1",
+        "type": "EmojiReact",
+        "actor": "https://pleroma.site/users/bob",
+        "object": "https://mastodon.net/users/alice/statuses/1",
+        "content": "x",
+        "to": ["https://mastodon.net/users/alice"]
+    }
+    options = {
+        "algorithm": "URDNA2015",
+        "format": "application/nquads"
+    }
+    iterations = 100
+    for activity in (mastodon_activity, pleroma_activity):
+        normalized = normalize(activity, options.copy())
+        assert normalized
+        start_time = time.time()
+        for _ in range(iterations):
+            assert normalize(activity, options.copy()) == normalized
+        normalize_time = max(time.time() - start_time, 0.000001)
+        print(activity['type'] + ' ' +
+              str(int(iterations / normalize_time)) +
+              ' normalizations per second')
+
+
+def _test_delivery_function(delivery_state: {}, host: str,
+                            retries: int, tries: int) -> bool:
+    with delivery_state['lock']:
+        delivery_state['inFlight'][host] = \
+            delivery_state['inFlight'].get(host, 0) + 1
+        delivery_state['maxPerHost'] = \
+            max(delivery_state['maxPerHost'],
+                delivery_state['inFlight'][host])
+        total = sum(delivery_state['inFlight'].values())
+        delivery_state['maxInFlight'] = \
+            max(delivery_state['maxInFlight'], total)
+    time.sleep(0.05)
+    with delivery_state['lock']:
+        delivery_state['inFlight'][host] -= 1
+        delivery_state['tries'].append(tries)
+    return tries < retries
+
+
+def _test_delivery_wait(engine: {}) -> None:
+    for _ in range(200):
+        if delivery_metrics(engine)['queued'] == 0:
+            break
+        time.sleep(0.05)
+
+
+def _test_delivery_engine(base_dir: str) -> None:
+    print('delivery engine')
+    engine = new_delivery_engine(4, 1, 2, 20, 0, 0, 60, 0, 1, 0)
+    delivery_state = {
+        "inFlight": {},
+        "maxPerHost": 0,
+        "maxInFlight": 0,
+        "tries": [],
+        "lock": threading.Lock()
+    }
+    hosts = ('first.host', 'second.host', 'third.host')
+    for index in range(9):
+        host = hosts[index % 3]
+        inbox_url = 'https://' + host + '/inbox'
+        assert delivery_add(engine, inbox_url, _test_delivery_function,
+                            (delivery_state, host, 0), {}, None)
+    # a delivery which is tried again
+    assert delivery_add(engine, 'https://fourth.host/inbox',
+                        _test_delivery_function,
+                        (delivery_state, 'fourth.host', 2), {}, None)
+    _test_delivery_wait(engine)
+    metrics = delivery_metrics(engine)
+    assert metrics['queued'] == 0
+    assert metrics['inFlight'] == 0
+    assert metrics['workers'] == 4
+    assert metrics['completed'] == 10
+    assert delivery_state['maxPerHost'] == 1
+    assert delivery_state['maxInFlight'] <= 2
+    # the retried delivery was tried three times
+    assert delivery_state['tries'].count(2) == 1
+    assert delivery_state['tries'].count(1) == 1
+
+    # the queue is bounded
+    engine = new_delivery_engine(1, 1, 0, 2, 0, 0, 60, 0, 1, 0)
+    for index in range(3):
+        added = delivery_add(engine, 'https://fifth.host/inbox',
+                             _test_delivery_function,
+                             (delivery_state, 'fifth.host', 0), {}, None)
+        assert added == (index < 2)
+    metrics = delivery_metrics(engine)
+    assert metrics['queued'] == 2
+    assert metrics['maxHostDepth'] == 2
+    assert metrics['dropped'] == 1
+
+    # jittered exponential backoff
+    engine = new_delivery_engine(1, 1, 0, 2, 30, 3600, 60, 0, 1, 0)
+    assert 15 <= delivery_backoff_secs(engine, 1) <= 30
+    assert 240 <= delivery_backoff_secs(engine, 5) <= 480
+    assert 1800 <= delivery_backoff_secs(engine, 20) <= 3600
+
+    # deliveries resume after a restart
+    queue_dir = base_dir + '/.testDeliveries'
+    if os.path.isdir(queue_dir):
+        shutil.rmtree(queue_dir, ignore_errors=False)
+    engine = new_delivery_engine(1, 1, 0, 10, 0, 0, 60, 0, 1, 0)
+    for host in ('sixth.host', 'seventh.host'):
+        inbox_url = 'https://' + host + '/inbox'
+        record = {
+            "sender": "alice",
+            "body": '{"type": "Create"}',
+            "bodyDigest": 'SHA-256=abc'
+        }
+        assert delivery_add(engine, inbox_url, _test_delivery_function,
+                            (delivery_state, host, 1), record, queue_dir)
+    # the body is stored once for both deliveries
+    assert len(os.listdir(queue_dir + '/bodies')) == 1
+    for filename in os.listdir(queue_dir):
+        if filename.endswith('.json'):
+            assert 'body' not in load_json(queue_dir + '/' + filename)
+    # a delivery which is too old is abandoned
+    record = {
+        "queued": time.time() - 120
+    }
+    assert not delivery_add(engine, 'https://eighth.host/inbox',
+                            _test_delivery_function,
+                            (delivery_state, 'eighth.host', 0),
+                            record, queue_dir)
+    records = delivery_load(queue_dir)
+    assert len(records) == 2
+    assert records[0]['sender'] == 'alice'
+    assert records[0]['body'] == '{"type": "Create"}'
+    assert records[0]['attempts'] == []
+    engine = new_delivery_engine(2, 1, 2, 10, 0, 0, 60, 0, 1, 0)
+    for record in records:
+        host = record['inboxUrl'].split('/')[2]
+        assert delivery_add(engine, record['inboxUrl'],
+                            _test_delivery_function,
+                            (delivery_state, host, 1), record, queue_dir)
+    _test_delivery_wait(engine)
+    assert delivery_metrics(engine)['completed'] == 2
+    for record in records:
+        assert len(record['attempts']) == 2
+    assert not delivery_load(queue_dir)
+    assert not os.listdir(queue_dir + '/bodies')
+    shutil.rmtree(queue_dir, ignore_errors=False)
+
+    # deliveries to each host are rate limited, and the time taken
+    # to fan out to all hosts is reported
+    engine = new_delivery_engine(4, 4, 4, 20, 0, 0, 60, 0.1, 2, 0)
+    fanout_id = delivery_fanout_begin(engine, 'test post')
+    start_time = time.time()
+    for index in range(8):
+        host = hosts[index % 2]
+        inbox_url = 'https://' + host + '/inbox'
+        record = {
+            "fanout": fanout_id
+        }
+        assert delivery_add(engine, inbox_url, _test_delivery_function,
+                            (delivery_state, host, 0), record, None)
+    assert delivery_metrics(engine)['fanouts'] == 1
+    delivery_fanout_end(engine, fanout_id)
+    _test_delivery_wait(engine)
+    # two deliveries to each host straight away, then one every 0.1 secs
+    fanout_secs = time.time() - start_time
+    assert fanout_secs >= 0.15
+    assert fanout_secs < 5
+    metrics = delivery_metrics(engine)
+    assert metrics['completed'] == 8
+    assert metrics['rateLimited'] > 0
+    assert metrics['fanouts'] == 0
+    assert metrics['fanoutsCompleted'] == 1
+    assert metrics['lastFanoutSecs'] >= 0.15
+
+    # deliveries which are rejected by the inbox are not retried
+    assert delivery_rejected(404)
+    assert delivery_rejected(410)
+    assert delivery_rejected(422)
+    assert not delivery_rejected(429)
+    assert not delivery_rejected(408)
+    assert not delivery_rejected(503)
+    assert not delivery_rejected(0)
+
+    # the same activity is only sent once to an inbox
+    engine = new_delivery_engine(1, 1, 1, 10, 0, 0, 60, 0, 1, 60)
+    for index in range(4):
+        host = hosts[index % 2]
+        record = {
+            "coalesce": 'https://local.net/users/alice/statuses/1'
+        }
+        assert delivery_add(engine, 'https://' + host + '/inbox',
+                            _test_delivery_function,
+                            (delivery_state, host, 0), record, None)
+    # a different activity to the same inbox
+    record = {
+        "coalesce": 'https://local.net/users/alice/statuses/2'
+    }
+    assert delivery_add(engine, 'https://first.host/inbox',
+                        _test_delivery_function,
+                        (delivery_state, 'first.host', 0), record, None)
+    # an edit keeps the same activity id but has a different body
+    record = {
+        "coalesce": 'https://local.net/users/alice/statuses/1',
+        "bodyDigest": 'edited'
+    }
+    assert delivery_add(engine, 'https://first.host/inbox',
+                        _test_delivery_function,
+                        (delivery_state, 'first.host', 0), record, None)
+    _test_delivery_wait(engine)
+    metrics = delivery_metrics(engine)
+    assert metrics['completed'] == 4
+    assert metrics['coalesced'] == 2
+
+
+def _test_delivery_targets(base_dir: str) -> None:
+    print('delivery targets')
+    targets_dir = base_dir + '/.testDeliveryTargets'
+    if os.path.isdir(targets_dir):
+        shutil.rmtree(targets_dir, ignore_errors=False)
+    os.mkdir(targets_dir)
+    os.mkdir(data_dir(targets_dir))
+    handle = 'bob@remote.net'
+    actor = 'https://remote.net/users/bob'
+    assert delivery_targets_inbox(targets_dir, handle) is None
+    assert delivery_targets_shared_inbox(targets_dir, 'remote.net') is None
+    delivery_targets_set_inbox(targets_dir, handle,
+                               actor + '/inbox',
+                               'https://remote.net/inbox',
+                               actor, 'remote.net')
+    target = delivery_targets_inbox(targets_dir, handle)
+    assert target['inbox'] == actor + '/inbox'
+    assert target['actor'] == actor
+    assert delivery_targets_shared_inbox(targets_dir, 'remote.net') == \
+        'https://remote.net/inbox'
+    # a domain without a shared inbox
+    delivery_targets_set_shared_inbox(targets_dir, 'other.net', '')
+    assert delivery_targets_shared_inbox(targets_dir, 'other.net') == ''
+
+    # the inbox changes when an actor update is received
+    actor_json = {
+        "id": actor,
+        "inbox": 'https://remote.net/users/bob/newinbox'
+    }
+    delivery_targets_update_actor(targets_dir, actor_json)
+    target = delivery_targets_inbox(targets_dir, handle)
+    assert target['inbox'] == 'https://remote.net/users/bob/newinbox'
+
+    # delivery targets are reloaded after a restart
+    delivery_targets_save(targets_dir)
+    assert os.path.isfile(data_dir(targets_dir) + '/deliveryTargets.json')
+    del DELIVERY_TARGETS[targets_dir]
+    target = delivery_targets_inbox(targets_dir, handle)
+    assert target['inbox'] == 'https://remote.net/users/bob/newinbox'
+    assert delivery_targets_shared_inbox(targets_dir, 'other.net') == ''
+
+    # the target is forgotten when the actor moves
+    actor_json['movedTo'] = 'https://elsewhere.net/users/bob'
+    delivery_targets_update_actor(targets_dir, actor_json)
+    assert delivery_targets_inbox(targets_dir, handle) is None
+    delivery_targets_set_inbox(targets_dir, handle,
+                               actor + '/inbox', None, actor, 'remote.net')
+    assert delivery_targets_inbox(targets_dir, handle)
+    # the target is forgotten when the actor is deleted
+    delivery_targets_forget_actor(targets_dir, actor)
+    assert delivery_targets_inbox(targets_dir, handle) is None
+
+    metrics = delivery_targets_metrics(targets_dir)
+    assert metrics['handles'] == 0
+    assert metrics['domains'] == 2
+    # counts since the restart
+    assert metrics['hits'] == 3
+    assert metrics['misses'] == 2
+    del DELIVERY_TARGETS[targets_dir]
+    shutil.rmtree(targets_dir, ignore_errors=False)
+
+
+def _test_https_cert(cert_filename: str, key_filename: str) -> None:
+    """Creates a self-signed certificate for a local https server
+    """
+    private_key = rsa.generate_private_key(public_exponent=65537,
+                                           key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    curr_time = datetime.datetime.now(datetime.timezone.utc)
+    alt_names = \
+        x509.SubjectAlternativeName([x509.IPAddress(
+            ipaddress.ip_address('127.0.0.1'))])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name)
+    cert = cert.public_key(private_key.public_key())
+    cert = cert.serial_number(x509.random_serial_number())
+    cert = cert.not_valid_before(curr_time - datetime.timedelta(days=1))
+    cert = cert.not_valid_after(curr_time + datetime.timedelta(days=1))
+    cert = cert.add_extension(alt_names, critical=False)
+    cert = cert.sign(private_key, hashes.SHA256())
+    with open(cert_filename, 'wb') as fp_cert:
+        fp_cert.write(cert.public_bytes(serialization.Encoding.PEM))
+    key_bytes = \
+        private_key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption())
+    with open(key_filename, 'wb') as fp_key:
+        fp_key.write(key_bytes)
+
+
+def _test_session_pools(base_dir: str) -> None:
+    print('session pools')
+    pool_dir = base_dir + '/.testSessionPools'
+    if os.path.isdir(pool_dir):
+        shutil.rmtree(pool_dir, ignore_errors=False)
+    os.mkdir(pool_dir)
+    cert_filename = pool_dir + '/cert.pem'
+    key_filename = pool_dir + '/key.pem'
+    _test_https_cert(cert_filename, key_filename)
+
+    with open(pool_dir + '/pooled', 'w+', encoding='utf-8') as fp_pooled:
+        fp_pooled.write('pooled')
+
+    # a local stand-in https server which keeps connections alive
+    handler_class = \
+        type('PoolHandler', (SimpleHTTPRequestHandler,), {
+            "protocol_version": 'HTTP/1.1',
+            "log_message": lambda self, format, *args: None
+        })
+    handler = functools.partial(handler_class, directory=pool_dir)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert_filename, key_filename)
+    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
+    httpd.daemon_threads = True
+    server_thread = threading.Thread(target=httpd.serve_forever,
+                                     daemon=True)
+    server_thread.start()
+    url = 'https://127.0.0.1:' + str(httpd.server_address[1]) + '/pooled'
+
+    session_pools_evict_idle(time.time() + SESSION_POOL_IDLE_SECS + 1)
+    before = session_pool_metrics().get('clearnet', {})
+    # requests from different sessions reuse the same connection
+    for _ in range(2):
+        session = create_session(None)
+        for _ in range(3):
+            result = session.get(url, verify=cert_filename, timeout=10)
+            assert result.status_code == 200
+            assert result.text == 'pooled'
+    metrics = session_pool_metrics()['clearnet']
+    assert metrics['requests'] - before.get('requests', 0) == 6
+    assert metrics['connections'] - before.get('connections', 0) == 1
+    assert metrics['hosts'] >= 1
+    assert metrics['idleConnections'] >= 1
+
+    # the scheduler job leaves recently used connections open
+    expire_session_pools()
+    assert session_pool_metrics()['clearnet']['hosts'] >= 1
+
+    # connections to hosts which are no longer used are closed
+    assert session_pools_evict_idle(time.time()) == 0
+    evicted = \
+        session_pools_evict_idle(time.time() + SESSION_POOL_IDLE_SECS + 1)
+    assert evicted >= 1
+    metrics = session_pool_metrics()['clearnet']
+    assert metrics['hosts'] == 0
+    assert metrics['evicted'] - before.get('evicted', 0) == evicted
+
+    httpd.shutdown()
+    httpd.server_close()
+    shutil.rmtree(pool_dir, ignore_errors=False)
+
+
+def _test_scheduler_job(calls: [], wait_event) -> None:
+    calls.append(time.time())
+    if wait_event:
+        wait_event.wait(5)
+
+
+def _test_scheduler_failing_job(calls: [], message: str) -> None:
+    calls.append(time.time())
+    raise ValueError(message)
+
+
+def _test_scheduler() -> None:
+    print('scheduler')
+    scheduler = new_scheduler()
+    quick_calls = []
+    failing_calls = []
+    slow_calls = []
+    slow_event = threading.Event()
+    quick_args = (quick_calls, None)
+    scheduler_add_job(scheduler, 'quick', _test_scheduler_job,
+                      quick_args, 0.1, 0, False)
+    failing_args = (failing_calls, 'test failure')
+    scheduler_add_job(scheduler, 'failing', _test_scheduler_failing_job,
+                      failing_args, 0.1, 0, True)
+    slow_args = (slow_calls, slow_event)
+    scheduler_add_job(scheduler, 'slow', _test_scheduler_job,
+                      slow_args, 0.1, 0, True)
+    # nothing runs until the scheduler is started
+    time.sleep(0.2)
+    assert not quick_calls
+    scheduler_start(scheduler)
+
+    for _ in range(50):
+        if len(quick_calls) >= 3 and len(failing_calls) >= 3:
+            break
+        time.sleep(0.1)
+    assert len(quick_calls) >= 3
+    # jobs which fail are run again
+    assert len(failing_calls) >= 3
+    metrics = scheduler_metrics(scheduler)
+    assert metrics['failing']['failures'] >= 2
+    assert metrics['failing']['failures'] <= metrics['failing']['runs']
+    assert metrics['quick']['failures'] == 0
+    assert metrics['quick']['runs'] >= 3
+    assert metrics['quick']['maxLatenessSecs'] >= 0
+    assert metrics['quick']['maxRunSecs'] >= \
+        metrics['quick']['meanRunSecs']
+
+    # a threaded job is not started again while it is still running
+    assert len(slow_calls) == 1
+    assert metrics['slow']['running']
+    assert metrics['slow']['runs'] == 0
+    assert metrics['slow']['overlaps'] >= 1
+    slow_event.set()
+    for _ in range(50):
+        if len(slow_calls) >= 2:
+            break
+        time.sleep(0.1)
+    assert len(slow_calls) >= 2
+    assert scheduler_metrics(scheduler)['slow']['runs'] >= 1
+
+    # a job added while the scheduler is sleeping runs when it is due
+    added_calls = []
+    added_args = (added_calls, None)
+    scheduler_add_job(scheduler, 'added', _test_scheduler_job,
+                      added_args, 60, 0, False)
+    for _ in range(50):
+        if added_calls:
+            break
+        time.sleep(0.1)
+    assert len(added_calls) == 1
+
+    # the scheduler stops when cancelled
+    scheduler['thread'].kill()
+    scheduler['thread'].join(5)
+    assert not scheduler['thread'].is_alive()
+
+
+def _test_fitness_metrics(base_dir: str) -> None:
+    print('fitness metrics')
+    fitness = {}
+    scheduler = new_scheduler()
+    metrics_args = (base_dir, fitness, {}, {}, scheduler)
+    scheduler_add_job(scheduler, 'metrics', collect_fitness_metrics,
+                      metrics_args, 10, 0, False)
+    scheduler_start(scheduler)
+    for _ in range(100):
+        if scheduler_metrics(scheduler)['metrics']['runs'] > 0:
+            break
+        time.sleep(0.05)
+    scheduler['thread'].kill()
+    for queue_name in ('DELIVERY', 'DELIVERY_TARGETS', 'SESSION_POOLS',
+                       'PERSON_CACHE', 'WEBFINGER_CACHE', 'CONFIG',
+                       'SCHEDULER'):
+        assert queue_name in fitness['queues']
+    assert fitness['queues']['SCHEDULER']['metrics']['failures'] == 0
+
+
+def _test_config_store(base_dir: str) -> None:
+    print('config store')
+    config_dir = base_dir + '/.tests/config'
+    if os.path.isdir(config_dir):
+        shutil.rmtree(config_dir, ignore_errors=False)
+    os.makedirs(config_dir)
+
+    assert get_config_param(config_dir, 'domain') is None
+    assert os.path.isfile(config_dir + '/config.json')
+    set_config_param(config_dir, 'domain', 'config.domain')
+    set_config_param(config_dir, 'maxLikeCount', 10)
+    assert get_config_param(config_dir, 'domain') == 'config.domain'
+    assert get_config_param(config_dir, 'maxLikeCount') == 10
+    config_json = load_json(config_dir + '/config.json')
+    assert config_json['domain'] == 'config.domain'
+    assert config_json['maxLikeCount'] == 10
+    reloads = config_metrics(config_dir)['reloads']
+
+    # values are read from memory, without reloading the file
+    for _ in range(100):
+        assert get_config_param(config_dir, 'domain') == 'config.domain'
+    assert config_metrics(config_dir)['reloads'] == reloads
+
+    # returned lists can't alter the configuration
+    set_config_param(config_dir, 'allowedDomains', ['a.domain'])
+    allowed = get_config_param(config_dir, 'allowedDomains')
+    allowed.append('b.domain')
+    assert get_config_param(config_dir, 'allowedDomains') == ['a.domain']
+
+    # the file is edited by hand
+    config_json = load_json(config_dir + '/config.json')
+    config_json['domain'] = 'edited.domain'
+    save_json(config_json, config_dir + '/config.json')
+    curr_time = time.time() + 10
+    os.utime(config_dir + '/config.json', (curr_time, curr_time))
+    # the change is seen by a set, which doesn't overwrite it
+    set_config_param(config_dir, 'instanceTitle', 'Config')
+    assert get_config_param(config_dir, 'domain') == 'edited.domain'
+    assert get_config_param(config_dir, 'instanceTitle') == 'Config'
+    assert config_metrics(config_dir)['reloads'] == reloads + 1
+
+    # the change is seen by a get after the check interval
+    config_json['domain'] = 'another.domain'
+    save_json(config_json, config_dir + '/config.json')
+    curr_time += 10
+    os.utime(config_dir + '/config.json', (curr_time, curr_time))
+    CONFIG_SNAPSHOTS[config_dir]['checked'] = 0
+    assert get_config_param(config_dir, 'domain') == 'another.domain'
+    assert get_config_param(config_dir, 'instanceTitle') is None
+    assert config_metrics(config_dir)['reloads'] == reloads + 2
+
+    # the instance directory is recreated within the check interval
+    shutil.rmtree(config_dir, ignore_errors=False)
+    os.makedirs(config_dir)
+    assert get_config_param(config_dir, 'domain') == 'another.domain'
+    config_changed(config_dir)
+    assert get_config_param(config_dir, 'domain') is None
+    set_config_param(config_dir, 'admin', 'alice')
+    assert load_json(config_dir + '/config.json') == {"admin": 'alice'}
+
+    shutil.rmtree(config_dir, ignore_errors=False)
+    del CONFIG_SNAPSHOTS[config_dir]
+
+
+def _test_blocklist(base_dir: str) -> None:
+    print('blocklist')
+    block_dir = base_dir + '/.tests/blocklist'
+    if os.path.isdir(block_dir):
+        shutil.rmtree(block_dir, ignore_errors=False)
+    nickname = 'alice'
+    domain = 'alice.domain'
+    account_dir = acct_dir(block_dir, nickname, domain)
+    os.makedirs(account_dir)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'troll', 'troll.domain', None, None)
+
+    # instance block list
+    add_global_block(block_dir, 'spammer', '*', None)
+    add_global_block(block_dir, '*', 'blocked.domain', None)
+    add_global_block(block_dir, 'troll', 'troll.domain', None)
+    add_global_block(block_dir, '#badtag', None, None)
+    assert is_blocked_nickname(block_dir, 'spammer')
+    assert not is_blocked_nickname(block_dir, 'pammer')
+    assert is_blocked(block_dir, nickname, domain,
+                      'spammer', 'any.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'someone', 'blocked.domain', None, None)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'someone', 'locked.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'troll', 'troll.domain', None, None)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'other', 'troll.domain', None, None)
+    assert is_blocked_domain(block_dir, 'blocked.domain', None, None)
+    assert is_blocked_domain(block_dir, 'sub.blocked.domain', None, None)
+    assert not is_blocked_domain(block_dir, 'troll.domain', None, None)
+    assert is_blocked_hashtag(block_dir, 'badtag')
+    assert is_blocked_hashtag(block_dir, '#badtag')
+    assert not is_blocked_hashtag(block_dir, 'goodtag')
+    remove_global_block(block_dir, 'troll', 'troll.domain')
+    assert not is_blocked(block_dir, nickname, domain,
+                          'troll', 'troll.domain', None, None)
+
+    # the instance block list is edited by hand
+    blocking_filename = data_dir(block_dir) + '/blocking.txt'
+    with open(blocking_filename, 'a+', encoding='utf-8') as fp_block:
+        fp_block.write('newcomer@*\n')
+    BLOCKLISTS[blocking_filename]['checked'] = 0
+    assert is_blocked_nickname(block_dir, 'newcomer')
+
+    # federated block list
+    with open(data_dir(block_dir) + '/block_api.txt', 'w+',
+              encoding='utf-8') as fp_api:
+        fp_api.write('fed.domain\nfedtroll@fed2.domain\n')
+    blocklist_changed(data_dir(block_dir) + '/block_api.txt')
+    assert is_blocked_domain(block_dir, 'fed.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'someone', 'fed.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'fedtroll', 'fed2.domain', None, None)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'someone', 'fed2.domain', None, None)
+
+    # a domain which is within an earlier handle or domain is kept
+    save_federated_blocks(block_dir, ['bob@example.domain', 'example.domain',
+                                      'ample.domain'])
+    assert is_blocked_domain(block_dir, 'example.domain', None, None)
+    assert is_blocked_domain(block_dir, 'ample.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'bob', 'example.domain', None, None)
+    assert not is_blocked_domain(block_dir, 'le.domain', None, None)
+
+    # account block list
+    add_block(block_dir, nickname, domain, 'pest', 'pest.domain', None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'pest', 'pest.domain', None, None)
+    assert not is_blocked(block_dir, 'bob', domain,
+                          'pest', 'pest.domain', None, None)
+    remove_block(block_dir, nickname, domain, 'pest', 'pest.domain')
+    assert not is_blocked(block_dir, nickname, domain,
+                          'pest', 'pest.domain', None, None)
+
+    # broch mode only allows domains which are followed
+    with open(account_dir + '/following.txt', 'w+',
+              encoding='utf-8') as fp_foll:
+        fp_foll.write('friend@social.friend.domain\n')
+    assert not broch_mode_is_active(block_dir)
+    set_broch_mode(block_dir, domain, True)
+    assert broch_mode_is_active(block_dir)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'friend', 'social.friend.domain', None, None)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'someone', 'other.friend.domain', None, None)
+    assert is_blocked(block_dir, nickname, domain,
+                      'someone', 'stranger.domain', None, None)
+    assert is_blocked_domain(block_dir, 'stranger.domain', None, None)
+    assert not is_blocked_domain(block_dir, 'friend.domain', None, None)
+    set_broch_mode(block_dir, domain, False)
+    assert not broch_mode_is_active(block_dir)
+    assert not is_blocked(block_dir, nickname, domain,
+                          'someone', 'stranger.domain', None, None)
+
+    shutil.rmtree(block_dir, ignore_errors=False)
+
+
+def _test_blocklist_benchmark(base_dir: str) -> None:
+    print('blocklist benchmark')
+    block_dir = base_dir + '/.tests/blocklistbench'
+    if os.path.isdir(block_dir):
+        shutil.rmtree(block_dir, ignore_errors=False)
+    nickname = 'alice'
+    domain = 'alice.domain'
+    os.makedirs(acct_dir(block_dir, nickname, domain))
+    no_of_entries = 50000
+    blocking_filename = data_dir(block_dir) + '/blocking.txt'
+    with open(blocking_filename, 'w+', encoding='utf-8') as fp_block:
+        for index in range(no_of_entries):
+            if index % 3 == 0:
+                fp_block.write('*@domain' + str(index) + '.example\n')
+            elif index % 3 == 1:
+                fp_block.write('user' + str(index) + '@host' +
+                               str(index) + '.example\n')
+            else:
+                fp_block.write('nick' + str(index) + '@*\n')
+
+    start_time = time.time()
+    assert is_blocked_domain(block_dir, 'domain0.example', None, None)
+    compile_time = time.time() - start_time
+
+    lookups = 20000
+    blocked_count = 0
+    start_time = time.time()
+    for index in range(lookups):
+        entry_index = (index * 7) % (no_of_entries * 2)
+        block_nickname = 'user' + str(entry_index)
+        block_domain = 'host' + str(entry_index) + '.example'
+        if is_blocked(block_dir, nickname, domain,
+                      block_nickname, block_domain, None, None):
+            blocked_count += 1
+    lookup_time = max(time.time() - start_time, 0.000001)
+    assert blocked_count > 0
+    assert blocked_count < lookups
+    print(str(no_of_entries) + ' entries compiled in ' +
+          str(int(compile_time * 1000)) + 'mS, ' +
+          str(int(lookups / lookup_time)) + ' account checks per second')
+    shutil.rmtree(block_dir, ignore_errors=False)
+
+
+def _test_follows_index(base_dir: str) -> None:
+    print('follows index')
+    follows_dir = base_dir + '/.tests/followsindex'
+    if os.path.isdir(follows_dir):
+        shutil.rmtree(follows_dir, ignore_errors=False)
+    nickname = 'alice'
+    domain = 'alice.domain'
+    account_dir = acct_dir(follows_dir, nickname, domain)
+    os.makedirs(account_dir)
+    followers_filename = account_dir + '/followers.txt'
+    assert not is_follower_of_person(follows_dir, nickname, domain,
+                                     'bob', 'bob.domain')
+    assert get_no_of_followers(follows_dir, nickname, domain) == 0
+    assert get_followers_list(follows_dir, nickname, domain,
+                              'followers.txt') == []
+
+    add_follower_of_person(follows_dir, nickname, domain,
+                           'bob', 'bob.domain', [], False, False)
+    add_follower_of_person(follows_dir, nickname, domain,
+                           'Carol', 'carol.domain:8000', [], False, False)
+    add_follower_of_person(follows_dir, nickname, domain,
+                           'group', 'bob.domain', [], False, True)
+    assert is_follower_of_person(follows_dir, nickname, domain,
+                                 'bob', 'bob.domain')
+    assert not is_follower_of_person(follows_dir, nickname, domain,
+                                     'ob', 'bob.domain')
+    assert is_follower_of_person(follows_dir, nickname, domain,
+                                 'carol', 'carol.domain')
+    assert is_follower_of_person(follows_dir, nickname, domain,
+                                 'carol', 'carol.domain:8000')
+    assert is_follower_of_person(follows_dir, nickname, domain,
+                                 'group', 'bob.domain')
+    assert get_no_of_followers(follows_dir, nickname, domain) == 3
+    assert get_followers_list(follows_dir, nickname, domain,
+                              'followers.txt') == \
+        ['!group@bob.domain', 'Carol@carol.domain:8000', 'bob@bob.domain']
+    assert get_follower_domains(follows_dir, nickname, domain) == \
+        ['bob.domain', 'carol.domain']
+    # the index matches the file
+    with open(followers_filename, 'r', encoding='utf-8') as fp_foll:
+        assert fp_foll.read().splitlines() == \
+            get_followers_list(follows_dir, nickname, domain,
+                               'followers.txt')
+
+    remove_follower(follows_dir, nickname, domain, 'bob', 'bob.domain')
+    assert not is_follower_of_person(follows_dir, nickname, domain,
+                                     'bob', 'bob.domain')
+    assert get_no_of_followers(follows_dir, nickname, domain) == 2
+
+    # the followers file is changed by something else
+    with open(followers_filename, 'a+', encoding='utf-8') as fp_foll:
+        fp_foll.write('https://dave.domain/users/dave\n')
+    assert is_follower_of_person(follows_dir, nickname, domain,
+                                 'dave', 'dave.domain')
+    assert get_no_of_followers(follows_dir, nickname, domain) == 3
+
+    # following
+    follow_person(follows_dir, nickname, domain, 'eve', 'eve.domain',
+                  [], False, False, 'following.txt')
+    assert is_following_actor(follows_dir, nickname, domain,
+                              'https://eve.domain/users/eve')
+    assert is_following_actor(follows_dir, nickname, domain,
+                              '@eve@eve.domain')
+    assert not is_following_actor(follows_dir, nickname, domain,
+                                  'https://eve.domain/users/mallory')
+    unfollow_account(follows_dir, nickname, domain, 'eve', 'eve.domain',
+                     False, False, 'following.txt')
+    assert not is_following_actor(follows_dir, nickname, domain,
+                                  'https://eve.domain/users/eve')
+
+    shutil.rmtree(follows_dir, ignore_errors=False)
+
+
+def _test_follows_index_benchmark(base_dir: str) -> None:
+    print('follows index benchmark')
+    follows_dir = base_dir + '/.tests/followsbench'
+    if os.path.isdir(follows_dir):
+        shutil.rmtree(follows_dir, ignore_errors=False)
+    nickname = 'alice'
+    domain = 'alice.domain'
+    account_dir = acct_dir(follows_dir, nickname, domain)
+    os.makedirs(account_dir)
+    no_of_followers = 10000
+    with open(account_dir + '/followers.txt', 'w+',
+              encoding='utf-8') as fp_foll:
+        for index in range(no_of_followers):
+            fp_foll.write('follower' + str(index) + '@instance' +
+                          str(index % 500) + '.domain\n')
+
+    lookups = 20000
+    found = 0
+    start_time = time.time()
+    for index in range(lookups):
+        follower_nickname = 'follower' + str(index)
+        follower_domain = 'instance' + str(index % 500) + '.domain'
+        if is_follower_of_person(follows_dir, nickname, domain,
+                                 follower_nickname, follower_domain):
+            found += 1
+    lookup_time = max(time.time() - start_time, 0.000001)
+    assert found == no_of_followers
+    assert get_no_of_followers(follows_dir, nickname, domain) == \
+        no_of_followers
+    print(str(no_of_followers) + ' followers ' +
+          str(int(lookups / lookup_time)) + ' membership checks per second')
+    shutil.rmtree(follows_dir, ignore_errors=False)
+
+
+def _test_webfinger_cache(base_dir: str) -> None:
+    print('webfinger cache')
+    cache_dir = base_dir + '/.tests/webfingercache'
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=False)
+    os.makedirs(cache_dir + '/cache')
+    cached_webfingers = {}
+    wf_json = {
+        "subject": "acct:alice@alice.domain",
+        "links": []
+    }
+    assert not get_webfinger_from_cache('alice@alice.domain',
+                                        cached_webfingers)
+    store_webfinger_in_cache('alice@alice.domain', wf_json,
+                             cached_webfingers)
+    assert get_webfinger_from_cache('alice@alice.domain',
+                                    cached_webfingers) == wf_json
+    assert not webfinger_failed_recently('alice@alice.domain',
+                                         cached_webfingers)
+
+    # failures are cached, with the time before retrying doubling
+    store_webfinger_failure_in_cache('bob@dead.domain', cached_webfingers)
+    assert webfinger_failed_recently('bob@dead.domain', cached_webfingers)
+    assert not get_webfinger_from_cache('bob@dead.domain',
+                                        cached_webfingers)
+    entry = cached_webfingers['bob@dead.domain']
+    first_retry_secs = entry['expires'] - entry['stored']
+    store_webfinger_failure_in_cache('bob@dead.domain', cached_webfingers)
+    entry = cached_webfingers['bob@dead.domain']
+    assert entry['failures'] == 2
+    assert entry['expires'] - entry['stored'] == first_retry_secs * 2
+
+    # a failure doesn't replace a result which has not expired
+    store_webfinger_failure_in_cache('alice@alice.domain',
+                                     cached_webfingers)
+    assert get_webfinger_from_cache('alice@alice.domain',
+                                    cached_webfingers) == wf_json
+
+    # results expire
+    cached_webfingers['alice@alice.domain']['expires'] = time.time() - 1
+    assert not get_webfinger_from_cache('alice@alice.domain',
+                                        cached_webfingers)
+    assert not cached_webfingers.get('alice@alice.domain')
+    store_webfinger_in_cache('alice@alice.domain', wf_json,
+                             cached_webfingers)
+
+    # saved to file and loaded after a restart
+    save_webfinger_cache(cache_dir, cached_webfingers)
+    loaded_webfingers = {}
+    assert load_webfinger_cache(cache_dir, loaded_webfingers) == 2
+    assert get_webfinger_from_cache('alice@alice.domain',
+                                    loaded_webfingers) == wf_json
+    assert webfinger_failed_recently('bob@dead.domain', loaded_webfingers)
+
+    metrics = webfinger_cache_metrics(cached_webfingers)
+    assert metrics['entries'] == 2
+    assert metrics['failedEntries'] == 1
+    assert metrics['hits'] == 2
+    assert metrics['failureHits'] == 1
+    assert metrics['misses'] == 2
+    assert metrics['expired'] == 1
+
+    # the number of entries is bounded
+    bounded_webfingers = {}
+    for index in range(WEBFINGER_CACHE_MAX_ENTRIES + 10):
+        handle = 'user' + str(index) + '@some.domain'
+        store_webfinger_in_cache(handle, wf_json, bounded_webfingers)
+    assert len(bounded_webfingers) == WEBFINGER_CACHE_MAX_ENTRIES
+    assert not bounded_webfingers.get('user0@some.domain')
+    metrics = webfinger_cache_metrics(bounded_webfingers)
+    assert metrics['evictions'] == 10
+
+    shutil.rmtree(cache_dir, ignore_errors=False)
+
+
 def run_all_tests():
     base_dir = os.getcwd()
     data_dir_testing(base_dir)
@@ -9186,6 +11037,27 @@ def run_all_tests():
     _test_checkbox_names()
     _test_thread_functions()
     _test_functions()
+    _test_inbox_queue(base_dir)
+    _test_inbox_queue_lanes(base_dir)
+    _test_inbox_admission()
+    _test_inbox_seen()
+    _test_inbox_keys()
+    _test_key_cache()
+    _test_signing_context()
+    _test_jsonld_verified_cache()
+    _test_jsonld_normalize_benchmark()
+    _test_recent_posts_cache_benchmark()
+    _test_delivery_engine(base_dir)
+    _test_delivery_targets(base_dir)
+    _test_session_pools(base_dir)
+    _test_scheduler()
+    _test_fitness_metrics(base_dir)
+    _test_config_store(base_dir)
+    _test_blocklist(base_dir)
+    _test_blocklist_benchmark(base_dir)
+    _test_follows_index(base_dir)
+    _test_follows_index_benchmark(base_dir)
+    _test_webfinger_cache(base_dir)
     _test_conversation_to_convthread()
     _test_bridgy()
     _test_link_tracking()
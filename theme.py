@@ -17,6 +17,8 @@ from utils import string_ends_with
 from utils import is_account_dir
 from utils import load_json
 from utils import save_json
+from utils import get_config_param
+from utils import set_config_param
 from utils import get_image_extensions
 from utils import copytree
 from utils import acct_dir
@@ -178,71 +180,46 @@ def _copy_theme_help_files(base_dir: str, theme_name: str,
         break
 
 
+def _set_theme_config_param(base_dir: str, variable_name: str,
+                            variable_value) -> bool:
+    """Sets a configuration value used by the theme
+    """
+    if not os.path.isfile(base_dir + '/config.json'):
+        return False
+    set_config_param(base_dir, variable_name, variable_value)
+    return True
+
+
 def _set_theme_in_config(base_dir: str, name: str) -> bool:
     """Sets the theme with the given name within config.json
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['theme'] = name
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'theme', name)
 
 
 def _set_newswire_publish_as_icon(base_dir: str, use_icon: bool) -> bool:
     """Shows the newswire publish action as an icon or a button
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['showPublishAsIcon'] = use_icon
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'showPublishAsIcon', use_icon)
 
 
 def _set_icons_as_buttons(base_dir: str, use_buttons: bool) -> bool:
     """Whether to show icons in the header (inbox, outbox, etc)
     as buttons
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['iconsAsButtons'] = use_buttons
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'iconsAsButtons', use_buttons)
 
 
 def _set_rss_icon_at_top(base_dir: str, at_top: bool) -> bool:
     """Whether to show RSS icon at the top of the timeline
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['rssIconAtTop'] = at_top
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'rssIconAtTop', at_top)
 
 
 def _set_publish_button_at_top(base_dir: str, at_top: bool) -> bool:
     """Whether to show the publish button above the title image
     in the newswire column
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['publishButtonAtTop'] = at_top
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'publishButtonAtTop', at_top)
 
 
 def _set_full_width_timeline_button_header(base_dir: str,
@@ -250,25 +227,17 @@ def _set_full_width_timeline_button_header(base_dir: str,
     """Shows the timeline button header containing inbox, outbox,
     calendar, etc as full width
     """
-    config_filename = base_dir + '/config.json'
-    if not os.path.isfile(config_filename):
-        return False
-    config_json = load_json(config_filename)
-    if not config_json:
-        return False
-    config_json['fullWidthTlButtonHeader'] = full_width
-    return save_json(config_json, config_filename)
+    return _set_theme_config_param(base_dir, 'fullWidthTlButtonHeader',
+                                   full_width)
 
 
 def get_theme(base_dir: str) -> str:
     """Gets the current theme name from config.json
     """
-    config_filename = base_dir + '/config.json'
-    if os.path.isfile(config_filename):
-        config_json = load_json(config_filename)
-        if config_json:
-            if config_json.get('theme'):
-                return config_json['theme']
+    if os.path.isfile(base_dir + '/config.json'):
+        theme_name = get_config_param(base_dir, 'theme')
+        if theme_name:
+            return theme_name
     return 'default'
 
 
@@ -8,22 +8,31 @@ __status__ = "Production"
 __module_group__ = "Core"
 
 import threading
-import sys
 import time
 from socket import error as SocketError
 from utils import date_utcnow
 
+# Threads are stopped cooperatively. Calling kill on a thread sets its
+# cancel event, and the thread stops with SystemExit when it next
+# reaches a cancellation point, such as thread_sleep or
+# thread_check_cancelled, placed within its loops. Blocking network
+# calls have timeouts, so that a thread reaches a cancellation point
+# within a bounded time. Unlike tracing every line executed, this has
+# no overhead while the thread is running.
+
 
 class thread_with_trace(threading.Thread):
     def __init__(self, *args, **keywords):
         self.start_time = date_utcnow()
         self.is_started = False
+        self.killed = False
+        self.cancel_event = threading.Event()
+        self.cancel_callbacks = []
         tries = 0
         while tries < 3:
             try:
                 self._args, self._keywords = args, keywords
                 threading.Thread.__init__(self, *self._args, **self._keywords)
-                self.killed = False
                 break
             except BaseException as ex:
                 print('ERROR: threads.py/__init__ failed - ' + str(ex))
@@ -34,8 +43,6 @@ class thread_with_trace(threading.Thread):
         tries = 0
         while tries < 3:
             try:
-                self.__run_backup = self.run
-                self.run = self.__run
                 threading.Thread.start(self)
                 break
             except BaseException as ex:
@@ -45,38 +52,17 @@ class thread_with_trace(threading.Thread):
         # note that this is set True even if all tries failed
         self.is_started = True
 
-    def __run(self):
-        sys.settrace(self.globaltrace)
-        if not callable(self.__run_backup):
-            print('ERROR: threads.py/__run ' +
-                  str(self.__run_backup) + 'is not callable')
-            return
-#        try:
-        self.__run_backup()
-        self.run = self.__run_backup
-#        except BaseException as ex:
-#            print('ERROR: threads.py/__run failed - ' + str(ex) +
-#                  ', ' + str(self.__run_backup))
-
-    def globaltrace(self, frame, event, arg):
-        """Trace the thread
-        """
-        if event == 'call':
-            return self.localtrace
-        return None
-
-    def localtrace(self, frame, event, arg):
-        """Trace the thread
-        """
-        if self.killed:
-            if event == 'line':
-                raise SystemExit()
-        return self.localtrace
-
     def kill(self):
-        """Kill the thread
+        """Cancel the thread, which stops when it next reaches
+        a cancellation point
         """
         self.killed = True
+        self.cancel_event.set()
+        # callbacks may block, eg. shutting down a server,
+        # so they are not run on the calling thread
+        for callback in self.cancel_callbacks:
+            callback_thread = threading.Thread(target=callback, daemon=True)
+            callback_thread.start()
 
     def clone(self, func):
         """Create a clone
@@ -87,6 +73,56 @@ class thread_with_trace(threading.Thread):
                                  daemon=True)
 
 
+def _thread_cancel_event() -> threading.Event:
+    """Returns the cancel event of the current thread, or None if it
+    can't be cancelled
+    """
+    return getattr(threading.current_thread(), 'cancel_event', None)
+
+
+def thread_cancelled() -> bool:
+    """Returns True if the current thread has been cancelled
+    """
+    cancel_event = _thread_cancel_event()
+    if cancel_event is None:
+        return False
+    return cancel_event.is_set()
+
+
+def thread_check_cancelled() -> None:
+    """Cancellation point which stops the current thread
+    if it has been cancelled
+    """
+    if thread_cancelled():
+        raise SystemExit()
+
+
+def thread_sleep(seconds: float) -> None:
+    """Sleeps for the given number of seconds. This is a cancellation
+    point, and returns early to stop the current thread if it is
+    cancelled while sleeping
+    """
+    cancel_event = _thread_cancel_event()
+    if cancel_event is None:
+        time.sleep(seconds)
+        return
+    if cancel_event.wait(seconds):
+        raise SystemExit()
+
+
+def thread_on_cancel(callback) -> None:
+    """Calls the given function if the current thread is cancelled,
+    eg. to stop a server loop which has no cancellation points
+    """
+    curr_thread = threading.current_thread()
+    if not hasattr(curr_thread, 'cancel_callbacks'):
+        return
+    curr_thread.cancel_callbacks.append(callback)
+    if curr_thread.cancel_event.is_set():
+        callback_thread = threading.Thread(target=callback, daemon=True)
+        callback_thread.start()
+
+
 def remove_dormant_threads(base_dir: str, threads_list: [], debug: bool,
                            timeout_mins: int) -> None:
     """Removes threads whose execution has completed
@@ -16,6 +16,9 @@ import shutil
 import datetime
 import json
 import locale
+import copy
+import threading
+from collections import OrderedDict
 from pprint import pprint
 import idna
 from dateutil.tz import tz
@@ -23,6 +26,24 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from followingCalendar import add_person_to_calendar
 
+# config.json is held in memory for each instance directory, so that
+# getting a configuration value doesn't read and parse the file. The
+# file is checked at most once per CONFIG_CHECK_SECS and reloaded if
+# its modification time, inode or size have changed, eg. because it
+# was edited by hand. set_config_param updates it in place, and the
+# tests call config_changed when they recreate an instance directory.
+CONFIG_CHECK_SECS = 1
+CONFIG_SNAPSHOTS = {}
+CONFIG_LOCK = threading.Lock()
+
+# followers.txt and following.txt are indexed in memory for each
+# account, so that checking whether someone is a follower or counting
+# followers doesn't involve reading the file. follow_person and
+# remove_follower update the index when they write the file, and if
+# the file has been changed by anything else then it is read again.
+FOLLOWS_INDEXES = {}
+FOLLOWS_INDEXES_LOCK = threading.Lock()
+
 VALID_HASHTAG_CHARS = \
     set('_0123456789' +
         'abcdefghijklmnopqrstuvwxyz' +
@@ -1046,31 +1067,242 @@ def _create_config(base_dir: str) -> None:
     save_json(config_json, config_filename)
 
 
+def _file_change_state(filename: str) -> ():
+    """Returns the modification time, inode and size of a file,
+    which are used to detect whether it has changed
+    """
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_size)
+
+
+def _config_snapshot(base_dir: str) -> {}:
+    """Returns the configuration held in memory for the given instance
+    """
+    with CONFIG_LOCK:
+        snapshot = CONFIG_SNAPSHOTS.get(base_dir)
+        if snapshot is None:
+            snapshot = {
+                "config": {},
+                "fileState": None,
+                "checked": 0,
+                "reloads": 0,
+                "lock": threading.Lock()
+            }
+            CONFIG_SNAPSHOTS[base_dir] = snapshot
+    return snapshot
+
+
+def config_changed(base_dir: str) -> None:
+    """Called when config.json has been replaced, so that the next
+    lookup loads it rather than waiting for the check interval.
+    This is a hook for the tests, which recreate instance directories.
+    Elsewhere config.json is only written by set_config_param, which
+    updates the snapshot in place
+    """
+    with CONFIG_LOCK:
+        snapshot = CONFIG_SNAPSHOTS.get(base_dir)
+    if not snapshot:
+        return
+    with snapshot['lock']:
+        snapshot['checked'] = 0
+        snapshot['fileState'] = None
+
+
+def _config_snapshot_check(base_dir: str, snapshot: {},
+                           force_check: bool) -> None:
+    """Loads the configuration if the file has changed since it was
+    last checked. This should be called with the snapshot lock held
+    """
+    curr_time = time.time()
+    if not force_check and \
+       curr_time - snapshot['checked'] < CONFIG_CHECK_SECS:
+        return
+    snapshot['checked'] = curr_time
+
+    config_filename = base_dir + '/config.json'
+    file_state = _file_change_state(config_filename)
+    if file_state is None:
+        _create_config(base_dir)
+        file_state = _file_change_state(config_filename)
+    if file_state == snapshot['fileState']:
+        return
+    config_json = load_json(config_filename)
+    if not isinstance(config_json, dict):
+        # the file may be part way through being written,
+        # so keep the previous configuration and try again later
+        return
+    snapshot['config'] = config_json
+    snapshot['fileState'] = file_state
+    snapshot['reloads'] += 1
+
+
 def set_config_param(base_dir: str, variable_name: str,
                      variable_value) -> None:
     """Sets a configuration value
     """
-    _create_config(base_dir)
     config_filename = base_dir + '/config.json'
-    config_json = {}
-    if os.path.isfile(config_filename):
-        config_json = load_json(config_filename)
     variable_name = _convert_to_camel_case(variable_name)
-    config_json[variable_name] = variable_value
-    save_json(config_json, config_filename)
+    snapshot = _config_snapshot(base_dir)
+    with snapshot['lock']:
+        # make sure that any changes to the file are not overwritten
+        _config_snapshot_check(base_dir, snapshot, True)
+        snapshot['config'][variable_name] = variable_value
+        save_json(snapshot['config'], config_filename)
+        snapshot['fileState'] = _file_change_state(config_filename)
 
 
 def get_config_param(base_dir: str, variable_name: str) -> str:
     """Gets a configuration value
     """
-    _create_config(base_dir)
-    config_filename = base_dir + '/config.json'
-    config_json = load_json(config_filename)
-    if config_json:
-        variable_name = _convert_to_camel_case(variable_name)
-        if variable_name in config_json:
-            return config_json[variable_name]
-    return None
+    variable_name = _convert_to_camel_case(variable_name)
+    snapshot = _config_snapshot(base_dir)
+    with snapshot['lock']:
+        _config_snapshot_check(base_dir, snapshot, False)
+        value = snapshot['config'].get(variable_name)
+    if isinstance(value, (dict, list)):
+        # so that the caller can't alter the configuration
+        return copy.deepcopy(value)
+    return value
+
+
+def config_metrics(base_dir: str) -> {}:
+    """Returns the number of configuration values and how many times
+    the configuration has been loaded from file
+    """
+    snapshot = _config_snapshot(base_dir)
+    with snapshot['lock']:
+        return {
+            "values": len(snapshot['config']),
+            "reloads": snapshot['reloads']
+        }
+
+
+def _follows_line_counted(line: str) -> bool:
+    """Is the given line of a follows file counted as a follow?
+    """
+    if '#' in line:
+        return False
+    if '@' in line and \
+       '.' in line and \
+       not line.startswith('http'):
+        return True
+    if (line.startswith('http') or
+        line.startswith('ipfs') or
+        line.startswith('ipns') or
+        line.startswith('hyper')) and \
+       has_users_path(line):
+        return True
+    return False
+
+
+def _follows_index_add(index: {}, line: str, prepend: bool) -> None:
+    """Adds a line of a follows file to its index
+    """
+    entry = line.strip()
+    if prepend:
+        index['lines'].insert(0, entry)
+    else:
+        index['lines'].append(entry)
+    if _follows_line_counted(entry):
+        index['count'] += 1
+    entry = entry.lower()
+    if not entry:
+        return
+    index['entries'].add(entry)
+
+    # handles of followed groups begin with !
+    handle = entry
+    if handle.startswith('!'):
+        handle = handle[1:]
+    if '://' in handle:
+        # the entry is an actor url
+        handle_nickname = get_nickname_from_actor(handle)
+        handle_domain, handle_port = get_domain_from_actor(handle)
+        handle = None
+        if handle_nickname and handle_domain:
+            handle = \
+                get_full_domain(handle_nickname + '@' + handle_domain,
+                                handle_port)
+    if handle and '@' in handle:
+        index['handles'].add(handle)
+        # also match the handle without a port number
+        index['handles'].add(remove_domain_port(handle))
+
+    follow_domain, _ = get_domain_from_actor(entry)
+    if follow_domain:
+        index['domains'][follow_domain] = \
+            index['domains'].get(follow_domain, 0) + 1
+
+
+def _follows_index_build(filename: str, content: str,
+                         file_state: ()) -> {}:
+    """Creates an index for a follows file with the given content
+    and stores it
+    """
+    index = {
+        "fileState": file_state,
+        "exists": content is not None,
+        "lines": [],
+        "entries": set(),
+        "handles": set(),
+        "domains": {},
+        "count": 0
+    }
+    if content:
+        for line in content.splitlines():
+            _follows_index_add(index, line, False)
+    with FOLLOWS_INDEXES_LOCK:
+        FOLLOWS_INDEXES[filename] = index
+    return index
+
+
+def get_follows_index(filename: str) -> {}:
+    """Returns the index for a followers.txt or following.txt file,
+    reading the file if it has changed since the index was created.
+    The index contains the lines of the file, lower case entries and
+    handles, the number of follows and the number of follows for
+    each domain
+    """
+    file_state = _file_change_state(filename)
+    index = FOLLOWS_INDEXES.get(filename)
+    if index:
+        if index['fileState'] == file_state:
+            return index
+    content = None
+    if file_state:
+        try:
+            with open(filename, 'r', encoding='utf-8') as fp_foll:
+                content = fp_foll.read()
+        except OSError:
+            print('EX: get_follows_index unable to read ' + filename)
+    return _follows_index_build(filename, content, file_state)
+
+
+def _follows_index_prepended(filename: str, index: {}, line: str) -> None:
+    """Updates the index after a line has been added to the start
+    of its follows file
+    """
+    file_state = _file_change_state(filename)
+    with FOLLOWS_INDEXES_LOCK:
+        if FOLLOWS_INDEXES.get(filename) is not index:
+            return
+        if file_state == index['fileState']:
+            # the file was not written
+            return
+        _follows_index_add(index, line, True)
+        index['exists'] = True
+        index['fileState'] = file_state
+
+
+def update_follows_index(filename: str, content: str) -> None:
+    """Updates the index after its follows file has been written
+    with the given content
+    """
+    file_state = _file_change_state(filename)
+    _follows_index_build(filename, content, file_state)
 
 
 def get_followers_list(base_dir: str,
@@ -1079,22 +1311,7 @@ def get_followers_list(base_dir: str,
     """Returns a list of followers for the given account
     """
     filename = acct_dir(base_dir, nickname, domain) + '/' + follow_file
-
-    if not os.path.isfile(filename):
-        return []
-
-    lines: list[str] = []
-    try:
-        with open(filename, 'r', encoding='utf-8') as fp_foll:
-            lines = fp_foll.readlines()
-    except OSError:
-        print('EX: get_followers_list unable to read ' + filename)
-
-    if lines:
-        for i, _ in enumerate(lines):
-            lines[i] = lines[i].strip()
-        return lines
-    return []
+    return list(get_follows_index(filename)['lines'])
 
 
 def get_followers_of_person(base_dir: str,
@@ -1930,8 +2147,12 @@ def follow_person(base_dir: str, nickname: str, domain: str,
     if group_account:
         handle_to_follow = '!' + handle_to_follow
     filename = acct_handle_dir(base_dir, handle) + '/' + follow_file
-    if os.path.isfile(filename):
-        if text_in_file(handle_to_follow, filename):
+    follows_index = get_follows_index(filename)
+    if follows_index['exists']:
+        follow_handle = handle_to_follow.lower()
+        if follow_handle.startswith('!'):
+            follow_handle = follow_handle[1:]
+        if follow_handle in follows_index['handles']:
             if debug:
                 print('DEBUG: follow already exists')
             return True
@@ -1946,6 +2167,7 @@ def follow_person(base_dir: str, nickname: str, domain: str,
         except OSError as ex:
             print('WARN: Failed to write entry to follow file ' +
                   filename + ' ' + str(ex))
+        _follows_index_prepended(filename, follows_index, handle_to_follow)
     else:
         # first follow
         if debug:
@@ -1958,6 +2180,7 @@ def follow_person(base_dir: str, nickname: str, domain: str,
                 fp_foll.write(handle_to_follow + '\n')
         except OSError:
             print('EX: follow_person unable to write ' + filename)
+        _follows_index_prepended(filename, follows_index, handle_to_follow)
 
     if follow_file.endswith('following.txt'):
         # Default to adding new follows to the calendar.
@@ -2064,15 +2287,7 @@ def clear_from_post_caches(base_dir: str, recent_posts_cache: {},
                     print('EX: clear_from_post_caches file not removed ' +
                           str(post_filename))
             # if the post is in the recent posts cache then remove it
-            if recent_posts_cache.get('index'):
-                if post_id in recent_posts_cache['index']:
-                    recent_posts_cache['index'].remove(post_id)
-            if recent_posts_cache.get('json'):
-                if recent_posts_cache['json'].get(post_id):
-                    del recent_posts_cache['json'][post_id]
-            if recent_posts_cache.get('html'):
-                if recent_posts_cache['html'].get(post_id):
-                    del recent_posts_cache['html'][post_id]
+            remove_post_id_from_cache(recent_posts_cache, post_id)
         break
 
 
@@ -2378,20 +2593,37 @@ def remove_post_from_cache(post_json_object: {},
     if '#' in post_id:
         post_id = post_id.split('#', 1)[0]
     post_id = remove_id_ending(post_id).replace('/', '#')
-    if post_id not in recent_posts_cache['index']:
-        return
+    remove_post_id_from_cache(recent_posts_cache, post_id)
 
-    if recent_posts_cache.get('index'):
-        if post_id in recent_posts_cache['index']:
-            recent_posts_cache['index'].remove(post_id)
 
-    if recent_posts_cache.get('json'):
-        if recent_posts_cache['json'].get(post_id):
-            del recent_posts_cache['json'][post_id]
+def remove_post_id_from_cache(recent_posts_cache: {}, post_id: str) -> None:
+    """Removes the post with the given cache id from the recent
+    posts cache, so that it is rendered again the next time
+    it is shown
+    """
+    if not recent_posts_cache.get('index'):
+        return
+    recent_posts_cache['index'].pop(post_id, None)
+    for field in ('json', 'parsed', 'html'):
+        if recent_posts_cache.get(field):
+            recent_posts_cache[field].pop(post_id, None)
+
 
-    if recent_posts_cache.get('html'):
-        if recent_posts_cache['html'].get(post_id):
-            del recent_posts_cache['html'][post_id]
+def update_post_in_cache(recent_posts_cache: {}, post_id: str,
+                         post_json_object: {}) -> bool:
+    """Replaces the json of a post within the recent posts cache,
+    such as when it is muted, and removes its rendered html.
+    Returns True if the post was in the cache
+    """
+    if not recent_posts_cache.get('index'):
+        return False
+    if post_id not in recent_posts_cache['index']:
+        return False
+    post_str = json.dumps(post_json_object)
+    recent_posts_cache['json'][post_id] = post_str
+    recent_posts_cache['parsed'][post_id] = json.loads(post_str)
+    recent_posts_cache['html'].pop(post_id, None)
+    return True
 
 
 def delete_cached_html(base_dir: str, nickname: str, domain: str,
@@ -2928,7 +3160,10 @@ def get_cached_post_filename(base_dir: str, nickname: str, domain: str,
 
 def update_recent_posts_cache(recent_posts_cache: {}, max_recent_posts: int,
                               post_json_object: {}, html_str: str) -> None:
-    """Store recent posts in memory so that they can be quickly recalled
+    """Store recent posts in memory so that they can be quickly recalled.
+    The index is in order from least to most recently used, and for
+    each post the json string, the parsed json and the rendered html
+    are stored
     """
     if not post_json_object.get('id'):
         return
@@ -2938,25 +3173,53 @@ def update_recent_posts_cache(recent_posts_cache: {}, max_recent_posts: int,
     post_id = remove_id_ending(post_id).replace('/', '#')
     if recent_posts_cache.get('index'):
         if post_id in recent_posts_cache['index']:
-            return
-        recent_posts_cache['index'].append(post_id)
-        post_json_object['muted'] = False
-        recent_posts_cache['json'][post_id] = json.dumps(post_json_object)
-        recent_posts_cache['html'][post_id] = html_str
-
-        while len(recent_posts_cache['html'].items()) > max_recent_posts:
-            post_id = recent_posts_cache['index'][0]
-            recent_posts_cache['index'].pop(0)
-            if recent_posts_cache['json'].get(post_id):
-                del recent_posts_cache['json'][post_id]
             if recent_posts_cache['html'].get(post_id):
-                del recent_posts_cache['html'][post_id]
+                return
+            # the html was removed, eg. by muting, so store it again
+            recent_posts_cache['html'][post_id] = html_str
+            return
     else:
-        recent_posts_cache['index'] = [post_id]
+        recent_posts_cache['index'] = OrderedDict()
         recent_posts_cache['json'] = {}
+        recent_posts_cache['parsed'] = {}
         recent_posts_cache['html'] = {}
-        recent_posts_cache['json'][post_id] = json.dumps(post_json_object)
-        recent_posts_cache['html'][post_id] = html_str
+    post_json_object['muted'] = False
+    post_str = json.dumps(post_json_object)
+    recent_posts_cache['index'][post_id] = None
+    recent_posts_cache['json'][post_id] = post_str
+    # a separate copy, so that later changes to the post being
+    # rendered don't alter the cache
+    recent_posts_cache['parsed'][post_id] = json.loads(post_str)
+    recent_posts_cache['html'][post_id] = html_str
+
+    # remove the least recently used posts
+    while len(recent_posts_cache['index']) > max_recent_posts:
+        oldest_id, _ = recent_posts_cache['index'].popitem(last=False)
+        recent_posts_cache['json'].pop(oldest_id, None)
+        recent_posts_cache['parsed'].pop(oldest_id, None)
+        recent_posts_cache['html'].pop(oldest_id, None)
+
+
+def get_recent_cached_post(recent_posts_cache: {}, post_id: str) -> {}:
+    """Returns the json string and parsed json of a post within the
+    recent posts cache as a dict, or None if it is not cached.
+    The post becomes the most recently used
+    """
+    if not recent_posts_cache.get('index'):
+        return None
+    post_str = recent_posts_cache['json'].get(post_id)
+    post_json_object = recent_posts_cache['parsed'].get(post_id)
+    if not post_str or not post_json_object:
+        return None
+    try:
+        recent_posts_cache['index'].move_to_end(post_id)
+    except KeyError:
+        # removed by another thread
+        return None
+    return {
+        "json": post_str,
+        "parsed": post_json_object
+    }
 
 
 def file_last_modified(filename: str) -> str:
@@ -3584,11 +3847,7 @@ def reject_post_id(base_dir: str, nickname: str, domain: str,
         post_url = remove_eol(index_filename)
         post_url = post_url.replace('.json', '').strip()
 
-        if post_url in recent_posts_cache['index']:
-            if recent_posts_cache['json'].get(post_url):
-                del recent_posts_cache['json'][post_url]
-            if recent_posts_cache['html'].get(post_url):
-                del recent_posts_cache['html'][post_url]
+        remove_post_id_from_cache(recent_posts_cache, post_url)
 
     try:
         with open(post_filename + '.reject', 'w+',
@@ -410,7 +410,7 @@ def update_avatar_image_cache(signing_priv_key_pem: str,
                 print('avatar image url: ' + avatar_url)
             result = session.get(avatar_url,
                                  headers=session_headers,
-                                 params=None,
+                                 params=None, timeout=20,
                                  allow_redirects=True)
             if result.status_code < 200 or \
                result.status_code > 202:
@@ -13,6 +13,8 @@ from session import get_json
 from session import get_json_valid
 from cache import store_webfinger_in_cache
 from cache import get_webfinger_from_cache
+from cache import store_webfinger_failure_in_cache
+from cache import webfinger_failed_recently
 from utils import get_url_from_post
 from utils import remove_html
 from utils import acct_handle_dir
@@ -97,6 +99,11 @@ def webfinger_handle(session, handle: str, http_prefix: str,
         if debug:
             print('Webfinger from cache: ' + str(wfg))
         return wfg
+    if webfinger_failed_recently(wf_handle, cached_webfingers):
+        # don't keep asking an instance which is not responding
+        if debug:
+            print('Webfinger recently failed: ' + wf_handle)
+        return None
     url = http_prefix + '://' + domain + '/.well-known/webfinger'
     hdr = {
         'Accept': 'application/jrd+json'
@@ -111,6 +118,7 @@ def webfinger_handle(session, handle: str, http_prefix: str,
                      project_version, http_prefix, from_domain)
     except BaseException as ex:
         print('ERROR: webfinger_handle ' + wf_handle + ' ' + str(ex))
+        store_webfinger_failure_in_cache(wf_handle, cached_webfingers)
         return None
 
     # if the first attempt fails then try specifying the webfinger
@@ -132,11 +140,13 @@ def webfinger_handle(session, handle: str, http_prefix: str,
                          project_version, http_prefix, from_domain)
         except BaseException as ex:
             print('ERROR: webfinger_handle ' + wf_handle + ' ' + str(ex))
+            store_webfinger_failure_in_cache(wf_handle, cached_webfingers)
             return None
 
     if get_json_valid(result):
         store_webfinger_in_cache(wf_handle, result, cached_webfingers)
     else:
+        store_webfinger_failure_in_cache(wf_handle, cached_webfingers)
         print("WARN: Unable to webfinger " + str(url) + ' ' +
               'from_domain: ' + str(from_domain) + ' ' +
               'nickname: ' + str(nickname) + ' ' +